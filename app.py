@@ -1,527 +1,286 @@
 import streamlit as st
-import anthropic
 import os
 from datetime import datetime
-import json
-import re
+import threading
 import time
 import traceback
-from dotenv import load_dotenv, set_key
+
+import history_cache
+import history_writer
+from batch_generation import enqueue_experience, list_queue
+from budget import ANONYMOUS_USER, BUDGET_LEVEL_LABELS, budget_status, use_user
+from cancellation import CancelToken, get_cancellation_stats, record_cancellation
+from checkpoints import (
+    STAGE_LABELS,
+    STAGES,
+    checkpoint_models,
+    completed_scenario,
+    delete_checkpoint,
+    failed_stage,
+    list_unfinished_checkpoints,
+    new_checkpoint,
+    reset_from,
+    run_checkpointed,
+    skip_rewrite,
+)
+from history_store import (
+    delete_history,
+    find_similar_histories,
+    get_backend,
+    get_char_count_summary,
+    get_favorites,
+    get_statistics,
+    history_enabled,
+    is_favorite,
+    is_streamlit_cloud,
+    load_history,
+    location_record_id,
+    record_id,
+    save_history,
+    toggle_favorite,
+    update_history,
+)
+from metrics import metrics_server_error, start_metrics_server
+from model_router import get_route_stats
+from prefetch import (
+    POLL_SEC,
+    adopt,
+    discard,
+    env_prefetch_enabled,
+    get_prefetch_stats,
+    maybe_start,
+    observe_input,
+    pending_prefetch,
+    take,
+)
+from profiler import TRACE_LOG_PATH, env_profile_mode, profile_run, profiled, run_in_context, span
+from scenario_text import LineBreakNormalizer, count_characters, enforce_line_breaks, panel_keys, split_pages
+from scenario_pipeline import (
+    GENERATION_MODE,
+    GENERATION_MODES,
+    REWRITE_MODE,
+    REWRITE_MODES,
+    PIPELINED,
+    PROMPT_VERSION,
+    load_master_prompt,
+    regenerate_section,
+)
+from token_estimator import (
+    CONDENSED_EXPERIENCE_CHARS,
+    MAX_EXPERIENCE_TOKENS,
+    estimate_tokens,
+    expected_output_tokens,
+    is_oversized_experience,
+)
 
 # バージョン情報
 VERSION = "1.0.1"
-PROMPT_VERSION = "3.0"
-
-# Streamlit Cloud環境かどうかを検出
-def is_streamlit_cloud():
-    """Streamlit Cloud環境かどうかを検出"""
-    # Streamlit Cloudでは HOME が /home/appuser または /home/adminuser
-    home_dir = os.getenv("HOME", "")
-    if "/home/appuser" in home_dir or "/home/adminuser" in home_dir:
-        return True
-    # 環境変数でも判定
-    if os.getenv("STREAMLIT_SHARING_MODE"):
-        return True
-    return False
+
+# 生成方式の表示名
+GENERATION_MODE_LABELS = {
+    "single": "一括生成",
+    "outline": "アウトライン→並列展開",
+}
+
+# チェックポイントのステージの状態の表示
+STAGE_STATUS_ICONS = {
+    "pending": "⏳",
+    "running": "🔄",
+    "done": "✅",
+    "skipped": "⏭️",
+    "failed": "❌",
+    "cancelled": "⏹️",
+}
+
+# 自動リライトの方式の表示名
+REWRITE_MODE_LABELS = {
+    "patch": "変更箇所のみ（高速）",
+    "full": "全文リライト",
+}
+
+# プロファイルの表示名
+PROFILE_MODE_LABELS = {
+    "": "オフ",
+    "spans": "処理ごとの時間",
+    "cprofile": "＋cProfile",
+}
+# 画面に残す直近のプロファイル
+PROFILE_HISTORY = 10
 
 # ============================================================================
-# 文字数カウント関数
+# 起動時に1回だけ行う処理（プロセス内でキャッシュ）
 # ============================================================================
 
-def count_characters(text):
-    """
-    シナリオの文字数を正確にカウント
-    
-    Args:
-        text: カウント対象のテキスト
-        
-    Returns:
-        文字数（改行、記号、括弧を除いた純粋なテキスト文字のみ）
-    """
-    # 改行を削除
-    text = text.replace('\n', '').replace('\r', '')
+@st.cache_resource(show_spinner=False)
+def load_custom_css():
+    """カスタムCSSを読み込む"""
+    css_path = os.path.join(os.path.dirname(__file__), "assets", "style.css")
+    with open(css_path, "r", encoding="utf-8") as f:
+        return f"<style>\n{f.read()}</style>"
 
-    # 除外する記号・括弧を削除
-    text = re.sub(r'[※「」『』■\(\)（）…！？!?〜～\s]', '', text)
+@st.cache_resource(show_spinner=False)
+def load_env_file():
+    """.envファイルを読み込む（ローカル環境用）"""
+    env_path = os.path.join(os.path.dirname(__file__), ".env")
+    if not os.path.exists(env_path):
+        return False
+    from dotenv import load_dotenv
 
-    # 残った文字数をカウント
-    return len(text)
+    return load_dotenv(env_path)
 
-# ページ設定
-st.set_page_config(
-    page_title="スカッと系ショート漫画シナリオ生成ツール | 愛カツ",
-    page_icon="⚡",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
+# ============================================================================
+# シナリオの表示
+# ============================================================================
 
-# カスタムCSS
-st.markdown("""
-<style>
-    .main-header {
-        font-size: 2.5rem;
-        font-weight: bold;
-        color: #333;
-        text-align: center;
-        margin-bottom: 1rem;
-        padding: 1rem;
-    }
-    
-    .sub-header {
-        font-size: 1.2rem;
-        color: #666;
-        text-align: center;
-        margin-bottom: 2rem;
-    }
-    
-    .version-badge {
-        display: inline-block;
-        background: #f0f0f0;
-        color: #333;
-        font-size: 0.9rem;
-        font-weight: normal;
-        padding: 0.3rem 0.8rem;
-        border-radius: 5px;
-        margin-left: 1rem;
-        vertical-align: middle;
-    }
-    
-    .output-section {
-        background: #f9f9f9;
-        padding: 1rem;
-        margin-top: 1rem;
-        border: 1px solid #e0e0e0;
-    }
+# 表示用に変換したシナリオを残す件数（履歴を行き来しても作り直さない程度）
+RENDER_CACHE_ENTRIES = 64
 
-    [data-testid="stSidebar"] .stButton button {
-        justify-content: flex-start;
-        text-align: left;
-        padding-left: 0;
-        padding-right: 0;
-    }
-    
-    [data-testid="stSidebar"] .stButton {
-        margin-bottom: -0.5rem;
-    }
-</style>
-""", unsafe_allow_html=True)
+def _html(text):
+    """Markdownで改行を表示するため、\nを<br>に変換する"""
+    html = text.strip().replace("\n", "<br>")
+    return f'<div class="output-section">{html}</div>'
 
-# マスタープロンプトを読み込む
-def load_master_prompt():
-    prompt_path = os.path.join(os.path.dirname(__file__), "prompts", "master_prompt.md")
-    with open(prompt_path, "r", encoding="utf-8") as f:
-        return f.read()
+def _is_heading(line):
+    return not line.strip() or line.lstrip().startswith(("■", "━"))
 
-# 改行を強制的に修正する関数
-def enforce_line_breaks(text):
+# 表示のたびに作り直さないよう、内容（のハッシュ）ごとにプロセス内で使い回す
+# （cache_data と違って取り出すたびにコピーしない。戻り値は書き換えない）
+@st.cache_resource(show_spinner=False, max_entries=RENDER_CACHE_ENTRIES)
+def rendered_scenario(text, normalize=True):
     """
-    シナリオテキストの改行を強制的に修正する
-    ※カメラ、※状況、セリフ、心の声をそれぞれ別の行に分離
+    シナリオを表示用のHTMLに変換する
+
+    Args:
+        text: シナリオ
+        normalize: 先に enforce_line_breaks をかけるか（履歴は保存したときのままなのでかける）
 
-    シンプルなアプローチ：
-    1. 各行を処理
-    2. 改行が必要なパターンの前に改行を挿入
-    3. 結果を返す
+    Returns:
+        {"intro": 編より前（分析など）のHTML,
+         "parts": [{"part", "chars", "lead": 見出し以外の前置きのHTML, "pages": [{"label", "page", "panels", "html"}]}]}
+        編に分けられなければ parts は空で、intro に全文が入る
     """
-    # まず、改行が必要なパターンの前に特殊マーカーを挿入
-    result = text
-
-    # パターン1: ※カメラ、※状況説明などの前に改行
-    # ただし、行頭の※は除外
-    result = re.sub(r'(?<!^)(?<!\n)(※)', r'\n\1', result)
-
-    # パターン2: キャラ名「セリフ」の前に改行（A子、B男、義母、助産師など）
-    # 日本語のキャラ名パターン
-    result = re.sub(r'(?<!\n)([A-Z][子男]「)', r'\n\1', result)
-    result = re.sub(r'(?<!\n)(義母「)', r'\n\1', result)
-    result = re.sub(r'(?<!\n)(義父「)', r'\n\1', result)
-    result = re.sub(r'(?<!\n)(助産師「)', r'\n\1', result)
-    result = re.sub(r'(?<!\n)(看護師「)', r'\n\1', result)
-    result = re.sub(r'(?<!\n)(医師「)', r'\n\1', result)
-    result = re.sub(r'(?<!\n)(弁護士「)', r'\n\1', result)
-    result = re.sub(r'(?<!\n)(探偵「)', r'\n\1', result)
-    result = re.sub(r'(?<!\n)(上司「)', r'\n\1', result)
-    result = re.sub(r'(?<!\n)(友人「)', r'\n\1', result)
-    result = re.sub(r'(?<!\n)(母「)', r'\n\1', result)
-    result = re.sub(r'(?<!\n)(父「)', r'\n\1', result)
-
-    # パターン3: キャラ名（心の声）の前に改行
-    result = re.sub(r'(?<!\n)([A-Z][子男]（)', r'\n\1', result)
-    result = re.sub(r'(?<!\n)(義母（)', r'\n\1', result)
-    result = re.sub(r'(?<!\n)(義父（)', r'\n\1', result)
-    result = re.sub(r'(?<!\n)(助産師（)', r'\n\1', result)
-    result = re.sub(r'(?<!\n)(看護師（)', r'\n\1', result)
-    result = re.sub(r'(?<!\n)(医師（)', r'\n\1', result)
-    result = re.sub(r'(?<!\n)(弁護士（)', r'\n\1', result)
-    result = re.sub(r'(?<!\n)(探偵（)', r'\n\1', result)
-    result = re.sub(r'(?<!\n)(上司（)', r'\n\1', result)
-    result = re.sub(r'(?<!\n)(友人（)', r'\n\1', result)
-    result = re.sub(r'(?<!\n)(母（)', r'\n\1', result)
-    result = re.sub(r'(?<!\n)(父（)', r'\n\1', result)
-
-    # 連続する改行を1つにまとめる（3つ以上の連続改行を2つに）
-    result = re.sub(r'\n{3,}', '\n\n', result)
-
-    # 各行の先頭・末尾の空白を整理
-    lines = result.split('\n')
-    cleaned_lines = []
-    for line in lines:
-        stripped = line.strip()
-        if stripped:
-            cleaned_lines.append(stripped)
+    if normalize:
+        text = enforce_line_breaks(text)
+    panels = {}
+    for part, page, panel in panel_keys(text):
+        panels.setdefault((part, page), []).append(panel)
+    intro, parts = [], {}
+    for block in split_pages(text):
+        if block["part"] is None:
+            intro.append(block["text"])
+            continue
+        part = parts.setdefault(block["part"], {"part": block["part"], "chars": 0, "lead": [], "pages": []})
+        part["chars"] += count_characters(block["text"])
+        if block["page"] is None:
+            lead = "\n".join(line for line in block["text"].split("\n") if not _is_heading(line))
+            if lead:
+                part["lead"].append(lead)
         else:
-            # 空行は保持（ただし連続しすぎないように）
-            if cleaned_lines and cleaned_lines[-1] != '':
-                cleaned_lines.append('')
-
-    return '\n'.join(cleaned_lines)
+            part["pages"].append({
+                "label": f"P{block['page']}",
+                "page": block["page"],
+                "panels": panels.get((block["part"], block["page"]), []),
+                "html": _html(block["text"]),
+            })
+    return {
+        "intro": _html("\n".join(intro)) if "".join(intro).strip() else "",
+        "parts": [
+            {**part, "lead": _html("\n".join(part["lead"])) if part["lead"] else ""}
+            for part in parts.values()
+        ],
+    }
 
-# シナリオ自動チェック＆リライト関数
-def check_and_fix_scenario(api_key, scenario_draft):
-    """
-    生成されたシナリオを自動でチェックし、品質向上のためにリライトする
+def render_scenario(text, key, normalize=True, on_regenerate=None):
     """
-    client = anthropic.Anthropic(api_key=api_key)
-    
-    rewrite_prompt = f"""
-以下のシナリオを、チェック基準に基づいて 客観的に自己評価 → 問題点抽出 → 最適な形にリライト してください。
-トーンは漫画のネーム用のシナリオとして、テンポよく、読者にとって理解しやすく、感情移入しやすい形に整えてください。
-
-【元のシナリオ】
-{scenario_draft}
-
-【ステップ1：問題点の抽出】※内部処理のみ、出力不要
-
-以下のチェック基準に照らして、改善すべき点を把握：
-
-▼ チェック基準
-1. ストーリーのつじつま
-   - 設定の矛盾はないか
-   - 行動の必然性はあるか
-   - 状況説明は明瞭か
-   - 現実味はあるか（倫理観、違法行為、NG描写）
-
-2. セリフと感情の自然さ
-   - 会話の流れは自然か
-   - 年齢・性格に合った話し方か
-   - ポエム調・文学調を避けているか
-   - 共感を生む感情描写になっているか
-
-3. 話のまとまり・伏線回収
-   - 伏線の貼り方と回収
-   - 展開テンポ
-   - ラストの納得感
-
-4. スカッとポイントの設計
-   - 前編に「小さなスカッと」があるか
-   - 後編に「大きなスカッと」があるか
-   - 読者が「スカッとした！」と感じられるか
-
-5. テーマ/体験談への忠実性【超重要】
-   - 入力された体験談に記載されている内容のみを使用しているか
-   - 体験談に記載されていない設定・情報・要素を追加していないか
-   - 体験談から大きく逸脱した展開になっていないか
-
-6. 前後編の構成
-   - 前編だけでも完結感があるか
-   - 前編にスカッとポイントがあるか
-   - 後編への引きが適切か
-   - 後編で完全解決しているか
-
-7. **【最重要】改行フォーマット**
-   - ※カメラ指示は必ず1行目に単独で記述されているか
-   - ※シーン描写（場所、状況、動作、音など）は、それぞれ必ず別の行に記述されているか
-   - セリフ（「」で囲まれたもの）は、1つずつ必ず別の行に記述されているか
-   - 心の声（（）で囲まれたもの）は、1つずつ必ず別の行に記述されているか
-   - 同じ行に複数の要素が書かれていないか
-
-【ステップ2：シナリオの完全リライト版を生成】
-
-以下の条件を守って、最適化したシナリオを出力してください。
-
-▼ リライト条件
-- 前編5ページ・後編5ページのショート漫画を想定
-- テンポの良いネーム用シナリオ
-- **【最重要】前後編でそれぞれ完結しつつ、後編を絶対に読みたくなる構造**
-  - 前編 = 問題提示 + 小スカッと（満足度60%）
-  - 後編 = 真相 + 大スカッと（満足度100%）
-  - 前編ラストに必ず「強烈な引き」を入れる
-- **1ページ=ひとつの感情変化**を基本にする
-- キャラの行動と感情が自然
-- 読者が共感できる描写
-- セリフは短く、説明過多を避ける
-- クライマックスに向けて段階的に盛り上げる
-- 伏線は自然に回収
-- NG描写（鬱・殺人・宗教・差別・過度な暴力）なし
-- **体験談への忠実性【最重要】**：
-  - 入力された体験談に記載されている内容のみを使用すること
-  - 体験談に記載されていない設定・情報・要素は一切追加しない
-  - 体験談から大きく逸脱した展開は絶対に避けること
-- **【必須】改行フォーマットの厳守**：
-  - 各コマで、※カメラ、※状況、セリフ、心の声は必ずそれぞれ別の行に記述すること
-  - 同じ行に複数の要素を書いてはいけません
-  - 例：
-    ```
-    1コマ目
-    ※カメラ：引き
-    ※リビング。夕方
-    ※A子が疲れた表情でソファに座っている
-    A子「今日も疲れたな…」
-    A子（また一人でご飯か…）
-    ```
-
-【重要】出力はリライトしたシナリオのみ。分析や評価コメントは不要です。
-元のシナリオのフォーマット（【体験談の分析】から始まる形式）を維持してください。
-"""
+    シナリオを前編/後編の折りたたみとページのタブに分けて表示する
 
-    try:
-        message = client.messages.create(
-            model="claude-haiku-3-5-20250313",
-            max_tokens=8000,
-            temperature=0.5,
-            messages=[
-                {"role": "user", "content": rewrite_prompt}
-            ]
+    開いている編・選んでいるページだけを組み立てて送る（閉じている分は再実行のたびに送らない）。
+    on_regenerate を渡すと、ページごとに「作り直す」を出し、押されたら on_regenerate(編, ページ, コマ, 直したい点) を呼ぶ
+    （コマは、ページ全体なら None）。
+    """
+    rendered = rendered_scenario(text, normalize)
+    if rendered["intro"]:
+        st.markdown(rendered["intro"], unsafe_allow_html=True)
+    for index, part in enumerate(rendered["parts"]):
+        label = f"■{part['part']}（{len(part['pages'])}ページ・{part['chars']:,}文字）"
+        with st.expander(label, expanded=index == 0, key=f"{key}_{part['part']}", on_change="rerun") as section:
+            if not section.open:
+                continue
+            if part["lead"]:
+                st.markdown(part["lead"], unsafe_allow_html=True)
+            if len(part["pages"]) <= 1:
+                for page in part["pages"]:
+                    st.markdown(page["html"], unsafe_allow_html=True)
+                    if on_regenerate is not None:
+                        regenerate_controls(f"{key}_{part['part']}_P{page['page']}", part["part"], page, on_regenerate)
+                continue
+            tabs = st.tabs([page["label"] for page in part["pages"]], key=f"{key}_{part['part']}_pages",
+                           on_change="rerun")
+            for tab, page in zip(tabs, part["pages"]):
+                with tab:
+                    if tab.open:
+                        st.markdown(page["html"], unsafe_allow_html=True)
+                        if on_regenerate is not None:
+                            regenerate_controls(
+                                f"{key}_{part['part']}_P{page['page']}", part["part"], page, on_regenerate
+                            )
+
+def regenerate_controls(key, part, page, on_regenerate):
+    """1ページ（または1コマ）だけを作り直す操作"""
+    with st.popover("🔁 このページを作り直す"):
+        panel = st.selectbox(
+            "作り直す範囲",
+            [None, *page["panels"]],
+            format_func=lambda panel: "ページ全体" if panel is None else f"{panel}コマ目",
+            key=f"{key}_target",
         )
+        instruction = st.text_input("直したい点（任意）", key=f"{key}_instruction",
+                                    placeholder="例：義母の嫌味をもっと具体的に")
+        if st.button("🔁 作り直す", key=f"{key}_run", type="primary"):
+            on_regenerate(part, page["page"], panel, instruction)
 
-        rewritten_scenario = message.content[0].text
-        return rewritten_scenario
-    except Exception as e:
-        return scenario_draft
-
-# ============================================================================
-# シナリオ生成関数
-# ============================================================================
-
-def generate_scenario(api_key, experience):
+def regenerate_page(api_key, text, part, page, panel, instruction):
     """
-    Claude APIを使用してシナリオを生成
-    
-    Args:
-        api_key: Anthropic APIキー
-        experience: 体験談
-        
+    シナリオの1ページ（1コマ）だけを作り直す
+
     Returns:
-        生成されたシナリオのテキスト
+        (作り直したシナリオ, 使ったモデル)。失敗したらエラーを表示して None
     """
-    client = anthropic.Anthropic(api_key=api_key)
-
-    master_prompt = load_master_prompt()
-
-    # ユーザー入力を構造化
-    user_prompt = f"""
-{master_prompt}
-
----
-
-## オーダー
-{experience}
-
-上記の体験談を、スカッと系ショート漫画のシナリオプロット（前編5P・後編5P）に変換してください。
-"""
-
+    label = f"{part}P{page}" + (f"の{panel}コマ目" if panel is not None else "")
+    meta = {}
     try:
-        message = client.messages.create(
-            model="claude-sonnet-4-5-20250929",
-            max_tokens=8000,
-            temperature=0.7,
-            messages=[
-                {"role": "user", "content": user_prompt}
-            ]
-        )
-
-        return message.content[0].text
+        with st.spinner(f"🔁 {label}を作り直しています..."), use_user(session_user()):
+            scenario, issues = regenerate_section(api_key, text, part, page, panel, instruction, meta=meta)
     except Exception as e:
-        return f"エラーが発生しました: {str(e)}"
-
-# 履歴を保存
-def save_history(experience, result):
-    # Streamlit Cloud環境ではファイル保存をスキップ
-    if is_streamlit_cloud():
-        return None
-
-    try:
-        history_dir = os.path.join(os.path.dirname(__file__), "output")
-        os.makedirs(history_dir, exist_ok=True)
-
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"scenario_{timestamp}.json"
-        filepath = os.path.join(history_dir, filename)
-
-        data = {
-            "timestamp": datetime.now().isoformat(),
-            "experience": experience,
-            "prompt_version": PROMPT_VERSION,
-            "result": result
-        }
-
-        with open(filepath, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-
-        return filepath
-    except Exception:
+        st.error(f"❌ {label}を作り直せませんでした: {e}")
         return None
+    st.session_state.regenerate_notice = {"label": label, "issues": issues}
+    return scenario, meta["regenerate"]["model"]
 
-# 履歴を読み込む
-def load_history(limit=10, search_query=""):
-    # Streamlit Cloud環境ではファイル読み込みをスキップ
-    if is_streamlit_cloud():
-        return []
-
-    try:
-        history_dir = os.path.join(os.path.dirname(__file__), "output")
-        if not os.path.exists(history_dir):
-            return []
-
-        history_files = sorted(
-            [f for f in os.listdir(history_dir) if f.endswith('.json') and f != 'favorites.json'],
-            reverse=True
-        )
-
-        histories = []
-        for filename in history_files:
-            filepath = os.path.join(history_dir, filename)
-            with open(filepath, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                # 検索クエリがある場合、フィルタリング
-                if search_query:
-                    if (search_query.lower() in data.get('experience', '').lower() or
-                        search_query.lower() in data.get('result', '').lower()):
-                        histories.append(data)
-                else:
-                    histories.append(data)
-
-            # 制限数に達したら終了
-            if len(histories) >= limit:
-                break
-
-        return histories
-    except Exception:
-        return []
-
-# お気に入り管理
-def get_favorites():
-    """お気に入りリストを取得"""
-    # Streamlit Cloud環境ではファイル操作をスキップ
-    if is_streamlit_cloud():
-        return []
-
-    try:
-        favorites_file = os.path.join(os.path.dirname(__file__), "output", "favorites.json")
-        if os.path.exists(favorites_file):
-            with open(favorites_file, "r", encoding="utf-8") as f:
-                return json.load(f)
-    except Exception:
-        pass
-    return []
-
-def save_favorites(favorites):
-    """お気に入りリストを保存"""
-    # Streamlit Cloud環境ではファイル操作をスキップ
-    if is_streamlit_cloud():
+def render_regenerate_notice():
+    """直前に作り直した部分と、整合性チェックで見つかった問題"""
+    notice = st.session_state.pop("regenerate_notice", None)
+    if notice is None:
         return
+    st.success(f"✅ {notice['label']}を作り直しました")
+    for issue in notice["issues"]:
+        st.warning(f"⚠️ {issue}")
 
-    try:
-        favorites_file = os.path.join(os.path.dirname(__file__), "output", "favorites.json")
-        os.makedirs(os.path.dirname(favorites_file), exist_ok=True)
-        with open(favorites_file, "w", encoding="utf-8") as f:
-            json.dump(favorites, f, ensure_ascii=False, indent=2)
-    except Exception:
-        pass
-
-def toggle_favorite(timestamp):
-    """お気に入りの追加/削除を切り替え"""
-    favorites = get_favorites()
-    if timestamp in favorites:
-        favorites.remove(timestamp)
-    else:
-        favorites.append(timestamp)
-    save_favorites(favorites)
-    return timestamp in favorites
-
-def is_favorite(timestamp):
-    """お気に入りかどうかを確認"""
-    favorites = get_favorites()
-    return timestamp in favorites
-
-# 統計情報を取得
-def get_statistics():
-    """生成統計情報を取得"""
-    # Streamlit Cloud環境ではファイル操作をスキップ
-    if is_streamlit_cloud():
-        return {"total_count": 0}
-
-    try:
-        history_dir = os.path.join(os.path.dirname(__file__), "output")
-        if not os.path.exists(history_dir):
-            return {"total_count": 0}
-
-        history_files = [f for f in os.listdir(history_dir) if f.endswith('.json') and f != 'favorites.json']
+def download_content(hist):
+    """履歴のダウンロード用の内容（ダウンロードボタンが押されたときにだけ作る）"""
+    return f"""# スカッと系ショート漫画シナリオ
 
-        stats = {
-            "total_count": len(history_files)
-        }
-
-        return stats
-    except Exception:
-        return {"total_count": 0}
-
-# シナリオを編集して保存
-def update_history(timestamp, updated_result):
-    """履歴のシナリオを更新"""
-    # Streamlit Cloud環境ではファイル操作をスキップ
-    if is_streamlit_cloud():
-        return False
+## 生成情報
+- 日時: {hist['timestamp'][:19]}
+- プロンプトバージョン: v{hist.get('prompt_version', '不明')}
 
-    try:
-        history_dir = os.path.join(os.path.dirname(__file__), "output")
-        history_files = [f for f in os.listdir(history_dir) if f.endswith('.json') and f != 'favorites.json']
-
-        for filename in history_files:
-            filepath = os.path.join(history_dir, filename)
-            with open(filepath, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                if data.get('timestamp', '') == timestamp:
-                    data['result'] = updated_result
-                    data['updated_at'] = datetime.now().isoformat()
-                    data['is_edited'] = True
-                    with open(filepath, "w", encoding="utf-8") as f:
-                        json.dump(data, f, ensure_ascii=False, indent=2)
-                    return True
-    except Exception:
-        pass
-    return False
+## 体験談
+{hist.get('experience', 'なし')}
 
-# 履歴を削除
-def delete_history(timestamp):
-    """指定されたtimestampの履歴を削除"""
-    # Streamlit Cloud環境ではファイル操作をスキップ
-    if is_streamlit_cloud():
-        return False
+## 生成されたシナリオ
 
-    try:
-        history_dir = os.path.join(os.path.dirname(__file__), "output")
-        history_files = [f for f in os.listdir(history_dir) if f.endswith('.json') and f != 'favorites.json']
-
-        for filename in history_files:
-            filepath = os.path.join(history_dir, filename)
-            try:
-                with open(filepath, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                    if data.get('timestamp', '') == timestamp:
-                        # お気に入りからも削除
-                        favorites = get_favorites()
-                        if timestamp in favorites:
-                            favorites.remove(timestamp)
-                            save_favorites(favorites)
-                        # ファイルを削除
-                        os.remove(filepath)
-                        return True
-            except Exception:
-                continue
-    except Exception:
-        pass
-    return False
+{hist['result']}
+"""
 
 # APIキーを保存
 def save_api_key(api_key):
@@ -541,8 +300,12 @@ def save_api_key(api_key):
                 f.write(f"ANTHROPIC_API_KEY={api_key}\n")
         else:
             # 既存の.envファイルを更新
+            from dotenv import set_key
+
             set_key(env_path, "ANTHROPIC_API_KEY", api_key)
 
+        # 起動中のプロセスにも反映
+        os.environ["ANTHROPIC_API_KEY"] = api_key
         return True
     except Exception as e:
         st.error(f"APIキーの保存に失敗しました: {str(e)}")
@@ -560,17 +323,209 @@ def get_api_key():
     # ローカル環境の場合は環境変数から
     return os.getenv("ANTHROPIC_API_KEY", "")
 
+# 生成中の初稿のプレビュー
+def make_draft_preview(placeholder):
+    """
+    ストリーミング中の初稿を、改行を整えながら表示する関数を返す
+
+    Returns:
+        (on_text, render)
+        on_text は生成スレッドから呼ばれ、テキストをためるだけ。
+        render は画面のスレッドから呼び、ためたテキストを表示する。
+    """
+    normalizer = LineBreakNormalizer()
+    lock = threading.Lock()
+    state = {"text": "", "shown": ""}
+
+    def on_text(chunk):
+        with lock:
+            state["text"] += normalizer.feed(chunk)
+
+    def render():
+        with lock:
+            text = state["text"]
+        if text != state["shown"]:
+            state["shown"] = text
+            placeholder.text(text)
+
+    return on_text, render
+
+# 生成をキャンセルできるように別スレッドで動かす
+def run_cancellable(target, token, render, interval_sec=0.25):
+    """
+    target() を別スレッドで動かし、終わるまで interval_sec ごとに render() で画面を更新する
+
+    Streamlit はキャンセルボタン・入力の変更・ブラウザを閉じたことを、
+    画面のスレッドで次に st を呼んだときの例外として伝える。
+    render() で st を呼び続け、その例外を受けたら token をキャンセルしてAPI呼び出しを止める。
+    """
+    from streamlit.runtime.scriptrunner import StopException
+
+    outcome = {}
+
+    def work():
+        try:
+            outcome["result"] = target()
+        except BaseException as e:
+            outcome["error"] = e
+
+    # 生成スレッドの処理も、この実行のプロファイルに入れる
+    thread = threading.Thread(target=run_in_context(work), name="scenario-generation", daemon=True)
+    thread.start()
+    try:
+        while thread.is_alive():
+            render()
+            thread.join(interval_sec)
+        render()
+    except BaseException as e:
+        token.cancel("切断" if isinstance(e, StopException) else "キャンセル・入力の変更")
+        # 接続を閉じたので、生成スレッドはすぐに抜ける
+        thread.join(5.0)
+        record_cancellation(token)
+        st.session_state.last_cancellation = {
+            "reason": token.reason,
+            "saved_output_tokens": token.saved_output_tokens,
+            "saved_sec": token.saved_sec,
+        }
+        raise
+
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
+
+# 入力中の初稿の先読み
+def watch_prefetch(api_key, experience, settings):
+    """入力が落ち着いたら初稿の先読みを始め、先読みが終わるまで状態を表示する"""
+    maybe_start(st.session_state, api_key, experience, settings, user=session_user())
+    if pending_prefetch(st.session_state, experience):
+        _prefetch_status(api_key, experience, settings)
+
+@st.fragment(run_every=POLL_SEC)
+def _prefetch_status(api_key, experience, settings):
+    # 入力が debounce 秒変わらなかったか、先読みが終わったかを POLL_SEC ごとに確かめる
+    speculative = maybe_start(st.session_state, api_key, experience, settings, user=session_user())
+    if speculative is None:
+        return
+    if speculative.running:
+        st.caption(f"🔮 初稿を先読みしています...（{len(speculative.text()):,}文字）")
+    else:
+        # 確かめ続けるのをやめる
+        st.rerun(scope="app")
+
+# 生成（チェックポイントの続きから）
+@profiled("ui.generation")
+def run_generation(api_key, checkpoint, speculative=None):
+    """
+    チェックポイントの終わっていないステージから生成し、完成したら履歴に保存して再実行する
+
+    失敗したときはチェックポイントを残し、「途中で止まった生成」からそのステージだけやり直せるようにする。
+    speculative（入力中に先読みした初稿）を渡すと、その初稿を引き継いで自動リライトから続ける。
+    """
+    try:
+        # 進捗表示用のプレースホルダー
+        progress_container = st.container()
+
+        with progress_container:
+            st.info("🚀 シナリオ生成を開始します...")
+            # 押すと再実行になり、実行中の生成はキャンセルされる
+            st.button("⏹️ 生成をキャンセル", key="cancel_generation")
+
+            progress_bar = st.progress(0)
+            status_text = st.empty()
+            with st.expander("👀 生成中の初稿", expanded=False):
+                on_draft_text, render_draft = make_draft_preview(st.empty())
+
+            # 生成スレッドは状態を書き込むだけにし、表示は画面のスレッドで行う
+            progress = {"value": 0, "status": "", "started": time.monotonic()}
+
+            def set_progress(status, value=None):
+                progress["status"] = status
+                if value is not None:
+                    progress["value"] = value
+
+            def render():
+                progress_bar.progress(progress["value"])
+                elapsed = time.monotonic() - progress["started"]
+                status_text.text(f"{progress['status']}（{elapsed:.0f}秒経過）")
+                render_draft()
+
+            token = CancelToken()
+            # 生成スレッドのAPI呼び出しを、このユーザーの予算に数える
+            with use_user(session_user()):
+                checkpoint = run_cancellable(
+                    lambda: run_checkpointed(
+                        api_key,
+                        adopt(speculative, checkpoint, cancel=token, on_progress=set_progress,
+                              on_draft_text=on_draft_text),
+                        cancel=token, on_progress=set_progress, on_draft_text=on_draft_text
+                    ),
+                    token,
+                    render,
+                )
+
+            stopped_at = failed_stage(checkpoint)
+            if stopped_at is not None:
+                st.session_state.generation_error = {
+                    "stage": stopped_at,
+                    "error": checkpoint["stages"][stopped_at]["error"],
+                }
+                st.rerun()
+
+            final_scenario = completed_scenario(checkpoint)
+            progress_bar.progress(100)
+            status_text.text(f"✅ シナリオ生成が完了しました！（{time.monotonic() - progress['started']:.0f}秒）")
+
+            # セッションステートに保存
+            st.session_state.result = final_scenario
+            st.session_state.experience = checkpoint["experience"]
+            st.session_state.stitch_issues = checkpoint["stitch_issues"]
+
+            # 履歴に保存し、チェックポイントは消す（ページを作り直したときに同じ履歴を更新する）
+            location = save_history(checkpoint["experience"], final_scenario, models=checkpoint_models(checkpoint))
+            st.session_state.result_id = location_record_id(location)
+            st.session_state.result_models = checkpoint_models(checkpoint)
+            delete_checkpoint(checkpoint["id"])
+
+            # 成功メッセージ
+            st.success("🎉 シナリオが生成されました！")
+            st.balloons()
+
+            # 少し待ってからリロード
+            time.sleep(1)
+            st.rerun()
+
+    except Exception as e:
+        st.error(f"❌ 予期しないエラーが発生しました: {str(e)}")
+        st.info("💡 エラーが続く場合は、開発者にお問い合わせください")
+        with st.expander("🔍 詳細なエラー情報"):
+            st.code(traceback.format_exc())
+
 # メイン画面
 def main():
+    # ページ設定
+    st.set_page_config(
+        page_title="スカッと系ショート漫画シナリオ生成ツール | 愛カツ",
+        page_icon="⚡",
+        layout="wide",
+        initial_sidebar_state="expanded"
+    )
+
+    # カスタムCSS
+    st.markdown(load_custom_css(), unsafe_allow_html=True)
+
     # .envファイルを読み込む（ローカル環境用）
-    load_dotenv()
+    load_env_file()
+
+    # 監視からスクレイプする /metrics（SCENARIO_METRICS_PORT を指定したときだけ。プロセスで1回だけ立てる）
+    if start_metrics_server() is None and metrics_server_error():
+        st.warning(f"⚠️ メトリクスのサーバーを立てられませんでした（{metrics_server_error()}）")
 
     # ヘッダー
     st.markdown(f'<div class="main-header">⚡ スカッと系ショート漫画シナリオ生成ツール <span class="version-badge">v{VERSION}</span></div>', unsafe_allow_html=True)
     st.markdown(f'<div class="sub-header">前編5P・後編5P完結形式（プロンプトv{PROMPT_VERSION}）｜愛カツ専用ツール</div>', unsafe_allow_html=True)
 
     # サイドバー設定
-    with st.sidebar:
+    with st.sidebar, span("ui.sidebar"):
         # プロジェクト識別情報
         st.markdown("""
         <div style="background-color: #FFE5E5; padding: 1rem; border-radius: 10px; margin-bottom: 1rem; border: 2px solid #FF6B6B;">
@@ -615,6 +570,40 @@ def main():
         story_format = "前後編2話完結（前編5ページ・後編5ページ）"
         st.info(f"📖 **形式**: {story_format}")
 
+        generation_mode = st.radio(
+            "🧩 生成方式",
+            GENERATION_MODES,
+            index=GENERATION_MODES.index(GENERATION_MODE) if GENERATION_MODE in GENERATION_MODES else 0,
+            format_func=lambda mode: GENERATION_MODE_LABELS.get(mode, mode),
+            horizontal=True,
+            help="「アウトライン→並列展開」は先に全体の構成を作り、10ページを同時に書き起こすため高速です"
+        )
+
+        rewrite_mode = st.radio(
+            "✨ 自動リライトの方式",
+            REWRITE_MODES,
+            index=REWRITE_MODES.index(REWRITE_MODE) if REWRITE_MODE in REWRITE_MODES else 0,
+            format_func=lambda mode: REWRITE_MODE_LABELS.get(mode, mode),
+            horizontal=True,
+            help="「変更箇所のみ」は書き直したコマだけを出力させるため高速です。形式が正しくない場合は自動で全文リライトに切り替えます"
+        )
+
+        pipelined = st.checkbox(
+            "⚡ 前編のリライトを先に始める",
+            value=PIPELINED,
+            disabled=generation_mode != "single",
+            help="一括生成のとき、初稿の後編を書いている間に前編のリライトを始めて待ち時間を短くします"
+        )
+
+        prefetch = st.checkbox(
+            "🔮 入力中に初稿を先読みする",
+            value=env_prefetch_enabled(),
+            disabled=generation_mode != "single",
+            key="prefetch",
+            help="体験談の入力がしばらく変わらなければ裏で初稿を作り始め、生成ボタンを押したときに引き継ぎます。"
+                 "入力を変えると先読みは捨てるため、そのぶんAPIの利用料がかかります"
+        )
+
         st.divider()
 
         # 統計情報表示
@@ -630,6 +619,61 @@ def main():
         else:
             st.info("まだ統計情報がありません")
 
+        # 文字数の分布（保存時に数えた内訳から集計）
+        if stats["total_count"] > 0:
+            with st.expander("📏 文字数の分布"):
+                summary = get_char_count_summary()
+                if summary["scenario_count"] > 0:
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        st.metric("1本の文字数（中央値）", f"{summary['script_total']['median']:.0f}")
+                        st.metric("1ページ（中央値）", f"{summary['page']['median']:.0f}")
+                    with col2:
+                        st.metric("1コマ（中央値）", f"{summary['panel']['median']:.0f}")
+                        st.metric("セリフの割合（中央値）", f"{summary['dialogue_ratio']['median']:.0%}")
+                    st.bar_chart(
+                        [row["script_total"] for row in reversed(summary["totals"])],
+                        height=150
+                    )
+                    st.dataframe(
+                        [
+                            {"項目": label, **{k: round(v, 2) for k, v in summary[key].items()}}
+                            for key, label in (("script_total", "1本"), ("page", "ページ"), ("panel", "コマ"))
+                        ],
+                        hide_index=True,
+                        use_container_width=True
+                    )
+                    if summary["outliers"]:
+                        st.caption(f"⚠️ 外れ値: {len(summary['outliers'])}件")
+                        st.dataframe(summary["outliers"], hide_index=True, use_container_width=True)
+                else:
+                    st.info("コマ形式のシナリオがまだありません")
+
+        # 履歴キャッシュとセッションごとのメモリ使用量・履歴の書き込み状況
+        with st.expander("🧠 メモリと保存"):
+            cache = history_cache.cache_stats()
+            col1, col2 = st.columns(2)
+            with col1:
+                st.metric("履歴キャッシュ", f"{cache['bytes'] / 1024 / 1024:.1f} / {cache['max_bytes'] / 1024 / 1024:.0f} MB")
+            with col2:
+                st.metric("ヒット率", f"{cache['hit_rate']:.0%}")
+            st.caption(f"{cache['entries']}件・追い出し {cache['evictions']}回")
+            writes = history_writer.write_stats()
+            st.caption(
+                f"保存先: {get_backend().uri}｜保存待ち {writes['pending']}件・保存済み {writes['written']}件・"
+                f"再試行 {writes['retries']}回・失敗 {writes['failed']}件・保存までの時間（最大）{writes['latency_max_sec']:.1f}秒"
+            )
+            if writes["failed"]:
+                st.warning(f"⚠️ 履歴の保存に失敗したものがあります: {writes['last_error']}")
+            sessions = history_cache.active_sessions()
+            if sessions:
+                # st.dataframe は毎回の描画でpandasへの変換が走るのでMarkdownの表にする
+                rows = "\n".join(
+                    f"| {row['session']} | {row['own_bytes'] / 1024:.0f} KB | {row['shared_bytes'] / 1024:.0f} KB | {row['idle_sec']}秒前 |"
+                    for row in sessions
+                )
+                st.markdown(f"| セッション | 固有 | 共有 | 最終描画 |\n|---|---|---|---|\n{rows}")
+
         st.divider()
 
         # 履歴表示
@@ -654,14 +698,14 @@ def main():
         # お気に入りフィルター
         if filter_type == "お気に入りのみ":
             favorites = get_favorites()
-            histories = [h for h in histories if h.get('timestamp', '') in favorites]
+            histories = [h for h in histories if record_id(h) in favorites]
         
         if histories:
             st.caption(f"表示中: {len(histories)}件")
             for i, hist in enumerate(histories, 1):
-                timestamp = hist.get('timestamp', '')
+                key = record_id(hist)
                 experience_preview = hist.get('experience', '')[:30] if hist.get('experience') else '体験談なし'
-                is_fav = is_favorite(timestamp) if timestamp else False
+                is_fav = is_favorite(key) if key else False
                 
                 # タイトル（リンク風ボタン）
                 if st.button(
@@ -675,15 +719,15 @@ def main():
                     st.rerun()
                 
                 # お気に入りボタン
-                if timestamp:
-                    fav_key = f"fav_{i}_{timestamp}"
+                if key:
+                    fav_key = f"fav_{i}_{key}"
                     if st.button(
                         "⭐" if is_fav else "☆", 
                         key=fav_key, 
                         type="tertiary",
                         help="お気に入り"
                     ):
-                        toggle_favorite(timestamp)
+                        toggle_favorite(key)
                         st.rerun()
                 
                 # 区切り線
@@ -693,6 +737,46 @@ def main():
 
         st.divider()
 
+        # モデルルーティングの統計
+        route_stats = get_route_stats()
+        if route_stats:
+            with st.expander("🧭 モデルルーティング"):
+                st.dataframe(route_stats, hide_index=True, use_container_width=True)
+
+        # キャンセルの集計
+        cancel_stats = get_cancellation_stats()
+        if cancel_stats["cancellations"]:
+            with st.expander("⏹️ キャンセル"):
+                reasons = "、".join(f"{reason} {count}件" for reason, count in cancel_stats["reasons"].items())
+                st.markdown(f"""
+- キャンセル: {cancel_stats['cancellations']}件（{reasons}）
+- 使わずに済んだ出力: 約{cancel_stats['saved_output_tokens']:,} トークン
+- 短縮できた時間: 約{cancel_stats['saved_sec']:.0f}秒
+""")
+
+        # 先読みの集計（debounce を調整する目安）
+        prefetch_stats = get_prefetch_stats()
+        if prefetch_stats["started"]:
+            with st.expander("🔮 先読み"):
+                st.markdown(f"""
+- 先読み: {prefetch_stats['started']}件（引き継ぎ {prefetch_stats['hits']}件・書きかけで引き継ぎ {prefetch_stats['partial_hits']}件・破棄 {prefetch_stats['misses']}件）
+- 引き継げた割合: {prefetch_stats['hit_rate']:.0%}
+- 捨てた初稿: 入力 約{prefetch_stats['wasted_input_tokens']:,} / 出力 約{prefetch_stats['wasted_output_tokens']:,} トークン（約${prefetch_stats['wasted_cost_usd']:.4f}）
+- 短縮できた時間: 約{prefetch_stats['saved_sec']:.0f}秒
+""")
+
+        # APIの利用料の予算
+        budget = budget_status(user=session_user())
+        if budget["enabled"]:
+            with st.expander("💰 予算", expanded=budget["level"] != "normal"):
+                render_budget(budget)
+
+        # 直前の実行のプロファイル（この実行のものは、終わってから次の実行で表示される）
+        profile_traces = st.session_state.get("profile_traces")
+        if profile_mode() and profile_traces:
+            with st.expander("🔬 プロファイル"):
+                render_profile(profile_traces)
+
         # ツール情報
         with st.expander("ℹ️ ツール情報"):
             st.markdown(f"""
@@ -711,11 +795,19 @@ def main():
 - 自動リライト：約20〜40秒
 - 合計：約1〜2分
             """)
+            # 遅いときの調査用（環境変数 SCENARIO_PROFILE でも有効にできる）
+            st.selectbox(
+                "🔬 プロファイル",
+                list(PROFILE_MODE_LABELS),
+                index=list(PROFILE_MODE_LABELS).index(env_profile_mode()),
+                format_func=PROFILE_MODE_LABELS.get,
+                key="profile_mode",
+            )
 
     # メインコンテンツ
     col1, col2 = st.columns([2, 1])
 
-    with col1:
+    with col1, span("ui.input"):
         st.header("✍️ 体験談を入力")
         experience = st.text_area(
             "シナリオ化したい体験談を自由に記述してください",
@@ -723,6 +815,41 @@ def main():
             placeholder="例：\n夫にモラハラされていた私が、ある日親友の一言で離婚を決意。\n義母に理不尽な要求をされ続けていたが、ついに反撃した。\n婚活パーティーで出会った男性が、実は...",
             help="具体的な体験談を入力すると、より良いシナリオが生成されます"
         )
+        # 入力が変わったら、前の入力で先読みしていた初稿は捨てる
+        observe_input(st.session_state, experience)
+
+        # 送信前のトークン数の目安
+        condense = False
+        if experience:
+            prompt_tokens = estimate_tokens(load_master_prompt()) + estimate_tokens(experience)
+            st.caption(
+                f"🔢 推定トークン数: 入力 約{prompt_tokens:,} / "
+                f"出力 約{expected_output_tokens('draft', experience):,}"
+            )
+            if is_oversized_experience(experience):
+                st.warning(
+                    f"⚠️ 体験談が長すぎます（目安: {MAX_EXPERIENCE_TOKENS:,}トークン以内）。"
+                    "出力が途中で打ち切られる可能性があります"
+                )
+                condense = st.checkbox(
+                    "✂️ 体験談を要約してから生成する",
+                    value=True,
+                    help=f"生成前に体験談を約{CONDENSED_EXPERIENCE_CHARS:,}文字に要約します"
+                )
+
+            # 過去に似ている体験談があれば、生成せずに使い回せるようにする
+            similar_histories = find_similar_histories(experience)
+            if similar_histories:
+                st.warning(f"♻️ 似ている体験談が過去に{len(similar_histories)}件あります。生成する前に確認してください")
+                for i, similar in enumerate(similar_histories):
+                    with st.expander(
+                        f"類似度 {similar['similarity']:.0%}｜{similar.get('timestamp', '')[:16].replace('T', ' ')}"
+                    ):
+                        st.caption(similar.get("experience", "")[:200])
+                        if st.button("♻️ このシナリオを使う", key=f"reuse_similar_{i}"):
+                            st.session_state.selected_history = similar
+                            st.session_state.selected_history_index = None
+                            st.rerun()
 
     with col2:
         st.header("💡 体験談のヒント")
@@ -754,92 +881,129 @@ def main():
     # 生成ボタン
     st.divider()
 
-    if not api_key:
+    # 直前にキャンセルした生成
+    cancellation = st.session_state.pop("last_cancellation", None)
+    if cancellation:
+        st.info(
+            f"⏹️ 生成を中止しました（{cancellation['reason']}）。"
+            f"使わずに済んだ出力: 約{cancellation['saved_output_tokens']:,} トークン・約{cancellation['saved_sec']:.0f}秒"
+        )
+
+    # 直前に失敗した生成
+    generation_error = st.session_state.pop("generation_error", None)
+    if generation_error:
+        st.error(f"❌ {STAGE_LABELS[generation_error['stage']]}でエラーが発生しました: {generation_error['error']}")
+        if generation_error["stage"] in ("condense", "draft"):
+            st.info("💡 解決方法:\n- APIキーとクレジット残高を確認してください\n- インターネット接続を確認してください\n- しばらく待ってから再試行してください")
+        else:
+            st.info("💡 初稿までは保存してあります。下の「途中で止まった生成」から、このステージだけやり直せます")
+
+    # 途中で止まった生成（終わったステージはやり直さずに再開できる）
+    resume_action = None
+    unfinished = list_unfinished_checkpoints() if api_key else []
+    for checkpoint in unfinished:
+        stages = checkpoint["stages"]
+        stopped_at = failed_stage(checkpoint)
+        with st.container(border=True):
+            st.markdown(f"**⏸️ 途中で止まった生成**（{checkpoint['created_at'][:19]}）: {checkpoint['experience'][:40]}…")
+            st.caption(" → ".join(
+                f"{STAGE_LABELS[stage]} {STAGE_STATUS_ICONS.get(stages[stage]['status'], '')}" for stage in STAGES
+            ))
+            if stopped_at and stages[stopped_at]["error"]:
+                st.caption(f"{STAGE_LABELS[stopped_at]}のエラー: {stages[stopped_at]['error']}")
+            draft_done = stages["draft"]["status"] == "done"
+            cols = st.columns(3)
+            with cols[0]:
+                if draft_done and stages["rewrite"]["status"] not in ("done", "skipped"):
+                    if st.button("🔁 リライトだけやり直す", key=f"retry_rewrite_{checkpoint['id']}"):
+                        resume_action = reset_from(checkpoint, "rewrite")
+                elif st.button("▶️ 続きから再開", key=f"resume_{checkpoint['id']}"):
+                    resume_action = checkpoint
+            with cols[1]:
+                if draft_done and stages["rewrite"]["status"] not in ("done", "skipped"):
+                    if st.button("⏭️ 初稿のまま使う", key=f"skip_rewrite_{checkpoint['id']}"):
+                        resume_action = skip_rewrite(checkpoint)
+            with cols[2]:
+                if st.button("🗑️ 破棄", key=f"discard_{checkpoint['id']}"):
+                    delete_checkpoint(checkpoint["id"])
+                    st.rerun()
+
+    budget = budget_status(user=session_user())
+    if budget["level"] == "exhausted":
+        st.error("🚫 APIの利用料の上限に達したため、生成を止めています。上限が戻ってから（翌日・翌月・設定の変更後）再開してください")
+    elif resume_action is not None:
+        run_generation(api_key, resume_action)
+    elif not api_key:
         st.warning("⚠️ サイドバーでAnthropic API Keyを入力してください")
     elif not experience:
         st.warning("⚠️ 体験談を入力してください")
     else:
+        settings = {
+            "generation_mode": generation_mode,
+            "rewrite_mode": rewrite_mode,
+            "condense": condense,
+            "pipelined": pipelined,
+        }
+        if prefetch:
+            watch_prefetch(api_key, experience, settings)
+        else:
+            discard(st.session_state)
         if st.button("🎬 シナリオを生成する", type="primary"):
-            try:
-                # 進捗表示用のプレースホルダー
-                progress_container = st.container()
-                
-                with progress_container:
-                    st.info("🚀 シナリオ生成を開始します...")
-                    
-                    # ステップ1: シナリオ生成
-                    progress_bar = st.progress(0)
-                    status_text = st.empty()
-                    
-                    status_text.text("📝 ステップ1/2: シナリオ初稿を作成中... (約30-60秒)")
-                    progress_bar.progress(25)
-                    
-                    draft_scenario = generate_scenario(api_key, experience)
-                    
-                    # エラーチェック
-                    if draft_scenario.startswith("エラーが発生しました"):
-                        st.error(f"❌ シナリオ生成中にエラーが発生しました: {draft_scenario}")
-                        st.info("💡 解決方法:\n- APIキーが正しいか確認してください\n- インターネット接続を確認してください\n- しばらく待ってから再試行してください")
-                    else:
-                        progress_bar.progress(50)
-                        
-                        # ステップ2: 自動チェック＆リライト
-                        status_text.text("✨ ステップ2/2: 品質チェック＆自動リライト中... (約20-40秒)")
-                        progress_bar.progress(75)
-                        
-                        final_scenario = check_and_fix_scenario(api_key, draft_scenario)
-                        
-                        # 改行を強制的に修正
-                        final_scenario = enforce_line_breaks(final_scenario)
-                        
-                        progress_bar.progress(100)
-                        status_text.text("✅ シナリオ生成が完了しました！")
-                        
-                        # セッションステートに保存
-                        st.session_state.result = final_scenario
-                        st.session_state.experience = experience
-
-                        # 履歴に保存
-                        save_history(experience, final_scenario)
-                        
-                        # 成功メッセージ
-                        st.success("🎉 シナリオが生成されました！")
-                        st.balloons()
-                        
-                        # 少し待ってからリロード
-                        time.sleep(1)
-                        st.rerun()
-                        
-            except anthropic.APIError as e:
-                st.error(f"❌ APIエラーが発生しました: {str(e)}")
-                st.info("💡 解決方法:\n- APIキーとクレジット残高を確認してください\n- APIの利用制限を確認してください")
-            except Exception as e:
-                st.error(f"❌ 予期しないエラーが発生しました: {str(e)}")
-                st.info("💡 エラーが続く場合は、開発者にお問い合わせください")
-                import traceback
-                with st.expander("🔍 詳細なエラー情報"):
-                    st.code(traceback.format_exc())
+            speculative = take(st.session_state, experience, settings) if prefetch else None
+            run_generation(api_key, new_checkpoint(experience, settings), speculative)
+        # 急がない体験談は Message Batches（料金は半額）で夜間にまとめて生成する
+        if history_enabled() and st.button(
+            "🌙 夜間の一括生成に回す", help="python batch_generation.py run でまとめて生成し、履歴に保存します"
+        ):
+            if enqueue_experience(experience, user=session_user()):
+                st.success(f"✅ 夜間の一括生成に回しました（待ち: {len(list_queue())}件）")
+            else:
+                st.error("❌ 一括生成のキューに入れられませんでした")
 
     # 結果表示（新規生成 or 履歴選択）
     if "selected_history" in st.session_state:
         # 履歴が選択された場合
         st.divider()
         hist = st.session_state.selected_history
-        st.header(f"📝 履歴 #{st.session_state.selected_history_index}")
+        if st.session_state.selected_history_index is None:
+            # 似ている体験談から使い回した場合
+            st.header(f"♻️ 過去のシナリオ（類似度 {hist.get('similarity', 0):.0%}）")
+        else:
+            st.header(f"📝 履歴 #{st.session_state.selected_history_index}")
 
         # 履歴情報の表示
         prompt_ver = hist.get('prompt_version', '不明')
+        models = hist.get('models') or {}
+        models_str = " / ".join(f"{stage}: {model}" for stage, model in models.items()) or '不明'
         st.info(f"""
 **体験談**: {hist.get('experience', 'なし')}
 **日時**: {hist['timestamp'][:19]}
 **プロンプトバージョン**: v{prompt_ver}
+**モデル**: {models_str}
         """)
 
-        # シナリオ表示（改行処理を適用し、HTMLの<br>に変換）
-        formatted_result = enforce_line_breaks(hist['result'])
-        # Markdownで改行を表示するため、\nを<br>に変換
-        html_result = formatted_result.replace('\n', '<br>')
-        st.markdown(f'<div class="output-section">{html_result}</div>', unsafe_allow_html=True)
+        # 1ページ・1コマだけ作り直し、前のシナリオを版に残して保存する
+        def regenerate_history(part, page, panel, instruction):
+            regenerated = regenerate_page(api_key, hist['result'], part, page, panel, instruction)
+            if regenerated is None:
+                return
+            scenario, model = regenerated
+            models = {**(hist.get('models') or {}), "regenerate": model}
+            if update_history(record_id(hist), scenario, reason="regenerate", fields={"models": models}):
+                st.session_state.selected_history = {**hist, 'result': scenario, 'models': models}
+                # 編集欄に前のシナリオが残らないようにする
+                st.session_state.pop(f"edit_{hist.get('timestamp', '')}", None)
+                st.rerun()
+            else:
+                st.session_state.pop("regenerate_notice", None)
+                st.error("❌ 保存に失敗しました")
+
+        # シナリオ表示（改行処理を適用し、前編/後編・ページごとに表示）
+        render_regenerate_notice()
+        render_scenario(
+            hist['result'], key=f"view_{record_id(hist) or 'history'}",
+            on_regenerate=regenerate_history if api_key else None
+        )
 
         # 編集機能
         with st.expander("✏️ シナリオを編集", expanded=False):
@@ -853,11 +1017,10 @@ def main():
             col_edit1, col_edit2 = st.columns(2)
             with col_edit1:
                 if st.button("💾 保存", key=f"save_edit_{hist.get('timestamp', '')}"):
-                    if update_history(hist.get('timestamp', ''), edited_scenario):
+                    if update_history(record_id(hist), edited_scenario):
                         st.success("✅ シナリオを更新しました！")
-                        # 履歴を再読み込み
-                        hist['result'] = edited_scenario
-                        st.session_state.selected_history = hist
+                        # 履歴を再読み込み（共有キャッシュの値は書き換えずにコピーする）
+                        st.session_state.selected_history = {**hist, 'result': edited_scenario}
                         st.rerun()
                     else:
                         st.error("❌ 保存に失敗しました")
@@ -871,45 +1034,33 @@ def main():
         
         timestamp_str = hist['timestamp'][:19].replace(":", "").replace("-", "").replace(" ", "_")
 
-        # 完全な内容を作成
-        full_content = f"""# スカッと系ショート漫画シナリオ
-
-## 生成情報
-- 日時: {hist['timestamp'][:19]}
-- プロンプトバージョン: v{prompt_ver}
-
-## 体験談
-{hist.get('experience', 'なし')}
-
-## 生成されたシナリオ
-
-{hist['result']}
-"""
-
+        # ダウンロードの内容は押されたときにだけ作る（ダウンロードしても再実行しない）
         with col1:
             st.download_button(
                 label="📄 TXT",
-                data=full_content,
+                data=lambda: download_content(hist),
                 file_name=f"scenario_{timestamp_str}.txt",
                 mime="text/plain",
-                key="hist_txt_dl"
+                key="hist_txt_dl",
+                on_click="ignore"
             )
 
         with col2:
             st.download_button(
                 label="📋 MD",
-                data=full_content,
+                data=lambda: download_content(hist),
                 file_name=f"scenario_{timestamp_str}.md",
                 mime="text/markdown",
-                key="hist_md_dl"
+                key="hist_md_dl",
+                on_click="ignore"
             )
         
         with col3:
             # お気に入りボタン
-            timestamp = hist.get('timestamp', '')
-            is_fav = is_favorite(timestamp) if timestamp else False
-            if st.button("⭐ お気に入り" if is_fav else "☆ お気に入り", key=f"fav_detail_{timestamp}"):
-                toggle_favorite(timestamp)
+            key = record_id(hist)
+            is_fav = is_favorite(key) if key else False
+            if st.button("⭐ お気に入り" if is_fav else "☆ お気に入り", key=f"fav_detail_{key}"):
+                toggle_favorite(key)
                 st.rerun()
         
         with col4:
@@ -921,7 +1072,7 @@ def main():
                     st.rerun()
             with col_delete:
                 if st.button("🗑️ 削除", type="secondary"):
-                    if delete_history(hist.get('timestamp', '')):
+                    if delete_history(record_id(hist)):
                         st.success("✅ 履歴を削除しました")
                         del st.session_state.selected_history
                         del st.session_state.selected_history_index
@@ -935,9 +1086,34 @@ def main():
         st.divider()
         st.header("📝 生成されたシナリオ")
 
-        # 結果表示エリア（改行を<br>に変換して表示）
-        html_result = st.session_state.result.replace('\n', '<br>')
-        st.markdown(f'<div class="output-section">{html_result}</div>', unsafe_allow_html=True)
+        # アウトライン→並列展開のつなぎ合わせで見つかった問題
+        stitch_issues = st.session_state.get("stitch_issues") or []
+        if stitch_issues:
+            with st.expander(f"⚠️ 整合性チェック（{len(stitch_issues)}件）"):
+                for issue in stitch_issues:
+                    st.markdown(f"- {issue}")
+
+        def regenerate_result(part, page, panel, instruction):
+            regenerated = regenerate_page(api_key, st.session_state.result, part, page, panel, instruction)
+            if regenerated is None:
+                return
+            scenario, model = regenerated
+            st.session_state.result = scenario
+            st.session_state.pop("edit_new_scenario", None)
+            # 保存した履歴も、前のシナリオを版に残して更新する
+            result_id = st.session_state.get("result_id")
+            if result_id:
+                models = {**(st.session_state.get("result_models") or {}), "regenerate": model}
+                st.session_state.result_models = models
+                update_history(result_id, scenario, reason="regenerate", fields={"models": models})
+            st.rerun()
+
+        # 結果表示エリア（生成時に改行を整えてあるので、そのまま前編/後編・ページごとに表示）
+        render_regenerate_notice()
+        render_scenario(
+            st.session_state.result, key="view_new", normalize=False,
+            on_regenerate=regenerate_result if api_key else None
+        )
 
         # 編集機能
         with st.expander("✏️ シナリオを編集", expanded=False):
@@ -968,11 +1144,13 @@ def main():
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             filename = f"scenario_{timestamp}.txt"
 
+            result = st.session_state.result
             st.download_button(
                 label="📄 テキストでダウンロード",
-                data=st.session_state.result,
+                data=lambda: result,
                 file_name=filename,
-                mime="text/plain"
+                mime="text/plain",
+                on_click="ignore"
             )
 
         with col2:
@@ -981,9 +1159,10 @@ def main():
 
             st.download_button(
                 label="📋 Markdownでダウンロード",
-                data=st.session_state.result,
+                data=lambda: result,
                 file_name=md_filename,
-                mime="text/markdown"
+                mime="text/markdown",
+                on_click="ignore"
             )
         
         with col3:
@@ -993,10 +1172,88 @@ def main():
         with col4:
             if st.button("🔄 新しいシナリオを生成"):
                 del st.session_state.result
+                st.session_state.pop("stitch_issues", None)
+                st.session_state.pop("result_id", None)
+                st.session_state.pop("result_models", None)
                 if "experience" in st.session_state:
                     del st.session_state.experience
                 st.rerun()
 
+def session_user():
+    """予算のユーザーごとの上限に数えるユーザー（ログインしていればメールアドレス、なければ接続元のIPアドレス）"""
+    try:
+        if st.user.is_logged_in and st.user.email:
+            return st.user.email
+    except Exception:
+        pass
+    ip_address = st.context.ip_address
+    return ip_address if isinstance(ip_address, str) and ip_address else ANONYMOUS_USER
+
+def render_budget(status):
+    """予算ごとの使用額と、いまの抑え方を表示する"""
+    for cap in status["caps"]:
+        st.progress(
+            min(1.0, cap["spent_usd"] / cap["cap_usd"]),
+            text=f"{cap['label']}: ${cap['spent_usd']:.2f} / ${cap['cap_usd']:.2f}（残り {cap['remaining']:.0%}）",
+        )
+    level = status["level"]
+    if level == "normal":
+        st.caption("✅ 通常どおり生成します")
+    elif level == "exhausted":
+        st.error(f"🚫 {BUDGET_LEVEL_LABELS[level]}")
+    else:
+        st.warning(f"⚠️ 予算の残りが少ないため: {BUDGET_LEVEL_LABELS[level]}")
+
+def profile_mode():
+    """このセッションのプロファイルのモード（サイドバーで選んでいなければ環境変数）"""
+    return st.session_state.get("profile_mode", env_profile_mode())
+
+def render_profile(traces):
+    """直前の実行の処理ごとの時間と、時間のかかった関数を表示する"""
+    trace = traces[-1]
+    st.caption(f"直前の実行: {trace['total_ms']:.0f} ms（{trace['timestamp'][11:19]}）")
+    # st.dataframe は毎回の描画でpandasへの変換が走るのでMarkdownの表にする
+    rows = "\n".join(
+        f"| {row['name']} | {row['count']} | {row['total_ms']:.1f} | {row['self_ms']:.1f} |"
+        for row in trace["breakdown"]
+    )
+    st.markdown(f"| 処理 | 回数 | 合計ms | 自身ms |\n|---|---|---|---|\n{rows}")
+    if trace["top_functions"]:
+        rows = "\n".join(
+            f"| `{row['function']}` | {row['calls']} | {row['self_ms']:.1f} | {row['cumulative_ms']:.1f} |"
+            for row in trace["top_functions"]
+        )
+        st.markdown(f"| 関数 | 呼び出し | 自身ms | 累計ms |\n|---|---|---|---|\n{rows}")
+    st.caption("直近の実行: " + " / ".join(f"{t['total_ms']:.0f}" for t in traces) + " ms")
+    st.caption(f"トレース: {TRACE_LOG_PATH}")
+
+def run_profiled():
+    """画面の1回の実行を、プロファイルが有効ならプロファイルしながら動かす"""
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+    ctx = get_script_run_ctx()
+    trace = None
+    try:
+        with profile_run(profile_mode(), session=ctx.session_id if ctx else "") as trace:
+            main()
+    finally:
+        # st.rerun() などで抜けたときも残す
+        if trace is not None and "total_ms" in trace:
+            traces = st.session_state.setdefault("profile_traces", [])
+            # 個々のスパンはJSONLだけに残す
+            traces.append({key: value for key, value in trace.items() if key != "spans"})
+            del traces[:-PROFILE_HISTORY]
+
+def record_session_memory():
+    """このセッションが持っている値のメモリ使用量を記録する（🧠 メモリに表示）"""
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        return
+    history_cache.record_session(ctx.session_id, list(st.session_state.values()))
+
 if __name__ == "__main__":
-    main()
+    run_profiled()
+    record_session_memory()
 
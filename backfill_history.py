@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+過去の履歴を、いまのプロンプトで自動リライトし直すバックフィル
+
+PROMPT_VERSION や check_and_fix_scenario のリライトのプロンプトを改善しても、output/ の過去のシナリオは
+古いままになる。条件（プロンプトのバージョン・日付・お気に入り）で選んだ履歴に、自動リライト（rewrite）
+または改行の整形だけ（normalize）をかけ直す。
+
+- 同時に処理する件数（--workers）と、1分あたりに始める件数（--records-per-min）で抑える
+- 前のシナリオは履歴の revisions に残る（update_history）
+- 進み具合は保存先の backfill_<ジョブ名>.json に1件ごとに書くので、止まっても同じジョブ名で続きから再開できる
+  （終わった履歴は飛ばし、失敗した履歴はやり直す）
+- APIの利用料の予算（budget）を使い切ったらそこで止める
+- 最後に件数・スループット・トークン数・コストを表示する
+
+画面で編集した履歴（is_edited）は、--include-edited を付けない限り対象にしない。
+
+    python backfill_history.py --dry-run
+    python backfill_history.py --job prompt-3.0 --workers 2 --records-per-min 10
+    python backfill_history.py --stage normalize --since 2025-01-01 --favorites
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from budget import BudgetExceeded
+from history_store import get_backend, get_favorites, history_enabled, iter_history_records, record_id, update_history
+from model_router import choose_route, estimate_cost
+from scenario_pipeline import PROMPT_VERSION, REWRITE_MODE, REWRITE_MODES, RewriteFailed, check_and_fix_scenario
+from scenario_text import enforce_line_breaks
+from token_estimator import estimate_tokens, expected_output_tokens
+
+STAGES = ("rewrite", "normalize")
+JOB_PREFIX = "backfill_"
+
+# 状態が done / unchanged の履歴は、再開したときに飛ばす
+FINISHED_STATUSES = ("done", "unchanged")
+
+# ============================================================================
+# 対象の選択
+# ============================================================================
+
+def _version_key(version):
+    """"3.0" → (3, 0)（数字でないバージョンは一番古い扱い）"""
+    try:
+        return tuple(int(part) for part in str(version).split("."))
+    except ValueError:
+        return ()
+
+def select_records(prompt_versions=None, before_version=PROMPT_VERSION, since=None, until=None, favorites=False,
+                   include_edited=False, limit=None):
+    """
+    バックフィルする履歴を選ぶ（新しい順）
+
+    Args:
+        prompt_versions: このプロンプトのバージョンの履歴だけ（省略可）
+        before_version: このバージョンより古いプロンプトの履歴だけ（None なら問わない）
+        since / until: 生成日（"YYYY-MM-DD"、両端を含む）
+        favorites: お気に入りだけ
+        include_edited: 画面で編集した履歴も含める
+        limit: 最大件数
+    """
+    favorite_keys = set(get_favorites()) if favorites else None
+    selected = []
+    for record in iter_history_records():
+        version = record.get("prompt_version")
+        day = (record.get("timestamp") or "")[:10]
+        if prompt_versions and version not in prompt_versions:
+            continue
+        if before_version is not None and _version_key(version) >= _version_key(before_version):
+            continue
+        if (since and day < since) or (until and day > until):
+            continue
+        if favorite_keys is not None and record_id(record) not in favorite_keys:
+            continue
+        if record.get("is_edited") and not include_edited:
+            continue
+        if not record.get("result"):
+            continue
+        selected.append(record)
+        if limit and len(selected) >= limit:
+            break
+    return selected
+
+def estimate_backfill_cost(records, stage="rewrite", mode=None):
+    """リライトし直すときのコストの目安（USD）"""
+    if stage != "rewrite":
+        return 0.0
+    rewrite_stage = "rewrite_patch" if (mode or REWRITE_MODE) == "patch" else "rewrite"
+    total = 0.0
+    for record in records:
+        input_tokens = estimate_tokens(record["result"])
+        model = choose_route(rewrite_stage, input_tokens)["model"]
+        total += estimate_cost(model, input_tokens, expected_output_tokens(rewrite_stage, record["result"]))
+    return total
+
+# ============================================================================
+# ジョブの状態
+# ============================================================================
+
+class BackfillJob:
+    """バックフィルの進み具合（保存先の backfill_<ジョブ名>.json）"""
+
+    def __init__(self, name, settings, restart=False):
+        self.name = name
+        self.filename = f"{JOB_PREFIX}{name}.json"
+        self._lock = threading.Lock()
+        state = None if restart else self._load()
+        now = datetime.now().isoformat()
+        self.state = state or {"job": name, "created_at": now, "updated_at": now, "settings": settings, "records": {}}
+        self.resumed = state is not None
+
+    def _load(self):
+        if not history_enabled():
+            return None
+        try:
+            return get_backend().get(self.filename)
+        except (KeyError, OSError, ValueError):
+            return None
+
+    def finished(self, key):
+        return self.state["records"].get(key, {}).get("status") in FINISHED_STATUSES
+
+    def record(self, key, result):
+        """1件の結果を書き込む（書けなくても続ける）"""
+        with self._lock:
+            self.state["records"][key] = result
+            self.state["updated_at"] = datetime.now().isoformat()
+            if not history_enabled():
+                return
+            try:
+                get_backend().put(self.filename, self.state)
+            except Exception:
+                pass
+
+# ============================================================================
+# 実行
+# ============================================================================
+
+class RateLimiter:
+    """1分あたり per_minute 回まで、間隔をそろえて始める（0 なら制限しない）"""
+
+    def __init__(self, per_minute):
+        self._interval = 60.0 / per_minute if per_minute else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self, stop=None):
+        if not self._interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self._interval
+        if stop is not None:
+            stop.wait(max(0.0, slot - now))
+        else:
+            time.sleep(max(0.0, slot - now))
+
+def _meta_usage(meta):
+    """リライトの meta から {モデル}・トークン数・コストを取り出す"""
+    models, input_tokens, output_tokens, cost = {}, 0, 0, 0.0
+    for stage, stage_meta in meta.items():
+        if not isinstance(stage_meta, dict) or "model" not in stage_meta:
+            continue
+        models[stage] = stage_meta["model"]
+        input_tokens += stage_meta.get("input_tokens", 0)
+        output_tokens += stage_meta.get("output_tokens", 0)
+        cost += estimate_cost(stage_meta["model"], stage_meta.get("input_tokens", 0), stage_meta.get("output_tokens", 0))
+    return models, input_tokens, output_tokens, cost
+
+def backfill_record(api_key, record, stage="rewrite", mode=None):
+    """
+    1件をリライト（または改行の整形）し直して保存する
+
+    Returns:
+        {"status": "done" / "unchanged" / "failed", "error", "input_tokens", "output_tokens", "cost_usd", "sec"}
+    """
+    start = time.monotonic()
+    old = record["result"]
+    meta = {}
+    result = {"status": "failed", "error": "", "input_tokens": 0, "output_tokens": 0, "cost_usd": 0.0}
+    try:
+        if stage == "rewrite":
+            new = enforce_line_breaks(check_and_fix_scenario(api_key, old, meta=meta, mode=mode, fallback=False))
+        else:
+            new = enforce_line_breaks(old)
+        models, result["input_tokens"], result["output_tokens"], result["cost_usd"] = _meta_usage(meta)
+        if new == old:
+            result["status"] = "unchanged"
+        else:
+            fields = {
+                "prompt_version": PROMPT_VERSION,
+                "models": {**(record.get("models") or {}), **models},
+                "backfilled_at": datetime.now().isoformat(),
+            }
+            if update_history(record_id(record), new, reason=f"backfill:{stage}", fields=fields):
+                result["status"] = "done"
+            else:
+                result["error"] = "履歴を保存できませんでした"
+    except RewriteFailed as e:
+        # 失敗するまでに使った分も数える
+        _, result["input_tokens"], result["output_tokens"], result["cost_usd"] = _meta_usage(meta)
+        result["error"] = str(e)
+        if isinstance(e.__cause__, BudgetExceeded):
+            raise e.__cause__
+    result["sec"] = round(time.monotonic() - start, 2)
+    return result
+
+def run_backfill(api_key, records, job, stage="rewrite", mode=None, workers=2, records_per_min=0, on_result=None):
+    """
+    選んだ履歴をバックフィルする（ジョブで終わっている履歴は飛ばす）
+
+    Args:
+        on_result: 1件終わるごとに on_result(履歴, 結果) を呼ぶ（省略可）
+
+    Returns:
+        集計（format_summary で表示する）
+    """
+    todo = [record for record in records if not job.finished(record_id(record))]
+    limiter = RateLimiter(records_per_min)
+    stop = threading.Event()
+    stopped = {"reason": ""}
+
+    def process(record):
+        limiter.wait(stop)
+        if stop.is_set():
+            return
+        key = record_id(record)
+        try:
+            result = backfill_record(api_key, record, stage, mode)
+        except BudgetExceeded as e:
+            # 予算が戻ってから再開できるよう、この履歴は失敗として残して止める
+            stopped["reason"] = str(e)
+            stop.set()
+            result = {"status": "failed", "error": str(e), "input_tokens": 0, "output_tokens": 0,
+                      "cost_usd": 0.0, "sec": 0.0}
+        job.record(key, result)
+        if on_result is not None:
+            on_result(record, result)
+
+    start = time.monotonic()
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        list(executor.map(process, todo))
+    except KeyboardInterrupt:
+        stopped["reason"] = "中断されました（同じジョブ名で続きから再開できます）"
+        stop.set()
+        raise
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        elapsed = time.monotonic() - start
+
+    results = [job.state["records"][record_id(record)] for record in todo if record_id(record) in job.state["records"]]
+    counts = {status: sum(1 for r in results if r["status"] == status) for status in ("done", "unchanged", "failed")}
+    return {
+        "job": job.name,
+        "stage": stage,
+        "selected": len(records),
+        "skipped": len(records) - len(todo),
+        "processed": len(results),
+        **counts,
+        "wall_sec": round(elapsed, 2),
+        "records_per_min": round(len(results) / elapsed * 60, 2) if elapsed > 0 else 0.0,
+        "input_tokens": sum(r["input_tokens"] for r in results),
+        "output_tokens": sum(r["output_tokens"] for r in results),
+        "cost_usd": round(sum(r["cost_usd"] for r in results), 4),
+        "stopped": stopped["reason"],
+    }
+
+def format_summary(summary):
+    lines = [
+        f"ジョブ: {summary['job']}（{summary['stage']}）",
+        f"  対象: {summary['selected']}件（前回までに終わった {summary['skipped']}件は飛ばした）",
+        f"  更新: {summary['done']}件 / 変更なし: {summary['unchanged']}件 / 失敗: {summary['failed']}件",
+        f"  時間: {summary['wall_sec']:.1f}秒（{summary['records_per_min']:.1f}件/分）",
+        f"  トークン: 入力 {summary['input_tokens']:,} / 出力 {summary['output_tokens']:,}",
+        f"  コスト: ${summary['cost_usd']:.4f}",
+    ]
+    if summary["stopped"]:
+        lines.append(f"  ⚠️ 途中で止めました: {summary['stopped']}")
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="過去の履歴をいまのプロンプトでリライトし直す")
+    parser.add_argument("--stage", choices=STAGES, default="rewrite", help="rewrite: 自動リライト / normalize: 改行の整形だけ")
+    parser.add_argument("--rewrite-mode", choices=REWRITE_MODES, default=REWRITE_MODE)
+    parser.add_argument("--prompt-version", nargs="+", help="このプロンプトのバージョンの履歴だけ")
+    parser.add_argument("--all-versions", action="store_true",
+                        help=f"いまのプロンプト（v{PROMPT_VERSION}）で生成した履歴も対象にする")
+    parser.add_argument("--since", help="この日以降に生成した履歴（YYYY-MM-DD）")
+    parser.add_argument("--until", help="この日までに生成した履歴（YYYY-MM-DD）")
+    parser.add_argument("--favorites", action="store_true", help="お気に入りだけ")
+    parser.add_argument("--include-edited", action="store_true", help="画面で編集した履歴も対象にする")
+    parser.add_argument("--limit", type=int, help="最大件数")
+    parser.add_argument("--workers", type=int, default=2, help="同時に処理する件数")
+    parser.add_argument("--records-per-min", type=float, default=10, help="1分あたりに始める件数（0 なら制限しない）")
+    parser.add_argument("--job", default=None, help="ジョブ名（同じ名前で再開する。省略時は日付）")
+    parser.add_argument("--restart", action="store_true", help="前回の進み具合を使わずに最初からやり直す")
+    parser.add_argument("--dry-run", action="store_true", help="対象の件数とコストの目安だけ表示する")
+    parser.add_argument("--output", help="集計をJSONで保存するパス")
+    args = parser.parse_args(argv)
+
+    if not history_enabled():
+        print("この環境では履歴を保存していません")
+        return 1
+
+    records = select_records(
+        prompt_versions=args.prompt_version,
+        before_version=None if args.all_versions or args.prompt_version else PROMPT_VERSION,
+        since=args.since, until=args.until, favorites=args.favorites,
+        include_edited=args.include_edited, limit=args.limit,
+    )
+    if args.dry_run:
+        print(f"対象: {len(records)}件")
+        print(f"コストの目安: ${estimate_backfill_cost(records, args.stage, args.rewrite_mode):.4f}")
+        return 0
+
+    api_key = os.getenv("ANTHROPIC_API_KEY", "")
+    if args.stage == "rewrite" and not api_key:
+        print("rewrite には ANTHROPIC_API_KEY が必要です")
+        return 1
+
+    settings = {key: value for key, value in vars(args).items() if key not in ("job", "restart", "dry_run", "output")}
+    job = BackfillJob(args.job or datetime.now().strftime("%Y%m%d"), settings, restart=args.restart)
+    if job.resumed:
+        print(f"ジョブ {job.name} の続きから再開します")
+
+    def report(record, result):
+        mark = {"done": "✓ 更新", "unchanged": "- 変更なし", "failed": "✗ 失敗"}[result["status"]]
+        print(f"{record_id(record)}: {mark} {result['error']}".rstrip())
+
+    summary = run_backfill(
+        api_key, records, job, args.stage, args.rewrite_mode, args.workers, args.records_per_min, on_result=report
+    )
+    print("\n" + format_summary(summary))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+    return 1 if summary["failed"] or summary["stopped"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+夜間の一括生成（Message Batches）
+
+夜のうちに仕上がればよい体験談は、1件ずつ接続を張ったまま待たずに Message Batches API
+（非同期・料金は通常の半額）にまとめて投げる。1つのジョブは次のように進む:
+
+    drafting   初稿（draft）のバッチを投げて、終わるまで待つ
+    rewriting  届いた初稿から自動リライト（rewrite_patch / rewrite）のバッチを続けて投げて、終わるまで待つ
+    completed  差し替えを初稿に適用し、改行を整えて履歴に保存した
+
+- 自動リライトに失敗した体験談（形式の崩れた差し替え・エラー）は、初稿をそのまま保存する
+- 初稿に失敗した体験談は保存せず、ジョブに理由を残す
+- APIの利用料の予算（budget）を使い切っていれば投げず、残りが少なければ自動リライトを省く
+- ジョブの状態は保存先の bulk_<ID>.json に残すので、poll はいつでも（別のマシンからでも）続きから進められる
+
+体験談は画面の「🌙 夜間の一括生成に回す」で保存先の bulk_queue.json に貯まり、submit / run で取り出す。
+ANTHROPIC_BASE_URL を設定すると、そのURLのAPI（手元の検証用サーバーなど）に投げる。
+
+    python batch_generation.py submit                     # 貯まった体験談を投げる
+    python batch_generation.py submit --file orders.txt   # 「---」だけの行で区切った体験談を投げる
+    python batch_generation.py poll                       # 途中のジョブを1回ずつ進める
+    python batch_generation.py run --poll-interval 300    # 投げて、終わるまで待つ（cron 向け）
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from budget import BudgetExceeded, budget_remaining, check_budget, record_usage, should_skip_rewrite
+from history_store import flush_history, get_backend, history_enabled, save_history
+from model_router import choose_route
+from scenario_pipeline import (
+    REWRITE_MODE,
+    REWRITE_MODES,
+    build_draft_prompt,
+    build_rewrite_prompt,
+    get_client,
+    parse_patch_response,
+)
+from scenario_text import apply_panel_edits, enforce_line_breaks, panel_keys
+from token_estimator import (
+    adaptive_max_tokens,
+    estimate_tokens,
+    estimate_tokens_raw,
+    expected_output_tokens,
+    expected_output_tokens_raw,
+    log_usage,
+)
+
+JOB_PREFIX = "bulk_"
+QUEUE_FILENAME = "bulk_queue.json"
+
+# Message Batches の料金（通常の料金に対する割合）
+BATCH_PRICE_FACTOR = 0.5
+# 結果を確かめる間隔（秒）。バッチはほとんどが1時間以内に終わる
+DEFAULT_POLL_INTERVAL = 60.0
+
+STAGE_TEMPERATURES = {"draft": 0.7, "rewrite": 0.5, "rewrite_patch": 0.5}
+JOB_STATUS_LABELS = {"drafting": "初稿の待ち", "rewriting": "自動リライトの待ち", "completed": "完了"}
+
+_memory_lock = threading.Lock()
+_memory = {}  # ID -> ジョブ（保存先がないとき）
+
+# ============================================================================
+# 体験談のキュー
+# ============================================================================
+
+def enqueue_experience(experience, user=None):
+    """
+    体験談を夜間の一括生成に回す
+
+    Returns:
+        キューに入れたか（保存先がない環境では False）
+    """
+    if not history_enabled() or not experience.strip():
+        return False
+    try:
+        backend = get_backend()
+        with backend.lock("bulk_queue"):
+            queue = _read_queue(backend)
+            queue.append({"experience": experience, "user": user, "queued_at": datetime.now().isoformat()})
+            backend.put(QUEUE_FILENAME, queue)
+        return True
+    except Exception:
+        return False
+
+def _read_queue(backend):
+    try:
+        queue = backend.get(QUEUE_FILENAME)
+    except (KeyError, ValueError):
+        return []
+    return queue if isinstance(queue, list) else []
+
+def list_queue():
+    """キューに貯まっている体験談"""
+    if not history_enabled():
+        return []
+    try:
+        return _read_queue(get_backend())
+    except Exception:
+        return []
+
+def take_queue():
+    """キューの体験談をすべて取り出す（取り出した分はキューから消える）"""
+    if not history_enabled():
+        return []
+    backend = get_backend()
+    with backend.lock("bulk_queue"):
+        queue = _read_queue(backend)
+        if queue:
+            backend.put(QUEUE_FILENAME, [])
+    return queue
+
+def return_to_queue(entries):
+    """take_queue() で取り出した体験談をキューの先頭に戻す（取り出した後に入った分はその後ろ）"""
+    if not entries:
+        return
+    backend = get_backend()
+    with backend.lock("bulk_queue"):
+        backend.put(QUEUE_FILENAME, list(entries) + _read_queue(backend))
+
+# ============================================================================
+# ジョブの状態
+# ============================================================================
+
+def _filename(job_id):
+    return f"{JOB_PREFIX}{job_id}.json"
+
+def save_job(job):
+    """ジョブの状態を保存する（保存先に書けなくてもプロセス内には残す）"""
+    job["updated_at"] = datetime.now().isoformat()
+    with _memory_lock:
+        _memory[job["id"]] = job
+    if not history_enabled():
+        return
+    try:
+        get_backend().put(_filename(job["id"]), job)
+    except Exception:
+        pass
+
+def load_job(job_id):
+    with _memory_lock:
+        if job_id in _memory:
+            return _memory[job_id]
+    if not history_enabled():
+        return None
+    try:
+        return get_backend().get(_filename(job_id))
+    except (KeyError, OSError, ValueError):
+        return None
+
+def list_jobs(unfinished_only=False):
+    """ジョブ（新しい順）"""
+    jobs = {}
+    if history_enabled():
+        try:
+            backend = get_backend()
+            for name in backend.names(JOB_PREFIX):
+                try:
+                    job = backend.get(name)
+                except (KeyError, ValueError):
+                    continue
+                jobs[job["id"]] = job
+        except Exception:
+            pass
+    with _memory_lock:
+        jobs.update(_memory)
+    selected = [job for job in jobs.values() if not unfinished_only or job["status"] != "completed"]
+    return sorted(selected, key=lambda job: job["created_at"], reverse=True)
+
+# ============================================================================
+# バッチの組み立て
+# ============================================================================
+
+def _request(custom_id, stage, prompt, source_text, remaining):
+    """
+    バッチの1件分のリクエストと、使用量の記録に使う見積もり
+
+    モデルと max_tokens は同期の生成（create_message）と同じルールで決める。
+    """
+    route = choose_route(stage, estimate_tokens(prompt), budget_remaining=remaining)
+    model = route["model"]
+    max_tokens = adaptive_max_tokens(expected_output_tokens(stage, source_text), model)
+    request = {
+        "custom_id": custom_id,
+        "params": {
+            "model": model,
+            "max_tokens": max_tokens,
+            "temperature": STAGE_TEMPERATURES[stage],
+            "messages": [{"role": "user", "content": prompt}],
+        },
+    }
+    plan = {
+        "stage": stage,
+        "model": model,
+        "route": route["name"],
+        "max_tokens": max_tokens,
+        "estimated_input_raw": estimate_tokens_raw(prompt),
+        "estimated_output_raw": expected_output_tokens_raw(stage, source_text),
+    }
+    return request, plan
+
+def _submit(client, job, kind, requests):
+    batch = client.messages.batches.create(requests=requests)
+    job["batches"][kind] = batch.id
+    job["submitted_at"][kind] = datetime.now().isoformat()
+
+def submit_job(client, experiences, rewrite_mode=None, master_prompt=None):
+    """
+    体験談をまとめて初稿のバッチに投げ、ジョブを作る
+
+    Args:
+        client: Anthropicクライアント
+        experiences: 体験談の文字列、または {"experience", "user"} のリスト
+        rewrite_mode: "patch" / "full"（省略時は REWRITE_MODE）
+        master_prompt: 省略時は prompts/master_prompt.md
+
+    Raises:
+        BudgetExceeded: 予算を使い切っている場合（バッチは投げない）
+    """
+    remaining = budget_remaining()
+    check_budget(remaining)
+
+    now = datetime.now()
+    job = {
+        "id": f"{now.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}",
+        "created_at": now.isoformat(),
+        "updated_at": now.isoformat(),
+        "status": "drafting",
+        "rewrite_mode": rewrite_mode or REWRITE_MODE,
+        "batches": {"draft": None, "rewrite": None},
+        "submitted_at": {"draft": None, "rewrite": None},
+        "items": {},
+    }
+    requests = []
+    for i, entry in enumerate(experiences, 1):
+        if isinstance(entry, str):
+            entry = {"experience": entry}
+        custom_id = f"item-{i:04d}"
+        request, plan = _request(
+            custom_id, "draft", build_draft_prompt(entry["experience"], master_prompt), entry["experience"], remaining
+        )
+        requests.append(request)
+        job["items"][custom_id] = {
+            "experience": entry["experience"],
+            "user": entry.get("user"),
+            "status": "drafting",
+            "plans": {"draft": plan},
+            "models": {},
+            "draft": None,
+            "error": "",
+            "history": None,
+        }
+    if not requests:
+        raise ValueError("体験談がありません")
+
+    _submit(client, job, "draft", requests)
+    save_job(job)
+    return job
+
+# ============================================================================
+# 結果の取り込み
+# ============================================================================
+
+def _ingest(item, stage, result):
+    """
+    バッチの1件の結果を使用量に数え、テキストを返す
+
+    Returns:
+        (テキスト, stop_reason)。失敗した場合は (None, 理由)
+    """
+    if result.type != "succeeded":
+        error = getattr(getattr(result, "error", None), "error", None)
+        message = getattr(error, "message", "") if error is not None else ""
+        return None, f"{result.type}: {message}".rstrip(": ")
+
+    message = result.message
+    plan = item["plans"][stage]
+    record_usage(plan["model"], message.usage, user=item.get("user"), price_factor=BATCH_PRICE_FACTOR)
+    log_usage(
+        plan["stage"], plan["model"], plan["estimated_input_raw"], plan["estimated_output_raw"],
+        plan["max_tokens"], message.usage, message.stop_reason,
+    )
+    item["models"][plan["stage"]] = plan["model"]
+    text = "".join(getattr(block, "text", "") for block in message.content)
+    return text, message.stop_reason
+
+def _finish(item, scenario, error=""):
+    """改行を整えて履歴に保存する"""
+    item["history"] = save_history(item["experience"], enforce_line_breaks(scenario), models=item["models"])
+    item["status"] = "completed"
+    if error:
+        item["error"] = error
+
+def _ingest_drafts(client, job):
+    received = set()
+    for entry in client.messages.batches.results(job["batches"]["draft"]):
+        item = job["items"].get(entry.custom_id)
+        # 前回の取り込みで数えた分は、使用量に数え直さない
+        if item is None or item["status"] != "drafting":
+            continue
+        received.add(entry.custom_id)
+        text, reason = _ingest(item, "draft", entry.result)
+        if text:
+            # 打ち切られた初稿も、後の自動リライトに任せて進める
+            item["draft"] = text
+            item["status"] = "drafted"
+        else:
+            item["status"] = "failed"
+            item["error"] = f"初稿の生成に失敗しました（{reason}）"
+    for custom_id, item in job["items"].items():
+        if custom_id not in received and item["status"] == "drafting":
+            item["status"] = "failed"
+            item["error"] = "初稿の結果が返ってきませんでした"
+
+def _submit_rewrites(client, job):
+    """初稿が届いた体験談を、自動リライトのバッチに続けて投げる"""
+    drafted = {custom_id: item for custom_id, item in job["items"].items() if item["status"] == "drafted"}
+    if drafted and should_skip_rewrite():
+        for item in drafted.values():
+            _finish(item, item["draft"], "予算の残りが少ないため自動リライトを省略しました")
+        drafted = {}
+    if not drafted:
+        job["status"] = "completed"
+        return
+
+    remaining = budget_remaining()
+    requests = []
+    for custom_id, item in drafted.items():
+        # コマに分割できない初稿は差し替えられないので全文リライト
+        stage = "rewrite_patch" if job["rewrite_mode"] == "patch" and panel_keys(item["draft"]) else "rewrite"
+        request, plan = _request(custom_id, stage, build_rewrite_prompt(stage, item["draft"]), item["draft"], remaining)
+        requests.append(request)
+        item["plans"]["rewrite"] = plan
+    # 投げられなかったときは drafted のまま残し、次の poll で投げ直す
+    _submit(client, job, "rewrite", requests)
+    for item in drafted.values():
+        item["status"] = "rewriting"
+    job["status"] = "rewriting"
+
+def _apply_rewrite(item, text, stop_reason):
+    """リライトの結果を初稿に適用する（使えなければ ValueError / KeyError）"""
+    if item["plans"]["rewrite"]["stage"] == "rewrite":
+        return text
+    if stop_reason == "max_tokens":
+        raise ValueError("差し替えが途中で打ち切られました")
+    return apply_panel_edits(item["draft"], parse_patch_response(text))
+
+def _ingest_rewrites(client, job):
+    for entry in client.messages.batches.results(job["batches"]["rewrite"]):
+        item = job["items"].get(entry.custom_id)
+        if item is None or item["status"] != "rewriting":
+            continue
+        text, reason = _ingest(item, "rewrite", entry.result)
+        if not text:
+            _finish(item, item["draft"], f"自動リライトに失敗したため初稿を保存しました（{reason}）")
+            continue
+        try:
+            _finish(item, _apply_rewrite(item, text, reason))
+        except (ValueError, KeyError) as e:
+            _finish(item, item["draft"], f"自動リライトに失敗したため初稿を保存しました（{e}）")
+    for item in job["items"].values():
+        if item["status"] == "rewriting":
+            _finish(item, item["draft"], "自動リライトの結果が返ってきませんでした。初稿を保存しました")
+    job["status"] = "completed"
+
+def advance_job(client, job):
+    """
+    ジョブを1段階進める（待っているバッチが終わっていなければ何もしない）
+
+    Returns:
+        ジョブ（job["status"] が "completed" なら終わり）
+    """
+    if job["status"] == "completed":
+        return job
+    kind = "draft" if job["status"] == "drafting" else "rewrite"
+    batch = client.messages.batches.retrieve(job["batches"][kind])
+    if batch.processing_status != "ended":
+        return job
+
+    if kind == "draft":
+        _ingest_drafts(client, job)
+        # リライトのバッチを投げられなくても、取り込んだ初稿と使用量は残しておく
+        save_job(job)
+        _submit_rewrites(client, job)
+    else:
+        _ingest_rewrites(client, job)
+    save_job(job)
+    return job
+
+def run_job(client, job, poll_interval=DEFAULT_POLL_INTERVAL, timeout=None, sleep=time.sleep, on_progress=None):
+    """
+    ジョブが終わるまで poll_interval 秒ごとに進める
+
+    Args:
+        timeout: 待つ上限（秒、省略時は終わるまで）。過ぎたら途中のまま返す（後の poll で続きから進められる）
+        on_progress: 状態が変わるたびに on_progress(ジョブ) を呼ぶ（省略可）
+    """
+    start = time.monotonic()
+    while True:
+        status = job["status"]
+        job = advance_job(client, job)
+        if on_progress is not None and job["status"] != status:
+            on_progress(job)
+        if job["status"] == "completed":
+            return job
+        if timeout is not None and time.monotonic() - start >= timeout:
+            return job
+        sleep(poll_interval)
+
+def job_summary(job):
+    """{"completed", "failed", "fallback", "waiting"} の件数"""
+    items = list(job["items"].values())
+    return {
+        "completed": sum(1 for item in items if item["status"] == "completed" and not item["error"]),
+        "fallback": sum(1 for item in items if item["status"] == "completed" and item["error"]),
+        "failed": sum(1 for item in items if item["status"] == "failed"),
+        "waiting": sum(1 for item in items if item["status"] not in ("completed", "failed")),
+    }
+
+def format_job(job):
+    summary = job_summary(job)
+    lines = [
+        f"ジョブ {job['id']}: {JOB_STATUS_LABELS[job['status']]}（{len(job['items'])}件）",
+        f"  保存: {summary['completed']}件 / 初稿のまま保存: {summary['fallback']}件 / "
+        f"失敗: {summary['failed']}件 / 待ち: {summary['waiting']}件",
+    ]
+    for custom_id, item in job["items"].items():
+        if item["error"]:
+            lines.append(f"  {custom_id}: {item['error']}")
+    return "\n".join(lines)
+
+# ============================================================================
+# コマンドライン
+# ============================================================================
+
+def read_experiences(path):
+    """「---」だけの行で区切った体験談を読み込む"""
+    with open(path, "r", encoding="utf-8") as f:
+        blocks, current = [], []
+        for line in f:
+            if line.strip() == "---":
+                blocks.append("".join(current))
+                current = []
+            else:
+                current.append(line)
+        blocks.append("".join(current))
+    return [block.strip() for block in blocks if block.strip()]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="体験談を Message Batches でまとめて生成する")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, text in (("submit", "体験談をバッチに投げる"), ("run", "投げて、終わるまで待つ")):
+        sub = subparsers.add_parser(name, help=text)
+        sub.add_argument("--file", help="「---」だけの行で区切った体験談のファイル（省略時はキューから取り出す）")
+        sub.add_argument("--rewrite-mode", choices=REWRITE_MODES, default=REWRITE_MODE)
+    poll = subparsers.add_parser("poll", help="途中のジョブを進める")
+    poll.add_argument("--job", help="ジョブID（省略時は途中のジョブすべて）")
+    poll.add_argument("--wait", action="store_true", help="終わるまで待つ")
+    for sub in (subparsers.choices["run"], poll):
+        sub.add_argument("--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL, help="結果を確かめる間隔（秒）")
+        sub.add_argument("--timeout", type=float, help="待つ上限（秒）")
+    args = parser.parse_args(argv)
+
+    api_key = os.getenv("ANTHROPIC_API_KEY", "")
+    if not api_key:
+        print("ANTHROPIC_API_KEY が必要です")
+        return 1
+    if not history_enabled():
+        print("この環境では履歴を保存していないため、一括生成の結果を残せません")
+        return 1
+    client = get_client(api_key)
+
+    if args.command in ("submit", "run"):
+        experiences = read_experiences(args.file) if args.file else take_queue()
+        if not experiences:
+            print("生成する体験談がありません")
+            return 0
+        try:
+            job = submit_job(client, experiences, args.rewrite_mode)
+        except BaseException as e:
+            # 投げられなかった体験談はキューに戻して、予算やAPIが戻ってから投げる
+            if not args.file:
+                return_to_queue(experiences)
+            if not isinstance(e, BudgetExceeded):
+                raise
+            print(e)
+            return 1
+        print(f"ジョブ {job['id']} を投げました（{len(job['items'])}件）")
+        jobs = [job] if args.command == "run" else []
+        wait = args.command == "run"
+    else:
+        if args.job:
+            job = load_job(args.job)
+            if job is None:
+                print(f"ジョブ {args.job} が見つかりません")
+                return 1
+            jobs = [job]
+        else:
+            jobs = list_jobs(unfinished_only=True)
+        wait = args.wait
+        if not jobs:
+            print("途中のジョブはありません")
+            return 0
+
+    failed = False
+    for job in jobs:
+        if wait:
+            job = run_job(client, job, args.poll_interval, args.timeout, on_progress=lambda j: print(format_job(j)))
+        else:
+            job = advance_job(client, job)
+            print(format_job(job))
+        failed = failed or job_summary(job)["failed"] > 0
+    # 後回しにした履歴の書き込みを待ってから終わる
+    flush_history()
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
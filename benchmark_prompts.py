@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+プロンプトのバージョンごとのベンチマーク
+
+決まった体験談のコーパス（benchmarks/experiences.json）を、プロンプトのバージョンごとに
+初稿生成 → 自動リライトのパイプラインに通し、次の値を比べる。
+
+- 入力トークン数（プロンプト）・出力トークン数・コスト
+- レイテンシ（APIの応答時間の合計）
+- リライトが必要だった割合（リライトで内容が変わった割合）
+- 形式違反の割合（初稿・最終結果それぞれ）
+
+実際のAPIは呼ばない。APIの代わりに次のどれかを使う。
+
+- synthetic: 決まった形のシナリオを返す模擬API。プロンプトの長さによるトークン数・
+  レイテンシ・コストの差だけを測る（品質の指標は常に同じになる）
+- replay: record で録音した応答を再生する（同じプロンプト・同じ体験談なら何度でも再現できる）
+- record: 実際のAPIを呼んで応答を録音する（ANTHROPIC_API_KEY が必要）
+
+    python benchmark_prompts.py
+    python benchmark_prompts.py --mode record --recording benchmarks/recording.jsonl
+    python benchmark_prompts.py --mode replay --recording benchmarks/recording.jsonl --output report.json
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+import unicodedata
+from contextlib import contextmanager
+from types import SimpleNamespace
+from unittest import mock
+
+import scenario_pipeline
+from model_router import estimate_cost
+from scenario_pipeline import PARTS, check_and_fix_scenario, generate_scenario
+from scenario_text import PAGES_PER_PART, enforce_line_breaks, format_violations
+from token_estimator import estimate_tokens_raw
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PROMPT_FILES = {
+    "v1": "prompt_v1.md",
+    "v2": "prompt_v2.md",
+    "v3": "prompt_v3.md",
+    "master": os.path.join("prompts", "master_prompt.md"),
+}
+DEFAULT_CORPUS = os.path.join(BASE_DIR, "benchmarks", "experiences.json")
+
+# 模擬APIの応答時間のモデル（初回トークンまでの時間 + 入力・出力の処理時間）
+SYNTHETIC_FIRST_TOKEN_SEC = 0.8
+SYNTHETIC_INPUT_TOKENS_PER_SEC = 20000.0
+SYNTHETIC_OUTPUT_TOKENS_PER_SEC = 60.0
+
+# パイプラインに渡すAPIキー（模擬APIなので使われない）
+_BENCHMARK_API_KEY = "benchmark"
+
+# ============================================================================
+# 模擬API・録音・再生
+# ============================================================================
+
+def load_prompt(version):
+    """バージョンのプロンプトを読み込む"""
+    with open(os.path.join(BASE_DIR, PROMPT_FILES[version]), "r", encoding="utf-8") as f:
+        return f.read()
+
+def load_corpus(path=DEFAULT_CORPUS):
+    """体験談のコーパスを読み込む（[{"id": ..., "experience": ...}, ...]）"""
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def request_key(messages, temperature):
+    """録音・再生に使うリクエストのキー（モデルの選び方が変わっても同じキーになる）"""
+    payload = json.dumps({"messages": messages, "temperature": temperature}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _message(text, input_tokens, output_tokens, stop_reason="end_turn"):
+    """anthropic の Message と同じ属性を持つオブジェクト"""
+    return SimpleNamespace(
+        content=[SimpleNamespace(text=text)],
+        usage=SimpleNamespace(input_tokens=input_tokens, output_tokens=output_tokens),
+        stop_reason=stop_reason,
+    )
+
+def synthetic_scenario(experience):
+    """体験談の文から、形式どおりのシナリオを組み立てる"""
+    sentences = [s for s in experience.replace("\n", "").split("。") if s.strip()] or ["体験談"]
+    lines = ["【体験談の分析】", f"・核となる感情：{sentences[0][:30]}", "", "【シナリオプロット】", ""]
+    index = 0
+    for part in PARTS:
+        if part == "後編":
+            lines += ["━" * 37, "■後編", "━" * 37, ""]
+        else:
+            lines += ["■前編", ""]
+        for page in range(1, PAGES_PER_PART + 1):
+            lines.append(f"【P{page}】")
+            for panel in range(1, 4):
+                sentence = sentences[index % len(sentences)][:40]
+                index += 1
+                lines += [f"{panel}コマ目", "※カメラ：引き", f"※{sentence}", f"A子「{sentence[:20]}」", ""]
+    return "\n".join(lines).rstrip()
+
+def _draft_from_rewrite_prompt(prompt):
+    """リライトのプロンプトから元のシナリオを取り出す"""
+    start = prompt.index("【元のシナリオ】") + len("【元のシナリオ】")
+    end = prompt.index("【ステップ1", start)
+    return prompt[start:end].strip()
+
+def _experience_from_draft_prompt(prompt):
+    """初稿生成のプロンプトから体験談を取り出す"""
+    body = prompt.rsplit("## オーダー", 1)[-1]
+    return body.split("上記の体験談を", 1)[0].strip()
+
+class SyntheticClient:
+    """
+    APIの代わりに決まった形のシナリオを返す模擬クライアント
+
+    初稿には形式どおりのシナリオ、リライトには「変更なし」を返す。
+    トークン数は token_estimator の推定値、レイテンシは応答時間のモデルから計算する（待たない）。
+    """
+
+    def __init__(self):
+        self.messages = self
+        self.calls = []
+
+    def create(self, model, max_tokens, temperature, messages):
+        prompt = messages[0]["content"]
+        if "【元のシナリオ】" in prompt:
+            text = '{"edits": []}' if '{"edits"' in prompt else _draft_from_rewrite_prompt(prompt)
+        else:
+            text = synthetic_scenario(_experience_from_draft_prompt(prompt))
+
+        input_tokens = estimate_tokens_raw("".join(m["content"] for m in messages))
+        output_tokens = min(estimate_tokens_raw(text), max_tokens)
+        latency = (
+            SYNTHETIC_FIRST_TOKEN_SEC
+            + input_tokens / SYNTHETIC_INPUT_TOKENS_PER_SEC
+            + output_tokens / SYNTHETIC_OUTPUT_TOKENS_PER_SEC
+        )
+        self.calls.append({
+            "model": model, "input_tokens": input_tokens, "output_tokens": output_tokens, "latency_sec": latency,
+        })
+        return _message(text, input_tokens, output_tokens)
+
+class RecordingClient:
+    """実際のAPIを呼び、応答とレイテンシを録音する"""
+
+    def __init__(self, client, path):
+        self.messages = self
+        self.calls = []
+        self._client = client
+        self._path = path
+
+    def create(self, model, max_tokens, temperature, messages):
+        start = time.perf_counter()
+        message = self._client.messages.create(
+            model=model, max_tokens=max_tokens, temperature=temperature, messages=messages
+        )
+        latency = time.perf_counter() - start
+        entry = {
+            "key": request_key(messages, temperature),
+            "model": model,
+            "text": message.content[0].text,
+            "input_tokens": message.usage.input_tokens,
+            "output_tokens": message.usage.output_tokens,
+            "stop_reason": message.stop_reason,
+            "latency_sec": latency,
+        }
+        with open(self._path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.calls.append({
+            "model": model, "input_tokens": entry["input_tokens"],
+            "output_tokens": entry["output_tokens"], "latency_sec": latency,
+        })
+        return message
+
+class MissingRecordingError(RuntimeError):
+    """録音にないリクエスト"""
+
+class ReplayClient:
+    """RecordingClient で録音した応答を再生する"""
+
+    def __init__(self, path):
+        self.messages = self
+        self.calls = []
+        self._recording = {}
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._recording[entry["key"]] = entry
+
+    def create(self, model, max_tokens, temperature, messages):
+        entry = self._recording.get(request_key(messages, temperature))
+        if entry is None:
+            raise MissingRecordingError("録音にないリクエストです（プロンプトか体験談が録音時と違います）")
+        self.calls.append({
+            "model": entry.get("model", model), "input_tokens": entry["input_tokens"],
+            "output_tokens": entry["output_tokens"], "latency_sec": entry["latency_sec"],
+        })
+        return _message(entry["text"], entry["input_tokens"], entry["output_tokens"], entry["stop_reason"])
+
+@contextmanager
+def use_client(client):
+    """パイプラインのAPI呼び出しを client に向ける（使用量のログ・推定の補正・予算には記録しない）"""
+    with mock.patch.object(scenario_pipeline, "get_client", lambda api_key: client), \
+            mock.patch.object(scenario_pipeline, "log_usage", lambda *args, **kwargs: None), \
+            mock.patch.object(scenario_pipeline, "record_usage", lambda *args, **kwargs: 0.0), \
+            mock.patch.object(scenario_pipeline, "budget_remaining", lambda: None):
+        yield client
+
+# ============================================================================
+# 計測
+# ============================================================================
+
+def run_experience(client, experience, master_prompt, rewrite_mode):
+    """1件の体験談をパイプラインに通して計測する"""
+    client.calls.clear()
+    meta = {}
+    start = time.perf_counter()
+    draft = generate_scenario(_BENCHMARK_API_KEY, experience, meta=meta, master_prompt=master_prompt)
+    failed = draft.startswith("エラーが発生しました")
+    final = draft if failed else check_and_fix_scenario(_BENCHMARK_API_KEY, draft, meta=meta, mode=rewrite_mode)
+    wall_sec = time.perf_counter() - start
+
+    calls = list(client.calls)
+    normalized_draft = enforce_line_breaks(draft)
+    normalized_final = enforce_line_breaks(final)
+    return {
+        "failed": failed,
+        "calls": len(calls),
+        "input_tokens": sum(call["input_tokens"] for call in calls),
+        "output_tokens": sum(call["output_tokens"] for call in calls),
+        "latency_sec": sum(call["latency_sec"] for call in calls),
+        "wall_sec": wall_sec,
+        "cost_usd": sum(estimate_cost(call["model"], call["input_tokens"], call["output_tokens"]) for call in calls),
+        "rewrite_needed": not failed and normalized_final != normalized_draft,
+        "rewrite_error": meta.get("rewrite_error"),
+        "draft_violations": [] if failed else format_violations(draft),
+        "final_violations": [] if failed else format_violations(normalized_final),
+    }
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def summarize(version, master_prompt, rows):
+    """体験談ごとの計測結果をバージョンの集計にまとめる"""
+    ok = [row for row in rows if not row["failed"]]
+    count = len(ok) or 1
+    return {
+        "version": version,
+        "experiences": len(rows),
+        "errors": len(rows) - len(ok),
+        "prompt_tokens": estimate_tokens_raw(master_prompt),
+        "input_tokens_mean": sum(row["input_tokens"] for row in ok) / count,
+        "output_tokens_mean": sum(row["output_tokens"] for row in ok) / count,
+        "latency_p50_sec": _percentile([row["latency_sec"] for row in ok], 0.5),
+        "latency_p95_sec": _percentile([row["latency_sec"] for row in ok], 0.95),
+        "cost_usd_mean": sum(row["cost_usd"] for row in ok) / count,
+        "rewrite_needed_rate": sum(row["rewrite_needed"] for row in ok) / count,
+        "format_violation_rate": sum(bool(row["draft_violations"]) for row in ok) / count,
+        "final_violation_rate": sum(bool(row["final_violations"]) for row in ok) / count,
+        "violations": sorted({v for row in ok for v in row["draft_violations"]}),
+    }
+
+def run_benchmark(client, versions=None, corpus=None, rewrite_mode="patch"):
+    """
+    プロンプトのバージョンごとにコーパス全体を計測する
+
+    Args:
+        client: SyntheticClient / ReplayClient / RecordingClient
+        versions: 計測するバージョン（省略時はすべて）
+        corpus: 体験談のリスト（省略時は benchmarks/experiences.json）
+        rewrite_mode: 自動リライトの方式（"patch" / "full"）
+
+    Returns:
+        バージョンごとの集計のリスト
+    """
+    versions = versions or list(PROMPT_FILES)
+    corpus = corpus if corpus is not None else load_corpus()
+    reports = []
+    with use_client(client):
+        for version in versions:
+            master_prompt = load_prompt(version)
+            rows = [run_experience(client, item["experience"], master_prompt, rewrite_mode) for item in corpus]
+            reports.append(summarize(version, master_prompt, rows))
+    return reports
+
+def _display_width(text):
+    """全角文字を2桁として数えた表示幅"""
+    return sum(2 if unicodedata.east_asian_width(char) in ("F", "W") else 1 for char in text)
+
+def format_report(reports):
+    """集計を表にする"""
+    columns = [
+        ("version", "バージョン", "{}"),
+        ("prompt_tokens", "プロンプト", "{:,}"),
+        ("input_tokens_mean", "入力/件", "{:,.0f}"),
+        ("output_tokens_mean", "出力/件", "{:,.0f}"),
+        ("latency_p50_sec", "p50秒", "{:.1f}"),
+        ("latency_p95_sec", "p95秒", "{:.1f}"),
+        ("cost_usd_mean", "USD/件", "{:.4f}"),
+        ("rewrite_needed_rate", "要リライト", "{:.0%}"),
+        ("format_violation_rate", "形式違反", "{:.0%}"),
+        ("final_violation_rate", "最終違反", "{:.0%}"),
+        ("errors", "エラー", "{}"),
+    ]
+    rows = [[label for _, label, _ in columns]]
+    rows += [[fmt.format(report[key]) for key, _, fmt in columns] for report in reports]
+    widths = [max(_display_width(row[i]) for row in rows) for i in range(len(columns))]
+    return "\n".join(
+        "  ".join(" " * (width - _display_width(cell)) + cell for cell, width in zip(row, widths))
+        for row in rows
+    )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="プロンプトのバージョンごとのベンチマーク")
+    parser.add_argument("--versions", nargs="+", choices=list(PROMPT_FILES), default=list(PROMPT_FILES))
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS, help="体験談のコーパス（JSON）")
+    parser.add_argument("--mode", choices=("synthetic", "replay", "record"), default="synthetic")
+    parser.add_argument("--recording", default=os.path.join(BASE_DIR, "benchmarks", "recording.jsonl"))
+    parser.add_argument("--rewrite-mode", choices=scenario_pipeline.REWRITE_MODES, default="patch")
+    parser.add_argument("--output", help="集計をJSONで保存するパス")
+    args = parser.parse_args(argv)
+
+    if args.mode == "synthetic":
+        client = SyntheticClient()
+    elif args.mode == "replay":
+        client = ReplayClient(args.recording)
+    else:
+        api_key = os.getenv("ANTHROPIC_API_KEY")
+        if not api_key:
+            print("record には ANTHROPIC_API_KEY が必要です")
+            return 1
+        import anthropic
+
+        client = RecordingClient(anthropic.Anthropic(api_key=api_key), args.recording)
+
+    reports = run_benchmark(client, args.versions, load_corpus(args.corpus), args.rewrite_mode)
+    print(format_report(reports))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
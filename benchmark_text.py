@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+シナリオテキストの整形・文字数カウントの規模のベンチマーク（ファジングつき）
+
+enforce_line_breaks や count_characters はモデルの出力をそのまま受け取る。max_tokens で打ち切られて
+同じセリフが延々と続く出力や、空白だけの長い行のような壊れた出力でも、入力の長さに比例する時間・
+メモリで終わることを確かめる。
+
+1KB〜10MB の入力を種類ごとに作って各関数に通し、次の値を測る。
+
+- 時間（repeat 回の最小）と、隣り合う大きさの間の時間の伸び（指数。1 なら線形、2 なら二乗）
+- tracemalloc で測ったメモリのピークの、入力のバイト数に対する倍率
+
+指数が MAX_EXPONENT を超えるか、メモリの倍率が MAX_MEMORY_RATIO を超えると失敗にする。
+
+    python benchmark_text.py
+    python benchmark_text.py --sizes 1000 100000 --kinds runaway whitespace --targets enforce_line_breaks
+    python benchmark_text.py --output report.json
+"""
+
+import argparse
+import json
+import math
+import random
+import sys
+import time
+import tracemalloc
+
+from scenario_text import (
+    LineBreakNormalizer,
+    count_characters,
+    enforce_line_breaks,
+    format_violations,
+    scenario_char_stats,
+    split_parts,
+)
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000, 10_000_000]
+
+# 線形とみなす時間の伸びの上限（計測のぶれを見込む）
+MAX_EXPONENT = 1.3
+# メモリのピークの上限（入力のバイト数に対する倍率。行ごとの str オブジェクトなどで数倍にはなる）
+MAX_MEMORY_RATIO = 40.0
+# この時間より短い計測は伸びの判定に使わない（固定の手間が大半を占めるため）
+MIN_TIMED_SEC = 0.002
+
+# ストリーミングで1回に受け取る文字数（APIのテキストの断片くらい）
+STREAM_CHUNK = 64
+
+_SCENARIO_UNIT = """【P1】
+1コマ目
+※カメラ：引き
+※状況：リビング。義母がソファに座っている
+A子「今日は何のご用ですか？」
+義母（また嫌味を言われる…）
+
+**2コマ目**
+※カメラ：アップ　B男「母さん、連絡してから来てって言ったよね」A子（よく言った！）
+
+"""
+
+# 入力の種類: 名前 -> (説明, 繰り返す単位 または None（fuzz）)
+INPUT_KINDS = {
+    "scenario": ("形式どおりのシナリオの繰り返し", _SCENARIO_UNIT),
+    "runaway": ("改行なしで同じセリフが続く（max_tokens で打ち切られた暴走）", "A子「ごめんなさい」"),
+    "no_breaks": ("※・セリフ・心の声が改行なしで混ざった1行", "※カメラ：寄り　義母「あら」母（まさか）B男「え」"),
+    "whitespace": ("空白だけの長い行のあとに数字（コマ番号の見出しの判定を狙う）", None),
+    "names": ("末尾が重なるキャラ名の連続（否定の後読みを狙う）", "義母母母義父父「"),
+    "blank_lines": ("空行の連続", "\n"),
+    "fuzz": ("記号・見出し・キャラ名のランダムな並び（seed で再現）", None),
+}
+
+_FUZZ_TOKENS = [
+    "※", "「", "」", "（", "）", "■前編", "■後編", "【P", "】", "コマ目", "**", "━━━",
+    "A子", "B男", "義母", "母", "探偵", "看護師", "\n", "\n\n\n", " ", "　", "\t", "1", "23",
+    "あ", "いう", "カメラ：", "…", "！？", "〜",
+]
+
+TARGETS = {
+    "enforce_line_breaks": enforce_line_breaks,
+    "count_characters": count_characters,
+    "stream": None,  # LineBreakNormalizer に STREAM_CHUNK 文字ずつ渡す
+    "scenario_char_stats": scenario_char_stats,
+    "format_violations": format_violations,
+    "split_parts": split_parts,
+}
+
+# ============================================================================
+# 入力
+# ============================================================================
+
+def make_input(kind, size, seed=0):
+    """種類 kind の、UTF-8 でおよそ size バイトの入力を作る"""
+    _, unit = INPUT_KINDS[kind]
+    if kind == "whitespace":
+        half = size // 2
+        return " " * half + "\t" * (size - half - 8) + "12345678"
+    if kind == "fuzz":
+        rng = random.Random(seed)
+        parts, total = [], 0
+        while total < size:
+            token = rng.choice(_FUZZ_TOKENS)
+            parts.append(token)
+            total += len(token.encode("utf-8"))
+        return "".join(parts)
+    count = max(1, size // len(unit.encode("utf-8")))
+    return unit * count
+
+def _stream(text):
+    normalizer = LineBreakNormalizer()
+    out = []
+    for start in range(0, len(text), STREAM_CHUNK):
+        out.append(normalizer.feed(text[start:start + STREAM_CHUNK]))
+    out.append(normalizer.flush())
+    return "".join(out)
+
+def _target(name):
+    return _stream if name == "stream" else TARGETS[name]
+
+# ============================================================================
+# 計測
+# ============================================================================
+
+def measure(func, text, repeat=3):
+    """
+    1つの関数を1つの入力で測る
+
+    Returns:
+        {"sec": 最小の時間, "peak_bytes": メモリのピーク}
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(text)
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func(text)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"sec": min(timings), "peak_bytes": peak}
+
+def growth_exponent(size_a, sec_a, size_b, sec_b):
+    """大きさが size_a → size_b になったときの時間の伸び（sec ∝ size^指数）"""
+    if sec_a < MIN_TIMED_SEC or sec_b <= 0:
+        return None
+    return math.log(sec_b / sec_a) / math.log(size_b / size_a)
+
+def run_benchmark(sizes=None, kinds=None, targets=None, repeat=3, seed=0, on_row=None):
+    """
+    入力の種類 × 関数 × 大きさで測る
+
+    Args:
+        on_row: 1つ測るごとに on_row(行) を呼ぶ（省略可）
+
+    Returns:
+        {"rows": [{"kind", "target", "size", "sec", "mb_per_sec", "peak_bytes", "memory_ratio", "exponent"}],
+         "violations": [説明, ...]}
+    """
+    sizes = sorted(sizes or DEFAULT_SIZES)
+    rows, violations = [], []
+    for kind in kinds or INPUT_KINDS:
+        inputs = {size: make_input(kind, size, seed) for size in sizes}
+        for name in targets or TARGETS:
+            func = _target(name)
+            previous = None
+            for size in sizes:
+                text = inputs[size]
+                input_bytes = len(text.encode("utf-8"))
+                result = measure(func, text, repeat)
+                row = {
+                    "kind": kind,
+                    "target": name,
+                    "size": input_bytes,
+                    "sec": round(result["sec"], 6),
+                    "mb_per_sec": round(input_bytes / 1e6 / result["sec"], 2) if result["sec"] > 0 else None,
+                    "peak_bytes": result["peak_bytes"],
+                    "memory_ratio": round(result["peak_bytes"] / input_bytes, 2),
+                    "exponent": None,
+                }
+                if previous is not None:
+                    exponent = growth_exponent(previous["size"], previous["sec"], input_bytes, result["sec"])
+                    row["exponent"] = round(exponent, 2) if exponent is not None else None
+                if row["exponent"] is not None and row["exponent"] > MAX_EXPONENT:
+                    violations.append(
+                        f"{name}（{kind}）: {previous['size']:,} → {input_bytes:,} バイトで時間が "
+                        f"{row['exponent']} 乗で伸びています"
+                    )
+                if row["memory_ratio"] > MAX_MEMORY_RATIO:
+                    violations.append(
+                        f"{name}（{kind}）: {input_bytes:,} バイトの入力でメモリのピークが {row['memory_ratio']} 倍です"
+                    )
+                rows.append(row)
+                previous = row
+                if on_row is not None:
+                    on_row(row)
+    return {"rows": rows, "violations": violations}
+
+def format_row(row):
+    exponent = "" if row["exponent"] is None else f"  指数 {row['exponent']:.2f}"
+    return (
+        f"{row['target']:<20} {row['kind']:<12} {row['size']:>11,} B  {row['sec'] * 1000:>10.2f} ms  "
+        f"メモリ {row['memory_ratio']:>5.1f} 倍{exponent}"
+    )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="シナリオテキストの処理が入力の長さに比例して終わるかを測る")
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES, help="入力の大きさ（バイト）")
+    parser.add_argument("--kinds", nargs="+", choices=list(INPUT_KINDS), help="入力の種類（省略時はすべて）")
+    parser.add_argument("--targets", nargs="+", choices=list(TARGETS), help="測る関数（省略時はすべて）")
+    parser.add_argument("--repeat", type=int, default=3, help="時間を測る回数（最小を使う）")
+    parser.add_argument("--seed", type=int, default=0, help="fuzz の入力の seed")
+    parser.add_argument("--output", help="結果をJSONで保存するパス")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.sizes, args.kinds, args.targets, args.repeat, args.seed,
+                           on_row=lambda row: print(format_row(row), flush=True))
+    if report["violations"]:
+        print("\n⚠️ 入力の長さに比例しない処理があります:")
+        for violation in report["violations"]:
+            print(f"  {violation}")
+    else:
+        print(f"\n✅ すべて線形（指数 {MAX_EXPONENT} 以下・メモリ {MAX_MEMORY_RATIO:.0f} 倍以下）でした")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 1 if report["violations"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
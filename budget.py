@@ -0,0 +1,279 @@
+"""
+APIの利用料の予算（日・月・ユーザーごとの上限）
+
+すべてのセッションが同じ ANTHROPIC_API_KEY を使うので、API呼び出しごとの message.usage から
+料金（config/model_routes.json の料金表）を計算し、履歴と同じ保存先の usage_ledger.json に
+日ごと・ユーザーごとに積み上げる（複数のプロセスからでも、保存先のロックの中で読み直して足す）。
+
+上限は config/budget.json（環境変数 SCENARIO_BUDGET_CONFIG で変更可）で決める。
+上限がひとつも決まっていなければ何もしない。予算の残り（上限に対する割合。複数あれば一番少ないもの）に応じて
+段階的に抑える:
+
+    残りが skip_rewrite_below 以下     → 自動リライト（任意のステージ）を飛ばす
+    残りが model_routes.json の max_budget_remaining 以下 → 安いモデルにルーティングする
+    使い切った                         → 新しいAPI呼び出しを断る（BudgetExceeded）
+                                         途中までの生成はチェックポイントに残り、予算が戻れば再開できる
+
+ユーザーは use_user で囲んだ処理の中のAPI呼び出しに付く（生成スレッドにも引き継がれる）。
+"""
+
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from model_router import choose_route, estimate_cost
+
+BUDGET_PATH = os.getenv(
+    "SCENARIO_BUDGET_CONFIG",
+    os.path.join(os.path.dirname(__file__), "config", "budget.json"),
+)
+LEDGER_FILENAME = "usage_ledger.json"
+
+# 自動リライトを飛ばし始める予算の残り（設定ファイルにないとき）
+DEFAULT_SKIP_REWRITE_BELOW = 0.25
+# 台帳に残す日数（月の上限の計算に足りる分）
+LEDGER_KEEP_DAYS = 62
+# 画面の表示に使う台帳を読み直す間隔（API呼び出しの前は毎回読み直す）
+LEDGER_REFRESH_SEC = 5.0
+
+ANONYMOUS_USER = "anonymous"
+
+BUDGET_LEVEL_LABELS = {
+    "normal": "通常",
+    "skip_rewrite": "自動リライトを省略",
+    "cheaper_model": "自動リライトを省略・安いモデル",
+    "exhausted": "上限に達したため停止",
+}
+
+_lock = threading.Lock()
+_config_cache = {"mtime": None, "config": None}
+_ledger_cache = {"loaded_at": 0.0, "ledger": None}
+# 保存先に書けないとき（Streamlit Cloud のローカル保存など）はプロセス内だけで数える
+_memory_ledger = {"days": {}}
+
+_user = contextvars.ContextVar("budget_user", default=ANONYMOUS_USER)
+
+
+class BudgetExceeded(Exception):
+    """予算の上限に達したので、APIを呼ばずに断った"""
+
+
+# ============================================================================
+# 設定
+# ============================================================================
+
+def load_budget_config():
+    """予算の設定を読み込む（更新されていればプロセス内で読み直す）"""
+    try:
+        mtime = os.path.getmtime(BUDGET_PATH)
+    except OSError:
+        return {}
+
+    with _lock:
+        if _config_cache["mtime"] != mtime:
+            try:
+                with open(BUDGET_PATH, "r", encoding="utf-8") as f:
+                    _config_cache["config"] = json.load(f)
+            except (OSError, ValueError):
+                # 編集途中の壊れた設定は無視して、前回の設定を使い続ける
+                if _config_cache["config"] is None:
+                    _config_cache["config"] = {}
+            _config_cache["mtime"] = mtime
+        return _config_cache["config"]
+
+def _caps(config):
+    """{"daily_usd", "monthly_usd", "per_user_daily_usd"} のうち、決まっている上限"""
+    caps = {}
+    for key in ("daily_usd", "monthly_usd", "per_user_daily_usd"):
+        value = config.get(key)
+        if isinstance(value, (int, float)) and value > 0:
+            caps[key] = float(value)
+    return caps
+
+def budget_enabled():
+    """上限がひとつでも決まっているか"""
+    return bool(_caps(load_budget_config()))
+
+# ============================================================================
+# ユーザー
+# ============================================================================
+
+@contextmanager
+def use_user(user):
+    """この中のAPI呼び出しを user の利用に数える"""
+    token = _user.set(user or ANONYMOUS_USER)
+    try:
+        yield
+    finally:
+        _user.reset(token)
+
+def current_user():
+    return _user.get()
+
+# ============================================================================
+# 台帳
+# ============================================================================
+
+def _backend():
+    """履歴の保存先（保存できない環境では None）"""
+    # history_store は scenario_pipeline を読み込むので、ここで読み込む
+    from history_store import get_backend, history_enabled
+
+    return get_backend() if history_enabled() else None
+
+def _prune(ledger, today):
+    oldest = datetime.fromordinal(today.toordinal() - LEDGER_KEEP_DAYS).strftime("%Y-%m-%d")
+    for day in [day for day in ledger["days"] if day < oldest]:
+        del ledger["days"][day]
+
+def _read_ledger(backend):
+    try:
+        ledger = backend.get(LEDGER_FILENAME)
+    except (KeyError, ValueError):
+        return {"days": {}}
+    return ledger if isinstance(ledger, dict) and isinstance(ledger.get("days"), dict) else {"days": {}}
+
+def load_ledger(fresh=False):
+    """
+    日ごとの利用の台帳
+
+    Returns:
+        {"days": {"YYYY-MM-DD": {"cost_usd", "input_tokens", "output_tokens", "calls", "users": {ユーザー: USD}}}}
+    """
+    now = time.monotonic()
+    with _lock:
+        if not fresh and _ledger_cache["ledger"] is not None and now - _ledger_cache["loaded_at"] < LEDGER_REFRESH_SEC:
+            return _ledger_cache["ledger"]
+    ledger = _memory_ledger
+    try:
+        backend = _backend()
+        if backend is not None:
+            ledger = _read_ledger(backend)
+    except Exception:
+        pass
+    with _lock:
+        _ledger_cache.update(loaded_at=now, ledger=ledger)
+    return ledger
+
+def _add(ledger, day, user, cost, input_tokens, output_tokens):
+    entry = ledger["days"].setdefault(
+        day, {"cost_usd": 0.0, "input_tokens": 0, "output_tokens": 0, "calls": 0, "users": {}}
+    )
+    entry["cost_usd"] += cost
+    entry["input_tokens"] += input_tokens
+    entry["output_tokens"] += output_tokens
+    entry["calls"] += 1
+    entry["users"][user] = entry["users"].get(user, 0.0) + cost
+
+def record_usage(model, usage, user=None, now=None, price_factor=1.0):
+    """
+    API呼び出し1回分の利用を台帳に足す
+
+    Args:
+        price_factor: 料金表に掛ける割合（Message Batches の割引など）
+
+    Returns:
+        この呼び出しの料金（USD）
+    """
+    input_tokens = getattr(usage, "input_tokens", 0) or 0
+    output_tokens = getattr(usage, "output_tokens", 0) or 0
+    cost = estimate_cost(model, input_tokens, output_tokens) * price_factor
+    now = now or datetime.now()
+    day = now.strftime("%Y-%m-%d")
+    user = user or current_user()
+
+    ledger = None
+    try:
+        backend = _backend()
+        if backend is not None:
+            # 別のプロセスが同時に足しても消えないよう、ロックの中で読み直す
+            with backend.lock("usage_ledger"):
+                ledger = _read_ledger(backend)
+                _add(ledger, day, user, cost, input_tokens, output_tokens)
+                _prune(ledger, now)
+                backend.put(LEDGER_FILENAME, ledger)
+    except Exception:
+        ledger = None
+    if ledger is None:
+        with _lock:
+            _add(_memory_ledger, day, user, cost, input_tokens, output_tokens)
+            _prune(_memory_ledger, now)
+        ledger = _memory_ledger
+    with _lock:
+        _ledger_cache.update(loaded_at=time.monotonic(), ledger=ledger)
+    return cost
+
+# ============================================================================
+# 予算の残り
+# ============================================================================
+
+def _cheaper_model_active(remaining):
+    """予算の残りのせいで、初稿が安いモデルにルーティングされるか"""
+    return choose_route("draft", 0, budget_remaining=remaining)["model"] != choose_route("draft", 0)["model"]
+
+def budget_status(user=None, fresh=False, now=None):
+    """
+    予算の使用状況
+
+    Returns:
+        {"enabled", "remaining"（0〜1、上限がなければ None）, "level"（BUDGET_LEVEL_LABELS のキー）,
+         "caps": [{"name", "label", "spent_usd", "cap_usd", "remaining"}]}
+    """
+    config = load_budget_config()
+    caps = _caps(config)
+    if not caps:
+        return {"enabled": False, "remaining": None, "level": "normal", "caps": []}
+
+    now = now or datetime.now()
+    today = now.strftime("%Y-%m-%d")
+    month = now.strftime("%Y-%m")
+    user = user or current_user()
+    days = load_ledger(fresh=fresh)["days"]
+    spent = {
+        "daily_usd": days.get(today, {}).get("cost_usd", 0.0),
+        "monthly_usd": sum(entry.get("cost_usd", 0.0) for day, entry in days.items() if day.startswith(month)),
+        "per_user_daily_usd": days.get(today, {}).get("users", {}).get(user, 0.0),
+    }
+    labels = {"daily_usd": "今日", "monthly_usd": "今月", "per_user_daily_usd": "今日（このユーザー）"}
+
+    rows = [
+        {
+            "name": name,
+            "label": labels[name],
+            "spent_usd": round(spent[name], 4),
+            "cap_usd": cap,
+            "remaining": max(0.0, 1 - spent[name] / cap),
+        }
+        for name, cap in caps.items()
+    ]
+    remaining = min(row["remaining"] for row in rows)
+    if remaining <= 0:
+        level = "exhausted"
+    elif _cheaper_model_active(remaining):
+        level = "cheaper_model"
+    elif remaining <= config.get("skip_rewrite_below", DEFAULT_SKIP_REWRITE_BELOW):
+        level = "skip_rewrite"
+    else:
+        level = "normal"
+    return {"enabled": True, "remaining": remaining, "level": level, "caps": rows}
+
+def budget_remaining():
+    """
+    ルーティングに使う予算の残り（0〜1、上限がなければ None）
+
+    API呼び出しの直前に呼ぶので、台帳は読み直す
+    """
+    return budget_status(fresh=True)["remaining"]
+
+def check_budget(remaining):
+    """予算を使い切っていれば BudgetExceeded を投げる"""
+    if remaining is not None and remaining <= 0:
+        raise BudgetExceeded("APIの利用料の上限に達しました。上限が戻ってから（翌日・翌月・設定の変更後）再開してください")
+
+def should_skip_rewrite():
+    """予算の残りが少ないので、自動リライトを飛ばすか"""
+    return budget_status(fresh=True)["level"] in ("skip_rewrite", "cheaper_model", "exhausted")
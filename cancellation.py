@@ -0,0 +1,138 @@
+"""
+生成のキャンセル
+
+生成中に「⏹️ 生成をキャンセル」を押したとき・入力を変えたとき・ブラウザを閉じたときに、
+実行中のAPI呼び出し（ストリーミング）の接続を切り、残りのステージ（リライト）を飛ばす。
+キャンセルで使わずに済んだ出力トークン数と秒数の目安をプロセス全体で集計する。
+
+使い方:
+    token = CancelToken()
+    # 別スレッドから
+    token.cancel("キャンセル")
+    # API呼び出し側
+    token.check()  # キャンセルされていれば GenerationCancelled
+"""
+
+import threading
+
+# 出力の速さが測れなかったときに使う目安（トークン/秒）
+DEFAULT_OUTPUT_TOKENS_PER_SEC = 60.0
+
+_lock = threading.Lock()
+_stats = {"cancellations": 0, "saved_output_tokens": 0, "saved_sec": 0.0, "reasons": {}}
+
+
+class GenerationCancelled(BaseException):
+    """
+    生成がキャンセルされた
+
+    パイプラインの except Exception（エラー時は初稿を返す、など）で握りつぶされないよう
+    Streamlit の StopException と同じく BaseException を継承する
+    """
+
+
+class CancelToken:
+    """
+    1回の生成のキャンセル状態（スレッドをまたいで共有する）
+
+    parent を渡すと、生成の一部（前編のリライトなど）だけを止められるトークンになる。
+    親がキャンセルされたら一緒にキャンセルし、そのときに使わずに済んだ分は親にも加える
+    （やり直しなどで子だけを止めた分は、キャンセルで節約した分ではないので加えない）。
+    一部の処理が終わったら detach() で親から外す。
+    """
+
+    def __init__(self, parent=None):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._parent = parent
+        self._cancelled_by_parent = False
+        self._forget_parent = None
+        self.reason = ""
+        self.saved_output_tokens = 0
+        self.saved_sec = 0.0
+        if parent is not None:
+            self._forget_parent = parent.on_cancel(self._follow_parent)
+
+    def _follow_parent(self):
+        with self._lock:
+            if not self._event.is_set():
+                self._cancelled_by_parent = True
+        self.cancel(self._parent.reason)
+
+    def detach(self):
+        """親から外す（親がキャンセルされても、もう呼ばれない）"""
+        forget, self._forget_parent = self._forget_parent, None
+        if forget is not None:
+            forget()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason="キャンセル"):
+        """キャンセルする（2回目以降は何もしない）"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def on_cancel(self, callback):
+        """
+        キャンセルされたら callback() を呼ぶ（ストリームを閉じるなど）
+
+        Returns:
+            登録を取り消す関数
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._remove(callback)
+        callback()
+        return lambda: None
+
+    def _remove(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def check(self):
+        """キャンセルされていれば GenerationCancelled を投げる"""
+        if self._event.is_set():
+            raise GenerationCancelled(self.reason)
+
+    def add_savings(self, output_tokens, seconds):
+        """キャンセルで使わずに済んだ出力トークン数・秒数を加える"""
+        with self._lock:
+            self.saved_output_tokens += int(output_tokens)
+            self.saved_sec += seconds
+            propagate = self._parent is not None and self._cancelled_by_parent
+        if propagate:
+            self._parent.add_savings(output_tokens, seconds)
+
+
+def record_cancellation(token):
+    """キャンセルされた生成を集計に加える"""
+    with _lock:
+        _stats["cancellations"] += 1
+        _stats["saved_output_tokens"] += token.saved_output_tokens
+        _stats["saved_sec"] += token.saved_sec
+        _stats["reasons"][token.reason] = _stats["reasons"].get(token.reason, 0) + 1
+
+
+def get_cancellation_stats():
+    """
+    キャンセルの集計
+
+    Returns:
+        {"cancellations", "saved_output_tokens", "saved_sec", "reasons": {理由: 件数}}
+    """
+    with _lock:
+        return {**_stats, "saved_sec": round(_stats["saved_sec"], 1), "reasons": dict(_stats["reasons"])}
@@ -0,0 +1,321 @@
+"""
+生成パイプラインのチェックポイント
+
+ステージ（体験談の要約 → 初稿 → 自動リライト → 改行の整形）が終わるたびに、
+そのステージの出力と状態を checkpoint_<ID>.json として履歴と同じ保存先に書き込む。
+途中のステージで失敗・キャンセルしても、終わったステージはやり直さずに続きから再開できる。
+完成して履歴に保存したチェックポイントは消す。
+予算（budget）の残りが少ないときは自動リライトを飛ばす。予算を使い切って断られたステージは
+失敗として残るので、予算が戻ってから続きを再開できる。
+
+ステージの状態:
+    pending（まだ）/ running（実行中）/ done（完了）/ skipped（飛ばした）/ failed（失敗）/ cancelled（キャンセル）
+"""
+
+import threading
+import time
+from datetime import datetime
+
+from budget import should_skip_rewrite
+from cancellation import GenerationCancelled
+from history_store import get_backend, history_enabled, new_record_id
+from metrics import add_gauge, inc, observe
+from scenario_pipeline import (
+    RewriteFailed,
+    check_and_fix_scenario,
+    condense_experience,
+    generate_and_fix_pipelined,
+    generate_scenario,
+    generate_scenario_outlined,
+    record_skipped_stage,
+)
+from scenario_text import enforce_line_breaks
+
+STAGES = ("condense", "draft", "rewrite", "normalize")
+STAGE_LABELS = {
+    "condense": "体験談の要約",
+    "draft": "初稿",
+    "rewrite": "自動リライト",
+    "normalize": "改行の整形",
+}
+CHECKPOINT_PREFIX = "checkpoint_"
+
+# この秒数より前から "running" のままのチェックポイントは、プロセスが落ちたものとして再開できるようにする
+STALE_RUNNING_SEC = 600
+
+# 保存先に書けないとき（Streamlit Cloud のローカル保存など）もプロセス内には残す
+_memory_lock = threading.Lock()
+_memory = {}  # ID -> チェックポイント
+
+def _filename(checkpoint_id):
+    return f"{CHECKPOINT_PREFIX}{checkpoint_id}.json"
+
+def new_checkpoint(experience, settings):
+    """
+    新しいチェックポイントを作る（まだ保存しない）
+
+    Args:
+        experience: 体験談
+        settings: {"generation_mode", "rewrite_mode", "condense", "pipelined"}
+    """
+    now = datetime.now().isoformat()
+    return {
+        "id": new_record_id(),
+        "created_at": now,
+        "updated_at": now,
+        "status": "running",
+        "experience": experience,
+        "settings": dict(settings),
+        "stitch_issues": [],
+        "stages": {
+            stage: {"status": "pending", "output": None, "error": "", "models": {}}
+            for stage in STAGES
+        },
+    }
+
+def save_checkpoint(checkpoint):
+    """チェックポイントを保存する（保存先に書けなくてもプロセス内には残る）"""
+    checkpoint["updated_at"] = datetime.now().isoformat()
+    with _memory_lock:
+        _memory[checkpoint["id"]] = checkpoint
+    if not history_enabled():
+        return
+    try:
+        get_backend().put(_filename(checkpoint["id"]), checkpoint)
+    except Exception:
+        pass
+
+def load_checkpoint(checkpoint_id):
+    """チェックポイントを読み込む（なければ None）"""
+    with _memory_lock:
+        if checkpoint_id in _memory:
+            return _memory[checkpoint_id]
+    if not history_enabled():
+        return None
+    try:
+        return get_backend().get(_filename(checkpoint_id))
+    except Exception:
+        return None
+
+def delete_checkpoint(checkpoint_id):
+    """チェックポイントを消す"""
+    with _memory_lock:
+        _memory.pop(checkpoint_id, None)
+    if not history_enabled():
+        return
+    try:
+        get_backend().delete(_filename(checkpoint_id))
+    except Exception:
+        pass
+
+def _is_unfinished(checkpoint, now):
+    if checkpoint.get("status") in ("failed", "cancelled"):
+        return True
+    if checkpoint.get("status") != "running":
+        return False
+    try:
+        updated = datetime.fromisoformat(checkpoint["updated_at"]).timestamp()
+    except (KeyError, ValueError):
+        return False
+    return now - updated > STALE_RUNNING_SEC
+
+def list_unfinished_checkpoints(limit=3):
+    """
+    失敗・キャンセルなどで途中で止まったチェックポイント（新しい順）
+    """
+    checkpoints = {}
+    if history_enabled():
+        try:
+            backend = get_backend()
+            for name in backend.names(CHECKPOINT_PREFIX):
+                try:
+                    checkpoint = backend.get(name)
+                except Exception:
+                    continue
+                checkpoints[checkpoint["id"]] = checkpoint
+        except Exception:
+            pass
+    with _memory_lock:
+        checkpoints.update(_memory)
+
+    now = time.time()
+    unfinished = [c for c in checkpoints.values() if _is_unfinished(c, now)]
+    unfinished.sort(key=lambda c: c.get("updated_at", ""), reverse=True)
+    return unfinished[:limit]
+
+def failed_stage(checkpoint):
+    """失敗・キャンセルしたステージ（なければ None）"""
+    for stage in STAGES:
+        if checkpoint["stages"][stage]["status"] in ("failed", "cancelled"):
+            return stage
+    return None
+
+def reset_from(checkpoint, stage):
+    """stage とそれ以降のステージをやり直すようにする（「リライトだけやり直す」など）"""
+    for name in STAGES[STAGES.index(stage):]:
+        checkpoint["stages"][name] = {"status": "pending", "output": None, "error": "", "models": {}}
+    return checkpoint
+
+def skip_rewrite(checkpoint):
+    """自動リライトを飛ばし、初稿をそのまま使うようにする"""
+    stages = checkpoint["stages"]
+    error = stages["rewrite"]["error"]
+    stages["rewrite"] = {"status": "skipped", "output": stages["draft"]["output"], "error": error, "models": {}}
+    stages["normalize"] = {"status": "pending", "output": None, "error": "", "models": {}}
+    return checkpoint
+
+def completed_scenario(checkpoint):
+    """完成したシナリオ（改行の整形まで終わっていなければ None）"""
+    return checkpoint["stages"]["normalize"]["output"]
+
+def checkpoint_models(checkpoint):
+    """各ステージで使ったモデル（履歴の models に保存する形）"""
+    models = {}
+    for stage in STAGES:
+        models.update(checkpoint["stages"][stage]["models"])
+    return models
+
+def _models(meta, rewrite):
+    """meta のうち、リライトのもの（rewrite=True）またはそれ以外の {ステージ: モデル}"""
+    return {
+        stage: stage_meta["model"]
+        for stage, stage_meta in meta.items()
+        if stage.startswith("rewrite") == rewrite and isinstance(stage_meta, dict) and "model" in stage_meta
+    }
+
+def _set_stage(checkpoint, stage, status, output=None, error="", models=None):
+    checkpoint["stages"][stage] = {"status": status, "output": output, "error": error, "models": models or {}}
+
+def _fail(checkpoint, stage, error):
+    _set_stage(checkpoint, stage, "failed", error=str(error))
+    checkpoint["status"] = "failed"
+    save_checkpoint(checkpoint)
+    return checkpoint
+
+def run_checkpointed(api_key, checkpoint, cancel=None, on_progress=None, on_draft_text=None):
+    """
+    チェックポイントの終わっていないステージを順に実行する
+
+    ステージが終わるたびに保存する。ステージが失敗したら "failed" にして止める（例外は投げない）。
+    キャンセルされたら実行中のステージを "cancelled" にして保存し、GenerationCancelled を投げ直す。
+
+    Args:
+        api_key: Anthropic APIキー
+        checkpoint: new_checkpoint / load_checkpoint のチェックポイント
+        cancel: キャンセル状態（省略可）
+        on_progress: 進捗を受け取る関数 on_progress(メッセージ, 進捗0-100 または None)（省略可）
+        on_draft_text: 初稿のテキストの断片を受け取る関数（省略可）
+
+    Returns:
+        チェックポイント（status は "completed" または "failed"）
+    """
+    add_gauge("scenario_generations_in_flight", 1)
+    start = time.perf_counter()
+    status = "cancelled"
+    try:
+        checkpoint = _run_stages(api_key, checkpoint, cancel, on_progress, on_draft_text)
+        status = checkpoint["status"]
+        return checkpoint
+    finally:
+        add_gauge("scenario_generations_in_flight", -1)
+        inc("scenario_generations_total", status=status)
+        observe("scenario_generation_duration_seconds", time.perf_counter() - start, status=status)
+
+def _run_stages(api_key, checkpoint, cancel, on_progress, on_draft_text):
+    notify = on_progress or (lambda message, value=None: None)
+    stages = checkpoint["stages"]
+    settings = checkpoint["settings"]
+    rewrite_mode = settings.get("rewrite_mode")
+    pipelined = settings.get("pipelined") and settings.get("generation_mode") != "outline"
+    # 予算の残りが少ないときは自動リライトを飛ばすので、一緒に走らせない
+    if pipelined and should_skip_rewrite():
+        pipelined = False
+
+    checkpoint["status"] = "running"
+    current = None
+    try:
+        for stage in STAGES:
+            if stages[stage]["status"] in ("done", "skipped"):
+                continue
+            current = stage
+            stage_started = time.perf_counter()
+            stages[stage]["status"] = "running"
+            save_checkpoint(checkpoint)
+            meta = {}
+
+            if stage == "condense":
+                if not settings.get("condense"):
+                    _set_stage(checkpoint, stage, "skipped", checkpoint["experience"])
+                    continue
+                notify("✂️ 体験談を要約中...")
+                output = condense_experience(api_key, checkpoint["experience"], meta=meta, cancel=cancel)
+                _set_stage(checkpoint, stage, "done", output, models=_models(meta, False))
+
+            elif stage == "draft":
+                notify("📝 ステップ1/2: シナリオ初稿を作成中... (約30-60秒)", 25)
+                source = stages["condense"]["output"]
+                rewritten = None
+                if settings.get("generation_mode") == "outline":
+                    output = generate_scenario_outlined(api_key, source, meta=meta, cancel=cancel)
+                elif pipelined:
+                    # 初稿の前編が書き上がった時点で前編のリライトを始める
+                    try:
+                        output, rewritten = generate_and_fix_pipelined(
+                            api_key, source, meta=meta, mode=rewrite_mode, on_progress=notify,
+                            on_draft_text=on_draft_text, cancel=cancel, fallback=False
+                        )
+                    except RewriteFailed as e:
+                        _set_stage(checkpoint, "draft", "done", e.draft, models=_models(meta, False))
+                        return _fail(checkpoint, "rewrite", e)
+                else:
+                    output = generate_scenario(api_key, source, meta=meta, on_text=on_draft_text, cancel=cancel)
+                if output.startswith("エラーが発生しました"):
+                    return _fail(checkpoint, stage, output)
+
+                checkpoint["stitch_issues"] = meta.get("expand", {}).get("stitch_issues", [])
+                _set_stage(checkpoint, stage, "done", output, models=_models(meta, False))
+                if rewritten is not None:
+                    _set_stage(checkpoint, "rewrite", "done", rewritten, models=_models(meta, True))
+                notify("📝 初稿が完成しました", 50)
+
+            elif stage == "rewrite":
+                if should_skip_rewrite():
+                    _set_stage(
+                        checkpoint, stage, "skipped", stages["draft"]["output"],
+                        error="予算の残りが少ないため省略しました"
+                    )
+                    continue
+                notify("✨ ステップ2/2: 品質チェック＆自動リライト中... (約20-40秒)", 75)
+                try:
+                    output = check_and_fix_scenario(
+                        api_key, stages["draft"]["output"], meta=meta, mode=rewrite_mode,
+                        cancel=cancel, fallback=False
+                    )
+                except RewriteFailed as e:
+                    return _fail(checkpoint, stage, e)
+                _set_stage(checkpoint, stage, "done", output, models=_models(meta, True))
+
+            else:
+                _set_stage(checkpoint, stage, "done", enforce_line_breaks(stages["rewrite"]["output"]))
+            observe("scenario_stage_duration_seconds", time.perf_counter() - stage_started, stage=stage)
+            save_checkpoint(checkpoint)
+
+    except GenerationCancelled:
+        # まだ始めていないステージも、キャンセルで使わずに済んだ分に数える
+        # （一緒に走らせている場合は generate_and_fix_pipelined が数える）
+        if cancel is not None:
+            source = stages["condense"]["output"] or checkpoint["experience"]
+            for stage in ("draft", "rewrite"):
+                if stage != current and stages[stage]["status"] == "pending" and not (pipelined and current == "draft"):
+                    record_skipped_stage(cancel, stage, source, rewrite_mode)
+        if current is not None:
+            stages[current]["status"] = "cancelled"
+        checkpoint["status"] = "cancelled"
+        save_checkpoint(checkpoint)
+        raise
+    except Exception as e:
+        return _fail(checkpoint, current, e)
+
+    checkpoint["status"] = "completed"
+    save_checkpoint(checkpoint)
+    return checkpoint
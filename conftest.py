@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+テストで共通に使うもの
+
+- API（anthropic のクライアント）の代わり: FakeApi・FakeStream・fake_message
+- 履歴の保存先を一時ディレクトリにするフィクスチャ: history_dir
+- トークン使用量のログ（token_estimator）と履歴・予算の台帳は、すべてのテストで一時ディレクトリに書く
+  （テストの偽の使用量で、本番の max_tokens の補正や予算の上限が狂わないように）
+"""
+
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import budget
+import checkpoints
+import history_store
+import profiler
+import scenario_pipeline
+import token_estimator
+
+
+def fake_message(text, input_tokens=1000, output_tokens=1000, stop_reason="end_turn"):
+    """anthropic の Message と同じ属性を持つオブジェクト"""
+    return SimpleNamespace(
+        content=[SimpleNamespace(text=text)],
+        usage=SimpleNamespace(input_tokens=input_tokens, output_tokens=output_tokens),
+        stop_reason=stop_reason,
+    )
+
+
+class FakeStream:
+    """
+    client.messages.stream() の代わり
+
+    text_stream を1行ずつ返す。delay 秒ずつ待ち、gate を渡したら半分まで返したところで
+    gate が開くまで止まる。close() されたら、次の行を読むときに読み込みエラーにする。
+    """
+
+    def __init__(self, message, delay=0.0, gate=None):
+        self._message = message
+        self._delay = delay
+        self._gate = gate
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    @property
+    def text_stream(self):
+        lines = self._message.content[0].text.splitlines(keepends=True)
+        for i, line in enumerate(lines):
+            if self._gate is not None and i == len(lines) // 2:
+                while not self._gate.wait(0.01) and not self.closed:
+                    pass
+            if self._delay:
+                time.sleep(self._delay)
+            if self.closed:
+                raise OSError("接続が閉じられました")
+            yield line
+
+    def close(self):
+        self.closed = True
+
+    def get_final_message(self):
+        return self._message
+
+
+class FakeApi:
+    """
+    anthropic.Anthropic の代わり（messages.create と messages.stream だけ）
+
+    respond(prompt) を上書きして、プロンプトごとの出力（文字列か fake_message）を返す。
+    例外を投げれば、API呼び出しの失敗になる。既定では output をそのまま返す。
+    """
+
+    usage = (1000, 1000)  # 文字列を返したときの (input_tokens, output_tokens)
+    delay = 0.0  # ストリーミングで1行ごとに待つ秒数
+
+    def __init__(self, output=""):
+        self.messages = self
+        self.output = output
+        self.prompts = []
+        self.streams = []
+        self._lock = threading.Lock()
+
+    def respond(self, prompt):
+        return self.output
+
+    def _reply(self, messages):
+        prompt = messages[0]["content"]
+        with self._lock:
+            self.prompts.append(prompt)
+        reply = self.respond(prompt)
+        return fake_message(reply, *self.usage) if isinstance(reply, str) else reply
+
+    def open_stream(self, prompt, message):
+        """stream() で返すストリーム（待ち方を変えるときに上書きする）"""
+        return FakeStream(message, self.delay)
+
+    def create(self, messages, **kwargs):
+        return self._reply(messages)
+
+    def stream(self, messages, **kwargs):
+        stream = self.open_stream(messages[0]["content"], self._reply(messages))
+        with self._lock:
+            self.streams.append(stream)
+        return stream
+
+
+@pytest.fixture(autouse=True)
+def usage_log(tmp_path, monkeypatch):
+    """トークン使用量のログを一時ディレクトリに書き、補正係数を読み直させる"""
+    path = tmp_path / "token_usage.jsonl"
+    monkeypatch.setattr(token_estimator, "USAGE_LOG_PATH", str(path))
+    monkeypatch.setattr(token_estimator, "_ratios", None)
+    return path
+
+
+@pytest.fixture(autouse=True)
+def isolated_output(tmp_path, monkeypatch):
+    """
+    履歴・予算の台帳・プロファイルの記録の保存先を一時ディレクトリにする（すべてのテスト）
+
+    テストの偽の料金が本番の日・月の上限に数えられないように、リポジトリの output/ には書かせない
+    """
+    monkeypatch.setattr(history_store, "HISTORY_DIR", str(tmp_path))
+    monkeypatch.setattr(profiler, "TRACE_LOG_PATH", str(tmp_path / "profile_traces.jsonl"))
+    monkeypatch.setattr(budget, "_ledger_cache", {"loaded_at": 0.0, "ledger": None})
+    monkeypatch.setattr(budget, "_memory_ledger", {"days": {}})
+    return tmp_path
+
+
+@pytest.fixture
+def history_dir(tmp_path, monkeypatch):
+    """履歴・チェックポイント・台帳の保存先を一時ディレクトリにする"""
+    monkeypatch.setattr(history_store, "HISTORY_DIR", str(tmp_path))
+    monkeypatch.setattr(history_store, "is_streamlit_cloud", lambda: False)
+    monkeypatch.setattr(checkpoints, "_memory", {})
+    return tmp_path
+
+
+@pytest.fixture
+def use_api(monkeypatch):
+    """生成パイプラインが api を使うようにする（use_api(api) は api を返す）"""
+
+    def use(api):
+        monkeypatch.setattr(scenario_pipeline, "get_client", lambda api_key: api)
+        return api
+    return use
@@ -2,12 +2,15 @@
 # -*- coding: utf-8 -*-
 """
 過去に生成されたシナリオの改行を修正するスクリプト
+
+履歴は設定されている保存先（SCENARIO_HISTORY_BACKEND）から読み、update_history で書き換える
+（保存先のロックの中で書き換え、修正前のシナリオは revisions に残し、インデックスも数え直す）。
 """
 
-import os
-import json
 import re
-from pathlib import Path
+from datetime import datetime
+
+from history_store import history_enabled, iter_history_records, record_id, update_history
 
 def enforce_line_breaks(text):
     """
@@ -79,65 +82,53 @@ def enforce_line_breaks(text):
     
     return '\n'.join(result_lines)
 
-def fix_scenario_file(filepath):
+def fix_scenario_record(data):
     """
-    1つのシナリオファイルを修正
+    1件の履歴の改行を修正する
+
+    Returns:
+        修正したか
     """
-    try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        original_result = data.get('result', '')
-        if not original_result:
-            return False
-        
-        # 改行を修正
-        fixed_result = enforce_line_breaks(original_result)
-        
-        # 変更があったかチェック
-        if original_result == fixed_result:
-            return False
-        
-        # ファイルを更新
-        data['result'] = fixed_result
-        data['fixed_line_breaks'] = True
-        data['fixed_at'] = datetime.now().isoformat()
-        
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        
-        return True
-    except Exception as e:
-        print(f"エラー: {filepath} - {str(e)}")
+    original_result = data.get('result', '')
+    if not original_result:
         return False
 
+    # 改行を修正
+    fixed_result = enforce_line_breaks(original_result)
+
+    # 変更があったかチェック
+    if original_result == fixed_result:
+        return False
+
+    fields = {"fixed_line_breaks": True, "fixed_at": datetime.now().isoformat()}
+    if not update_history(record_id(data), fixed_result, reason="fix_line_breaks", fields=fields):
+        raise RuntimeError("履歴を更新できませんでした")
+    return True
+
 def main():
     """
     過去の生成物をすべて修正
     """
-    output_dir = Path(__file__).parent / "output"
-    
-    if not output_dir.exists():
-        print("outputディレクトリが見つかりません")
+    if not history_enabled():
+        print("この環境では履歴を保存していません")
         return
-    
-    # JSONファイルを取得
-    json_files = list(output_dir.glob("scenario_*.json"))
-    
-    if not json_files:
-        print("修正対象のファイルが見つかりません")
+
+    records = list(iter_history_records())
+
+    if not records:
+        print("修正対象の履歴が見つかりません")
         return
-    
-    print(f"見つかったファイル数: {len(json_files)}")
-    
+
+    print(f"見つかった履歴の数: {len(records)}")
+
     fixed_count = 0
     skipped_count = 0
     error_count = 0
-    
-    for filepath in json_files:
-        print(f"処理中: {filepath.name}...", end=" ")
+
+    for data in records:
+        print(f"処理中: {record_id(data)}...", end=" ")
         try:
-            if fix_scenario_file(filepath):
+            if fix_scenario_record(data):
                 print("✓ 修正完了")
                 fixed_count += 1
             else:
@@ -146,15 +137,13 @@ def main():
         except Exception as e:
             print(f"✗ エラー: {str(e)}")
             error_count += 1
-    
+
     print("\n" + "="*50)
-    print(f"処理完了:")
+    print("処理完了:")
     print(f"  修正: {fixed_count}件")
     print(f"  変更なし: {skipped_count}件")
     print(f"  エラー: {error_count}件")
     print("="*50)
 
 if __name__ == "__main__":
-    from datetime import datetime
     main()
-
@@ -0,0 +1,478 @@
+"""
+生成履歴の保存先（バックエンド）
+
+history_store は履歴・お気に入り・インデックスを「名前 → JSON」のオブジェクトとして
+ここにあるバックエンドに保存する。環境変数 SCENARIO_HISTORY_BACKEND で選ぶ。
+
+- local: output/ の下に1件ずつJSONファイルで保存（既定）
+- sqlite: SQLiteのデータベース1つに保存（SCENARIO_HISTORY_SQLITE、既定は output/history.sqlite3）
+- s3: S3互換のオブジェクトストレージに保存（SCENARIO_S3_ENDPOINT・SCENARIO_S3_BUCKET など）
+
+Streamlit Cloud ではローカルのディスクが再起動で消えるので、sqlite（永続ディスクがある場合）か s3 を使う。
+
+どのバックエンドも次のメソッドを持つ:
+    get(name) -> dict/list（なければ KeyError）
+    put(name, data, indent=2)
+    delete(name) -> 削除したか
+    names(prefix) -> 名前のリスト
+    stamp(name) -> 版（キャッシュの判定用。なければ None）
+    listing_stamp() -> 一覧の版（None なら一覧をキャッシュしない）
+    location(name) -> 保存場所の表示用の文字列
+    lock(name) -> 読んで書き換える処理の排他（with で使う）
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from urllib.parse import quote, urlsplit
+from xml.etree import ElementTree
+
+try:
+    import fcntl
+except ImportError:  # Windows では同じプロセス内のロックだけ使う
+    fcntl = None
+
+BACKENDS = ("local", "sqlite", "s3")
+
+# ディレクトリの更新からこの秒数以内は、一覧のキャッシュを使わない
+# （更新時刻の刻みの中でファイルが増えると時刻が変わらないため）
+_RACY_SEC = 1.0
+
+# S3で一覧・読み書きのときに知ったETagを信じる秒数
+# （過ぎたらHEADで確かめ直し、ほかのインスタンスが書いた分に気づく）
+S3_ETAG_TTL_SEC = float(os.getenv("SCENARIO_S3_ETAG_TTL_SEC", "5"))
+# S3のロック: 取れるまで待つ秒数と、持ったまま落ちたプロセスのロックを取り直せるまでの秒数
+S3_LOCK_TIMEOUT_SEC = 30.0
+S3_LOCK_LEASE_SEC = 60.0
+
+# ============================================================================
+# 共通
+# ============================================================================
+
+def write_json_atomic(path, data, indent=2):
+    """
+    JSONを書き込む（一時ファイルに書いてから置き換える）
+
+    一時ファイル名はプロセスごとに別なので、同時に書き込んでも混ざらない
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp_", suffix=".json", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=indent)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+# プロセス内のスレッド用（fcntl がない環境ではこれだけで排他する）
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+
+def _thread_lock(key):
+    with _thread_locks_guard:
+        return _thread_locks.setdefault(key, threading.Lock())
+
+@contextmanager
+def file_lock(path):
+    """
+    ロックファイルによる排他（別プロセスとの間でも効く）
+
+    同じロックを入れ子で取らないこと
+    """
+    with _thread_lock(path):
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# ============================================================================
+# ローカルのディレクトリ
+# ============================================================================
+
+class LocalBackend:
+    """ディレクトリに1件ずつJSONファイルで保存する"""
+
+    kind = "local"
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.uri = f"local:{directory}"
+
+    def location(self, name):
+        return os.path.join(self.directory, name)
+
+    def get(self, name):
+        try:
+            with open(self.location(name), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise KeyError(name) from None
+
+    def put(self, name, data, indent=2):
+        write_json_atomic(self.location(name), data, indent=indent)
+
+    def delete(self, name):
+        try:
+            os.remove(self.location(name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def names(self, prefix=""):
+        try:
+            return [f for f in os.listdir(self.directory) if f.startswith(prefix) and f.endswith(".json")]
+        except FileNotFoundError:
+            return []
+
+    def stamp(self, name):
+        # 書き込みはすべて置き換えなので、更新時刻の刻みの中で書き換えられても inode で気づける
+        try:
+            stat = os.stat(self.location(name))
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def listing_stamp(self):
+        try:
+            stat = os.stat(self.directory)
+        except OSError:
+            return None
+        if time.time() - stat.st_mtime < _RACY_SEC:
+            return None
+        return stat.st_mtime_ns
+
+    def lock(self, name):
+        return file_lock(os.path.join(self.directory, f".{name}.lock"))
+
+# ============================================================================
+# SQLite
+# ============================================================================
+
+class SQLiteBackend:
+    """
+    SQLiteのデータベース1つに保存する
+
+    書き込むたびに全体の版（meta.version）を上げ、各オブジェクトにその値を持たせる。
+    版はキャッシュの判定に使う。
+    """
+
+    kind = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self.uri = f"sqlite:{path}"
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS objects (name TEXT PRIMARY KEY, body TEXT NOT NULL, version INTEGER NOT NULL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """書き込みのトランザクション（版を1つ上げてその値を渡す）"""
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('version', 1) "
+                "ON CONFLICT(key) DO UPDATE SET value = value + 1"
+            )
+            version = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+            yield conn, version
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def location(self, name):
+        return f"{self.path}#{name}"
+
+    def get(self, name):
+        row = self._connection().execute("SELECT body FROM objects WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return json.loads(row[0])
+
+    def put(self, name, data, indent=2):
+        body = json.dumps(data, ensure_ascii=False, indent=indent)
+        with self._transaction() as (conn, version):
+            conn.execute(
+                "INSERT OR REPLACE INTO objects (name, body, version) VALUES (?, ?, ?)", (name, body, version)
+            )
+
+    def delete(self, name):
+        with self._transaction() as (conn, _):
+            return conn.execute("DELETE FROM objects WHERE name = ?", (name,)).rowcount > 0
+
+    def names(self, prefix=""):
+        rows = self._connection().execute(
+            "SELECT name FROM objects WHERE substr(name, 1, ?) = ?", (len(prefix), prefix)
+        )
+        return [row[0] for row in rows]
+
+    def stamp(self, name):
+        row = self._connection().execute("SELECT version FROM objects WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def listing_stamp(self):
+        row = self._connection().execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return row[0] if row else 0
+
+    def lock(self, name):
+        return file_lock(f"{self.path}.{name}.lock")
+
+# ============================================================================
+# S3互換のオブジェクトストレージ
+# ============================================================================
+
+class S3Backend:
+    """
+    S3互換のオブジェクトストレージに保存する（パス形式のURL・署名v4）
+
+    boto3 を使わずに標準ライブラリだけでリクエストする。
+    ロックは「まだないときだけ書く」条件つきPUT（If-None-Match: *）でロック用のオブジェクトを作って取るので、
+    複数のインスタンス・プロセスの間でも効く。
+    ETagは etag_ttl 秒だけ使い回すので、ほかのインスタンスの書き込みにはその秒数以内に気づく。
+    """
+
+    kind = "s3"
+
+    def __init__(self, endpoint, bucket, prefix="", region="us-east-1",
+                 access_key="", secret_key="", timeout=10, etag_ttl=None):
+        self.endpoint = endpoint.rstrip("/")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.timeout = timeout
+        self.etag_ttl = S3_ETAG_TTL_SEC if etag_ttl is None else etag_ttl
+        self.uri = f"s3:{self.endpoint}/{bucket}/{prefix}"
+        # 一覧・読み書きで知ったETag {名前: (ETag, 知った時刻)}（stamp() でHEADを省く）
+        self._etags = {}
+
+    def _request(self, method, key="", query=None, body=b"", conditions=None):
+        """
+        署名つきのリクエストを送る（404 は KeyError）
+
+        conditions: 条件つきリクエストのヘッダー（{"if-none-match": "*"} など）。満たさなければ HTTPError（412）
+        """
+        path = f"/{self.bucket}" + (f"/{quote(key, safe='/~')}" if key else "")
+        canonical_query = "&".join(
+            f"{quote(k, safe='-_.~')}={quote(str(v), safe='-_.~')}" for k, v in sorted((query or {}).items())
+        )
+        now = datetime.now(timezone.utc)
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        date = now.strftime("%Y%m%d")
+        payload_hash = hashlib.sha256(body).hexdigest()
+        headers = {
+            "host": urlsplit(self.endpoint).netloc,
+            "x-amz-content-sha256": payload_hash,
+            "x-amz-date": amz_date,
+            **(conditions or {}),
+        }
+        signed_headers = ";".join(sorted(headers))
+        canonical_request = "\n".join([
+            method,
+            path,
+            canonical_query,
+            "".join(f"{name}:{headers[name]}\n" for name in sorted(headers)),
+            signed_headers,
+            payload_hash,
+        ])
+        scope = f"{date}/{self.region}/s3/aws4_request"
+        string_to_sign = "\n".join([
+            "AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()
+        ])
+        signing_key = f"AWS4{self.secret_key}".encode("utf-8")
+        for part in (date, self.region, "s3", "aws4_request"):
+            signing_key = hmac.new(signing_key, part.encode("utf-8"), hashlib.sha256).digest()
+        signature = hmac.new(signing_key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+        headers["Authorization"] = (
+            f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+            f"SignedHeaders={signed_headers}, Signature={signature}"
+        )
+
+        url = self.endpoint + path + (f"?{canonical_query}" if canonical_query else "")
+        request = urllib.request.Request(url, data=body if method == "PUT" else None, method=method, headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                raise KeyError(key) from None
+            raise
+
+    def location(self, name):
+        return f"s3://{self.bucket}/{self.prefix}{name}"
+
+    def get(self, name):
+        headers, body = self._request("GET", self.prefix + name)
+        self._etags[name] = (headers.get("ETag"), time.monotonic())
+        return json.loads(body.decode("utf-8"))
+
+    def put(self, name, data, indent=2):
+        body = json.dumps(data, ensure_ascii=False, indent=indent).encode("utf-8")
+        headers, _ = self._request("PUT", self.prefix + name, body=body)
+        self._etags[name] = (headers.get("ETag"), time.monotonic())
+
+    def delete(self, name):
+        existed = self.stamp(name) is not None
+        self._request("DELETE", self.prefix + name)
+        self._etags.pop(name, None)
+        return existed
+
+    def names(self, prefix=""):
+        names = []
+        etags = {}
+        query = {"list-type": 2, "prefix": self.prefix + prefix}
+        while True:
+            _, body = self._request("GET", query=query)
+            root = ElementTree.fromstring(body)
+            for item in root.findall("{*}Contents"):
+                name = item.findtext("{*}Key")[len(self.prefix):]
+                etags[name] = item.findtext("{*}ETag")
+                if name.endswith(".json"):
+                    names.append(name)
+            token = root.findtext("{*}NextContinuationToken")
+            if root.findtext("{*}IsTruncated") != "true" or not token:
+                break
+            query = {**query, "continuation-token": token}
+        listed_at = time.monotonic()
+        etags = {name: (etag, listed_at) for name, etag in etags.items()}
+        if not prefix:
+            self._etags = etags
+        else:
+            self._etags.update(etags)
+        return names
+
+    def stamp(self, name):
+        cached = self._etags.get(name)
+        if cached is not None and time.monotonic() - cached[1] < self.etag_ttl:
+            return cached[0]
+        try:
+            headers, _ = self._request("HEAD", self.prefix + name)
+        except KeyError:
+            self._etags.pop(name, None)
+            return None
+        self._etags[name] = (headers.get("ETag"), time.monotonic())
+        return self._etags[name][0]
+
+    def listing_stamp(self):
+        # 一覧は毎回取り直す（ETagもそのとき更新する）
+        return None
+
+    def _lock_key(self, name):
+        return f"{self.prefix}locks/{name}.lock"
+
+    def _try_lock(self, key):
+        """ロック用のオブジェクトを作る（ほかが持っていれば、期限切れのときだけ取り直す）"""
+        body = json.dumps({"expires_at": time.time() + S3_LOCK_LEASE_SEC}).encode("utf-8")
+        try:
+            self._request("PUT", key, body=body, conditions={"if-none-match": "*"})
+            return True
+        except urllib.error.HTTPError as e:
+            if e.code not in (409, 412):
+                raise
+        try:
+            headers, current = self._request("GET", key)
+        except KeyError:
+            return False  # ちょうど外れた。次の試行で取る
+        try:
+            expires_at = json.loads(current.decode("utf-8"))["expires_at"]
+        except (ValueError, KeyError, TypeError):
+            expires_at = 0
+        if expires_at > time.time():
+            return False
+        try:
+            # 読んだときのまま（ほかが先に取り直していない）ときだけ置き換える
+            self._request("PUT", key, body=body, conditions={"if-match": headers.get("ETag")})
+            return True
+        except urllib.error.HTTPError as e:
+            if e.code not in (409, 412):
+                raise
+            return False
+
+    @contextmanager
+    def lock(self, name):
+        """
+        ロック用のオブジェクト locks/<name>.lock を条件つきPUTで作って排他する
+
+        取れなければ S3_LOCK_TIMEOUT_SEC 秒で TimeoutError。S3_LOCK_LEASE_SEC 秒を過ぎたロックは取り直せる
+        """
+        key = self._lock_key(name)
+        with _thread_lock(f"{self.uri}#{name}"):
+            deadline = time.monotonic() + S3_LOCK_TIMEOUT_SEC
+            delay = 0.02
+            while not self._try_lock(key):
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"S3のロックを取れませんでした: {key}")
+                # 同時に待っているプロセスが揃って取りに行かないよう、少しずらす
+                time.sleep(delay * random.uniform(0.5, 1.5))
+                delay = min(delay * 2, 0.5)
+            try:
+                yield
+            finally:
+                try:
+                    self._request("DELETE", key)
+                except (KeyError, OSError):
+                    pass
+
+# ============================================================================
+# 選択
+# ============================================================================
+
+def create_backend(kind, history_dir):
+    """
+    バックエンドを作る
+
+    Args:
+        kind: "local" / "sqlite" / "s3"
+        history_dir: ローカルの履歴ディレクトリ（local・sqlite の既定の場所）
+    """
+    if kind == "local":
+        return LocalBackend(history_dir)
+    if kind == "sqlite":
+        return SQLiteBackend(os.getenv("SCENARIO_HISTORY_SQLITE", os.path.join(history_dir, "history.sqlite3")))
+    if kind == "s3":
+        return S3Backend(
+            endpoint=os.getenv("SCENARIO_S3_ENDPOINT", "https://s3.amazonaws.com"),
+            bucket=os.getenv("SCENARIO_S3_BUCKET", ""),
+            prefix=os.getenv("SCENARIO_S3_PREFIX", "history/"),
+            region=os.getenv("AWS_REGION", "us-east-1"),
+            access_key=os.getenv("AWS_ACCESS_KEY_ID", ""),
+            secret_key=os.getenv("AWS_SECRET_ACCESS_KEY", ""),
+        )
+    raise ValueError(f"不明な保存先: {kind}（{' / '.join(BACKENDS)} のいずれか）")
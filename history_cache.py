@@ -0,0 +1,212 @@
+"""
+履歴データのプロセス内キャッシュ（全セッションで共有）
+
+Streamlitはブラウザのセッションごとに app.py を実行するので、
+セッションごとに履歴を読み込むと同じシナリオのコピーがセッションの数だけメモリに載る。
+このモジュールは読み込んだ履歴をプロセス内で1つだけ持ち、全セッションで共有する。
+
+- 読み込み時にキャッシュを通す（read-through）。ファイルの更新時刻・サイズが変わっていたら読み直す
+- 上限（SCENARIO_HISTORY_CACHE_MB）を超えたら、最も長く使われていないものから捨てる（LRU）
+- 共有する値は書き換えられないように読み取り専用にする（freeze）
+- 保存・更新・削除のときは該当するエントリを捨てる（invalidate）
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from types import MappingProxyType
+
+CACHE_MAX_BYTES = int(float(os.getenv("SCENARIO_HISTORY_CACHE_MB", "64")) * 1024 * 1024)
+
+# この秒数以内に画面を描画したセッションを「アクティブ」とみなす
+SESSION_ACTIVE_SEC = 600
+
+_lock = threading.Lock()
+_entries = OrderedDict()  # key -> {"stamp", "value", "size", "ids"}
+_total_bytes = 0
+# キャッシュのエントリに含まれるオブジェクトの id（セッションの使用量から共有分を除くため）
+_shared_ids = {}  # id -> 参照しているエントリの数
+_value_sizes = {}  # エントリの値の id -> サイズ
+_stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+_sessions = {}  # session_id -> {"own_bytes", "shared_bytes", "seen_at"}
+
+# ============================================================================
+# 読み取り専用の値
+# ============================================================================
+
+def freeze(value):
+    """辞書・リストを読み取り専用（MappingProxyType・tuple）にする"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+def thaw(value):
+    """freeze した値を書き換えられる dict・list に戻す（JSONに保存するときなど）"""
+    if isinstance(value, (dict, MappingProxyType)):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [thaw(item) for item in value]
+    return value
+
+def estimate_size(value, _seen=None):
+    """
+    値が使っているメモリのおおよそのバイト数（同じオブジェクトは1回だけ数える）
+
+    _seen を渡すと、数えたオブジェクトの id がそこに追加される
+    """
+    seen = set() if _seen is None else _seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+
+    size = sys.getsizeof(value)
+    if isinstance(value, (dict, MappingProxyType)):
+        size += sum(estimate_size(k, seen) + estimate_size(v, seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(item, seen) for item in value)
+    return size
+
+# ============================================================================
+# キャッシュ
+# ============================================================================
+
+def get(key, stamp, loader):
+    """
+    キャッシュから値を取り出す（なければ、または stamp が変わっていれば loader で読み込む）
+
+    Args:
+        key: キャッシュのキー
+        stamp: 元データの版（ファイルの更新時刻とサイズなど）。変わっていたら読み直す
+        loader: 値を読み込む関数（戻り値は freeze して保存する）
+
+    Returns:
+        読み取り専用の値
+    """
+    global _total_bytes
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and entry["stamp"] == stamp:
+            _entries.move_to_end(key)
+            _stats["hits"] += 1
+            return entry["value"]
+        _stats["misses"] += 1
+
+    # 読み込みはロックの外で行う（遅いディスクで他のセッションを待たせない）
+    value = freeze(loader())
+    ids = set()
+    size = estimate_size(value, ids)
+
+    with _lock:
+        _remove(key)
+        # 上限より大きいものはキャッシュしない
+        if size <= CACHE_MAX_BYTES:
+            _entries[key] = {"stamp": stamp, "value": value, "size": size, "ids": ids}
+            _total_bytes += size
+            _value_sizes[id(value)] = size
+            for object_id in ids:
+                _shared_ids[object_id] = _shared_ids.get(object_id, 0) + 1
+            while _total_bytes > CACHE_MAX_BYTES and _entries:
+                _remove(next(iter(_entries)))
+                _stats["evictions"] += 1
+    return value
+
+def _remove(key):
+    """エントリを1つ取り除く（_lock を持って呼ぶ）"""
+    global _total_bytes
+    entry = _entries.pop(key, None)
+    if entry is None:
+        return False
+    _total_bytes -= entry["size"]
+    _value_sizes.pop(id(entry["value"]), None)
+    for object_id in entry["ids"]:
+        count = _shared_ids.get(object_id, 0) - 1
+        if count > 0:
+            _shared_ids[object_id] = count
+        else:
+            _shared_ids.pop(object_id, None)
+    return True
+
+def invalidate(key=None):
+    """エントリを捨てる（key を省略するとすべて）"""
+    with _lock:
+        keys = list(_entries) if key is None else [key]
+        for item in keys:
+            if _remove(item):
+                _stats["invalidations"] += 1
+
+def cache_stats():
+    """キャッシュの件数・使用量・ヒット率など"""
+    with _lock:
+        lookups = _stats["hits"] + _stats["misses"]
+        return {
+            "entries": len(_entries),
+            "bytes": _total_bytes,
+            "max_bytes": CACHE_MAX_BYTES,
+            "hit_rate": _stats["hits"] / lookups if lookups else 0.0,
+            **_stats,
+        }
+
+# ============================================================================
+# セッションごとのメモリ
+# ============================================================================
+
+class _SeenWithShared(set):
+    """共有エントリのオブジェクトも「数えた」ことにする seen"""
+
+    def __init__(self, shared_ids):
+        super().__init__()
+        self._shared_ids = shared_ids
+
+    def __contains__(self, object_id):
+        return object_id in self._shared_ids or set.__contains__(self, object_id)
+
+def session_memory(values):
+    """
+    セッションが持っている値のメモリ使用量
+
+    キャッシュのエントリ（全セッションで共有）をそのまま持っている分は shared_bytes、
+    セッションだけが持っている分は own_bytes に数える。
+    共有エントリの中身（文字列など）を参照しているだけのコピーは own_bytes に含めない。
+    """
+    # 数えるのは時間がかかるので、ロックの中では共有エントリの id を写すだけにする
+    # （ほかのセッションのキャッシュの読み書きを待たせない）
+    with _lock:
+        shared_ids = frozenset(_shared_ids)
+        value_sizes = dict(_value_sizes)
+    shared_bytes = sum(value_sizes.get(id(value), 0) for value in values)
+    # 共有エントリの中のオブジェクトは数えず、セッション固有の分だけ数える
+    seen = _SeenWithShared(shared_ids)
+    own_bytes = sum(estimate_size(value, seen) for value in values)
+    return {"own_bytes": own_bytes, "shared_bytes": shared_bytes}
+
+def record_session(session_id, values):
+    """セッションのメモリ使用量を記録する（画面を描画するたびに呼ぶ）"""
+    report = session_memory(values)
+    with _lock:
+        _sessions[session_id] = {**report, "seen_at": time.time()}
+    return report
+
+def active_sessions():
+    """
+    アクティブなセッションごとのメモリ使用量
+
+    Returns:
+        [{"session", "own_bytes", "shared_bytes", "idle_sec"}, ...]
+    """
+    now = time.time()
+    with _lock:
+        for session_id in [s for s, r in _sessions.items() if now - r["seen_at"] > SESSION_ACTIVE_SEC]:
+            del _sessions[session_id]
+        return [
+            {
+                "session": session_id[:8],
+                "own_bytes": report["own_bytes"],
+                "shared_bytes": report["shared_bytes"],
+                "idle_sec": round(now - report["seen_at"]),
+            }
+            for session_id, report in sorted(_sessions.items(), key=lambda item: item[1]["seen_at"], reverse=True)
+        ]
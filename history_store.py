@@ -0,0 +1,673 @@
+"""
+生成履歴の保存・読み込み・お気に入り・統計
+
+履歴は1件ずつ scenario_<ID>.json という名前で保存先（history_backends）に保存する。
+保存先は環境変数 SCENARIO_HISTORY_BACKEND で選ぶ（既定は output/ の下のファイル）。
+IDは日時（マイクロ秒まで）と乱数で、同じ秒に複数のプロセスで生成しても重ならない。
+文字数の内訳（編・ページ・コマ・セリフ/ト書き）と体験談のMinHash署名は
+保存・更新のたびに1回だけ計算して history_index.json にまとめておき、
+統計画面や似ている体験談の検索では各履歴を読み直さずに使う。
+読み込んだ履歴・お気に入りは history_cache でプロセス内の全セッションが共有する。
+
+新しい履歴の書き込みは history_writer のキューに入れて後回しにする（生成後の画面を待たせない）。
+書き終わるまでの間も、同じプロセスの load_history には出てくる。
+
+複数のStreamlitサーバーのプロセスで同じ保存先を使えるように、
+読んで書き換える処理（お気に入り・編集・削除・インデックス）はバックエンドのロックを取り、
+ロックの中で読み直してから書き込む。
+"""
+
+import os
+import secrets
+import threading
+from datetime import datetime
+from statistics import median
+
+import history_cache
+import history_writer
+from history_backends import create_backend
+from profiler import profiled
+from scenario_pipeline import PROMPT_VERSION
+from scenario_text import scenario_char_stats
+from similar_experiences import (
+    ExperienceIndex,
+    jaccard_similarity,
+    minhash_signature,
+)
+
+HISTORY_DIR = os.getenv(
+    "SCENARIO_HISTORY_DIR",
+    os.path.join(os.path.dirname(__file__), "output"),
+)
+HISTORY_PREFIX = "scenario_"
+INDEX_FILENAME = "history_index.json"
+FAVORITES_FILENAME = "favorites.json"
+# インデックスの項目や署名の長さを変えたら上げる（古い項目は次の突き合わせで作り直す）
+INDEX_VERSION = 3
+
+# 保存先（local / sqlite / s3）
+BACKEND = os.getenv("SCENARIO_HISTORY_BACKEND", "local")
+
+# 新しい履歴の書き込みを後回しにするか（0 にすると save_history の中で書き終える）
+WRITE_BEHIND = os.getenv("SCENARIO_HISTORY_WRITE_BEHIND", "1") != "0"
+
+# 編集・削除の前に、後回しにしている書き込みを待つ最大秒数
+FLUSH_TIMEOUT_SEC = 10.0
+
+# 更新したときに残す、前のシナリオ（リビジョン）の数
+MAX_REVISIONS = 10
+
+# 似ている体験談とみなすJaccard類似度（文字3-gram）
+SIMILARITY_THRESHOLD = float(os.getenv("SCENARIO_SIMILARITY_THRESHOLD", "0.6"))
+
+# 外れ値の判定（四分位範囲の何倍外側から外れ値とするか）
+OUTLIER_IQR_FACTOR = 1.5
+
+# Streamlit Cloud環境かどうかを検出
+def is_streamlit_cloud():
+    """Streamlit Cloud環境かどうかを検出"""
+    # Streamlit Cloudでは HOME が /home/appuser または /home/adminuser
+    home_dir = os.getenv("HOME", "")
+    if "/home/appuser" in home_dir or "/home/adminuser" in home_dir:
+        return True
+    # 環境変数でも判定
+    if os.getenv("STREAMLIT_SHARING_MODE"):
+        return True
+    return False
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+def get_backend():
+    """設定されている保存先（HISTORY_DIR・BACKEND ごとに1つ作って使い回す）"""
+    key = (BACKEND, HISTORY_DIR)
+    with _backends_lock:
+        if key not in _backends:
+            _backends[key] = create_backend(BACKEND, HISTORY_DIR)
+        return _backends[key]
+
+def history_enabled():
+    """
+    履歴を保存・表示するか
+
+    Streamlit Cloud ではローカルのディスクが再起動で消えるので、ローカル以外の保存先のときだけ使う
+    """
+    return BACKEND != "local" or not is_streamlit_cloud()
+
+def new_record_id(now=None):
+    """重ならない履歴ID（日時順に並ぶ）"""
+    now = now or datetime.now()
+    return f"{now.strftime('%Y%m%d_%H%M%S_%f')}_{secrets.token_hex(3)}"
+
+def record_id(data):
+    """履歴のID（IDがない古い履歴は timestamp）"""
+    return data.get("id") or data.get("timestamp", "")
+
+def location_record_id(location):
+    """save_history が返した保存場所の履歴ID（わからなければ None）"""
+    name = (location or "").replace("\\", "/").replace("#", "/").rsplit("/", 1)[-1]
+    if not (name.startswith(HISTORY_PREFIX) and name.endswith(".json")):
+        return None
+    return name[len(HISTORY_PREFIX):-len(".json")]
+
+# ============================================================================
+# 書き込み待ちの履歴
+# ============================================================================
+
+_pending_lock = threading.Lock()
+_pending = {}  # (保存先のuri, ファイル名) -> 読み取り専用の履歴
+
+def _pending_records(backend):
+    """書き込み待ちの {ファイル名: 履歴}"""
+    with _pending_lock:
+        return {filename: data for (uri, filename), data in _pending.items() if uri == backend.uri}
+
+def _persist_record(backend, filename, data):
+    """履歴を1件書き込み、インデックスに反映する"""
+    backend.put(filename, data)
+    history_cache.invalidate(("record", backend.uri, filename))
+    _update_index(backend, filename, data)
+
+def flush_history(timeout=None):
+    """後回しにしている履歴の書き込みを待つ（時間内に終わったかを返す）"""
+    return history_writer.flush(timeout)
+
+def _history_files():
+    """履歴ファイル名の一覧（新しい順、書き込み待ちも含む）"""
+    backend = get_backend()
+    stamp = backend.listing_stamp()
+    if stamp is None:
+        names = backend.names(HISTORY_PREFIX)
+    else:
+        names = history_cache.get(("listing", backend.uri), stamp, lambda: backend.names(HISTORY_PREFIX))
+    pending = _pending_records(backend)
+    if pending:
+        names = set(names) | set(pending)
+    return tuple(sorted(names, reverse=True))
+
+def _read_record(filename):
+    """
+    履歴1件を読み込む（全セッションで共有する読み取り専用の値）
+
+    書き換えるときは history_cache.thaw() でコピーしてから使う。なければ KeyError
+    """
+    backend = get_backend()
+    pending = _pending_records(backend).get(filename)
+    if pending is not None:
+        return pending
+    stamp = backend.stamp(filename)
+    if stamp is None:
+        raise KeyError(filename)
+    return history_cache.get(("record", backend.uri, filename), stamp, lambda: backend.get(filename))
+
+# ============================================================================
+# 履歴インデックス（文字数の内訳）
+# ============================================================================
+
+_index_lock = threading.Lock()
+_index_cache = {"uri": None, "stamp": None, "index": None}
+
+def _index_entry(data):
+    """履歴1件分のインデックスの内容"""
+    return {
+        "index_version": INDEX_VERSION,
+        "timestamp": data.get("timestamp", ""),
+        "prompt_version": data.get("prompt_version", ""),
+        "is_edited": bool(data.get("is_edited")),
+        "char_stats": scenario_char_stats(data.get("result", "")),
+        "minhash": minhash_signature(data.get("experience", "")),
+    }
+
+def _load_index(backend):
+    """インデックスを読み込む（更新されていなければプロセス内のものを使う）"""
+    stamp = backend.stamp(INDEX_FILENAME)
+    if stamp is None:
+        return {"records": {}}
+
+    if _index_cache["uri"] != backend.uri or _index_cache["stamp"] != stamp:
+        try:
+            index = backend.get(INDEX_FILENAME)
+        except (KeyError, OSError, ValueError):
+            index = {"records": {}}
+        _index_cache.update(uri=backend.uri, stamp=stamp, index=index)
+    return _index_cache["index"]
+
+def _save_index(backend, index):
+    """インデックスを書き込む（backend.lock("index") を持って呼ぶ）"""
+    backend.put(INDEX_FILENAME, index, indent=None)
+    _index_cache.update(uri=backend.uri, stamp=backend.stamp(INDEX_FILENAME), index=index)
+
+def _update_index(backend, filename, data):
+    try:
+        with _index_lock, backend.lock("index"):
+            index = _load_index(backend)
+            records = dict(index.get("records", {}))
+            if data is None:
+                records.pop(filename, None)
+            else:
+                records[filename] = _index_entry(data)
+            _save_index(backend, {"records": records})
+    except Exception:
+        pass
+
+def update_history_index(filename, data):
+    """履歴1件分のインデックスを更新する（data が None なら削除）"""
+    _update_index(get_backend(), filename, data)
+
+def sync_history_index():
+    """
+    インデックスを履歴と突き合わせる
+
+    インデックスにない履歴（インデックス導入前の履歴など）と古い形式の項目だけを
+    読み直し、消えた履歴はインデックスから除く。書き込み待ちの履歴は書き終わってから入る。
+
+    Returns:
+        {ファイル名: インデックスの内容}
+    """
+    backend = get_backend()
+    with _index_lock:
+        index = _load_index(backend)
+        records = index.get("records", {})
+        pending = _pending_records(backend)
+        files = [f for f in _history_files() if f not in pending]
+        missing = [
+            f for f in files
+            if f not in records or records[f].get("index_version") != INDEX_VERSION
+        ]
+        if not missing and len(records) == len(files):
+            return records
+
+        entries = {}
+        for filename in missing:
+            try:
+                entries[filename] = _index_entry(backend.get(filename))
+            except (KeyError, OSError, ValueError):
+                continue
+        try:
+            with backend.lock("index"):
+                # 数えている間に別のプロセスが書いた分も残す
+                records = _load_index(backend).get("records", {})
+                files = [f for f in _history_files() if f not in pending]
+                records = {
+                    f: entries.get(f) or records[f] for f in files
+                    if f in entries or (f in records and records[f].get("index_version") == INDEX_VERSION)
+                }
+                _save_index(backend, {"records": records})
+        except OSError:
+            records = {f: entries.get(f) or records[f] for f in files if f in entries or f in records}
+        return records
+
+# ============================================================================
+# 履歴の保存・読み込み
+# ============================================================================
+
+# 履歴を保存
+def save_history(experience, result, models=None):
+    """
+    履歴を保存する（WRITE_BEHIND のときはキューに入れてすぐ戻る）
+
+    Returns:
+        保存場所（保存しないときは None）
+    """
+    if not history_enabled():
+        return None
+
+    try:
+        now = datetime.now()
+        data = {
+            "id": new_record_id(now),
+            "timestamp": now.isoformat(),
+            "experience": experience,
+            "prompt_version": PROMPT_VERSION,
+            "models": models or {},
+            "result": result
+        }
+        filename = f"{HISTORY_PREFIX}{data['id']}.json"
+        backend = get_backend()
+
+        if not WRITE_BEHIND:
+            _persist_record(backend, filename, data)
+            return backend.location(filename)
+
+        key = (backend.uri, filename)
+        with _pending_lock:
+            _pending[key] = history_cache.freeze(data)
+
+        def done(ok):
+            with _pending_lock:
+                _pending.pop(key, None)
+
+        history_writer.submit(lambda: _persist_record(backend, filename, data), on_done=done, description=filename)
+        return backend.location(filename)
+    except Exception:
+        return None
+
+# 履歴を読み込む
+@profiled("history.load_history")
+def load_history(limit=10, search_query=""):
+    if not history_enabled():
+        return []
+
+    try:
+        histories = []
+        for filename in _history_files():
+            try:
+                data = _read_record(filename)
+            except (KeyError, OSError, ValueError):
+                continue
+            # 検索クエリがある場合、フィルタリング
+            if search_query:
+                if (search_query.lower() in data.get('experience', '').lower() or
+                    search_query.lower() in data.get('result', '').lower()):
+                    histories.append(data)
+            else:
+                histories.append(data)
+
+            # 制限数に達したら終了
+            if len(histories) >= limit:
+                break
+
+        return histories
+    except Exception:
+        return []
+
+def iter_history_records():
+    """すべての履歴（新しい順、全セッションで共有する読み取り専用の値）"""
+    if not history_enabled():
+        return
+    for filename in _history_files():
+        try:
+            yield _read_record(filename)
+        except (KeyError, OSError, ValueError):
+            continue
+
+# お気に入り管理
+@profiled("history.get_favorites")
+def get_favorites():
+    """お気に入りリストを取得"""
+    if not history_enabled():
+        return []
+
+    try:
+        backend = get_backend()
+        stamp = backend.stamp(FAVORITES_FILENAME)
+        if stamp is not None:
+            favorites = history_cache.get(
+                ("favorites", backend.uri), stamp, lambda: backend.get(FAVORITES_FILENAME)
+            )
+            # 呼び出し側で書き換えられるようにコピーを返す
+            return list(favorites)
+    except Exception:
+        pass
+    return []
+
+def save_favorites(favorites):
+    """お気に入りリストを保存（丸ごと置き換える。1件ずつの変更は toggle_favorite を使う）"""
+    if not history_enabled():
+        return
+
+    try:
+        backend = get_backend()
+        with backend.lock("favorites"):
+            _write_favorites(backend, favorites)
+    except Exception:
+        pass
+
+def _write_favorites(backend, favorites):
+    """お気に入りを書き込む（backend.lock("favorites") を持って呼ぶ）"""
+    backend.put(FAVORITES_FILENAME, favorites)
+    history_cache.invalidate(("favorites", backend.uri))
+
+def _update_favorites(backend, change):
+    """
+    お気に入りを読み直して change(favorites) で書き換え、保存する
+
+    別プロセスが同時に切り替えても、片方の変更が消えないようロックの中で読み直す
+    """
+    with backend.lock("favorites"):
+        try:
+            favorites = backend.get(FAVORITES_FILENAME)
+        except (KeyError, ValueError):
+            favorites = []
+        if change(favorites) is not False:
+            _write_favorites(backend, favorites)
+        return favorites
+
+def toggle_favorite(key):
+    """お気に入りの追加/削除を切り替え（key は record_id() の値）"""
+    if not history_enabled():
+        return False
+
+    def toggle(favorites):
+        if key in favorites:
+            favorites.remove(key)
+        else:
+            favorites.append(key)
+
+    try:
+        return key in _update_favorites(get_backend(), toggle)
+    except Exception:
+        return False
+
+def is_favorite(key):
+    """お気に入りかどうかを確認"""
+    favorites = get_favorites()
+    return key in favorites
+
+def _find_record(backend, key):
+    """IDまたは timestamp が key の履歴のファイル名（なければ None）"""
+    filename = f"{HISTORY_PREFIX}{key}.json"
+    if backend.stamp(filename) is not None:
+        return filename
+    # IDがない古い履歴や timestamp で指定されたときは中身で探す
+    for filename in _history_files():
+        try:
+            data = _read_record(filename)
+            if key in (data.get("id"), data.get("timestamp")):
+                return filename
+        except (KeyError, OSError, ValueError):
+            continue
+    return None
+
+# シナリオを編集して保存
+def update_history(key, updated_result, reason="edit", fields=None):
+    """
+    履歴のシナリオを更新（key は record_id() の値。timestamp でもよい）
+
+    更新前のシナリオは revisions に残す（新しい順に MAX_REVISIONS 件まで）
+
+    Args:
+        key: 履歴のID
+        updated_result: 新しいシナリオ
+        reason: 更新の理由（"edit": 画面での編集 / "backfill": 新しいプロンプトでのリライト など）
+        fields: 一緒に更新する項目（prompt_version・models など、省略可）
+    """
+    if not history_enabled():
+        return False
+
+    try:
+        # 書き込み待ちの履歴を編集することもあるので、先に書き終える
+        flush_history(FLUSH_TIMEOUT_SEC)
+        backend = get_backend()
+        with backend.lock("records"):
+            filename = _find_record(backend, key)
+            if filename is None:
+                return False
+            # 別プロセスの変更を消さないよう、ロックの中で読み直す
+            data = backend.get(filename)
+            revision = {
+                "result": data.get("result", ""),
+                "prompt_version": data.get("prompt_version"),
+                "models": data.get("models") or {},
+                "saved_at": data.get("updated_at") or data.get("timestamp"),
+                "replaced_by": reason,
+            }
+            data["revisions"] = ([revision] + data.get("revisions", []))[:MAX_REVISIONS]
+            data['result'] = updated_result
+            data['updated_at'] = datetime.now().isoformat()
+            if reason == "edit":
+                data['is_edited'] = True
+            data.update(fields or {})
+            backend.put(filename, data)
+            history_cache.invalidate(("record", backend.uri, filename))
+            _update_index(backend, filename, data)
+            return True
+    except Exception:
+        pass
+    return False
+
+# 履歴を削除
+def delete_history(key):
+    """指定されたIDの履歴を削除（key は record_id() の値。timestamp でもよい）"""
+    if not history_enabled():
+        return False
+
+    try:
+        flush_history(FLUSH_TIMEOUT_SEC)
+        backend = get_backend()
+        with backend.lock("records"):
+            filename = _find_record(backend, key)
+            if filename is None:
+                return False
+            # お気に入りからも削除
+            favorite_keys = {key, record_id(backend.get(filename))}
+
+            def remove(favorites):
+                kept = [favorite for favorite in favorites if favorite not in favorite_keys]
+                if len(kept) == len(favorites):
+                    return False
+                favorites[:] = kept
+
+            _update_favorites(backend, remove)
+            backend.delete(filename)
+            history_cache.invalidate(("record", backend.uri, filename))
+            _update_index(backend, filename, None)
+            return True
+    except Exception:
+        pass
+    return False
+
+# ============================================================================
+# 統計
+# ============================================================================
+
+# 統計情報を取得
+def get_statistics():
+    """生成統計情報を取得"""
+    if not history_enabled():
+        return {"total_count": 0}
+
+    try:
+        return {"total_count": len(sync_history_index())}
+    except Exception:
+        return {"total_count": 0}
+
+def _quartiles(values):
+    """(第1四分位, 中央値, 第3四分位)"""
+    ordered = sorted(values)
+    half = len(ordered) // 2
+    lower = ordered[:half] or ordered
+    upper = ordered[-half:] if half else ordered
+    return median(lower), median(ordered), median(upper)
+
+def _fences(values):
+    """外れ値の境界（下限, 上限）"""
+    q1, _, q3 = _quartiles(values)
+    spread = (q3 - q1) * OUTLIER_IQR_FACTOR
+    return q1 - spread, q3 + spread
+
+def _distribution(values):
+    if not values:
+        return None
+    q1, med, q3 = _quartiles(values)
+    return {"min": min(values), "q1": q1, "median": med, "q3": q3, "max": max(values), "count": len(values)}
+
+_summary_cache = {"records": None, "summary": None}
+
+def get_char_count_summary():
+    """
+    履歴全体の文字数の分布と外れ値（インデックスから集計）
+
+    Returns:
+        {
+            "scenario_count": 集計対象の履歴数,
+            "script_total": シナリオ1本の文字数の分布,
+            "page": ページの文字数の分布,
+            "panel": コマの文字数の分布,
+            "dialogue_ratio": セリフの割合の分布,
+            "totals": [{"timestamp", "script_total", "dialogue_ratio"}, ...],
+            "outliers": [{"timestamp", "key", "chars", "reason"}, ...],
+        }
+    """
+    index_records = sync_history_index()
+    # インデックスが変わっていなければ前回の集計を使う
+    if _summary_cache["records"] is index_records:
+        return _summary_cache["summary"]
+
+    records = [
+        entry for entry in index_records.values()
+        if entry.get("char_stats", {}).get("script_total")
+    ]
+    page_values = []
+    panel_values = []
+    totals = []
+    for entry in records:
+        stats = entry["char_stats"]
+        page_values.extend(stats["pages"].values())
+        panel_values.extend(stats["panels"].values())
+        totals.append({
+            "timestamp": entry.get("timestamp", ""),
+            "script_total": stats["script_total"],
+            "dialogue_ratio": round(stats["dialogue"] / stats["script_total"], 3),
+        })
+
+    outliers = []
+    if len(records) >= 4:
+        low, high = _fences([row["script_total"] for row in totals])
+        for row in totals:
+            if not low <= row["script_total"] <= high:
+                outliers.append({
+                    "timestamp": row["timestamp"],
+                    "key": "全体",
+                    "chars": row["script_total"],
+                    "reason": "多すぎる" if row["script_total"] > high else "少なすぎる",
+                })
+        low, high = _fences(page_values)
+        for entry in records:
+            for key, chars in entry["char_stats"]["pages"].items():
+                if not low <= chars <= high:
+                    outliers.append({
+                        "timestamp": entry.get("timestamp", ""),
+                        "key": key,
+                        "chars": chars,
+                        "reason": "多すぎる" if chars > high else "少なすぎる",
+                    })
+
+    summary = {
+        "scenario_count": len(records),
+        "script_total": _distribution([row["script_total"] for row in totals]),
+        "page": _distribution(page_values),
+        "panel": _distribution(panel_values),
+        "dialogue_ratio": _distribution([row["dialogue_ratio"] for row in totals]),
+        "totals": totals,
+        "outliers": sorted(outliers, key=lambda row: row["timestamp"], reverse=True),
+    }
+    _summary_cache.update(records=index_records, summary=summary)
+    return summary
+
+# ============================================================================
+# 似ている体験談
+# ============================================================================
+
+_experience_index = ExperienceIndex()
+_experience_index_source = {"records": None}
+
+@profiled("history.find_similar")
+def find_similar_histories(experience, threshold=None, limit=3):
+    """
+    入力中の体験談と似ている過去の履歴を探す
+
+    インデックスのMinHash署名で候補を絞り、候補だけ履歴を読んで
+    文字n-gramのJaccard類似度を計算し直す。
+
+    Args:
+        experience: 体験談
+        threshold: 類似度の下限（省略時は SIMILARITY_THRESHOLD）
+        limit: 最大件数
+
+    Returns:
+        履歴の辞書に "similarity" を加えたもののリスト（類似度の高い順）
+    """
+    if not history_enabled():
+        return []
+    threshold = SIMILARITY_THRESHOLD if threshold is None else threshold
+
+    try:
+        signature = minhash_signature(experience)
+        if not signature:
+            return []
+
+        records = sync_history_index()
+        with _index_lock:
+            # インデックスが変わっていたら、変わった分だけLSHに反映する
+            if _experience_index_source["records"] is not records:
+                _experience_index.sync({
+                    filename: entry.get("minhash", "") for filename, entry in records.items()
+                })
+                _experience_index_source["records"] = records
+            # 推定値は誤差があるので少し緩めに候補を取る
+            candidates = _experience_index.query(signature, threshold=threshold - 0.15, limit=limit * 3)
+
+        matches = []
+        for filename, _ in candidates:
+            try:
+                data = _read_record(filename)
+            except (KeyError, OSError, ValueError):
+                continue
+            similarity = jaccard_similarity(experience, data.get("experience", ""))
+            if similarity >= threshold:
+                matches.append({**data, "similarity": similarity})
+        matches.sort(key=lambda data: data["similarity"], reverse=True)
+        return matches[:limit]
+    except Exception:
+        return []
@@ -0,0 +1,134 @@
+"""
+履歴の書き込みを後回しにするキュー（write-behind）
+
+生成が終わったら履歴の保存はキューに入れるだけにして、画面の更新を待たせない。
+バックグラウンドのスレッドが順に書き込み、失敗したら少し待って再試行する。
+プロセスの終了時（atexit）には、キューに残っている書き込みを終えてから終わる。
+"""
+
+import atexit
+import threading
+import time
+from collections import deque
+
+from metrics import observe
+
+# 1件の書き込みを試す回数と、再試行までの待ち時間（秒、回数ごとに倍にする）
+WRITE_ATTEMPTS = 4
+RETRY_BACKOFF_SEC = 0.2
+
+# 終了時に書き込みを待つ最大秒数
+SHUTDOWN_FLUSH_SEC = 30.0
+
+_condition = threading.Condition()
+_tasks = deque()  # {"task", "on_done", "description", "queued_at"}
+_in_flight = 0
+_thread = None
+_latencies = deque(maxlen=200)
+# abandoned は終了時に書き終わらなかった件数（失敗の内容と同じく last_error にも残す）
+_stats = {"queued": 0, "written": 0, "failed": 0, "retries": 0, "abandoned": 0, "last_error": ""}
+
+def submit(task, on_done=None, description=""):
+    """
+    書き込みをキューに入れる
+
+    Args:
+        task: 書き込む関数（例外が出たら再試行する）
+        on_done: 書き込みが終わったら（失敗しても）呼ぶ関数。引数は成功したかどうか
+        description: エラー表示用の説明（ファイル名など）
+    """
+    global _thread
+    with _condition:
+        _tasks.append({"task": task, "on_done": on_done, "description": description, "queued_at": time.time()})
+        _stats["queued"] += 1
+        if _thread is None or not _thread.is_alive():
+            _thread = threading.Thread(target=_run, name="history-writer", daemon=True)
+            _thread.start()
+        _condition.notify_all()
+
+def _run():
+    global _in_flight
+    while True:
+        with _condition:
+            while not _tasks:
+                _condition.wait()
+            item = _tasks.popleft()
+            _in_flight += 1
+        try:
+            _write(item)
+        finally:
+            with _condition:
+                _in_flight -= 1
+                _condition.notify_all()
+
+def _write(item):
+    """1件書き込む（失敗したら間を空けて再試行する）"""
+    ok = False
+    for attempt in range(WRITE_ATTEMPTS):
+        try:
+            item["task"]()
+            ok = True
+            break
+        except Exception as e:
+            with _condition:
+                _stats["last_error"] = f"{item['description']}: {e}"
+                if attempt + 1 < WRITE_ATTEMPTS:
+                    _stats["retries"] += 1
+            if attempt + 1 < WRITE_ATTEMPTS:
+                time.sleep(RETRY_BACKOFF_SEC * 2 ** attempt)
+
+    latency = time.time() - item["queued_at"]
+    with _condition:
+        if ok:
+            _stats["written"] += 1
+            _latencies.append(latency)
+        else:
+            _stats["failed"] += 1
+    if ok:
+        observe("scenario_history_write_duration_seconds", latency)
+    if item["on_done"] is not None:
+        try:
+            item["on_done"](ok)
+        except Exception:
+            pass
+
+def flush(timeout=None):
+    """
+    キューが空になり、書き込み中のものが終わるまで待つ
+
+    Returns:
+        時間内に終わったかどうか
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    with _condition:
+        while _tasks or _in_flight:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            _condition.wait(remaining)
+    return True
+
+def write_stats():
+    """
+    書き込みの状況（保存待ち・保存済み・失敗の件数と、キューに入ってから書き終わるまでの秒数）
+    """
+    with _condition:
+        now = time.time()
+        latencies = sorted(_latencies)
+        return {
+            **_stats,
+            "pending": len(_tasks) + _in_flight,
+            "oldest_pending_sec": round(now - _tasks[0]["queued_at"], 3) if _tasks else 0.0,
+            "latency_p50_sec": round(latencies[len(latencies) // 2], 3) if latencies else 0.0,
+            "latency_max_sec": round(latencies[-1], 3) if latencies else 0.0,
+        }
+
+def _flush_on_exit():
+    if flush(SHUTDOWN_FLUSH_SEC):
+        return
+    with _condition:
+        pending = len(_tasks) + _in_flight
+        _stats["abandoned"] += pending
+        _stats["last_error"] = f"終了時に{pending}件の書き込みが終わりませんでした"
+
+atexit.register(_flush_on_exit)
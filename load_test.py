@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+同時セッションの負荷テスト
+
+1つのプロセスの中で app.py のセッションを N 個（Streamlit の AppTest で画面なしに）同時に動かし、
+実際の操作の流れを繰り返して、1つのサーバープロセスで何人まで快適に使えるかを測る。
+
+1回の流れ:
+    開く → 履歴を検索 → 検索を消す → 履歴を開く → お気に入り → 編集して保存 → 閉じる → 体験談の入力 → 生成
+
+生成は模擬API（benchmark_prompts の SyntheticClient をストリーミングに対応させたもの）を使う。
+模擬APIの応答時間は、計算した応答時間に --api-latency-scale を掛けた秒数だけ待つ（0 なら待たない）。
+履歴は一時ディレクトリに作るので、output/ の履歴は変わらない。
+
+セッション数の段階ごとに次を出す。
+
+- 操作ごとの p50 / p95 / p99（秒）とエラー数
+- スループット（操作/秒）、CPU使用率（プロセス全体、100% = 1コア）、RSSの最大値
+- 飽和点: 生成以外の操作の p95 が --slo-p95-sec を超えたか、
+  セッションを増やしてもスループットが1割以上伸びなくなった最初のセッション数
+
+    python load_test.py
+    python load_test.py --sessions 1 2 4 8 16 --iterations 3 --output load_report.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unicodedata
+from contextlib import contextmanager
+from unittest import mock
+
+import checkpoints
+import history_cache
+import history_store
+from benchmark_prompts import SyntheticClient, load_corpus, synthetic_scenario, use_client
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(BASE_DIR, "app.py")
+
+INTERACTIONS = (
+    "open", "search", "clear_search", "open_history", "favorite", "edit_save", "close", "enter_experience", "generate",
+)
+
+# 生成は模擬APIの待ち時間と完成後の演出（1秒）を含むので、再実行の快適さの判定には使わない
+RERUN_INTERACTIONS = tuple(name for name in INTERACTIONS if name != "generate")
+
+# 1回の描画を待つ最大秒数
+RUN_TIMEOUT_SEC = 120
+
+# 模擬APIに渡すAPIキー（使われない）
+_LOAD_TEST_API_KEY = "load-test"
+
+# ============================================================================
+# 模擬API（ストリーミング対応）
+# ============================================================================
+
+class _SyntheticStream:
+    """SyntheticClient の応答を行ごとに返すストリーム"""
+
+    def __init__(self, message, delay_sec):
+        self._message = message
+        self._delay_sec = delay_sec
+        self._closed = threading.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    @property
+    def text_stream(self):
+        lines = self._message.content[0].text.splitlines(keepends=True) or [""]
+        for line in lines:
+            if self._closed.wait(self._delay_sec / len(lines)):
+                raise ConnectionError("接続が閉じられました")
+            yield line
+
+    def close(self):
+        self._closed.set()
+
+    def get_final_message(self):
+        return self._message
+
+class LoadTestClient(SyntheticClient):
+    """
+    SyntheticClient にストリーミングと応答待ちを足した模擬クライアント
+
+    latency_scale: 計算した応答時間に掛ける倍率（0 なら待たない）
+    """
+
+    def __init__(self, latency_scale=0.0):
+        super().__init__()
+        self.latency_scale = latency_scale
+        self._lock = threading.Lock()
+
+    def _respond(self, model, max_tokens, temperature, messages):
+        """(応答, 待つ秒数)"""
+        with self._lock:
+            message = super().create(model, max_tokens, temperature, messages)
+            latency = self.calls[-1]["latency_sec"]
+            # セッションをまたいで増え続けないようにする
+            self.calls.clear()
+        return message, latency * self.latency_scale
+
+    def create(self, model, max_tokens, temperature, messages):
+        message, delay_sec = self._respond(model, max_tokens, temperature, messages)
+        time.sleep(delay_sec)
+        return message
+
+    def stream(self, model, max_tokens, temperature, messages):
+        return _SyntheticStream(*self._respond(model, max_tokens, temperature, messages))
+
+# ============================================================================
+# セッション
+# ============================================================================
+
+def _find(elements, key_prefix=None, label_prefix=None):
+    for element in elements:
+        if key_prefix is not None and (element.key or "").startswith(key_prefix):
+            return element
+        if label_prefix is not None and (element.label or "").startswith(label_prefix):
+            return element
+    raise LookupError(key_prefix or label_prefix)
+
+class _Session:
+    """1人分のセッション（AppTest）と、操作ごとの所要時間"""
+
+    def __init__(self, experiences):
+        from streamlit.testing.v1 import AppTest
+
+        self.at = AppTest.from_file(APP_PATH, default_timeout=RUN_TIMEOUT_SEC)
+        self.experiences = experiences
+        self.samples = []  # (操作, 秒, エラー（成功したら ""）)
+
+    def _measure(self, name, action):
+        start = time.perf_counter()
+        try:
+            action()
+            error = str(self.at.exception[0].value) if self.at.exception else ""
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        self.samples.append((name, time.perf_counter() - start, error))
+
+    def run_flow(self, iteration):
+        at = self.at
+        experience = self.experiences[iteration % len(self.experiences)]
+        self._measure("open", at.run)
+        self._measure("search", lambda: at.text_input(key="history_search").set_value(experience[:4]).run())
+        self._measure("clear_search", lambda: at.text_input(key="history_search").set_value("").run())
+        self._measure("open_history", lambda: _find(at.button, key_prefix="hist_link_").click().run())
+        self._measure("favorite", lambda: _find(at.button, key_prefix="fav_detail_").click().run())
+
+        def edit_save():
+            area = _find(at.text_area, key_prefix="edit_")
+            area.set_value(area.value + "\n")
+            _find(at.button, key_prefix="save_edit_").click().run()
+
+        self._measure("edit_save", edit_save)
+        self._measure("close", lambda: _find(at.button, label_prefix="✖️ 閉じる").click().run())
+
+        self._measure(
+            "enter_experience",
+            lambda: _find(at.text_area, label_prefix="シナリオ化したい体験談").set_value(experience).run(),
+        )
+
+        def generate():
+            _find(at.button, label_prefix="🎬 シナリオを生成する").click().run()
+            if "result" not in at.session_state:
+                raise RuntimeError("シナリオが生成されませんでした")
+
+        self._measure("generate", generate)
+
+@contextmanager
+def shared_app_runtime():
+    """
+    AppTest のセッションを複数のスレッドで同時に動かせるようにする
+
+    AppTest は1回の実行ごとに、プロセス全体の Runtime と config.get_option（global.appTest）を差し替えて戻し、
+    スクリプトも毎回コンパイルし直す。そのままでは同時に動かしたセッションが、ほかのセッションの実行中に
+    それを戻してしまい、同時のコンパイルも失敗することがある（Python 3.11 の compile はスレッドセーフでない）。
+    本物のサーバーと同じく、Runtime とコンパイル済みのスクリプトを全セッションで共有する。
+    Runtime は最初の1回（ウォームアップ、計測しない）で作られたものを使う。
+    """
+    from streamlit import config
+    from streamlit.logger import set_log_level
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1 import AppTest, app_test, local_script_runner
+    from streamlit.testing.v1.util import build_mock_config_get_option
+
+    saved = (Runtime.__dict__["instance"], Runtime.__dict__["exists"], config.get_option)
+    script_cache = ScriptCache()
+    captured = []
+
+    def capture(cls):
+        if cls._instance is None:
+            raise RuntimeError("Runtime hasn't been created!")
+        captured.append(cls._instance)
+        return cls._instance
+
+    Runtime.instance = classmethod(capture)
+    try:
+        with mock.patch.object(app_test, "ScriptCache", lambda: script_cache), \
+                mock.patch.object(local_script_runner, "ScriptCache", lambda: script_cache):
+            AppTest.from_file(APP_PATH, default_timeout=RUN_TIMEOUT_SEC).run()
+            if not captured:
+                raise RuntimeError("AppTest の Runtime を取得できませんでした")
+            runtime = captured[0]
+            Runtime.instance = classmethod(lambda cls: runtime)
+            Runtime.exists = classmethod(lambda cls: True)
+            config.get_option = build_mock_config_get_option({"global.appTest": True})
+            # 描画のたびに出る Streamlit の警告で計測が遅くならないようにする
+            # （ログの設定はウォームアップで config を読んだときに戻されるので、その後で変える）
+            set_log_level("error")
+            yield runtime
+    finally:
+        Runtime.instance, Runtime.exists, config.get_option = saved
+
+# ============================================================================
+# 計測
+# ============================================================================
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def _latency_summary(samples):
+    seconds = [sec for _, sec, error in samples if not error]
+    errors = [error for _, _, error in samples if error]
+    return {
+        "count": len(samples),
+        "errors": len(errors),
+        "last_error": errors[-1] if errors else "",
+        "p50_sec": round(_percentile(seconds, 0.5), 3),
+        "p95_sec": round(_percentile(seconds, 0.95), 3),
+        "p99_sec": round(_percentile(seconds, 0.99), 3),
+    }
+
+def rss_mb():
+    """このプロセスの今のRSS（MB、/proc がなければ最大値）"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS はバイト、Linux はKB
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 1024
+
+def run_level(session_count, iterations, experiences, sample_interval_sec=0.1):
+    """
+    session_count 個のセッションで操作の流れを iterations 回ずつ同時に動かす
+
+    Returns:
+        {"sessions", "interactions": {操作: 集計}, "rerun": 集計, "throughput_per_sec", "cpu_percent", "rss_peak_mb", ...}
+    """
+    sessions = [_Session(experiences[i::session_count] or experiences) for i in range(session_count)]
+    barrier = threading.Barrier(session_count + 1)
+    errors = []
+
+    def work(session):
+        barrier.wait()
+        try:
+            for iteration in range(iterations):
+                session.run_flow(iteration)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(s,), daemon=True) for s in sessions]
+    for thread in threads:
+        thread.start()
+
+    rss_peak = rss_mb()
+    barrier.wait()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    while any(thread.is_alive() for thread in threads):
+        rss_peak = max(rss_peak, rss_mb())
+        next(thread for thread in threads if thread.is_alive()).join(sample_interval_sec)
+    wall = time.perf_counter() - start_wall
+    cpu = time.process_time() - start_cpu
+
+    samples = [sample for session in sessions for sample in session.samples]
+    return {
+        "sessions": session_count,
+        "iterations": iterations,
+        "interactions": {
+            name: _latency_summary([s for s in samples if s[0] == name]) for name in INTERACTIONS
+        },
+        "rerun": _latency_summary([s for s in samples if s[0] in RERUN_INTERACTIONS]),
+        "errors": sum(1 for _, _, error in samples if error) + len(errors),
+        "wall_sec": round(wall, 2),
+        "throughput_per_sec": round(len(samples) / wall, 2) if wall > 0 else 0.0,
+        "cpu_percent": round(100 * cpu / wall, 1) if wall > 0 else 0.0,
+        "rss_peak_mb": round(rss_peak, 1),
+    }
+
+def find_saturation(levels, slo_p95_sec, min_gain=1.1):
+    """
+    飽和点（快適に使えなくなる最初のセッション数）と理由
+
+    Returns:
+        (セッション数 または None, 理由)
+    """
+    previous = None
+    for level in levels:
+        if level["rerun"]["p95_sec"] > slo_p95_sec:
+            return level["sessions"], f"操作の p95 が {level['rerun']['p95_sec']:.2f}秒（目標 {slo_p95_sec}秒）を超えた"
+        if previous is not None and level["throughput_per_sec"] < previous["throughput_per_sec"] * min_gain:
+            return level["sessions"], (
+                f"スループットが伸びない（{previous['throughput_per_sec']} → {level['throughput_per_sec']} 操作/秒）"
+            )
+        previous = level
+    return None, "計測した範囲では飽和していない"
+
+def _seed_history(count, experiences):
+    for i in range(count):
+        experience = f"{experiences[i % len(experiences)]}（{i}）"
+        history_store.save_history(experience, synthetic_scenario(experience))
+    history_store.flush_history(timeout=60)
+
+def run_load_test(session_levels, iterations=2, history=30, latency_scale=0.0, slo_p95_sec=1.0, corpus=None):
+    """
+    セッション数の段階ごとに負荷テストを行う
+
+    履歴は一時ディレクトリに作り、終わったら元の保存先に戻す。
+
+    Returns:
+        {"levels": [...], "saturation_sessions", "saturation_reason", "settings"}
+    """
+    experiences = [item["experience"] for item in (corpus if corpus is not None else load_corpus())]
+    saved = (history_store.HISTORY_DIR, history_store.BACKEND, history_store.is_streamlit_cloud, checkpoints._memory)
+    saved_api_key = os.environ.get("ANTHROPIC_API_KEY")
+    with tempfile.TemporaryDirectory() as directory:
+        history_store.HISTORY_DIR = directory
+        history_store.BACKEND = "local"
+        history_store.is_streamlit_cloud = lambda: False
+        checkpoints._memory = {}
+        history_cache.invalidate()
+        # st.secrets は AppTest が実行ごとに差し替えるので、APIキーは環境変数で渡す
+        os.environ["ANTHROPIC_API_KEY"] = _LOAD_TEST_API_KEY
+        try:
+            with use_client(LoadTestClient(latency_scale)):
+                _seed_history(history, experiences)
+                with shared_app_runtime():
+                    levels = [run_level(count, iterations, experiences) for count in session_levels]
+                history_store.flush_history(timeout=60)
+        finally:
+            (history_store.HISTORY_DIR, history_store.BACKEND,
+             history_store.is_streamlit_cloud, checkpoints._memory) = saved
+            if saved_api_key is None:
+                os.environ.pop("ANTHROPIC_API_KEY", None)
+            else:
+                os.environ["ANTHROPIC_API_KEY"] = saved_api_key
+            history_cache.invalidate()
+
+    saturation, reason = find_saturation(levels, slo_p95_sec)
+    return {
+        "levels": levels,
+        "saturation_sessions": saturation,
+        "saturation_reason": reason,
+        "settings": {
+            "iterations": iterations, "history": history,
+            "api_latency_scale": latency_scale, "slo_p95_sec": slo_p95_sec,
+        },
+    }
+
+# ============================================================================
+# 表示
+# ============================================================================
+
+def _display_width(text):
+    """全角文字を2桁として数えた表示幅"""
+    return sum(2 if unicodedata.east_asian_width(char) in ("F", "W") else 1 for char in text)
+
+def _table(rows):
+    widths = [max(_display_width(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join(
+        "  ".join(" " * (width - _display_width(cell)) + cell for cell, width in zip(row, widths))
+        for row in rows
+    )
+
+def format_report(report):
+    """負荷テストの結果を表にする"""
+    lines = []
+    summary = [["セッション", "操作/秒", "CPU%", "RSS MB", "p50秒", "p95秒", "p99秒", "エラー"]]
+    for level in report["levels"]:
+        rerun = level["rerun"]
+        summary.append([
+            str(level["sessions"]), f"{level['throughput_per_sec']:.2f}", f"{level['cpu_percent']:.0f}",
+            f"{level['rss_peak_mb']:.0f}", f"{rerun['p50_sec']:.3f}", f"{rerun['p95_sec']:.3f}",
+            f"{rerun['p99_sec']:.3f}", str(level["errors"]),
+        ])
+    lines += ["生成以外の操作", _table(summary), ""]
+
+    for level in report["levels"]:
+        rows = [["操作", "回数", "p50秒", "p95秒", "p99秒", "エラー"]]
+        for name, stats in level["interactions"].items():
+            rows.append([
+                name, str(stats["count"]), f"{stats['p50_sec']:.3f}", f"{stats['p95_sec']:.3f}",
+                f"{stats['p99_sec']:.3f}", str(stats["errors"]),
+            ])
+        lines += [f"{level['sessions']}セッション", _table(rows), ""]
+
+    saturation = report["saturation_sessions"]
+    lines.append(f"飽和点: {saturation if saturation is not None else '-'}セッション（{report['saturation_reason']}）")
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="同時セッションの負荷テスト")
+    parser.add_argument("--sessions", nargs="+", type=int, default=[1, 2, 4, 8], help="同時セッション数の段階")
+    parser.add_argument("--iterations", type=int, default=2, help="セッションごとに操作の流れを繰り返す回数")
+    parser.add_argument("--history", type=int, default=30, help="あらかじめ作っておく履歴の件数")
+    parser.add_argument("--api-latency-scale", type=float, default=0.0, help="模擬APIの応答時間の倍率（0 なら待たない）")
+    parser.add_argument("--slo-p95-sec", type=float, default=1.0, help="生成以外の操作の p95 の目標（秒）")
+    parser.add_argument("--output", help="結果をJSONで保存するパス")
+    args = parser.parse_args(argv)
+
+    report = run_load_test(
+        args.sessions, args.iterations, args.history, args.api_latency_scale, args.slo_p95_sec
+    )
+    print(format_report(report))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 1 if any(level["errors"] for level in report["levels"]) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,287 @@
+"""
+動いているアプリのメトリクス（Prometheus のテキスト形式）
+
+プロセス内にカウンタ・ゲージ・ヒストグラムを持ち、生成パイプライン（API呼び出し・ステージ）と
+履歴の書き込みから更新する。環境変数 SCENARIO_METRICS_PORT を指定すると、Streamlit とは別の
+ポートで /metrics を返す HTTP サーバーを立てるので、既存の監視からスクレイプできる。
+
+- 更新（inc / add_gauge / observe）はロックを1回取って数を足すだけにし、生成の処理を遅くしない
+- 履歴の件数・キャッシュのヒット率・キューの深さなど、すでに各モジュールで数えているものは
+  スクレイプされたときに読み出す（collect）ので、普段は何もしない
+
+    SCENARIO_METRICS_PORT=8511 streamlit run app.py --server.port 8510
+    curl http://127.0.0.1:8511/metrics
+"""
+
+import bisect
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PORT_ENV = "SCENARIO_METRICS_PORT"
+HOST_ENV = "SCENARIO_METRICS_HOST"
+# 既定ではこのマシンからだけ受け付ける
+DEFAULT_HOST = "127.0.0.1"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# API呼び出し・生成にかかる秒数の区切り（初稿は30〜60秒かかる）
+LATENCY_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120, 180, 300)
+# 履歴の書き込み（キューに入ってから書き終わるまで）の秒数の区切り
+WRITE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# 更新するメトリクス: 名前 -> (種類, 説明, ヒストグラムの区切り)
+METRICS = {
+    "scenario_api_requests_total": ("counter", "API呼び出しの数（status はHTTPステータス・ok・cancelled・error）", None),
+    "scenario_api_request_duration_seconds": ("histogram", "API呼び出し1回の秒数", LATENCY_BUCKETS),
+    "scenario_generations_in_flight": ("gauge", "実行中の生成の数", None),
+    "scenario_generations_total": ("counter", "終わった生成の数（status は completed・failed・cancelled）", None),
+    "scenario_generation_duration_seconds": ("histogram", "生成1回（チェックポイントの続きから完成まで）の秒数", LATENCY_BUCKETS),
+    "scenario_stage_duration_seconds": ("histogram", "ステージ（要約・初稿・自動リライト・改行の整形）ごとの秒数", LATENCY_BUCKETS),
+    "scenario_rewrite_fallbacks_total": ("counter", "自動リライトに失敗して初稿をそのまま返した数", None),
+    "scenario_history_write_duration_seconds": ("histogram", "履歴の書き込みがキューに入ってから終わるまでの秒数", WRITE_BUCKETS),
+    "scenario_metrics_collector_errors_total": ("counter", "スクレイプのときに読み出せなかった回数（collector は関数名）", None),
+}
+
+_lock = threading.Lock()
+_values = {name: {} for name in METRICS}  # 名前 -> {ラベルのタプル: 値 または ヒストグラム}
+_collectors = []
+_server = None
+_server_error = None  # サーバーを立てられなかった理由（画面に出す）
+_server_lock = threading.Lock()
+
+# ============================================================================
+# 更新
+# ============================================================================
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+def inc(name, value=1, **labels):
+    """カウンタを増やす"""
+    key = _key(labels)
+    with _lock:
+        values = _values[name]
+        values[key] = values.get(key, 0) + value
+
+def add_gauge(name, delta, **labels):
+    """ゲージを delta だけ増減する"""
+    inc(name, delta, **labels)
+
+def observe(name, value, **labels):
+    """ヒストグラムに値を1つ加える"""
+    buckets = METRICS[name][2]
+    index = bisect.bisect_left(buckets, value)
+    key = _key(labels)
+    with _lock:
+        histogram = _values[name].get(key)
+        if histogram is None:
+            histogram = _values[name][key] = {"buckets": [0] * (len(buckets) + 1), "sum": 0.0, "count": 0}
+        histogram["buckets"][index] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+def register_collector(collector):
+    """
+    スクレイプのたびに呼ぶ関数を登録する
+
+    collector() は [(名前, 種類, 説明, [(ラベルの辞書, 値), ...]), ...] を返す
+    """
+    with _lock:
+        if collector not in _collectors:
+            _collectors.append(collector)
+
+def reset():
+    """更新したメトリクスを消す（テスト用）"""
+    with _lock:
+        for values in _values.values():
+            values.clear()
+
+# ============================================================================
+# 各モジュールで数えているもの（スクレイプのときに読み出す）
+# ============================================================================
+
+def _collect_app_state():
+    # 各モジュールは metrics を読み込むので、ここで読み込む
+    import history_cache
+    import history_writer
+    from batch_generation import list_queue
+    from cancellation import get_cancellation_stats
+    from history_store import get_statistics
+    from model_router import get_route_stats, queue_depth
+    from prefetch import get_prefetch_stats
+
+    routes = get_route_stats()
+    cache = history_cache.cache_stats()
+    writes = history_writer.write_stats()
+    cancellations = get_cancellation_stats()
+    prefetch = get_prefetch_stats()
+    return [
+        ("scenario_api_requests_in_flight", "gauge", "実行中のAPI呼び出しの数", [({}, queue_depth())]),
+        ("scenario_api_tokens_total", "counter", "API呼び出しのトークン数（ルートごと）", [
+            ({"route": row["route"], "model": row["model"], "kind": kind}, row[f"{kind}_tokens"])
+            for row in routes for kind in ("input", "output")
+        ]),
+        ("scenario_api_cost_usd_total", "counter", "API呼び出しの料金の見積もり（USD、ルートごと）", [
+            ({"route": row["route"], "model": row["model"]}, row["cost_usd"]) for row in routes
+        ]),
+        ("scenario_history_records", "gauge", "保存されている履歴の件数", [({}, get_statistics()["total_count"])]),
+        ("scenario_history_cache_entries", "gauge", "履歴キャッシュのエントリ数", [({}, cache["entries"])]),
+        ("scenario_history_cache_bytes", "gauge", "履歴キャッシュの使用量（バイト）", [({}, cache["bytes"])]),
+        ("scenario_history_cache_lookups_total", "counter", "履歴キャッシュの読み込み（result は hit・miss）", [
+            ({"result": "hit"}, cache["hits"]), ({"result": "miss"}, cache["misses"]),
+        ]),
+        ("scenario_history_cache_hit_ratio", "gauge", "履歴キャッシュのヒット率", [({}, cache["hit_rate"])]),
+        ("scenario_history_cache_evictions_total", "counter", "履歴キャッシュから追い出したエントリの数", [
+            ({}, cache["evictions"]),
+        ]),
+        ("scenario_history_writes_pending", "gauge", "保存待ちの履歴の書き込みの数", [({}, writes["pending"])]),
+        ("scenario_history_writes_total", "counter", "履歴の書き込みの数（result は written・failed・abandoned）", [
+            ({"result": "written"}, writes["written"]), ({"result": "failed"}, writes["failed"]),
+            ({"result": "abandoned"}, writes["abandoned"]),
+        ]),
+        ("scenario_history_write_retries_total", "counter", "履歴の書き込みの再試行の数", [({}, writes["retries"])]),
+        ("scenario_batch_queue_depth", "gauge", "夜間の一括生成を待っている体験談の数", [({}, len(list_queue()))]),
+        ("scenario_active_sessions", "gauge", "アクティブなブラウザセッションの数", [
+            ({}, len(history_cache.active_sessions())),
+        ]),
+        ("scenario_cancellations_total", "counter", "キャンセルした生成の数", [
+            ({"reason": reason}, count) for reason, count in cancellations["reasons"].items()
+        ]),
+        ("scenario_prefetch_total", "counter", "初稿の先読みの数（result は hit・partial_hit・miss）", [
+            ({"result": "hit"}, prefetch["hits"]),
+            ({"result": "partial_hit"}, prefetch["partial_hits"]),
+            ({"result": "miss"}, prefetch["misses"]),
+        ]),
+    ]
+
+register_collector(_collect_app_state)
+
+# ============================================================================
+# テキスト形式
+# ============================================================================
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+def _render_metric(lines, name, kind, help_text, samples):
+    lines.append(f"# HELP {name} {_escape(help_text)}")
+    lines.append(f"# TYPE {name} {kind}")
+    for labels, value in samples:
+        lines.append(f"{name}{_labels(labels)} {_number(value)}")
+
+def render():
+    """すべてのメトリクスを Prometheus のテキスト形式で返す"""
+    with _lock:
+        collectors = list(_collectors)
+    # 読み出せなかったことを同じスクレイプの数に含めるため、先に読み出す
+    collected = []
+    for collector in collectors:
+        try:
+            rows = list(collector())
+        except Exception:
+            inc("scenario_metrics_collector_errors_total", collector=getattr(collector, "__name__", repr(collector)))
+            continue
+        collected.extend(rows)
+
+    lines = []
+    with _lock:
+        snapshot = {
+            name: {key: dict(value, buckets=list(value["buckets"])) if isinstance(value, dict) else value
+                   for key, value in values.items()}
+            for name, values in _values.items()
+        }
+
+    for name, (kind, help_text, buckets) in METRICS.items():
+        values = snapshot[name]
+        if kind != "histogram":
+            _render_metric(lines, name, kind, help_text, sorted(values.items()))
+            continue
+        lines.append(f"# HELP {name} {_escape(help_text)}")
+        lines.append(f"# TYPE {name} histogram")
+        for key, histogram in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(list(buckets) + [float("inf")], histogram["buckets"]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(key, [('le', _number(float(bound)))])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(key)} {_number(histogram['sum'])}")
+            lines.append(f"{name}_count{_labels(key)} {histogram['count']}")
+
+    for name, kind, help_text, samples in collected:
+        _render_metric(lines, name, kind, help_text, [(_key(labels), value) for labels, value in samples])
+    return "\n".join(lines) + "\n"
+
+# ============================================================================
+# HTTP サーバー
+# ============================================================================
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def metrics_port():
+    """環境変数で指定されたポート（指定がなければ None）"""
+    try:
+        return int(os.environ[PORT_ENV])
+    except (KeyError, ValueError):
+        return None
+
+def metrics_server_error():
+    """サーバーを立てられなかった理由（立てていない・立てられたときは None）"""
+    with _server_lock:
+        return _server_error
+
+def start_metrics_server(port=None, host=None):
+    """
+    /metrics を返すサーバーを別スレッドで立てる（プロセスで1回だけ。2回目以降は同じサーバーを返す）
+
+    Args:
+        port: ポート（省略時は環境変数 SCENARIO_METRICS_PORT。どちらもなければ立てない。0 なら空いているポート）
+        host: 受け付けるアドレス（省略時は環境変数 SCENARIO_METRICS_HOST、既定は 127.0.0.1）
+
+    Returns:
+        サーバー（server.server_address でアドレスがわかる）。立てられなければ None
+        （理由は metrics_server_error() でわかる）
+    """
+    global _server, _server_error
+    with _server_lock:
+        if _server is not None:
+            return _server
+        port = metrics_port() if port is None else port
+        if port is None:
+            return None
+        host = host or os.getenv(HOST_ENV, DEFAULT_HOST)
+        try:
+            server = ThreadingHTTPServer((host, port), _Handler)
+        except OSError as e:
+            # 同じポートを別のプロセスが使っているなど
+            _server_error = f"{host}:{port}: {e}"
+            return None
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+        _server = server
+        _server_error = None
+        return server
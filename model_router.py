@@ -0,0 +1,226 @@
+"""
+パイプラインのステージごとのモデル選択（ルーティング）
+
+config/model_routes.json のルールに従って、入力の長さ・同時実行数・
+ユーザー区分・予算の残りからステージごとのモデルを選ぶ。
+ルールは上から順に評価し、最初に条件を満たしたものを使う。
+どれも満たさなければステージの default を使う。
+
+設定ファイルは更新時刻が変わったら読み直すので、コードを変えずに
+モデルの切り替えやルールの追加ができる。
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from metrics import inc, observe
+
+ROUTES_PATH = os.getenv(
+    "SCENARIO_MODEL_ROUTES",
+    os.path.join(os.path.dirname(__file__), "config", "model_routes.json"),
+)
+
+# 設定ファイルが読めない場合に使うモデル
+FALLBACK_MODELS = {
+    "draft": "claude-sonnet-4-5-20250929",
+    "outline": "claude-sonnet-4-5-20250929",
+    "expand": "claude-sonnet-4-5-20250929",
+    "rewrite": "claude-haiku-3-5-20250313",
+    "rewrite_patch": "claude-haiku-3-5-20250313",
+    "condense": "claude-haiku-3-5-20250313",
+    "regenerate": "claude-sonnet-4-5-20250929",
+}
+
+DEFAULT_USER_TIER = os.getenv("SCENARIO_USER_TIER", "standard")
+
+# パーセンタイル計算に使う直近の記録数
+LATENCY_WINDOW = 500
+
+_lock = threading.Lock()
+_config_cache = {"mtime": None, "config": None}
+_in_flight = 0
+_route_stats = {}
+
+# ============================================================================
+# 設定の読み込み
+# ============================================================================
+
+def load_routes_config():
+    """ルーティング設定を読み込む（更新されていればプロセス内で読み直す）"""
+    try:
+        mtime = os.path.getmtime(ROUTES_PATH)
+    except OSError:
+        return {"prices_per_mtok": {}, "stages": {}}
+
+    with _lock:
+        if _config_cache["mtime"] != mtime:
+            try:
+                with open(ROUTES_PATH, "r", encoding="utf-8") as f:
+                    _config_cache["config"] = json.load(f)
+            except (OSError, ValueError):
+                # 編集途中の壊れた設定は無視して、前回の設定を使い続ける
+                if _config_cache["config"] is None:
+                    _config_cache["config"] = {"prices_per_mtok": {}, "stages": {}}
+            _config_cache["mtime"] = mtime
+        return _config_cache["config"]
+
+# ============================================================================
+# ルート選択
+# ============================================================================
+
+def _matches(when, context):
+    """ルールの条件をすべて満たすかどうか（値が不明な条件は満たさない扱い）"""
+    checks = {
+        "min_input_tokens": lambda v: context["input_tokens"] >= v,
+        "max_input_tokens": lambda v: context["input_tokens"] <= v,
+        "min_queue_depth": lambda v: context["queue_depth"] >= v,
+        "max_queue_depth": lambda v: context["queue_depth"] <= v,
+        "user_tiers": lambda v: context["user_tier"] in v,
+        "min_budget_remaining": lambda v: context["budget_remaining"] is not None and context["budget_remaining"] >= v,
+        "max_budget_remaining": lambda v: context["budget_remaining"] is not None and context["budget_remaining"] <= v,
+    }
+    for key, value in when.items():
+        check = checks.get(key)
+        if check is None or not check(value):
+            return False
+    return True
+
+def choose_route(stage, input_tokens, user_tier=None, budget_remaining=None):
+    """
+    ステージのモデルを選ぶ
+
+    Args:
+        stage: パイプラインのステージ名（"draft" / "outline" / "expand" / "rewrite" / "rewrite_patch" / "condense" / "regenerate"）
+        input_tokens: 推定入力トークン数
+        user_tier: ユーザー区分（省略時は環境変数 SCENARIO_USER_TIER）
+        budget_remaining: 予算の残り（0〜1の割合、不明ならNone）
+
+    Returns:
+        {"name": ルート名, "model": モデルID, "stage": ステージ名}
+    """
+    stage_config = load_routes_config().get("stages", {}).get(stage, {})
+    context = {
+        "input_tokens": input_tokens,
+        "queue_depth": queue_depth(),
+        "user_tier": user_tier or DEFAULT_USER_TIER,
+        "budget_remaining": budget_remaining,
+    }
+
+    for route in stage_config.get("routes", []):
+        if route.get("model") and _matches(route.get("when", {}), context):
+            return {"name": route.get("name", route["model"]), "model": route["model"], "stage": stage}
+
+    model = stage_config.get("default") or FALLBACK_MODELS.get(stage, FALLBACK_MODELS["draft"])
+    return {"name": f"{stage}:default", "model": model, "stage": stage}
+
+# ============================================================================
+# 同時実行数（キューの深さ）
+# ============================================================================
+
+def queue_depth():
+    """このプロセスで実行中のAPI呼び出し数"""
+    return _in_flight
+
+@contextmanager
+def track_call(route):
+    """
+    API呼び出しを囲んで、実行中の数と所要時間・成否を記録する
+
+    使い方:
+        with track_call(route) as call:
+            message = client.messages.create(...)
+            call["usage"] = message.usage
+    """
+    global _in_flight
+    with _lock:
+        _in_flight += 1
+    call = {"usage": None, "cancelled": False}
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield call
+    except BaseException as e:
+        # キャンセルで止めた呼び出し（call["cancelled"]）はエラーに数えない
+        _record(route, time.perf_counter() - start, None, failed=not call["cancelled"])
+        status = "cancelled" if call["cancelled"] else str(getattr(e, "status_code", None) or "error")
+        raise
+    else:
+        _record(route, time.perf_counter() - start, call["usage"], failed=False)
+    finally:
+        # 失敗は APIのHTTPステータスごと（接続エラーなどは error）に数える
+        inc("scenario_api_requests_total", stage=route["stage"], model=route["model"], status=status)
+        observe("scenario_api_request_duration_seconds", time.perf_counter() - start, stage=route["stage"])
+        with _lock:
+            _in_flight -= 1
+
+# ============================================================================
+# ルートごとの統計
+# ============================================================================
+
+def estimate_cost(model, input_tokens, output_tokens):
+    """料金表からコスト（USD）を計算する"""
+    prices = load_routes_config().get("prices_per_mtok", {}).get(model)
+    if not prices:
+        return 0.0
+    return (input_tokens * prices.get("input", 0) + output_tokens * prices.get("output", 0)) / 1_000_000
+
+def _record(route, elapsed, usage, failed):
+    """1回の呼び出しを統計に加える"""
+    input_tokens = getattr(usage, "input_tokens", 0) or 0
+    output_tokens = getattr(usage, "output_tokens", 0) or 0
+    cost = estimate_cost(route["model"], input_tokens, output_tokens)
+
+    with _lock:
+        stats = _route_stats.setdefault(route["name"], {
+            "route": route["name"],
+            "stage": route["stage"],
+            "model": route["model"],
+            "calls": 0,
+            "errors": 0,
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "cost_usd": 0.0,
+            "latencies": deque(maxlen=LATENCY_WINDOW),
+        })
+        stats["model"] = route["model"]
+        stats["calls"] += 1
+        stats["errors"] += int(failed)
+        stats["input_tokens"] += input_tokens
+        stats["output_tokens"] += output_tokens
+        stats["cost_usd"] += cost
+        stats["latencies"].append(elapsed)
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def get_route_stats():
+    """
+    ルートごとのレイテンシ・コストの集計
+
+    Returns:
+        ルートごとの辞書のリスト
+    """
+    with _lock:
+        rows = []
+        for stats in _route_stats.values():
+            latencies = sorted(stats["latencies"])
+            rows.append({
+                "route": stats["route"],
+                "stage": stats["stage"],
+                "model": stats["model"],
+                "calls": stats["calls"],
+                "errors": stats["errors"],
+                "p50_sec": round(_percentile(latencies, 0.5), 2),
+                "p95_sec": round(_percentile(latencies, 0.95), 2),
+                "input_tokens": stats["input_tokens"],
+                "output_tokens": stats["output_tokens"],
+                "cost_usd": round(stats["cost_usd"], 4),
+            })
+        return sorted(rows, key=lambda row: row["route"])
@@ -0,0 +1,318 @@
+"""
+入力中の初稿の先読み（投機的な生成）
+
+待ち時間のほとんどは、生成ボタンを押してから始まる初稿の生成（30〜60秒）にかかっている。
+先読みを有効にすると、体験談の入力が debounce 秒のあいだ変わらなかった時点で裏で初稿の生成を始め、
+入力が変わったら取り消す。生成ボタンが押されたら、書き上がった初稿（または書きかけの初稿の続き）を
+チェックポイントの初稿として引き継ぎ、自動リライトから続ける。
+
+先読みするのは一括生成（single）で、体験談を要約しないときだけ（初稿が体験談だけで決まるとき）。
+当たった割合と、使われずに捨てた初稿のトークン数・料金をプロセス全体で集計するので、
+debounce（環境変数 SCENARIO_PREFETCH_DEBOUNCE_SEC）を調整する目安にする。
+
+使い方（state は st.session_state など、セッションごとの辞書）:
+    observe_input(state, experience)                   # 再実行のたびに。入力が変われば先読みを取り消す
+    maybe_start(state, api_key, experience, settings)  # 入力が落ち着いていれば先読みを始める
+    speculative = take(state, experience, settings)    # 生成ボタンが押されたら引き取る
+    checkpoint = adopt(speculative, checkpoint)        # 初稿をチェックポイントに入れる
+"""
+
+import os
+import threading
+import time
+
+from budget import use_user
+from cancellation import CancelToken, GenerationCancelled
+from model_router import estimate_cost
+from profiler import run_in_context
+from scenario_pipeline import build_draft_prompt, generate_scenario
+from token_estimator import estimate_tokens_raw
+
+PREFETCH_ENV = "SCENARIO_PREFETCH"
+DEBOUNCE_ENV = "SCENARIO_PREFETCH_DEBOUNCE_SEC"
+DEFAULT_DEBOUNCE_SEC = 4.0
+# 入力が落ち着いたか・先読みが終わったかを確かめる間隔（画面の fragment の run_every）
+POLL_SEC = 1.0
+
+STATE_KEY = "speculative_draft"
+TEXT_KEY = "prefetch_text"
+CHANGED_AT_KEY = "prefetch_changed_at"
+
+_lock = threading.Lock()
+_stats = {
+    "started": 0,
+    "hits": 0,  # 書き上がった初稿を引き継いだ
+    "partial_hits": 0,  # 書きかけの初稿を引き継いだ
+    "misses": 0,  # 入力が変わって取り消した・失敗した
+    "wasted_input_tokens": 0,
+    "wasted_output_tokens": 0,
+    "wasted_cost_usd": 0.0,
+    "saved_sec": 0.0,  # 生成ボタンを押す前に済んでいた初稿の生成時間
+}
+
+
+def env_prefetch_enabled():
+    return os.getenv(PREFETCH_ENV, "").strip().lower() in ("1", "true", "on", "yes")
+
+def debounce_sec():
+    """先読みを始めるまでに入力が変わらずにいる秒数"""
+    try:
+        return max(0.0, float(os.getenv(DEBOUNCE_ENV, DEFAULT_DEBOUNCE_SEC)))
+    except ValueError:
+        return DEFAULT_DEBOUNCE_SEC
+
+def prefetch_eligible(settings):
+    """この設定で、初稿を先読みできるか"""
+    return settings.get("generation_mode", "single") == "single" and not settings.get("condense")
+
+
+class SpeculativeDraft:
+    """裏で生成している初稿（スレッドをまたいで共有する）"""
+
+    def __init__(self, api_key, experience, user=None):
+        self.api_key = api_key
+        self.experience = experience
+        self.user = user
+        self.token = CancelToken()
+        self.meta = {}
+        self.status = "pending"  # pending / running / done / failed / cancelled
+        self.output = None
+        self.error = ""
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+        self._chunks = []
+        self._listeners = []
+        self._discarded = False  # 取り消して、使わないことにした
+        self._waste_recorded = False
+        self._done = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.status = "running"
+        self.started = time.monotonic()
+        self._thread = threading.Thread(target=run_in_context(self._run), name="speculative-draft", daemon=True)
+        self._thread.start()
+        with _lock:
+            _stats["started"] += 1
+        return self
+
+    def _run(self):
+        try:
+            with use_user(self.user):
+                output = generate_scenario(
+                    self.api_key, self.experience, meta=self.meta, on_text=self._on_text, cancel=self.token
+                )
+            if output.startswith("エラーが発生しました"):
+                self.status, self.error = "failed", output
+            else:
+                self.status, self.output = "done", output
+        except GenerationCancelled:
+            self.status = "cancelled"
+        except Exception as e:
+            self.status, self.error = "failed", str(e)
+        finally:
+            with self._lock:
+                self.finished = time.monotonic()
+            self._record_if_discarded()
+            self._done.set()
+
+    def _on_text(self, chunk):
+        with self._lock:
+            self._chunks.append(chunk)
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(chunk)
+
+    def text(self):
+        """ここまでに届いた初稿"""
+        with self._lock:
+            return "".join(self._chunks)
+
+    def follow(self, on_text):
+        """
+        ここまでの初稿を on_text に渡し、以降に届く断片も渡す
+
+        Returns:
+            渡すのをやめる関数
+        """
+        with self._lock:
+            received = "".join(self._chunks)
+            self._listeners.append(on_text)
+        if received:
+            on_text(received)
+
+        def forget():
+            with self._lock:
+                if on_text in self._listeners:
+                    self._listeners.remove(on_text)
+        return forget
+
+    @property
+    def running(self):
+        return not self._done.is_set() and self.status == "running"
+
+    def wait(self, timeout=None):
+        """終わるまで待つ（終わったかを返す）"""
+        return self._done.wait(timeout)
+
+    def cancel(self, reason="入力の変更"):
+        """
+        取り消す（生成が止まるのは待たない）
+
+        Streamlit の再実行の中から呼ぶので、使われずに捨てた分は生成が止まってから集計に加える。
+        """
+        with self._lock:
+            self._discarded = True
+        self.token.cancel(reason)
+        self._record_if_discarded()
+
+    def _record_if_discarded(self):
+        """取り消されていて生成も止まっていれば、捨てた分を1回だけ集計に加える"""
+        with self._lock:
+            if not self._discarded or self.finished is None or self._waste_recorded:
+                return
+            self._waste_recorded = True
+        _record_waste(self)
+
+
+def _usage(speculative):
+    """先読みで使った（と見積もった）トークン数と料金"""
+    draft = speculative.meta.get("draft") or {}
+    input_tokens = draft.get("input_tokens") or estimate_tokens_raw(build_draft_prompt(speculative.experience))
+    output_tokens = draft.get("output_tokens") or estimate_tokens_raw(speculative.text())
+    cost = estimate_cost(draft["model"], input_tokens, output_tokens) if draft.get("model") else 0.0
+    return input_tokens, output_tokens, cost
+
+def _record_waste(speculative):
+    if speculative.status == "pending":
+        return
+    input_tokens, output_tokens, cost = _usage(speculative)
+    with _lock:
+        _stats["misses"] += 1
+        _stats["wasted_input_tokens"] += input_tokens
+        _stats["wasted_output_tokens"] += output_tokens
+        _stats["wasted_cost_usd"] += cost
+
+def get_prefetch_stats():
+    """
+    先読みの集計
+
+    Returns:
+        {"started", "hits", "partial_hits", "misses", "hit_rate", "wasted_input_tokens",
+         "wasted_output_tokens", "wasted_cost_usd", "saved_sec"}
+    """
+    with _lock:
+        stats = dict(_stats)
+    used = stats["hits"] + stats["partial_hits"]
+    stats["hit_rate"] = used / stats["started"] if stats["started"] else 0.0
+    stats["wasted_cost_usd"] = round(stats["wasted_cost_usd"], 4)
+    stats["saved_sec"] = round(stats["saved_sec"], 1)
+    return stats
+
+# ============================================================================
+# セッションごとの状態
+# ============================================================================
+
+def observe_input(state, experience, now=None):
+    """
+    入力を記録する（再実行のたびに呼ぶ）
+
+    入力が変わったら、変わった時刻を残し、前の入力の先読みを取り消す。
+    """
+    if state.get(TEXT_KEY) == experience:
+        return
+    state[TEXT_KEY] = experience
+    state[CHANGED_AT_KEY] = now if now is not None else time.monotonic()
+    speculative = state.get(STATE_KEY)
+    if speculative is not None and speculative.experience != experience:
+        state.pop(STATE_KEY, None)
+        speculative.cancel("入力の変更")
+
+def maybe_start(state, api_key, experience, settings=None, user=None, debounce=None, now=None):
+    """
+    入力が debounce 秒変わっていなければ、先読みを始める
+
+    Returns:
+        先読み（始めていない・始められなければ None）
+    """
+    if not prefetch_eligible(settings or {}):
+        discard(state, "設定の変更")
+        return None
+    speculative = state.get(STATE_KEY)
+    if speculative is not None:
+        return speculative
+    if not api_key or not experience.strip():
+        return None
+    if state.get(TEXT_KEY) != experience:
+        observe_input(state, experience, now)
+    now = now if now is not None else time.monotonic()
+    if now - state.get(CHANGED_AT_KEY, now) < (debounce_sec() if debounce is None else debounce):
+        return None
+    speculative = SpeculativeDraft(api_key, experience, user).start()
+    state[STATE_KEY] = speculative
+    return speculative
+
+def discard(state, reason="先読みの停止"):
+    """先読みしていれば取り消す（先読みを無効にしたときなど）"""
+    speculative = state.pop(STATE_KEY, None)
+    if speculative is not None:
+        speculative.cancel(reason)
+
+def pending_prefetch(state, experience):
+    """入力が落ち着くのを待っているか、先読みが生成中か（画面で確かめ続ける必要があるか）"""
+    speculative = state.get(STATE_KEY)
+    if speculative is None:
+        return bool(experience.strip())
+    return speculative.running
+
+def take(state, experience, settings=None):
+    """
+    生成ボタンが押されたときに、この入力の先読みを引き取る（同じ入力・設定の先読みがなければ None）
+
+    失敗した・取り消された先読みは捨てる。
+    """
+    speculative = state.pop(STATE_KEY, None)
+    if speculative is None:
+        return None
+    if speculative.experience != experience or not prefetch_eligible(settings or {}) \
+            or speculative.status in ("failed", "cancelled"):
+        speculative.cancel("設定の変更")
+        return None
+    with _lock:
+        _stats["hits" if speculative.status == "done" else "partial_hits"] += 1
+        _stats["saved_sec"] += (speculative.finished or time.monotonic()) - speculative.started
+    return speculative
+
+def adopt(speculative, checkpoint, cancel=None, on_progress=None, on_draft_text=None):
+    """
+    先読みの初稿をチェックポイントの初稿にする（生成中なら書き上がるまで待つ）
+
+    生成中の先読みは、届いた分を on_draft_text に渡し続ける。cancel がキャンセルされたら先読みも取り消す。
+    先読みが失敗したら、チェックポイントはそのまま返す（ふつうに初稿から生成する）。
+    """
+    if speculative is None:
+        return checkpoint
+    if speculative.running and on_progress is not None:
+        on_progress("📝 ステップ1/2: 先読みしていた初稿の続きを作成中...", 25)
+    forget = speculative.follow(on_draft_text) if on_draft_text is not None else None
+    forget_cancel = cancel.on_cancel(speculative.token.cancel) if cancel is not None else None
+    try:
+        speculative.wait()
+    finally:
+        if forget is not None:
+            forget()
+        if forget_cancel is not None:
+            forget_cancel()
+    if cancel is not None and cancel.cancelled:
+        cancel.check()
+    if speculative.status != "done":
+        return checkpoint
+
+    stages = checkpoint["stages"]
+    stages["condense"] = {"status": "skipped", "output": checkpoint["experience"], "error": "", "models": {}}
+    models = {"draft": speculative.meta["draft"]["model"]} if "draft" in speculative.meta else {}
+    stages["draft"] = {"status": "done", "output": speculative.output, "error": "", "models": models}
+    if on_progress is not None:
+        on_progress("📝 初稿が完成しました（先読み）", 50)
+    return checkpoint
@@ -0,0 +1,254 @@
+"""
+操作ごとのプロファイラ
+
+アプリが遅いときに、時間が履歴の読み込み・お気に入りの読み込み・改行の整形・画面の構築・APIの
+どこにかかっているかを調べる。環境変数 SCENARIO_PROFILE（1 / cprofile）か、
+サイドバーの「ℹ️ ツール情報」の切り替えで有効にする（既定は無効）。
+
+スクリプトの1回の実行（再実行）を profile_run で囲み、その中の処理を span / profiled で囲むと、
+処理ごとの回数・合計時間・自身の時間（内側の処理を除いた時間）を集計する。
+cprofile のときは cProfile も取り、時間のかかった関数の上位を残す（同時に取れるのは1つの実行だけ）。
+1回の実行ごとに1行を output/profile_traces.jsonl（SCENARIO_PROFILE_TRACE_LOG で変更可）に追記する。
+
+無効のときの span / profiled は ContextVar を1回読むだけで、何も記録しない。
+
+使い方:
+    with profile_run("spans") as trace:
+        with span("ui.sidebar"):
+            ...
+    trace["breakdown"]  # 処理ごとの集計
+
+    @profiled("history.load_history")
+    def load_history(...):
+        ...
+"""
+
+import contextvars
+import cProfile
+import json
+import os
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+
+PROFILE_ENV = "SCENARIO_PROFILE"
+# cProfile を取る実行の割合（0〜1）
+CPROFILE_SAMPLE_ENV = "SCENARIO_PROFILE_SAMPLE"
+PROFILE_MODES = ("spans", "cprofile")
+
+TRACE_LOG_PATH = os.getenv(
+    "SCENARIO_PROFILE_TRACE_LOG",
+    os.path.join(
+        os.getenv("SCENARIO_HISTORY_DIR", os.path.join(os.path.dirname(__file__), "output")),
+        "profile_traces.jsonl",
+    ),
+)
+
+# 1回の実行でJSONLに残す個々のスパンの上限（集計はすべてのスパンで行う）
+MAX_RECORDED_SPANS = 300
+# 残す関数の数（自身の時間が長い順）
+TOP_FUNCTIONS = 15
+
+_current = contextvars.ContextVar("profile_span", default=None)
+# cProfile はスレッドをまたいで同時に有効にできないことがある（Python 3.12 以降）ので1つずつ
+_cprofile_lock = threading.Lock()
+_log_lock = threading.Lock()
+
+
+class _Frame:
+    """実行中のスパン（内側のスパンの時間を足していく）"""
+
+    __slots__ = ("trace", "name", "depth", "child_sec")
+
+    def __init__(self, trace, name, depth):
+        self.trace = trace
+        self.name = name
+        self.depth = depth
+        self.child_sec = 0.0
+
+
+class _Trace:
+    """1回の実行のスパンの集計（生成スレッドからも書き込まれる）"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.totals = {}  # 名前 -> [回数, 合計秒, 自身の秒]
+        self.spans = []
+        self.dropped = 0
+
+    def add(self, frame, parent, start, elapsed):
+        thread = threading.current_thread().name
+        with self.lock:
+            parent.child_sec += elapsed
+            totals = self.totals.setdefault(frame.name, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += elapsed
+            totals[2] += max(0.0, elapsed - frame.child_sec)
+            if len(self.spans) < MAX_RECORDED_SPANS:
+                self.spans.append({
+                    "name": frame.name,
+                    "depth": frame.depth,
+                    "thread": thread,
+                    "start_ms": round((start - self.start) * 1000, 2),
+                    "duration_ms": round(elapsed * 1000, 2),
+                })
+            else:
+                self.dropped += 1
+
+
+def env_profile_mode():
+    """環境変数で指定されたモード（"spans" / "cprofile"、無効なら ""）"""
+    value = os.getenv(PROFILE_ENV, "").strip().lower()
+    if value in PROFILE_MODES:
+        return value
+    return "spans" if value in ("1", "true", "on", "yes") else ""
+
+def cprofile_sample_rate():
+    """cProfile を取る実行の割合（環境変数がなければ毎回）"""
+    try:
+        return min(1.0, max(0.0, float(os.getenv(CPROFILE_SAMPLE_ENV, "1"))))
+    except ValueError:
+        return 1.0
+
+def profiling_active():
+    """いまの処理がプロファイルされているか"""
+    return _current.get() is not None
+
+@contextmanager
+def span(name):
+    """処理を囲んで時間を測る（プロファイルしていなければ何もしない）"""
+    parent = _current.get()
+    if parent is None:
+        yield
+        return
+    frame = _Frame(parent.trace, name, parent.depth + 1)
+    token = _current.set(frame)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        _current.reset(token)
+        frame.trace.add(frame, parent, start, elapsed)
+
+def profiled(name):
+    """関数全体を span(name) で囲むデコレーター"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current.get() is None:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _function_label(key):
+    filename, line, function = key
+    if filename == "~":
+        return function  # 組み込み関数
+    return f"{os.path.basename(filename)}:{line}({function})"
+
+def top_functions(profile, limit=TOP_FUNCTIONS):
+    """cProfile の結果のうち、自身の時間が長い関数"""
+    stats = pstats.Stats(profile).stats
+    rows = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:limit]
+    return [
+        {
+            "function": _function_label(key),
+            "calls": calls,
+            "self_ms": round(tottime * 1000, 2),
+            "cumulative_ms": round(cumtime * 1000, 2),
+        }
+        for key, (_, calls, tottime, cumtime, _) in rows
+    ]
+
+def _breakdown(trace, total_sec, spanned_sec):
+    rows = [
+        {"name": name, "count": count, "total_ms": round(total * 1000, 2), "self_ms": round(own * 1000, 2)}
+        for name, (count, total, own) in trace.totals.items()
+    ]
+    rows.sort(key=lambda row: row["self_ms"], reverse=True)
+    # どのスパンにも入っていない時間
+    other_ms = round(max(0.0, total_sec - spanned_sec) * 1000, 2)
+    rows.append({"name": "(その他)", "count": 1, "total_ms": other_ms, "self_ms": other_ms})
+    return rows
+
+def write_trace(result):
+    """トレースを1行追記する（書けなくても何もしない）"""
+    with _log_lock:
+        try:
+            os.makedirs(os.path.dirname(TRACE_LOG_PATH), exist_ok=True)
+            with open(TRACE_LOG_PATH, "a", encoding="utf-8") as f:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        except OSError:
+            pass
+
+@contextmanager
+def profile_run(mode, name="rerun", session=""):
+    """
+    1回の実行をプロファイルする
+
+    with の中で例外（Streamlit の再実行・停止を含む）が起きても、集計して書き出してから投げ直す。
+
+    Args:
+        mode: "spans" / "cprofile"（"" や None なら何もしない）
+        name: 実行の名前
+        session: セッションID（オフラインで分析するときの目印）
+
+    Yields:
+        結果の辞書（with を抜けると "total_ms", "breakdown", "top_functions" などが入る。無効なら None）
+    """
+    if mode not in PROFILE_MODES or _current.get() is not None:
+        yield None
+        return
+
+    trace = _Trace()
+    root = _Frame(trace, name, 0)
+    result = {"timestamp": datetime.now().isoformat(), "name": name, "session": session, "mode": mode}
+    profile = None
+    if mode == "cprofile" and random.random() < cprofile_sample_rate() and _cprofile_lock.acquire(blocking=False):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # 別のプロファイラが動いている
+            _cprofile_lock.release()
+            profile = None
+
+    token = _current.set(root)
+    try:
+        yield result
+    finally:
+        total_sec = time.perf_counter() - trace.start
+        _current.reset(token)
+        if profile is not None:
+            profile.disable()
+            _cprofile_lock.release()
+        with trace.lock:
+            result.update({
+                "total_ms": round(total_sec * 1000, 2),
+                "breakdown": _breakdown(trace, total_sec, root.child_sec),
+                "top_functions": top_functions(profile) if profile is not None else [],
+                "spans": list(trace.spans),
+                "dropped_spans": trace.dropped,
+            })
+        write_trace(result)
+
+def run_in_context(func):
+    """
+    func を、いまのプロファイル（スパンの親子関係）を引き継いで別スレッドで動かせるようにする
+
+    同じ Context には同時に1つのスレッドしか入れないので、呼ぶたびにコピーする。
+    """
+    context = contextvars.copy_context()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)
+    return wrapper
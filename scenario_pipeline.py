@@ -0,0 +1,1109 @@
+"""
+シナリオ生成パイプライン（初稿生成 → 自動チェック＆リライト）
+
+anthropicパッケージは読み込みが重いため、最初の生成時まで import を遅らせる。
+"""
+
+import json
+import os
+import re
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from functools import lru_cache
+
+from budget import budget_remaining, check_budget, record_usage
+from cancellation import DEFAULT_OUTPUT_TOKENS_PER_SEC, CancelToken, GenerationCancelled
+from metrics import inc
+from model_router import choose_route, track_call
+from profiler import profiled, run_in_context, span
+from scenario_text import (
+    NAMED_CHARACTERS,
+    PAGES_PER_PART,
+    PAGE_HEADER_PATTERN,
+    PANEL_HEADER_PATTERN,
+    PART_HEADER_PATTERN,
+    SPEAKER_LINE_PATTERN,
+    apply_panel_edits,
+    enforce_line_breaks,
+    find_second_part,
+    join_parts,
+    panel_keys,
+    replace_page,
+    split_pages,
+    split_parts,
+    split_sections,
+)
+from token_estimator import (
+    CONDENSED_EXPERIENCE_CHARS,
+    PATCH_OUTPUT_RATIO,
+    REWRITE_OUTPUT_RATIO,
+    adaptive_max_tokens,
+    estimate_tokens,
+    estimate_tokens_raw,
+    expected_output_tokens,
+    expected_output_tokens_raw,
+    log_usage,
+)
+
+# 履歴に記録するプロンプトのバージョン
+PROMPT_VERSION = "3.0"
+
+# max_tokensで打ち切られたときに続きを生成させる回数
+MAX_CONTINUATIONS = 2
+
+# 自動リライトの方式（"patch": 変更するコマだけ出力 / "full": 全文を出力）
+REWRITE_MODES = ("patch", "full")
+REWRITE_MODE = os.getenv("SCENARIO_REWRITE_MODE", "patch")
+
+JSON_BLOCK_PATTERN = re.compile(r'```(?:json)?\s*(\{.*\})\s*```', re.DOTALL)
+
+# 生成方式（"single": 一括生成 / "outline": アウトライン→ページごとに並列展開）
+GENERATION_MODES = ("single", "outline")
+GENERATION_MODE = os.getenv("SCENARIO_GENERATION_MODE", "single")
+
+# ページ展開の同時実行数
+EXPANSION_WORKERS = int(os.getenv("SCENARIO_EXPANSION_WORKERS", "10"))
+
+# 前編・後編のページ数
+PARTS = ("前編", "後編")
+
+# ============================================================================
+# APIクライアント・プロンプト
+# ============================================================================
+
+@lru_cache(maxsize=4)
+def get_client(api_key):
+    """
+    APIキーごとのAnthropicクライアントを取得（プロセス内で使い回す）
+    """
+    import anthropic
+
+    return anthropic.Anthropic(api_key=api_key)
+
+# マスタープロンプトを読み込む
+@lru_cache(maxsize=1)
+def load_master_prompt():
+    prompt_path = os.path.join(os.path.dirname(__file__), "prompts", "master_prompt.md")
+    with open(prompt_path, "r", encoding="utf-8") as f:
+        return f.read()
+
+# 自動チェック＆リライトのチェック基準
+REWRITE_CRITERIA = """
+▼ チェック基準
+1. ストーリーのつじつま
+   - 設定の矛盾はないか
+   - 行動の必然性はあるか
+   - 状況説明は明瞭か
+   - 現実味はあるか（倫理観、違法行為、NG描写）
+
+2. セリフと感情の自然さ
+   - 会話の流れは自然か
+   - 年齢・性格に合った話し方か
+   - ポエム調・文学調を避けているか
+   - 共感を生む感情描写になっているか
+
+3. 話のまとまり・伏線回収
+   - 伏線の貼り方と回収
+   - 展開テンポ
+   - ラストの納得感
+
+4. スカッとポイントの設計
+   - 前編に「小さなスカッと」があるか
+   - 後編に「大きなスカッと」があるか
+   - 読者が「スカッとした！」と感じられるか
+
+5. テーマ/体験談への忠実性【超重要】
+   - 入力された体験談に記載されている内容のみを使用しているか
+   - 体験談に記載されていない設定・情報・要素を追加していないか
+   - 体験談から大きく逸脱した展開になっていないか
+
+6. 前後編の構成
+   - 前編だけでも完結感があるか
+   - 前編にスカッとポイントがあるか
+   - 後編への引きが適切か
+   - 後編で完全解決しているか
+
+7. **【最重要】改行フォーマット**
+   - ※カメラ指示は必ず1行目に単独で記述されているか
+   - ※シーン描写（場所、状況、動作、音など）は、それぞれ必ず別の行に記述されているか
+   - セリフ（「」で囲まれたもの）は、1つずつ必ず別の行に記述されているか
+   - 心の声（（）で囲まれたもの）は、1つずつ必ず別の行に記述されているか
+   - 同じ行に複数の要素が書かれていないか
+"""
+
+# 自動チェック＆リライトのリライト条件
+REWRITE_CONDITIONS = """
+▼ リライト条件
+- 前編5ページ・後編5ページのショート漫画を想定
+- テンポの良いネーム用シナリオ
+- **【最重要】前後編でそれぞれ完結しつつ、後編を絶対に読みたくなる構造**
+  - 前編 = 問題提示 + 小スカッと（満足度60%）
+  - 後編 = 真相 + 大スカッと（満足度100%）
+  - 前編ラストに必ず「強烈な引き」を入れる
+- **1ページ=ひとつの感情変化**を基本にする
+- キャラの行動と感情が自然
+- 読者が共感できる描写
+- セリフは短く、説明過多を避ける
+- クライマックスに向けて段階的に盛り上げる
+- 伏線は自然に回収
+- NG描写（鬱・殺人・宗教・差別・過度な暴力）なし
+- **体験談への忠実性【最重要】**：
+  - 入力された体験談に記載されている内容のみを使用すること
+  - 体験談に記載されていない設定・情報・要素は一切追加しない
+  - 体験談から大きく逸脱した展開は絶対に避けること
+- **【必須】改行フォーマットの厳守**：
+  - 各コマで、※カメラ、※状況、セリフ、心の声は必ずそれぞれ別の行に記述すること
+  - 同じ行に複数の要素を書いてはいけません
+  - 例：
+    ```
+    1コマ目
+    ※カメラ：引き
+    ※リビング。夕方
+    ※A子が疲れた表情でソファに座っている
+    A子「今日も疲れたな…」
+    A子（また一人でご飯か…）
+    ```
+"""
+
+# 自動チェック＆リライト用プロンプト（全文リライト）
+REWRITE_PROMPT_TEMPLATE = """
+以下のシナリオを、チェック基準に基づいて 客観的に自己評価 → 問題点抽出 → 最適な形にリライト してください。
+トーンは漫画のネーム用のシナリオとして、テンポよく、読者にとって理解しやすく、感情移入しやすい形に整えてください。
+{reference}
+【元のシナリオ】
+{scenario_draft}
+
+【ステップ1：問題点の抽出】※内部処理のみ、出力不要
+
+以下のチェック基準に照らして、改善すべき点を把握：
+""" + REWRITE_CRITERIA + """
+【ステップ2：シナリオの完全リライト版を生成】
+
+以下の条件を守って、最適化したシナリオを出力してください。
+""" + REWRITE_CONDITIONS + """
+【重要】出力はリライトしたシナリオのみ。分析や評価コメントは不要です。
+元のシナリオのフォーマット（【体験談の分析】から始まる形式）を維持してください。
+"""
+
+# 自動チェック＆リライト用プロンプト（変更するコマだけを出力）
+REWRITE_PATCH_PROMPT_TEMPLATE = """
+以下のシナリオを、チェック基準に基づいて 客観的に自己評価 → 問題点抽出 → 最適な形にリライト してください。
+ただし、シナリオ全体は出力せず、書き直したコマだけを出力してください。
+{reference}
+【元のシナリオ】
+{scenario_draft}
+
+【ステップ1：問題点の抽出】※内部処理のみ、出力不要
+
+以下のチェック基準に照らして、改善すべき点を把握：
+""" + REWRITE_CRITERIA + """
+【ステップ2：書き直したコマだけを出力】
+
+以下の条件を守って書き直したコマを、次のJSON形式で出力してください。
+""" + REWRITE_CONDITIONS + """
+▼ 出力形式
+```json
+{{"edits": [
+  {{"part": "前編", "page": 1, "panel": 2, "lines": ["※カメラ：引き", "※リビング。夕方", "A子「今日も疲れたな…」"]}}
+]}}
+```
+- part は "前編" または "後編"、page は【P1】〜【P5】の数字、panel は「◯コマ目」の数字
+- lines はコマ番号の行を除いたコマの中身（1行＝1要素）
+- 元のシナリオにあるコマだけを指定し、コマの追加・削除はしない
+- 書き直しが不要なコマは出力しない。問題がなければ {{"edits": []}} を出力
+
+【重要】出力はJSONのみ。分析や評価コメントは不要です。
+"""
+
+# ============================================================================
+# API呼び出し（max_tokensの自動調整・打ち切り時の続き生成）
+# ============================================================================
+
+def _cancelled(cancel, stage, source_text, text="", started=None, call=None):
+    """
+    キャンセルされた呼び出しで使わずに済んだ出力トークン数・秒数を記録し、投げる例外を返す
+
+    出力の速さはこの呼び出しで届いた分から測る（届いていなければ目安の値を使う）
+    """
+    if call is not None:
+        call["cancelled"] = True
+    produced = estimate_tokens(text) if text else 0
+    elapsed = time.monotonic() - started if started is not None else 0.0
+    rate = produced / elapsed if produced and elapsed > 0 else DEFAULT_OUTPUT_TOKENS_PER_SEC
+    remaining = max(0, expected_output_tokens(stage, source_text) - produced)
+    cancel.add_savings(remaining, remaining / rate)
+    return GenerationCancelled(cancel.reason)
+
+def record_skipped_stage(cancel, stage, experience, mode=None, share=1.0):
+    """
+    キャンセルで始めずに済んだステージ（"draft" / "rewrite"）の出力トークン数・秒数を記録する
+
+    リライトは初稿がまだないので、体験談から見積もった初稿の長さから計算する。
+    share は全体のうち飛ばした割合（後編のリライトだけなら 0.5）
+    """
+    tokens = expected_output_tokens("draft", experience)
+    if stage == "rewrite":
+        tokens *= PATCH_OUTPUT_RATIO if (mode or REWRITE_MODE) == "patch" else REWRITE_OUTPUT_RATIO
+    tokens = int(tokens * share)
+    cancel.add_savings(tokens, tokens / DEFAULT_OUTPUT_TOKENS_PER_SEC)
+
+def create_message(client, stage, prompt, temperature, source_text, meta=None, user_tier=None, on_text=None,
+                   cancel=None):
+    """
+    モデルとmax_tokensを決めてメッセージを生成する
+
+    モデルは model_router のルールで選ぶ。
+    stop_reason が "max_tokens" の場合は、最初からやり直さずに
+    途中までの出力をアシスタントの発言として渡して続きを生成させる。
+    cancel を渡すと必ずストリーミングで生成し、キャンセルされたら接続を切って GenerationCancelled を投げる。
+    APIの利用料の予算（budget）を使い切っていれば、呼ばずに BudgetExceeded を投げる。
+
+    Args:
+        client: Anthropicクライアント
+        stage: パイプラインのステージ名（"draft" / "outline" / "expand" / "rewrite" / "rewrite_patch" / "condense" / "regenerate"）
+        prompt: ユーザープロンプト
+        temperature: temperature
+        source_text: 出力トークン数の推定に使うテキスト
+        meta: 指定した場合、meta[stage] に使用したモデルや使用量を記録する
+        user_tier: ユーザー区分（ルーティングに使用）
+        on_text: 指定した場合はストリーミングで生成し、受け取ったテキストの断片ごとに呼ぶ
+        cancel: キャンセル状態（cancellation.CancelToken、省略可）
+
+    Returns:
+        生成されたテキスト
+    """
+    if cancel is not None and cancel.cancelled:
+        raise _cancelled(cancel, stage, source_text)
+
+    # 予算を使い切っていれば呼ばずに断り、残りが少なければ安いモデルにルーティングする
+    remaining = budget_remaining()
+    check_budget(remaining)
+
+    estimated_input_raw = estimate_tokens_raw(prompt)
+    route = choose_route(stage, estimate_tokens(prompt), user_tier=user_tier, budget_remaining=remaining)
+    model = route["model"]
+    estimated_output_raw = expected_output_tokens_raw(stage, source_text)
+    max_tokens = adaptive_max_tokens(expected_output_tokens(stage, source_text), model)
+
+    stage_meta = {
+        "model": model,
+        "route": route["name"],
+        "input_tokens": 0,
+        "output_tokens": 0,
+        "stop_reason": None,
+        "continuations": 0,
+    }
+    if meta is not None:
+        meta[stage] = stage_meta
+
+    messages = [{"role": "user", "content": prompt}]
+    text = ""
+    for attempt in range(MAX_CONTINUATIONS + 1):
+        with span(f"api.{stage}"), track_call(route) as call:
+            if on_text is None and cancel is None:
+                message = client.messages.create(
+                    model=model,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    messages=messages
+                )
+            else:
+                started = time.monotonic()
+                received = []
+                try:
+                    with client.messages.stream(
+                        model=model,
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                        messages=messages
+                    ) as stream:
+                        # 最初の断片が届く前でも止められるよう、キャンセルされたらすぐ接続を切る
+                        forget = cancel.on_cancel(stream.close) if cancel is not None else None
+                        try:
+                            for chunk in stream.text_stream:
+                                if cancel is not None and cancel.cancelled:
+                                    break
+                                received.append(chunk)
+                                if on_text is not None:
+                                    on_text(chunk)
+                            if cancel is not None and cancel.cancelled:
+                                raise _cancelled(cancel, stage, source_text, text + "".join(received), started, call)
+                            message = stream.get_final_message()
+                        finally:
+                            if forget is not None:
+                                forget()
+                except Exception:
+                    # 接続を切ったことによる読み込みエラー
+                    if cancel is not None and cancel.cancelled:
+                        raise _cancelled(cancel, stage, source_text, text + "".join(received), started, call)
+                    raise
+            call["usage"] = message.usage
+        record_usage(model, message.usage)
+        text += message.content[0].text
+
+        stage_meta["input_tokens"] += message.usage.input_tokens
+        stage_meta["output_tokens"] += message.usage.output_tokens
+        stage_meta["stop_reason"] = message.stop_reason
+        stage_meta["continuations"] = attempt
+
+        # 続き生成の記録は出力のキャリブレーションに使わない
+        log_usage(
+            stage if attempt == 0 else f"{stage}:continuation",
+            model,
+            estimate_tokens_raw(prompt + text) if attempt else estimated_input_raw,
+            estimated_output_raw if attempt == 0 else None,
+            max_tokens,
+            message.usage,
+            message.stop_reason,
+        )
+
+        if message.stop_reason != "max_tokens":
+            break
+
+        # APIは末尾に空白のあるアシスタント発言を受け付けない
+        text = text.rstrip()
+        messages = [
+            {"role": "user", "content": prompt},
+            {"role": "assistant", "content": text},
+        ]
+    return text
+
+# ============================================================================
+# 体験談の要約（長すぎる体験談向け）
+# ============================================================================
+
+@profiled("pipeline.condense")
+def condense_experience(api_key, experience, meta=None, cancel=None):
+    """
+    長すぎる体験談を、事実を変えずに要約する
+
+    Args:
+        api_key: Anthropic APIキー
+        experience: 体験談
+        meta: 使用したモデルなどの記録先（省略可）
+        cancel: キャンセル状態（省略可）
+
+    Returns:
+        要約した体験談（失敗した場合は元の体験談）
+    """
+    client = get_client(api_key)
+
+    condense_prompt = f"""
+以下の体験談を、シナリオ化に必要な情報を残して{CONDENSED_EXPERIENCE_CHARS}文字以内に要約してください。
+
+- 登場人物、出来事、発言、出来事の順序は変えない
+- 体験談に書かれていない情報は追加しない
+- 出力は要約した体験談のみ
+
+【体験談】
+{experience}
+"""
+
+    try:
+        return create_message(client, "condense", condense_prompt, 0.2, experience, meta=meta, cancel=cancel)
+    except Exception:
+        return experience
+
+# ============================================================================
+# シナリオ自動チェック＆リライト
+# ============================================================================
+
+def load_json_response(text):
+    """
+    モデルの出力からJSONオブジェクトを取り出す（```json ... ``` にも対応）
+
+    Raises:
+        ValueError: JSONオブジェクトとして読めない場合
+    """
+    match = JSON_BLOCK_PATTERN.search(text)
+    payload = json.loads(match.group(1) if match else text.strip())
+    if not isinstance(payload, dict):
+        raise ValueError("JSONオブジェクトではありません")
+    return payload
+
+def parse_patch_response(text):
+    """
+    コマ単位の差し替え（JSON）をモデルの出力から取り出す
+
+    Raises:
+        ValueError: JSONとして読めない場合や、形式が正しくない場合
+    """
+    payload = load_json_response(text)
+    if not isinstance(payload.get("edits"), list):
+        raise ValueError("edits がありません")
+    return payload["edits"]
+
+def _format_reference(reference, part=None):
+    """書き直し対象外の参考部分と、書き直す範囲（前編だけ・後編だけをリライトするとき）"""
+    text = ""
+    if reference:
+        text += f"""
+【参考：シナリオの前半（書き直し対象外・出力しない）】
+{reference}
+
+※書き直すのは【元のシナリオ】の部分だけです。出力も【元のシナリオ】の範囲だけにしてください。
+"""
+    if part:
+        other = "後編" if part == "前編" else "前編"
+        text += f"""
+※【元のシナリオ】は{part}だけです。{part}だけを書き直して出力し、{other}は書き足さないでください。
+"""
+    return text
+
+def build_rewrite_prompt(stage, scenario_draft, reference=None, part=None):
+    """自動リライトのプロンプト（stage は "rewrite": 全文 / "rewrite_patch": 変更箇所のみ）"""
+    template = REWRITE_PATCH_PROMPT_TEMPLATE if stage == "rewrite_patch" else REWRITE_PROMPT_TEMPLATE
+    return template.format(scenario_draft=scenario_draft, reference=_format_reference(reference, part))
+
+def _keep_part(text, part):
+    """前編・後編だけのリライトに、ほかの編まで書かれていたら除く"""
+    first_half, second_half = split_parts(text)
+    if part == "前編":
+        return first_half
+    return second_half if second_half is not None else text
+
+def _rewrite_full(client, scenario_draft, meta, user_tier, reference=None, cancel=None, part=None):
+    """全文リライト（part を指定したら、その編だけを返す）"""
+    rewrite_prompt = build_rewrite_prompt("rewrite", scenario_draft, reference, part)
+    rewritten = create_message(
+        client, "rewrite", rewrite_prompt, 0.5, scenario_draft,
+        meta=meta, user_tier=user_tier, cancel=cancel
+    )
+    return _keep_part(rewritten, part) if part else rewritten
+
+def _rewrite_patch(client, scenario_draft, meta, user_tier, reference=None, cancel=None, part=None):
+    """
+    書き直したコマだけを出力させて、手元で初稿に適用する
+
+    Raises:
+        ValueError: 差し替えの形式が正しくない場合
+    """
+    patch_prompt = build_rewrite_prompt("rewrite_patch", scenario_draft, reference, part)
+    stage_meta = {}
+    try:
+        response = create_message(
+            client, "rewrite_patch", patch_prompt, 0.5, scenario_draft,
+            meta=stage_meta, user_tier=user_tier, cancel=cancel
+        )
+    finally:
+        if meta is not None:
+            meta.update(stage_meta)
+
+    if stage_meta["rewrite_patch"]["stop_reason"] == "max_tokens":
+        raise ValueError("差し替えが途中で打ち切られました")
+    edits = parse_patch_response(response)
+    rewritten = apply_panel_edits(scenario_draft, edits)
+    stage_meta["rewrite_patch"]["edits"] = len(edits)
+    return rewritten
+
+class RewriteFailed(Exception):
+    """
+    自動リライトに失敗した（fallback=False のとき）
+
+    draft にリライトする前の初稿を持つ
+    """
+
+    def __init__(self, draft, error):
+        super().__init__(str(error))
+        self.draft = draft
+
+def _rewrite_failed(scenario_draft, error, fallback, meta):
+    """
+    リライトの失敗を知らせ、fallback なら初稿を返す（そうでなければ RewriteFailed を投げる）
+
+    初稿を返すときは meta["rewrite_error"] とメトリクスに失敗を残す（呼び出し元から見えるように）
+    """
+    if not fallback:
+        raise RewriteFailed(scenario_draft, error) from error
+    inc("scenario_rewrite_fallbacks_total")
+    if meta is not None:
+        meta["rewrite_error"] = str(error)
+    return scenario_draft
+
+@profiled("pipeline.rewrite")
+def check_and_fix_scenario(api_key, scenario_draft, meta=None, user_tier=None, mode=None, reference=None,
+                           cancel=None, fallback=True, part=None):
+    """
+    生成されたシナリオを自動でチェックし、品質向上のためにリライトする
+
+    mode が "patch" の場合は書き直したコマだけを出力させて初稿に適用する。
+    差し替えの形式が正しくない場合は全文リライトに切り替える。
+
+    Args:
+        api_key: Anthropic APIキー
+        scenario_draft: シナリオ初稿
+        meta: 使用したモデルなどの記録先（省略可）
+        user_tier: ユーザー区分（モデルのルーティングに使用）
+        mode: "patch"（変更箇所のみ）または "full"（全文）。省略時は REWRITE_MODE
+        reference: 書き直し対象外の参考テキスト（後編だけをリライトするときの前編など）
+        cancel: キャンセル状態（省略可）。キャンセルされたら初稿を返さずに GenerationCancelled を投げる
+        fallback: リライトに失敗したとき初稿を返すか（False なら RewriteFailed を投げる）
+        part: scenario_draft が前編・後編の片方だけのときは "前編" / "後編"（ほかの編を出力させない）
+    """
+    client = get_client(api_key)
+    mode = mode or REWRITE_MODE
+
+    # コマに分割できない初稿は差し替えられないので全文リライト
+    if mode == "patch" and panel_keys(scenario_draft):
+        try:
+            return _rewrite_patch(client, scenario_draft, meta, user_tier, reference, cancel, part)
+        except (ValueError, KeyError):
+            pass
+        except Exception as e:
+            return _rewrite_failed(scenario_draft, e, fallback, meta)
+
+    try:
+        return _rewrite_full(client, scenario_draft, meta, user_tier, reference, cancel, part)
+    except Exception as e:
+        return _rewrite_failed(scenario_draft, e, fallback, meta)
+
+# ============================================================================
+# シナリオ生成
+# ============================================================================
+
+def build_draft_prompt(experience, master_prompt=None):
+    """初稿生成のプロンプト（master_prompt を省略すると prompts/master_prompt.md）"""
+    if master_prompt is None:
+        master_prompt = load_master_prompt()
+
+    # ユーザー入力を構造化
+    return f"""
+{master_prompt}
+
+---
+
+## オーダー
+{experience}
+
+上記の体験談を、スカッと系ショート漫画のシナリオプロット（前編5P・後編5P）に変換してください。
+"""
+
+@profiled("pipeline.draft")
+def generate_scenario(api_key, experience, meta=None, user_tier=None, on_text=None, master_prompt=None,
+                      cancel=None):
+    """
+    Claude APIを使用してシナリオを生成
+    
+    Args:
+        api_key: Anthropic APIキー
+        experience: 体験談
+        meta: 使用したモデルなどの記録先（省略可）
+        user_tier: ユーザー区分（モデルのルーティングに使用）
+        on_text: 指定した場合はストリーミングで生成し、テキストの断片ごとに呼ぶ
+        master_prompt: 使用するプロンプト（省略時は prompts/master_prompt.md、プロンプトの比較用）
+        cancel: キャンセル状態（省略可）
+        
+    Returns:
+        生成されたシナリオのテキスト
+    """
+    client = get_client(api_key)
+    user_prompt = build_draft_prompt(experience, master_prompt)
+
+    try:
+        return create_message(
+            client, "draft", user_prompt, 0.7, experience,
+            meta=meta, user_tier=user_tier, on_text=on_text, cancel=cancel
+        )
+    except Exception as e:
+        return f"エラーが発生しました: {str(e)}"
+
+# ============================================================================
+# アウトライン→ページごとの並列展開
+# ============================================================================
+
+OUTLINE_PROMPT_TEMPLATE = """
+{master_prompt}
+
+---
+
+## オーダー
+{experience}
+
+上記の体験談を、スカッと系ショート漫画のシナリオプロット（前編5P・後編5P）に変換するための
+「アウトライン」だけを作成してください。各ページの脚本（コマ割り・セリフ）はまだ書きません。
+
+▼ 出力形式（JSONのみ）
+```json
+{{"analysis": ["核となる感情：…", "読者が共感するポイント：…", "読者が怒りを感じるポイント：…", "スカッとのクライマックス：…"],
+ "emotion_design": ["前編の感情曲線：…", "後編の感情曲線：…"],
+ "ochi": {{"前編": "No.X（理由）", "後編": "No.X（理由）"}},
+ "characters": [{{"name": "A子", "description": "年齢、性格、読者が感情移入するポイント"}}],
+ "pages": [{{"part": "前編", "page": 1, "beat": "このページで起きること・感情の変化・ページ終わりの引き"}}]}}
+```
+- pages は前編P1〜P5、後編P1〜P5の10件をこの順番で出力
+- 登場人物の名前は「登場人物の名前ルール」に従う
+"""
+
+PAGE_PROMPT_TEMPLATE = """
+{master_prompt}
+
+---
+
+## オーダー
+{experience}
+
+## アウトライン（全ページ共通の設定）
+{outline_text}
+
+上記のアウトラインに沿って、**{part}の【P{page}】だけ**の脚本を書いてください。
+
+- このページの内容：{beat}
+- 前のページ：{previous_beat}
+- 次のページ：{next_beat}
+- 登場人物はアウトラインの人物だけを使う
+- 出力は「【P{page}】」の行から始め、コマ番号（1コマ目、2コマ目…）・※カメラ・※状況・セリフ・心の声を
+  「基本フォーマット」の改行ルールどおりに1行ずつ書く
+- ■前編・■後編の見出しや、分析・コメントは出力しない
+"""
+
+def parse_outline(text):
+    """
+    アウトライン（JSON）を取り出して形式を確認する
+
+    Raises:
+        ValueError: 形式が正しくない場合
+    """
+    outline = load_json_response(text)
+    pages = outline.get("pages")
+    expected = [(part, page) for part in PARTS for page in range(1, PAGES_PER_PART + 1)]
+    if not isinstance(pages, list) or [(p.get("part"), p.get("page")) for p in pages if isinstance(p, dict)] != expected:
+        raise ValueError("pages が前編P1〜後編P5の10件になっていません")
+    if not isinstance(outline.get("characters"), list) or not outline["characters"]:
+        raise ValueError("characters がありません")
+    return outline
+
+def _outline_lines(items):
+    """アウトラインの項目を「・」付きの行にする"""
+    if isinstance(items, str):
+        items = [items]
+    return [f"・{item}" for item in items or []]
+
+def format_outline(outline):
+    """アウトラインをシナリオ冒頭（分析〜登場人物）の形式にする"""
+    ochi = outline.get("ochi") or {}
+    lines = ["【体験談の分析】", *_outline_lines(outline.get("analysis")), ""]
+    lines += ["【感情設計】", *_outline_lines(outline.get("emotion_design")), ""]
+    lines += ["【落ちのパターン選定】", *(f"・{part}：{ochi.get(part, '')}" for part in PARTS), ""]
+    lines += ["【登場人物】"]
+    lines += [f"・{c.get('name', '')}：{c.get('description', '')}" for c in outline["characters"] if isinstance(c, dict)]
+    return "\n".join(lines)
+
+def _format_page_beats(outline):
+    """全ページのあらすじ（ページ展開のプロンプト用）"""
+    return "\n".join(f"・{p['part']}P{p['page']}：{p.get('beat', '')}" for p in outline["pages"])
+
+def check_page(text, part, page, character_names):
+    """
+    展開したページを整え、つなぎ合わせる前の整合性をチェックする
+
+    Args:
+        text: ページ展開の出力
+        part: "前編" / "後編"
+        page: ページ番号
+        character_names: アウトラインの登場人物名
+
+    Returns:
+        (整えたページのテキスト, 問題点のリスト)
+    """
+    issues = []
+    lines = []
+    for line in enforce_line_breaks(text).split("\n"):
+        # 編の見出しや区切り線はつなぎ合わせるときに付けるので除く
+        if PART_HEADER_PATTERN.match(line) or line.strip().startswith("━"):
+            continue
+        lines.append(line)
+
+    # 先頭はこのページの見出しにそろえる
+    header = f"【P{page}】"
+    header_index = next((i for i, line in enumerate(lines) if PAGE_HEADER_PATTERN.match(line)), None)
+    if header_index is None:
+        issues.append(f"{part}P{page}: ページ見出しがありません")
+        lines.insert(0, header)
+    else:
+        if int(PAGE_HEADER_PATTERN.match(lines[header_index]).group(1)) != page:
+            issues.append(f"{part}P{page}: ページ番号が違います（{lines[header_index].strip()}）")
+        lines = [header] + lines[header_index + 1:]
+
+    if not any(PANEL_HEADER_PATTERN.match(line) for line in lines):
+        issues.append(f"{part}P{page}: コマがありません")
+
+    # アウトラインにない人物のセリフ
+    known = set(character_names) | set(NAMED_CHARACTERS)
+    unknown = sorted({
+        match.group(1)
+        for match in map(SPEAKER_LINE_PATTERN.match, lines)
+        if match and match.group(1) not in known
+    })
+    if unknown:
+        issues.append(f"{part}P{page}: アウトラインにない人物のセリフがあります（{'、'.join(unknown)}）")
+
+    return "\n".join(lines).strip(), issues
+
+def stitch_pages(outline, pages):
+    """
+    アウトラインと展開したページをつなぎ合わせて1本のシナリオにする
+
+    Args:
+        outline: parse_outline の結果
+        pages: {(編, ページ): ページのテキスト}
+
+    Returns:
+        (シナリオのテキスト, 問題点のリスト)
+    """
+    names = [c.get("name", "") for c in outline["characters"] if isinstance(c, dict)]
+    separator = "━" * 37
+    blocks = [format_outline(outline), "", "【シナリオプロット】", ""]
+    issues = []
+    for part in PARTS:
+        if part == "後編":
+            blocks += [separator, "■後編", separator, ""]
+        else:
+            blocks += ["■前編", ""]
+        for page in range(1, PAGES_PER_PART + 1):
+            page_text, page_issues = check_page(pages[(part, page)], part, page, names)
+            issues += page_issues
+            blocks += [page_text, ""]
+    return enforce_line_breaks("\n".join(blocks)), issues
+
+def _merge_stage_meta(meta, stage, call_metas):
+    """並列に呼んだ各呼び出しの使用量を1つにまとめる"""
+    if meta is None or not call_metas:
+        return
+    merged = dict(call_metas[0])
+    merged["calls"] = len(call_metas)
+    merged["input_tokens"] = sum(m["input_tokens"] for m in call_metas)
+    merged["output_tokens"] = sum(m["output_tokens"] for m in call_metas)
+    merged["continuations"] = sum(m["continuations"] for m in call_metas)
+    meta[stage] = merged
+
+@profiled("pipeline.outline")
+def generate_scenario_outlined(api_key, experience, meta=None, user_tier=None, cancel=None):
+    """
+    アウトラインを作ってから、ページごとに並列で脚本を展開してシナリオを生成
+
+    所要時間は全ページの合計ではなく、いちばん長いページの展開時間に近くなる。
+    アウトラインが作れなかった場合は一括生成（generate_scenario）に切り替える。
+
+    Args:
+        api_key: Anthropic APIキー
+        experience: 体験談
+        meta: 使用したモデルなどの記録先（省略可）。meta["expand"]["stitch_issues"] に整合性チェックの結果が入る
+        user_tier: ユーザー区分（モデルのルーティングに使用）
+        cancel: キャンセル状態（省略可）
+
+    Returns:
+        生成されたシナリオのテキスト
+    """
+    client = get_client(api_key)
+    master_prompt = load_master_prompt()
+
+    try:
+        outline_text = create_message(
+            client, "outline",
+            OUTLINE_PROMPT_TEMPLATE.format(master_prompt=master_prompt, experience=experience),
+            0.7, experience, meta=meta, user_tier=user_tier, cancel=cancel
+        )
+        outline = parse_outline(outline_text)
+    except ValueError:
+        return generate_scenario(api_key, experience, meta=meta, user_tier=user_tier, cancel=cancel)
+    except Exception as e:
+        return f"エラーが発生しました: {str(e)}"
+
+    outline_summary = format_outline(outline) + "\n\n【ページごとのあらすじ】\n" + _format_page_beats(outline)
+    beats = [p.get("beat", "") for p in outline["pages"]]
+
+    def expand(index, pages_cancel):
+        page_info = outline["pages"][index]
+        call_meta = {}
+        prompt = PAGE_PROMPT_TEMPLATE.format(
+            master_prompt=master_prompt,
+            experience=experience,
+            outline_text=outline_summary,
+            part=page_info["part"],
+            page=page_info["page"],
+            beat=beats[index],
+            previous_beat=beats[index - 1] if index > 0 else "（なし：最初のページ）",
+            next_beat=beats[index + 1] if index + 1 < len(beats) else "（なし：最後のページ）",
+        )
+        text = create_message(
+            client, "expand", prompt, 0.7, beats[index], meta=call_meta, user_tier=user_tier, cancel=pages_cancel
+        )
+        return (page_info["part"], page_info["page"]), text, call_meta["expand"]
+
+    # 1ページでも展開に失敗したら、ほかのページの展開も止める（止めないと出力トークンの課金が続く）
+    pages_cancel = CancelToken(parent=cancel)
+    executor = ThreadPoolExecutor(max_workers=max(1, EXPANSION_WORKERS))
+    try:
+        futures = [
+            executor.submit(run_in_context(expand), index, pages_cancel) for index in range(len(outline["pages"]))
+        ]
+        wait(futures, return_when=FIRST_EXCEPTION)
+        failed = next((future for future in futures if future.done() and future.exception() is not None), None)
+        if failed is not None:
+            pages_cancel.cancel("ページの展開の失敗")
+            raise failed.exception()
+        results = [future.result() for future in futures]
+    except Exception as e:
+        return f"エラーが発生しました: {str(e)}"
+    finally:
+        pages_cancel.detach()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    _merge_stage_meta(meta, "expand", [call_meta for _, _, call_meta in results])
+    scenario, issues = stitch_pages(outline, {key: text for key, text, _ in results})
+    if meta is not None:
+        meta["expand"]["stitch_issues"] = issues
+    return scenario
+
+# ============================================================================
+# パイプライン実行（後編の初稿を書いている間に前編のリライトを始める）
+# ============================================================================
+
+PIPELINED = os.getenv("SCENARIO_PIPELINED", "1") == "1"
+
+@profiled("pipeline.draft_and_rewrite")
+def generate_and_fix_pipelined(api_key, experience, meta=None, user_tier=None, mode=None, on_progress=None,
+                               on_draft_text=None, cancel=None, fallback=True):
+    """
+    初稿をストリーミングで生成し、「■後編」まで届いた時点で前編のリライトを始める
+
+    後編は初稿の完成後にリライトし、最後に前編・後編のリライト結果をつなぎ直す。
+    「■後編」が見つからない初稿は、通常どおり全体をリライトする。
+
+    Args:
+        api_key: Anthropic APIキー
+        experience: 体験談
+        meta: 使用したモデルなどの記録先（省略可）
+        user_tier: ユーザー区分（モデルのルーティングに使用）
+        mode: 自動リライトの方式（"patch" / "full"）
+        on_progress: 進捗メッセージを受け取る関数（省略可）
+        on_draft_text: 初稿のテキストの断片を受け取る関数（省略可）
+        cancel: キャンセル状態（省略可）。キャンセルされたら実行中のリライトも止めて GenerationCancelled を投げる
+        fallback: リライトに失敗したとき初稿を返すか（False なら初稿全体を持った RewriteFailed を投げる）
+
+    Returns:
+        (初稿, リライト後のシナリオ)。初稿の生成に失敗した場合はリライト後もエラーメッセージ
+    """
+    notify = on_progress or (lambda message: None)
+    state = {"chunks": [], "line": "", "first_half": None}
+    half_metas = {"前編": {}, "後編": {}}
+
+    executor = ThreadPoolExecutor(max_workers=2)
+    futures = {}
+    tokens = {}
+
+    def start_rewrite(part, text, reference=None):
+        # やり直すときは、始まっている前のリライトを止める（止めないと出力トークンの課金が続く）
+        if part in tokens:
+            tokens[part].cancel(f"{part}の初稿の変更")
+            tokens[part].detach()
+            half_metas[part] = {}
+        tokens[part] = CancelToken(parent=cancel)
+        futures[part] = executor.submit(
+            run_in_context(check_and_fix_scenario), api_key, text, half_metas[part], user_tier, mode, reference,
+            tokens[part], fallback, part
+        )
+        futures[part].add_done_callback(lambda future, token=tokens[part]: token.detach())
+
+    def on_text(chunk):
+        if on_draft_text is not None:
+            on_draft_text(chunk)
+        if state["first_half"] is not None:
+            return
+        state["chunks"].append(chunk)
+        # 「■後編」は行頭にあるので、書きかけの行だけを調べる
+        line = state["line"] + chunk
+        if find_second_part(line) < 0:
+            state["line"] = line[line.rfind("\n") + 1:]
+            return
+        state["first_half"] = split_parts("".join(state["chunks"]))[0]
+        start_rewrite("前編", state["first_half"])
+        notify("✨ 前編の初稿が完成したので、後編を書いている間に前編のリライトを始めました")
+
+    try:
+        draft = generate_scenario(api_key, experience, meta=meta, user_tier=user_tier, on_text=on_text, cancel=cancel)
+        if draft.startswith("エラーが発生しました"):
+            return draft, draft
+
+        first_half, second_half = split_parts(draft)
+        if second_half is None:
+            notify("✨ 初稿全体をリライト中...")
+            return draft, check_and_fix_scenario(api_key, draft, meta, user_tier, mode, cancel=cancel, fallback=fallback)
+
+        # 続き生成などで前編の内容が変わっていたらやり直す
+        if "前編" not in futures or state["first_half"] != first_half:
+            start_rewrite("前編", first_half)
+        start_rewrite("後編", second_half, reference=first_half)
+        notify("✨ 後編のリライト中...")
+
+        rewritten = join_parts(futures["前編"].result(), futures["後編"].result())
+    except RewriteFailed as e:
+        # 前編・後編のどちらで失敗しても、初稿全体からやり直せるようにする
+        raise RewriteFailed(draft, e) from e
+    except GenerationCancelled:
+        # まだ始めていないリライトの分も、キャンセルで使わずに済んだ分に数える
+        if "前編" not in futures:
+            record_skipped_stage(cancel, "rewrite", experience, mode)
+        elif "後編" not in futures:
+            record_skipped_stage(cancel, "rewrite", experience, mode, share=0.5)
+        raise
+    finally:
+        # 失敗・キャンセルで抜けるときは、まだ動いているリライトも止める
+        for part, future in futures.items():
+            if not future.done():
+                tokens[part].cancel("リライトの中止")
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if meta is not None:
+        for stage in {stage for half_meta in half_metas.values() for stage in half_meta if stage != "rewrite_error"}:
+            _merge_stage_meta(meta, stage, [m[stage] for m in half_metas.values() if stage in m])
+        errors = [f"{part}: {m['rewrite_error']}" for part, m in half_metas.items() if "rewrite_error" in m]
+        if errors:
+            meta["rewrite_error"] = " / ".join(errors)
+    return draft, rewritten
+
+# ============================================================================
+# 1ページ・1コマだけの作り直し
+# ============================================================================
+
+REGENERATE_PAGE_PROMPT_TEMPLATE = """
+以下はスカッと系ショート漫画のシナリオの一部です。**{part}の【P{page}】だけ**を書き直してください。
+{instruction}
+【登場人物】
+{characters}
+
+【前のページ（参考・出力しない）】
+{previous_page}
+
+【書き直すページ】
+{target}
+
+【次のページ（参考・出力しない）】
+{next_page}
+
+- 前後のページとの話の流れ・ページ終わりの引きを保つ
+- 登場人物は【登場人物】の人物だけを使う。コマ数は元のページと同じくらいにする
+- 出力は「【P{page}】」の行から始め、コマ番号（1コマ目、2コマ目…）・※カメラ・※状況・セリフ・心の声を
+  1行ずつ書く
+- ■前編・■後編の見出しや、分析・コメントは出力しない
+"""
+
+REGENERATE_PANEL_PROMPT_TEMPLATE = """
+以下はスカッと系ショート漫画のシナリオの一部です。**{part}の【P{page}】の{panel}コマ目だけ**を書き直してください。
+{instruction}
+【登場人物】
+{characters}
+
+【このコマのあるページ（参考）】
+{context}
+
+【書き直すコマ】
+{target}
+
+- ページの前後のコマとの流れを保つ
+- 登場人物は【登場人物】の人物だけを使う
+
+▼ 出力形式
+```json
+{{"lines": ["※カメラ：引き", "※リビング。夕方", "A子「今日も疲れたな…」"]}}
+```
+- lines はコマ番号の行を除いたコマの中身（1行＝1要素）
+
+【重要】出力はJSONのみ。分析や評価コメントは不要です。
+"""
+
+CHARACTER_HEADER = "【登場人物】"
+
+def _character_block(intro):
+    """分析などの冒頭から【登場人物】の行を取り出す（なければ空）"""
+    lines = intro.split("\n")
+    start = next((i for i, line in enumerate(lines) if line.strip() == CHARACTER_HEADER), None)
+    if start is None:
+        return ""
+    block = []
+    for line in lines[start + 1:]:
+        if not line.strip() or line.lstrip().startswith("【"):
+            break
+        block.append(line.strip())
+    return "\n".join(block)
+
+def _character_names(characters):
+    """「・A子：…」の行から登場人物の名前"""
+    return [line.lstrip("・").split("：")[0].strip() for line in characters.split("\n") if "：" in line]
+
+def _format_instruction(instruction):
+    """編集者の直したい点"""
+    instruction = (instruction or "").strip()
+    return f"\n【直したい点】\n{instruction}\n" if instruction else ""
+
+@profiled("pipeline.regenerate")
+def regenerate_section(api_key, scenario, part, page, panel=None, instruction="", meta=None, user_tier=None,
+                       cancel=None):
+    """
+    シナリオの1ページ（panel を指定したら1コマ）だけを書き直して、元のシナリオに差し込む
+
+    モデルには書き直す部分と、登場人物・前後のページ（コマなら同じページ）だけを送る。
+
+    Args:
+        api_key: Anthropic APIキー
+        scenario: 元のシナリオ
+        part: "前編" / "後編"
+        page: ページ番号
+        panel: コマ番号（省略するとページ全体）
+        instruction: 直したい点（省略可）
+        meta: 使用したモデルなどの記録先（省略可。meta["regenerate"] に記録する）
+        user_tier: ユーザー区分（モデルのルーティングに使用）
+        cancel: キャンセル状態（省略可）
+
+    Returns:
+        (改行を整えた差し替え後のシナリオ, 問題点のリスト)
+
+    Raises:
+        ValueError: 指定したページ・コマがない場合や、出力の形式が正しくない場合
+    """
+    blocks = split_pages(scenario)
+    pages = [block for block in blocks if block["page"] is not None]
+    index = next((i for i, block in enumerate(pages) if (block["part"], block["page"]) == (part, page)), None)
+    if index is None:
+        raise ValueError(f"存在しないページです: {part}P{page}")
+    characters = _character_block("\n".join(block["text"] for block in blocks if block["part"] is None))
+    page_text = pages[index]["text"].strip()
+
+    if panel is None:
+        prompt = REGENERATE_PAGE_PROMPT_TEMPLATE.format(
+            part=part, page=page, instruction=_format_instruction(instruction), characters=characters or "（なし）",
+            previous_page=pages[index - 1]["text"].strip() if index > 0 else "（なし。シナリオの最初のページ）",
+            target=page_text,
+            next_page=pages[index + 1]["text"].strip() if index + 1 < len(pages) else "（なし。シナリオの最後のページ）",
+        )
+        source = page_text
+    else:
+        section = next(
+            (s for s in split_sections(scenario) if (s["part"], s["page"], s["panel"]) == (part, page, panel)), None
+        )
+        if section is None:
+            raise ValueError(f"存在しないコマです: {part}P{page}の{panel}コマ目")
+        source = "\n".join(section["lines"]).strip()
+        prompt = REGENERATE_PANEL_PROMPT_TEMPLATE.format(
+            part=part, page=page, panel=panel, instruction=_format_instruction(instruction),
+            characters=characters or "（なし）", context=page_text, target=source,
+        )
+
+    stage_meta = {}
+    try:
+        output = create_message(
+            get_client(api_key), "regenerate", prompt, 0.7, source,
+            meta=stage_meta, user_tier=user_tier, cancel=cancel
+        )
+    finally:
+        if meta is not None:
+            meta.update(stage_meta)
+    if stage_meta["regenerate"]["stop_reason"] == "max_tokens":
+        raise ValueError("書き直しが途中で打ち切られました")
+
+    if panel is None:
+        new_page, issues = check_page(output, part, page, _character_names(characters))
+        return enforce_line_breaks(replace_page(scenario, part, page, new_page)), issues
+    lines = load_json_response(output).get("lines")
+    edits = [{"part": part, "page": page, "panel": panel, "lines": lines}]
+    return enforce_line_breaks(apply_panel_edits(scenario, edits)), []
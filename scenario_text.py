@@ -0,0 +1,529 @@
+"""
+シナリオテキストの整形・文字数カウント
+
+正規表現はモジュール読み込み時に1回だけコンパイルする。
+Streamlitは再実行のたびにapp.pyを丸ごと実行し直すため、
+プロセス内で使い回したいものはこのモジュール側に置く。
+"""
+
+import re
+
+from profiler import profiled
+
+# ============================================================================
+# コンパイル済みパターン
+# ============================================================================
+
+# 改行の前に区切りを入れる第三者キャラ（A子・B男などの記号キャラ以外）
+NAMED_CHARACTERS = (
+    "義母", "義父", "助産師", "看護師", "医師", "弁護士",
+    "探偵", "上司", "友人", "母", "父",
+)
+
+# ※カメラ・※状況説明の前（行頭の※は除外）
+_CAMERA_BREAK = r'(?<!^)(?<!\n)※'
+
+def _name_alternative(name):
+    """
+    名前1つ分のパターン
+
+    ほかの名前の末尾と一致する名前（「義母」の「母」など）は、
+    その名前の途中では区切らないよう否定の後読みを付ける
+    """
+    prefixes = sorted({
+        other[:-len(name)] for other in NAMED_CHARACTERS
+        if other != name and other.endswith(name)
+    })
+    return "".join(f"(?<!{re.escape(prefix)})" for prefix in prefixes) + re.escape(name)
+
+# キャラ名「セリフ」・キャラ名（心の声）の前
+# 「義母」より先に「母」がマッチしないよう、長い名前を先に並べる
+_SPEAKER_BREAK = r'(?<!\n)(?:[A-Z][子男]|{names})[「（]'.format(
+    names="|".join(_name_alternative(name) for name in sorted(NAMED_CHARACTERS, key=len, reverse=True))
+)
+
+BREAK_BEFORE_PATTERN = re.compile(f'{_CAMERA_BREAK}|{_SPEAKER_BREAK}')
+
+# 文字数カウントから除外する記号・括弧・空白
+NON_COUNTED_PATTERN = re.compile(r'[※「」『』■\(\)（）…！？!?〜～\s]')
+
+# ============================================================================
+# 文字数カウント
+# ============================================================================
+
+def count_characters(text):
+    """
+    シナリオの文字数を正確にカウント
+
+    Args:
+        text: カウント対象のテキスト
+
+    Returns:
+        文字数（改行、記号、括弧を除いた純粋なテキスト文字のみ）
+    """
+    # 改行・記号・括弧・空白を削除して残った文字数をカウント
+    return len(NON_COUNTED_PATTERN.sub('', text))
+
+# ============================================================================
+# 改行の強制修正
+# ============================================================================
+
+@profiled("text.enforce_line_breaks")
+def enforce_line_breaks(text):
+    """
+    シナリオテキストの改行を強制的に修正する
+    ※カメラ、※状況、セリフ、心の声をそれぞれ別の行に分離
+
+    シンプルなアプローチ：
+    1. 改行が必要なパターンの前に改行を挿入
+    2. 連続する空行をまとめ、各行の前後の空白を除去
+    3. 結果を返す
+
+    モデルの出力は打ち切られて同じ文が延々と続くこともあるので、
+    入力の長さに比例する時間で終わるようにしている（benchmark_text.py で確認）。
+    """
+    # ※カメラ・※状況、キャラ名「セリフ」、キャラ名（心の声）の前に改行
+    # （置換を文字列で渡すと、区切りごとに Python の関数を呼ばずに済む）
+    result = BREAK_BEFORE_PATTERN.sub('\n\\g<0>', text)
+
+    # 各行の先頭・末尾の空白を整理
+    # 連続する空行は1つにまとめる（まとめるための置換で全文をもう1周しない）
+    cleaned_lines = []
+    for line in result.split('\n'):
+        stripped = line.strip()
+        if stripped:
+            cleaned_lines.append(stripped)
+        else:
+            # 空行は保持（ただし連続しすぎないように）
+            if cleaned_lines and cleaned_lines[-1] != '':
+                cleaned_lines.append('')
+
+    return '\n'.join(cleaned_lines)
+
+# 区切りの判定に必要な文字数（最長のキャラ名 + 「 の先読み、後読みは名前の長さまで）
+_MAX_BREAK_LENGTH = max(len(name) for name in NAMED_CHARACTERS) + 1
+_BREAK_LOOKBEHIND = max(len(name) for name in NAMED_CHARACTERS)
+
+class LineBreakNormalizer:
+    """
+    enforce_line_breaks のストリーミング版
+
+    生成中のテキストを少しずつ受け取り、確定した部分だけを返す。
+    feed() と flush() が返した文字列をすべてつなぐと、
+    全文に enforce_line_breaks をかけた結果と一致する。
+    区切りの判定に必要な先読みは数文字だけなので、新しく届いた分だけを走査する。
+
+    使い方:
+        normalizer = LineBreakNormalizer()
+        for chunk in stream:
+            show(normalizer.feed(chunk))
+        show(normalizer.flush())
+    """
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        # 後読み用の文字 + まだ区切りを判定していない文字（行頭は '\n' を後読み用に置く）
+        self._window = '\n'
+        self._context = 1
+        # 出力中の行の途中の空白（行末の空白なら捨てる）
+        self._pending_space = ''
+        self._line_started = False
+        self._has_output = False
+        self._last_blank = False
+
+    def feed(self, chunk):
+        """
+        テキストの断片を受け取る
+
+        Returns:
+            新しく確定した整形済みテキスト（まだ確定しない末尾の数文字は次回以降に返す）
+        """
+        out = []
+        for index, piece in enumerate(chunk.split('\n')):
+            if index > 0:
+                # 行が終わったので残りをすべて判定する
+                self._scan(out, final=True)
+                self._end_line(out)
+                self._window, self._context = '\n', 1
+            self._window += piece
+        self._scan(out, final=False)
+        return ''.join(out)
+
+    def flush(self):
+        """
+        残りをすべて確定させて返し、状態を初期化する
+
+        Returns:
+            残りの整形済みテキスト
+        """
+        out = []
+        self._scan(out, final=True)
+        self._end_line(out)
+        self._reset()
+        return ''.join(out)
+
+    def _scan(self, out, final):
+        """_window のうち判定できる範囲で区切りを探して出力する"""
+        window = self._window
+        # 行の途中では、最長の区切りが収まる位置までしか判定しない
+        limit = len(window) if final else len(window) - _MAX_BREAK_LENGTH + 1
+        pos = self._context
+        while pos < limit:
+            match = BREAK_BEFORE_PATTERN.search(window, pos)
+            if match is None or match.start() >= limit:
+                break
+            self._write(out, window[pos:match.start()])
+            self._end_line(out)
+            self._write(out, match.group())
+            pos = match.end()
+
+        done = max(pos, limit)
+        self._write(out, window[pos:done])
+        keep = max(0, done - _BREAK_LOOKBEHIND)
+        self._window = window[keep:]
+        self._context = done - keep
+
+    def _write(self, out, text):
+        """行の中身を出力する（行頭の空白は捨て、途中の空白は次の文字が来るまで保留）"""
+        if not self._line_started:
+            text = text.lstrip()
+            if not text:
+                return
+            if self._has_output:
+                out.append('\n')
+            self._line_started = True
+            self._has_output = True
+            self._last_blank = False
+
+        body = text.rstrip()
+        if body:
+            out.append(self._pending_space)
+            out.append(body)
+            self._pending_space = text[len(body):]
+        else:
+            self._pending_space += text
+
+    def _end_line(self, out):
+        """行を終える（空行は連続させず、先頭の空行は出さない）"""
+        if self._line_started:
+            self._line_started = False
+            self._pending_space = ''
+        elif self._has_output and not self._last_blank:
+            out.append('\n')
+            self._last_blank = True
+
+# ============================================================================
+# 前編/後編・ページ・コマ単位の分割
+# ============================================================================
+
+PART_HEADER_PATTERN = re.compile(r'^\s*■\s*(前編|後編)')
+PAGE_HEADER_PATTERN = re.compile(r'^\s*【\s*P\s*(\d+)\s*】')
+# 「**」の前後の空白を別々の \s* で受けると、空白だけの長い行で分け方を総当たりして二乗の時間がかかる
+PANEL_HEADER_PATTERN = re.compile(r'^\s*(?:\*+\s*)?(\d+)\s*コマ目')
+SEPARATOR_PATTERN = re.compile(r'^\s*━{3,}')
+# セリフ・心の声の行（キャラ名「…」／キャラ名（…））
+SPEAKER_LINE_PATTERN = re.compile(r'^\s*([^\s※「」（）【】■]{1,10}?)[「（]')
+
+def split_sections(text):
+    """
+    シナリオを前編/後編・ページ・コマ単位のセクションに分割する
+
+    各セクションは見出し行を含む行のリストを持ち、
+    すべてのセクションの行を '\\n' でつなぐと元のテキストに戻る。
+
+    Args:
+        text: シナリオのテキスト
+
+    Returns:
+        [{"part": "前編"/"後編"/None, "page": int/None, "panel": int/None, "lines": [...]}, ...]
+        コマ以外（分析・見出し・区切り線など）は panel が None のセクションになる
+    """
+    sections = []
+    part = None
+    page = None
+    current = {"part": None, "page": None, "panel": None, "lines": []}
+
+    for line in text.split('\n'):
+        part_match = PART_HEADER_PATTERN.match(line)
+        page_match = PAGE_HEADER_PATTERN.match(line)
+        panel_match = PANEL_HEADER_PATTERN.match(line)
+        boundary = part_match or page_match or SEPARATOR_PATTERN.match(line)
+
+        if part_match:
+            part, page = part_match.group(1), None
+        elif page_match and part:
+            page = int(page_match.group(1))
+
+        if panel_match and part and page:
+            # コマの開始
+            sections.append(current)
+            current = {"part": part, "page": page, "panel": int(panel_match.group(1)), "lines": [line]}
+        elif boundary and current["panel"] is not None:
+            # コマの終わり（次の見出し・区切り線）
+            sections.append(current)
+            current = {"part": part, "page": page, "panel": None, "lines": [line]}
+        else:
+            current["lines"].append(line)
+
+    sections.append(current)
+    return [section for section in sections if section["lines"] or section["panel"] is not None]
+
+def split_pages(text):
+    """
+    シナリオを表示用に、編より前（分析など）と、編ごとのページに分ける
+
+    各ブロックは見出し行を含み、すべてのブロックの text を '\\n' でつなぐと元のテキストに戻る。
+
+    Args:
+        text: シナリオのテキスト
+
+    Returns:
+        [{"part": "前編"/"後編"/None, "page": int/None, "text": ...}, ...]
+        編の見出しからP1の前まで（区切り線など）は page が None のブロックになる
+    """
+    blocks = []
+    current = {"part": None, "page": None, "lines": []}
+    part = None
+
+    for line in text.split('\n'):
+        part_match = PART_HEADER_PATTERN.match(line)
+        page_match = PAGE_HEADER_PATTERN.match(line) if part else None
+        if part_match:
+            part = part_match.group(1)
+            blocks.append(current)
+            current = {"part": part, "page": None, "lines": [line]}
+        elif page_match:
+            blocks.append(current)
+            current = {"part": part, "page": int(page_match.group(1)), "lines": [line]}
+        elif SEPARATOR_PATTERN.match(line) and current["page"] is not None:
+            # 前編の最後のページのあとの区切り線は、ページに含めない
+            blocks.append(current)
+            current = {"part": part, "page": None, "lines": [line]}
+        else:
+            current["lines"].append(line)
+
+    blocks.append(current)
+    return [
+        {"part": block["part"], "page": block["page"], "text": '\n'.join(block["lines"])}
+        for block in blocks
+        if block["lines"]
+    ]
+
+def replace_page(text, part, page, page_text):
+    """
+    1ページを差し替える（ページ末尾の空行は残す）
+
+    Args:
+        text: 元のシナリオ
+        part: "前編" / "後編"
+        page: ページ番号
+        page_text: 「【P◯】」の見出しから始まる新しいページ
+
+    Returns:
+        差し替え後のシナリオ
+
+    Raises:
+        ValueError: 存在しないページを指定した場合
+    """
+    blocks = split_pages(text)
+    for block in blocks:
+        if block["part"] == part and block["page"] == page:
+            lines = block["text"].split('\n')
+            # ページ末尾の空行は残す（次のページとの区切り）
+            trailing = []
+            for line in reversed(lines[1:]):
+                if line.strip():
+                    break
+                trailing.append(line)
+            block["text"] = '\n'.join([page_text.strip('\n')] + trailing)
+            return '\n'.join(block["text"] for block in blocks)
+    raise ValueError(f"存在しないページです: {part}P{page}")
+
+def panel_keys(text):
+    """シナリオに含まれるコマの (編, ページ, コマ) の一覧"""
+    return [
+        (section["part"], section["page"], section["panel"])
+        for section in split_sections(text)
+        if section["panel"] is not None
+    ]
+
+def apply_panel_edits(text, edits):
+    """
+    コマ単位の差し替えをシナリオに適用する
+
+    Args:
+        text: 元のシナリオ
+        edits: [{"part": "前編", "page": 1, "panel": 2, "lines": ["※カメラ：引き", ...]}, ...]
+            lines はコマ番号の行を除いたコマの中身
+
+    Returns:
+        差し替え後のシナリオ
+
+    Raises:
+        ValueError: 存在しないコマを指定した場合や、形式が正しくない場合
+    """
+    sections = split_sections(text)
+    by_key = {
+        (section["part"], section["page"], section["panel"]): section
+        for section in sections
+        if section["panel"] is not None
+    }
+
+    for edit in edits:
+        if not isinstance(edit, dict):
+            raise ValueError(f"差し替えの形式が正しくありません: {edit!r}")
+        key = (edit.get("part"), edit.get("page"), edit.get("panel"))
+        lines = edit.get("lines")
+        if key not in by_key:
+            raise ValueError(f"存在しないコマです: {key}")
+        if not isinstance(lines, list) or not lines or not all(isinstance(l, str) and l.strip() for l in lines):
+            raise ValueError(f"コマの中身が正しくありません: {key}")
+
+        section = by_key[key]
+        # コマ末尾の空行は残す（次のコマとの区切り）
+        trailing = []
+        for line in reversed(section["lines"][1:]):
+            if line.strip():
+                break
+            trailing.append(line)
+        section["lines"] = [section["lines"][0]] + [l.strip() for l in lines] + trailing
+
+    return '\n'.join(line for section in sections for line in section["lines"])
+
+def scenario_char_stats(text):
+    """
+    シナリオの文字数の内訳を数える（文字数は count_characters と同じ数え方）
+
+    編・ページ・コマの文字数は、コマ番号の行を除いたコマの中身から数える。
+    セリフ・心の声はキャラ名を除いた部分を dialogue、
+    それ以外のコマの行（※カメラ・※状況など）を narration とする。
+
+    Args:
+        text: シナリオのテキスト
+
+    Returns:
+        {
+            "total": シナリオ全体（分析なども含む）,
+            "script_total": コマの中身の合計,
+            "parts": {"前編": n, "後編": n},
+            "pages": {"前編/P1": n, ...},
+            "panels": {"前編/P1/1": n, ...},
+            "dialogue": n,
+            "narration": n,
+        }
+    """
+    stats = {
+        "total": count_characters(text),
+        "script_total": 0,
+        "parts": {},
+        "pages": {},
+        "panels": {},
+        "dialogue": 0,
+        "narration": 0,
+    }
+
+    for section in split_sections(text):
+        if section["panel"] is None:
+            continue
+        part, page, panel = section["part"], section["page"], section["panel"]
+        panel_count = 0
+        for line in section["lines"][1:]:
+            speaker = SPEAKER_LINE_PATTERN.match(line)
+            if speaker:
+                count = count_characters(line[speaker.end(1):])
+                stats["dialogue"] += count
+            else:
+                count = count_characters(line)
+                stats["narration"] += count
+            panel_count += count
+
+        panel_key = f"{part}/P{page}/{panel}"
+        page_key = f"{part}/P{page}"
+        stats["panels"][panel_key] = stats["panels"].get(panel_key, 0) + panel_count
+        stats["pages"][page_key] = stats["pages"].get(page_key, 0) + panel_count
+        stats["parts"][part] = stats["parts"].get(part, 0) + panel_count
+        stats["script_total"] += panel_count
+
+    return stats
+
+# 前編・後編それぞれのページ数
+PAGES_PER_PART = 5
+
+def format_violations(text):
+    """
+    シナリオの形式の問題点を洗い出す
+
+    - 「■前編」「■後編」の見出しがあるか
+    - 各編に【P1】〜【P5】がそろっているか、コマのないページがないか
+    - 1行に※カメラ・※状況・セリフ・心の声が混ざっていないか（改行ルール）
+
+    Args:
+        text: シナリオのテキスト
+
+    Returns:
+        問題点のリスト（問題がなければ空）
+    """
+    violations = []
+    sections = split_sections(text)
+
+    for part in ("前編", "後編"):
+        part_sections = [section for section in sections if section["part"] == part]
+        if not part_sections:
+            violations.append(f"「■{part}」の見出しがありません")
+            continue
+        pages = sorted({section["page"] for section in part_sections if section["page"]})
+        if pages != list(range(1, PAGES_PER_PART + 1)):
+            violations.append(f"{part}のページが【P1】〜【P{PAGES_PER_PART}】になっていません（{pages}）")
+        panel_pages = {section["page"] for section in part_sections if section["panel"] is not None}
+        for page in pages:
+            if page not in panel_pages:
+                violations.append(f"{part}P{page}: コマがありません")
+
+    # 区切りのない行（空行・コマ番号など）は整形し直すまでもない
+    mixed_lines = sum(
+        1 for line in text.split('\n')
+        if BREAK_BEFORE_PATTERN.search(line) and '\n' in enforce_line_breaks(line)
+    )
+    if mixed_lines:
+        violations.append(f"改行ルール違反: {mixed_lines}行")
+    return violations
+
+# ============================================================================
+# 前編/後編の境目
+# ============================================================================
+
+SECOND_PART_PATTERN = re.compile(r'^[ \t　]*■\s*後編', re.MULTILINE)
+PART_SEPARATOR = "━" * 37
+
+def find_second_part(text):
+    """
+    「■後編」の見出し行の開始位置を返す（見つからなければ-1）
+
+    Args:
+        text: シナリオのテキスト（生成途中でもよい）
+    """
+    match = SECOND_PART_PATTERN.search(text)
+    return match.start() if match else -1
+
+def split_parts(text):
+    """
+    シナリオを前半（分析〜前編）と後半（■後編〜）に分ける
+
+    Returns:
+        (前半, 後半)。「■後編」が見つからなければ (text, None)
+        前半の末尾の区切り線・空行は除く
+    """
+    index = find_second_part(text)
+    if index < 0:
+        return text, None
+
+    first_lines = text[:index].split('\n')
+    while first_lines and (not first_lines[-1].strip() or SEPARATOR_PATTERN.match(first_lines[-1])):
+        first_lines.pop()
+    return '\n'.join(first_lines), text[index:]
+
+def join_parts(first_half, second_half):
+    """split_parts で分けた前半と後半をつなぎ直す"""
+    return f"{first_half.rstrip()}\n\n{PART_SEPARATOR}\n{second_half.lstrip()}"
@@ -0,0 +1,176 @@
+"""
+似ている体験談の検出（MinHash / LSH）
+
+体験談は日本語なので単語ではなく文字n-gramで比べる。
+履歴の保存時に体験談のMinHash署名を作って履歴インデックスに入れておき、
+生成前に入力中の体験談と似ている履歴を探す。
+
+署名はバンドに分けてバケットに入れるので、数万件あっても
+同じバケットに入った候補だけを比べればよい。
+"""
+
+import random
+import re
+import unicodedata
+import zlib
+
+# 文字n-gramの長さ
+SHINGLE_SIZE = 3
+
+# 署名の長さ = バンド数 × バンドあたりの行数
+# 20 × 3 だと、類似度0.6（history_store.SIMILARITY_THRESHOLD）の組は約99%、
+# 0.3の組は約42%、0.1の組は約2%が候補に入る
+LSH_BANDS = 20
+LSH_ROWS = 3
+NUM_PERMUTATIONS = LSH_BANDS * LSH_ROWS
+
+# 署名の1要素を表す16進数の桁数
+_HEX_WIDTH = 8
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+# 署名は保存して使い回すので、プロセスをまたいで同じハッシュ関数を使う
+_rng = random.Random(20240401)
+_PERMUTATIONS = [
+    (_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+    for _ in range(NUM_PERMUTATIONS)
+]
+
+_IGNORED_PATTERN = re.compile(r'[\s「」『』（）()、。，．,.！？!?…〜～・]')
+
+# ============================================================================
+# 署名
+# ============================================================================
+
+def shingles(text):
+    """
+    体験談を文字n-gramの集合にする（空白・句読点・括弧は無視）
+
+    Args:
+        text: 体験談
+
+    Returns:
+        文字n-gramの集合（SHINGLE_SIZE より短い文は全体を1つとする）
+    """
+    normalized = _IGNORED_PATTERN.sub('', unicodedata.normalize("NFKC", text or "")).lower()
+    if len(normalized) <= SHINGLE_SIZE:
+        return {normalized} if normalized else set()
+    return {normalized[i:i + SHINGLE_SIZE] for i in range(len(normalized) - SHINGLE_SIZE + 1)}
+
+def minhash_signature(text):
+    """
+    体験談のMinHash署名
+
+    Returns:
+        NUM_PERMUTATIONS 個の32bit値をつないだ16進数の文字列（空の体験談は ""）
+    """
+    hashes = [zlib.crc32(shingle.encode("utf-8")) for shingle in shingles(text)]
+    if not hashes:
+        return ""
+    return "".join(
+        format(min((a * h + b) % _MERSENNE_PRIME for h in hashes) & _MAX_HASH, "08x")
+        for a, b in _PERMUTATIONS
+    )
+
+def band_keys(signature):
+    """署名をLSHのバンドに分けたバケットのキー"""
+    width = LSH_ROWS * _HEX_WIDTH
+    return [f"{band}:{signature[band * width:(band + 1) * width]}" for band in range(LSH_BANDS)]
+
+def estimated_similarity(signature_a, signature_b):
+    """2つの署名から推定したJaccard類似度"""
+    if not signature_a or len(signature_a) != len(signature_b):
+        return 0.0
+    same = sum(
+        signature_a[i:i + _HEX_WIDTH] == signature_b[i:i + _HEX_WIDTH]
+        for i in range(0, len(signature_a), _HEX_WIDTH)
+    )
+    return same / NUM_PERMUTATIONS
+
+def jaccard_similarity(text_a, text_b):
+    """2つの体験談の文字n-gramのJaccard類似度"""
+    a, b = shingles(text_a), shingles(text_b)
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+# ============================================================================
+# LSHインデックス
+# ============================================================================
+
+class ExperienceIndex:
+    """
+    署名をバンドごとのバケットに入れたLSHインデックス
+
+    使い方:
+        index = ExperienceIndex()
+        index.sync({"scenario_20250101_120000.json": signature, ...})
+        index.query(minhash_signature(experience), threshold=0.6)
+    """
+
+    def __init__(self):
+        self._signatures = {}
+        self._buckets = {}
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def add(self, key, signature):
+        """署名を追加する（同じキーがあれば置き換える）"""
+        if self._signatures.get(key) == signature:
+            return
+        self.remove(key)
+        # 空の署名や長さの違う古い署名はバケットに入れない
+        if len(signature or "") != NUM_PERMUTATIONS * _HEX_WIDTH:
+            return
+        self._signatures[key] = signature
+        for bucket in band_keys(signature):
+            self._buckets.setdefault(bucket, set()).add(key)
+
+    def remove(self, key):
+        """署名を取り除く"""
+        signature = self._signatures.pop(key, None)
+        if not signature:
+            return
+        for bucket in band_keys(signature):
+            keys = self._buckets.get(bucket)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._buckets[bucket]
+
+    def sync(self, signatures):
+        """
+        インデックスの中身を {キー: 署名} に合わせる（変わった分だけ入れ替える）
+        """
+        for key in [key for key in self._signatures if key not in signatures]:
+            self.remove(key)
+        for key, signature in signatures.items():
+            if self._signatures.get(key) != signature:
+                self.add(key, signature)
+
+    def query(self, signature, threshold=0.0, limit=10):
+        """
+        似ている署名を探す
+
+        Args:
+            signature: 探したい体験談の署名
+            threshold: 推定類似度の下限
+            limit: 最大件数
+
+        Returns:
+            [(キー, 推定類似度), ...]（類似度の高い順）
+        """
+        if not signature:
+            return []
+        candidates = set()
+        for bucket in band_keys(signature):
+            candidates.update(self._buckets.get(bucket, ()))
+
+        scored = [
+            (key, estimated_similarity(signature, self._signatures[key]))
+            for key in candidates
+        ]
+        scored = [(key, score) for key, score in scored if score >= threshold]
+        scored.sort(key=lambda item: (-item[1], item[0]))
+        return scored[:limit]
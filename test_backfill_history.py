@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+履歴のバックフィル（backfill_history.py）のテスト
+
+    python -m pytest -q test_backfill_history.py
+"""
+
+import json
+import threading
+
+import pytest
+
+import backfill_history
+import budget
+import history_store
+import scenario_pipeline
+from benchmark_prompts import synthetic_scenario
+from conftest import FakeApi
+
+EXPERIENCES = [
+    "義母が毎週末に連絡なしで家に来る。録音した会話を家族会議で流した。",
+    "夫の浮気を探偵に調べてもらい、弁護士と一緒に証拠を突きつけた。",
+    "上司に手柄を横取りされたが、会議で記録を見せて取り返した。",
+]
+
+
+class _PatchApi(FakeApi):
+    """前編P1の1コマ目を書き直すパッチを返す。fail_once に含まれるシナリオは1回目だけ失敗する"""
+
+    usage = (2000, 200)
+
+    def __init__(self, fail_once=()):
+        super().__init__()
+        self._fail_once = set(fail_once)
+        self._fail_lock = threading.Lock()
+
+    def respond(self, prompt):
+        with self._fail_lock:
+            failing = [text for text in self._fail_once if text in prompt]
+            for text in failing:
+                self._fail_once.discard(text)
+        if failing:
+            raise ConnectionError("一時的なAPIエラー")
+        edits = {"edits": [{"part": "前編", "page": 1, "panel": 1, "lines": ["※カメラ：寄り", "A子「新しいセリフ」"]}]}
+        return json.dumps(edits, ensure_ascii=False)
+
+
+@pytest.fixture
+def history(history_dir, tmp_path, monkeypatch):
+    monkeypatch.setattr(history_store, "WRITE_BEHIND", False)
+    monkeypatch.setattr(budget, "BUDGET_PATH", str(tmp_path / "budget.json"))
+    budget._config_cache.update(mtime=None, config=None)
+    backend = history_store.get_backend()
+    records = []
+    for i, experience in enumerate(EXPERIENCES):
+        record = {
+            "id": f"2025010{i + 1}_120000_000000_abc00{i}",
+            "timestamp": f"2025-01-0{i + 1}T12:00:00",
+            "experience": experience,
+            "prompt_version": "2.0",
+            "models": {"draft": "old-model"},
+            "result": synthetic_scenario(experience),
+        }
+        backend.put(f"scenario_{record['id']}.json", record)
+        records.append(record)
+    yield records
+    budget._config_cache.update(mtime=None, config=None)
+    budget._ledger_cache.update(loaded_at=0.0, ledger=None)
+
+
+def test_select_records_by_version_date_favorite_and_edit(history):
+    assert len(backfill_history.select_records()) == 3
+    assert backfill_history.select_records(prompt_versions=["1.0"]) == []
+    assert [r["id"] for r in backfill_history.select_records(since="2025-01-02", until="2025-01-02")] == [history[1]["id"]]
+
+    history_store.toggle_favorite(history[0]["id"])
+    assert [r["id"] for r in backfill_history.select_records(favorites=True)] == [history[0]["id"]]
+
+    history_store.update_history(history[2]["id"], "手で直したシナリオ")
+    assert history[2]["id"] not in [r["id"] for r in backfill_history.select_records()]
+    assert history[2]["id"] in [r["id"] for r in backfill_history.select_records(include_edited=True)]
+
+
+def test_backfill_keeps_revision_and_resumes_after_failure(history, use_api):
+    api = use_api(_PatchApi(fail_once=[history[1]["result"]]))
+    job = backfill_history.BackfillJob("test", {})
+    summary = backfill_history.run_backfill("key", backfill_history.select_records(), job, workers=2)
+
+    assert (summary["done"], summary["failed"], summary["processed"]) == (2, 1, 3)
+    assert summary["input_tokens"] > 0 and summary["cost_usd"] > 0
+    assert "一時的なAPIエラー" in job.state["records"][history[1]["id"]]["error"]
+
+    [updated] = [r for r in history_store.iter_history_records() if r["id"] == history[0]["id"]]
+    assert "新しいセリフ" in updated["result"]
+    assert updated["prompt_version"] == scenario_pipeline.PROMPT_VERSION
+    assert updated["models"]["draft"] == "old-model" and "rewrite_patch" in updated["models"]
+    assert updated["revisions"][0]["result"] == history[0]["result"]
+    assert updated["revisions"][0]["prompt_version"] == "2.0"
+    assert updated["revisions"][0]["replaced_by"] == "backfill:rewrite"
+    assert not updated.get("is_edited")
+
+    # 別のプロセスから同じジョブ名で再開すると、失敗した1件だけやり直す
+    calls = len(api.prompts)
+    resumed = backfill_history.BackfillJob("test", {})
+    assert resumed.resumed
+    records = backfill_history.select_records(before_version=None)
+    summary = backfill_history.run_backfill("key", records, resumed, workers=2)
+    assert (summary["skipped"], summary["done"], summary["failed"]) == (2, 1, 0)
+    assert len(api.prompts) == calls + 1
+
+
+def test_backfill_stops_when_budget_is_spent(history, use_api, tmp_path):
+    api = use_api(_PatchApi())
+    (tmp_path / "budget.json").write_text(json.dumps({"daily_usd": 0.001}), encoding="utf-8")
+    budget._config_cache.update(mtime=None, config=None)
+    budget._ledger_cache.update(loaded_at=0.0, ledger=None)
+
+    job = backfill_history.BackfillJob("budget", {})
+    summary = backfill_history.run_backfill("key", backfill_history.select_records(), job, workers=1)
+    assert "上限" in summary["stopped"]
+    assert summary["done"] == 1
+    assert len(api.prompts) == 1
+    assert backfill_history.format_summary(summary).count("途中で止めました") == 1
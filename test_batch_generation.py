@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+夜間の一括生成（batch_generation.py）のテスト
+
+Message Batches API は、このファイルの中で立てる簡易サーバーを相手に確かめる
+（anthropic のクライアントを base_url でそちらに向ける）。
+
+    python -m pytest -q test_batch_generation.py
+"""
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import batch_generation
+import history_store
+from benchmark_prompts import _experience_from_draft_prompt, synthetic_scenario
+from scenario_text import enforce_line_breaks
+
+EXPERIENCES = [
+    "義母が毎週末に連絡なしで家に来る。録音した会話を家族会議で流した。",
+    "同僚が私の企画を自分の手柄にした。部長の前で作成履歴を見せた。",
+    "ママ友が子どもの服を勝手にフリマに出した。出品画面を保存して本人に見せた。",
+]
+PATCH = {"edits": [{"part": "前編", "page": 1, "panel": 1, "lines": ["※カメラ：引き", "A子「ただいま」"]}]}
+
+# ============================================================================
+# Message Batches API の簡易サーバー
+# ============================================================================
+
+class _BatchHandler(BaseHTTPRequestHandler):
+    """バッチの作成・取得・結果の取得だけを受ける Message Batches API もどき"""
+
+    batches = None  # サーバーごとに {ID: {"requests", "polls"}}
+    polls_until_ended = 2
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body, content_type="application/json"):
+        data = body if isinstance(body, bytes) else json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _batch(self, batch_id, ended):
+        count = len(self.batches[batch_id]["requests"])
+        host = self.headers.get("Host")
+        return {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {
+                "processing": 0 if ended else count, "succeeded": count if ended else 0,
+                "errored": 0, "canceled": 0, "expired": 0,
+            },
+            "created_at": "2025-01-01T00:00:00Z",
+            "expires_at": "2025-01-02T00:00:00Z",
+            "ended_at": "2025-01-01T01:00:00Z" if ended else None,
+            "archived_at": None,
+            "cancel_initiated_at": None,
+            "results_url": f"http://{host}/v1/messages/batches/{batch_id}/results" if ended else None,
+        }
+
+    def do_POST(self):
+        if self.path != "/v1/messages/batches" or self.headers.get("x-api-key") != "test":
+            return self._reply(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        batch_id = f"msgbatch_{len(self.batches) + 1:02d}"
+        self.batches[batch_id] = {"requests": body["requests"], "polls": 0}
+        self._reply(200, self._batch(batch_id, ended=False))
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        batch_id = parts[3] if len(parts) > 3 else ""
+        if batch_id not in self.batches:
+            return self._reply(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+        batch = self.batches[batch_id]
+        if parts[-1] == "results":
+            lines = [json.dumps(self._result(request), ensure_ascii=False) for request in batch["requests"]]
+            return self._reply(200, "\n".join(lines).encode("utf-8"), "application/binary")
+        batch["polls"] += 1
+        self._reply(200, self._batch(batch_id, ended=batch["polls"] >= self.polls_until_ended))
+
+    def _result(self, request):
+        prompt = request["params"]["messages"][0]["content"]
+        if "【元のシナリオ】" in prompt:
+            text = json.dumps(PATCH, ensure_ascii=False)
+        else:
+            experience = _experience_from_draft_prompt(prompt)
+            if experience == EXPERIENCES[2]:
+                return {
+                    "custom_id": request["custom_id"],
+                    "result": {"type": "errored", "error": {
+                        "type": "error", "error": {"type": "overloaded_error", "message": "Overloaded"},
+                    }},
+                }
+            text = synthetic_scenario(experience)
+        message = {
+            "id": f"msg_{request['custom_id']}",
+            "type": "message",
+            "role": "assistant",
+            "model": request["params"]["model"],
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {"input_tokens": 1000, "output_tokens": 2000},
+        }
+        return {"custom_id": request["custom_id"], "result": {"type": "succeeded", "message": message}}
+
+
+@pytest.fixture
+def batch_server():
+    handler = type("Handler", (_BatchHandler,), {"batches": {}})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", handler.batches
+    server.shutdown()
+
+
+@pytest.fixture
+def client(batch_server):
+    import anthropic
+
+    url, _ = batch_server
+    return anthropic.Anthropic(api_key="test", base_url=url, max_retries=0)
+
+
+@pytest.fixture
+def history_dir(history_dir, monkeypatch):
+    monkeypatch.setattr(batch_generation, "_memory", {})
+    yield history_dir
+    history_store.flush_history(timeout=10)
+
+# ============================================================================
+# テスト
+# ============================================================================
+
+def test_bulk_job_submits_rewrite_batch_after_drafts(client, batch_server, history_dir, monkeypatch):
+    _, batches = batch_server
+    recorded = []
+    monkeypatch.setattr(
+        batch_generation, "record_usage",
+        lambda model, usage, user=None, price_factor=1.0: recorded.append((usage.output_tokens, user, price_factor)),
+    )
+    for experience in EXPERIENCES:
+        assert batch_generation.enqueue_experience(experience, user="a@example.com")
+
+    job = batch_generation.submit_job(client, batch_generation.take_queue(), rewrite_mode="patch")
+    assert batch_generation.list_queue() == []
+    assert list(batches) == ["msgbatch_01"]
+    assert job["status"] == "drafting"
+
+    # 初稿のバッチが終わるまでは、自動リライトのバッチを投げない
+    job = batch_generation.advance_job(client, job)
+    assert job["status"] == "drafting"
+    assert list(batches) == ["msgbatch_01"]
+
+    polls = []
+    job = batch_generation.run_job(client, job, poll_interval=0, sleep=polls.append)
+    assert job["status"] == "completed"
+    assert list(batches) == ["msgbatch_01", "msgbatch_02"]
+    # 失敗した初稿は自動リライトに回さない
+    assert len(batches["msgbatch_02"]["requests"]) == 2
+    assert all("【元のシナリオ】" in r["params"]["messages"][0]["content"] for r in batches["msgbatch_02"]["requests"])
+    assert recorded == [(2000, "a@example.com", batch_generation.BATCH_PRICE_FACTOR)] * 4
+
+    summary = batch_generation.job_summary(job)
+    assert summary == {"completed": 2, "fallback": 0, "failed": 1, "waiting": 0}
+    assert "Overloaded" in job["items"]["item-0003"]["error"]
+
+    history_store.flush_history(timeout=10)
+    records = {record["experience"]: record for record in history_store.iter_history_records()}
+    assert set(records) == set(EXPERIENCES[:2])
+    record = records[EXPERIENCES[0]]
+    assert record["result"] == enforce_line_breaks(record["result"])
+    assert "A子「ただいま」" in record["result"]
+    assert set(record["models"]) == {"draft", "rewrite_patch"}
+
+    # 別のプロセスからでも、保存されたジョブを読める
+    monkeypatch.setattr(batch_generation, "_memory", {})
+    assert batch_generation.load_job(job["id"])["status"] == "completed"
+    assert batch_generation.list_jobs(unfinished_only=True) == []
+
+
+def test_malformed_patch_saves_draft(client, batch_server, history_dir, monkeypatch):
+    monkeypatch.setattr(batch_generation, "record_usage", lambda *args, **kwargs: 0.0)
+    monkeypatch.setattr(_BatchHandler, "_result", _malformed_patch_result(_BatchHandler._result))
+
+    job = batch_generation.submit_job(client, EXPERIENCES[:1], rewrite_mode="patch")
+    job = batch_generation.run_job(client, job, poll_interval=0, sleep=lambda sec: None)
+
+    assert batch_generation.job_summary(job)["fallback"] == 1
+    history_store.flush_history(timeout=10)
+    [record] = history_store.iter_history_records()
+    assert record["result"] == enforce_line_breaks(synthetic_scenario(EXPERIENCES[0]))
+
+
+def _malformed_patch_result(result):
+    def patched(self, request):
+        entry = result(self, request)
+        if "【元のシナリオ】" in request["params"]["messages"][0]["content"]:
+            entry["result"]["message"]["content"][0]["text"] = "差し替えはありません"
+        return entry
+    return patched
+
+
+def _failing_create(self):
+    self.rfile.read(int(self.headers.get("Content-Length", 0)))
+    self._reply(500, {"type": "error", "error": {"type": "api_error", "message": "Internal server error"}})
+
+
+def test_queue_is_kept_when_submit_fails(client, history_dir, monkeypatch):
+    import anthropic
+
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "test")
+    monkeypatch.setattr(batch_generation, "get_client", lambda api_key: client)
+    monkeypatch.setattr(_BatchHandler, "do_POST", _failing_create)
+    for experience in EXPERIENCES[:2]:
+        batch_generation.enqueue_experience(experience, user="a@example.com")
+    queued = batch_generation.list_queue()
+
+    with pytest.raises(anthropic.InternalServerError):
+        batch_generation.main(["submit"])
+    assert batch_generation.list_queue() == queued
+
+
+def test_failed_rewrite_submit_does_not_recount_drafts(client, batch_server, history_dir, monkeypatch):
+    import anthropic
+
+    _, batches = batch_server
+    recorded = []
+    monkeypatch.setattr(batch_generation, "record_usage", lambda *args, **kwargs: recorded.append(args))
+    job = batch_generation.submit_job(client, EXPERIENCES[:2], rewrite_mode="patch")
+    batch_generation.advance_job(client, job)
+
+    with monkeypatch.context() as m:
+        m.setattr(_BatchHandler, "do_POST", _failing_create)
+        with pytest.raises(anthropic.InternalServerError):
+            batch_generation.advance_job(client, job)
+    assert len(recorded) == 2
+
+    # 次の poll は別のプロセスから、保存されたジョブで続ける
+    monkeypatch.setattr(batch_generation, "_memory", {})
+    job = batch_generation.load_job(job["id"])
+    assert {item["status"] for item in job["items"].values()} == {"drafted"}
+    job = batch_generation.run_job(client, job, poll_interval=0, sleep=lambda sec: None)
+
+    assert job["status"] == "completed"
+    assert list(batches) == ["msgbatch_01", "msgbatch_02"]
+    assert len(recorded) == 4
+
+
+def test_read_experiences_splits_on_separator(tmp_path):
+    path = tmp_path / "orders.txt"
+    path.write_text(f"{EXPERIENCES[0]}\n\n2行目\n---\n{EXPERIENCES[1]}\n---\n\n", encoding="utf-8")
+    assert batch_generation.read_experiences(str(path)) == [f"{EXPERIENCES[0]}\n\n2行目", EXPERIENCES[1]]
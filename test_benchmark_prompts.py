@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+プロンプトのベンチマーク（benchmark_prompts.py）のテスト
+
+    python -m pytest -q test_benchmark_prompts.py
+"""
+
+import json
+
+from benchmark_prompts import (
+    RecordingClient,
+    ReplayClient,
+    SyntheticClient,
+    run_benchmark,
+)
+from conftest import FakeApi, fake_message
+from scenario_text import format_violations
+
+CORPUS = [
+    {"id": "a", "experience": "義母が毎週末に連絡なしで家に来る。録音した会話を家族会議で流した。"},
+    {"id": "b", "experience": "夫の浮気を探偵に調べてもらい、弁護士と一緒に証拠を突きつけた。"},
+]
+
+
+def test_synthetic_run_reports_prompt_cost_per_version():
+    reports = {report["version"]: report for report in run_benchmark(SyntheticClient(), ["v1", "v3"], CORPUS)}
+
+    assert reports["v1"]["errors"] == reports["v3"]["errors"] == 0
+    assert reports["v3"]["prompt_tokens"] > reports["v1"]["prompt_tokens"]
+    assert reports["v3"]["input_tokens_mean"] > reports["v1"]["input_tokens_mean"]
+    assert reports["v3"]["cost_usd_mean"] > reports["v1"]["cost_usd_mean"]
+    assert reports["v1"]["format_violation_rate"] == 0
+    assert reports["v1"]["rewrite_needed_rate"] == 0
+
+
+class _ScriptedApi(FakeApi):
+    """初稿は1行に要素が混ざったシナリオ、リライトはそれを直すパッチを返す"""
+
+    usage = (3000, 2000)
+
+    def respond(self, prompt):
+        if "【元のシナリオ】" in prompt:
+            edits = {"edits": [{"part": "前編", "page": 1, "panel": 1, "lines": ["※カメラ：引き", "A子「ただいま」"]}]}
+            return fake_message(json.dumps(edits, ensure_ascii=False), 1000, 100)
+        return self.output
+
+
+def test_record_then_replay(tmp_path):
+    from benchmark_prompts import synthetic_scenario
+
+    draft = synthetic_scenario("ただいま。").replace("1コマ目\n※カメラ：引き\n", "1コマ目\n※カメラ：引き", 1)
+    assert format_violations(draft)
+
+    recording = str(tmp_path / "recording.jsonl")
+    recorded = run_benchmark(RecordingClient(_ScriptedApi(draft), recording), ["v2"], CORPUS[:1])
+    replayed = run_benchmark(ReplayClient(recording), ["v2"], CORPUS[:1])
+
+    for reports in (recorded, replayed):
+        report = reports[0]
+        assert report["errors"] == 0
+        assert report["input_tokens_mean"] == 4000
+        assert report["output_tokens_mean"] == 2100
+        assert report["rewrite_needed_rate"] == 1
+        assert report["format_violation_rate"] == 1
+        assert report["final_violation_rate"] == 0
+
+    # 録音にないプロンプトはエラーとして数える
+    missing = run_benchmark(ReplayClient(recording), ["v1"], CORPUS[:1])
+    assert missing[0]["errors"] == 1
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+シナリオテキストの処理の規模のベンチマーク（benchmark_text.py）のテスト
+
+    python -m pytest -q test_benchmark_text.py
+"""
+
+import time
+
+from benchmark_text import INPUT_KINDS, TARGETS, format_row, make_input, run_benchmark
+from scenario_text import PANEL_HEADER_PATTERN, split_sections
+
+
+def test_text_processing_scales_linearly_on_adversarial_inputs():
+    report = run_benchmark(sizes=[20_000, 160_000])
+
+    assert report["violations"] == []
+    assert len(report["rows"]) == len(INPUT_KINDS) * len(TARGETS) * 2
+    assert all(format_row(row) for row in report["rows"])
+
+
+def test_make_input_hits_requested_size():
+    for kind in INPUT_KINDS:
+        size = len(make_input(kind, 50_000).encode("utf-8"))
+        assert 40_000 <= size <= 50_100, (kind, size)
+    assert make_input("fuzz", 1_000, seed=1) == make_input("fuzz", 1_000, seed=1)
+
+
+def test_whitespace_line_is_not_quadratic():
+    # 以前のコマ番号の見出しの判定は、空白だけの長い行で二乗の時間がかかっていた（20万文字で数分）
+    start = time.perf_counter()
+    split_sections(" " * 200_000 + "\n■前編\n【P1】\n1コマ目\n")
+    assert time.perf_counter() - start < 1.0
+
+    for header in ("1コマ目", "  2コマ目", "**3コマ目**", "** 4 コマ目", "*5コマ目"):
+        assert PANEL_HEADER_PATTERN.match(header), header
+    assert not PANEL_HEADER_PATTERN.match("※1コマ目")
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+APIの利用料の予算（budget.py）のテスト
+
+    python -m pytest -q test_budget.py
+"""
+
+import json
+import math
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import budget
+import checkpoints
+from benchmark_prompts import synthetic_scenario
+from conftest import FakeApi, fake_message
+from model_router import choose_route
+
+EXPERIENCE = "義母が毎週末に連絡なしで家に来る。録音した会話を家族会議で流した。"
+SETTINGS = {"generation_mode": "single", "rewrite_mode": "patch", "condense": False, "pipelined": True}
+SONNET = "claude-sonnet-4-5-20250929"
+
+
+class _CountingApi(FakeApi):
+    """初稿は形式どおりのシナリオを返し、呼び出しを数える"""
+
+    def __init__(self):
+        super().__init__()
+        self.drafts = 0
+        self.rewrites = 0
+
+    def respond(self, prompt):
+        if "【元のシナリオ】" in prompt:
+            self.rewrites += 1
+            return fake_message(json.dumps({"edits": []}), 1000, 100)
+        self.drafts += 1
+        return synthetic_scenario(EXPERIENCE)
+
+
+@pytest.fixture
+def configure(history_dir, tmp_path, monkeypatch):
+    monkeypatch.setattr(budget, "BUDGET_PATH", str(tmp_path / "budget.json"))
+    monkeypatch.setattr(budget, "_memory_ledger", {"days": {}})
+
+    def write(**config):
+        (tmp_path / "budget.json").write_text(json.dumps(config), encoding="utf-8")
+        budget._config_cache.update(mtime=None, config=None)
+        budget._ledger_cache.update(loaded_at=0.0, ledger=None)
+
+    yield write
+    budget._config_cache.update(mtime=None, config=None)
+    budget._ledger_cache.update(loaded_at=0.0, ledger=None)
+
+
+def _spend(usd, user="u1"):
+    """sonnet の出力トークンで usd 分を使う（100万トークンで $15）"""
+    budget.record_usage(SONNET, SimpleNamespace(input_tokens=0, output_tokens=math.ceil(usd / 15 * 1_000_000)), user=user)
+
+
+def test_no_caps_means_no_limits(configure):
+    configure(daily_usd=None)
+    _spend(100)
+    status = budget.budget_status()
+    assert status == {"enabled": False, "remaining": None, "level": "normal", "caps": []}
+    budget.check_budget(budget.budget_remaining())
+
+
+def test_budget_degrades_in_steps(configure):
+    configure(daily_usd=10, monthly_usd=100, skip_rewrite_below=0.25)
+    assert budget.budget_status(fresh=True)["level"] == "normal"
+
+    _spend(8)
+    status = budget.budget_status(fresh=True)
+    assert status["level"] == "skip_rewrite"
+    assert status["remaining"] == pytest.approx(0.2, abs=1e-4)
+    assert {cap["name"]: cap["spent_usd"] for cap in status["caps"]} == {"daily_usd": pytest.approx(8.0), "monthly_usd": pytest.approx(8.0)}
+
+    _spend(1.5)
+    assert budget.budget_status(fresh=True)["level"] == "cheaper_model"
+    assert choose_route("draft", 1000, budget_remaining=budget.budget_remaining())["name"] == "draft:low-budget"
+
+    _spend(1)
+    assert budget.budget_status(fresh=True)["level"] == "exhausted"
+    with pytest.raises(budget.BudgetExceeded):
+        budget.check_budget(budget.budget_remaining())
+
+    # 台帳は保存先に残り、別のプロセスからも同じ使用額が見える
+    budget._ledger_cache.update(loaded_at=0.0, ledger=None)
+    [(day, entry)] = budget.load_ledger()["days"].items()
+    assert day == datetime.now().strftime("%Y-%m-%d")
+    assert entry["calls"] == 3
+    assert entry["users"] == {"u1": pytest.approx(10.5, abs=1e-4)}
+
+
+def test_per_user_cap_only_limits_that_user(configure):
+    configure(per_user_daily_usd=5)
+    _spend(5, user="heavy")
+    assert budget.budget_status(user="heavy", fresh=True)["level"] == "exhausted"
+    assert budget.budget_status(user="light", fresh=True)["level"] == "normal"
+
+    with budget.use_user("light"):
+        assert budget.current_user() == "light"
+        budget.record_usage(SONNET, SimpleNamespace(input_tokens=1000, output_tokens=0))
+    assert budget.load_ledger(fresh=True)["days"][datetime.now().strftime("%Y-%m-%d")]["users"]["light"] > 0
+
+
+def test_pipeline_skips_rewrite_then_refuses_and_resumes(configure, use_api):
+    api = use_api(_CountingApi())
+
+    # 残りが少ないと自動リライトを飛ばす
+    configure(daily_usd=10)
+    _spend(8)
+    checkpoint = checkpoints.run_checkpointed("key", checkpoints.new_checkpoint(EXPERIENCE, SETTINGS))
+    assert checkpoint["status"] == "completed"
+    assert checkpoint["stages"]["rewrite"]["status"] == "skipped"
+    assert api.rewrites == 0
+    # 呼び出しの料金も台帳に入る
+    assert budget.budget_status(fresh=True)["caps"][0]["spent_usd"] > 8
+
+    # 使い切るとAPIを呼ばずに止まり、チェックポイントに残る
+    _spend(2)
+    drafts = api.drafts
+    checkpoint = checkpoints.run_checkpointed("key", checkpoints.new_checkpoint(EXPERIENCE, SETTINGS))
+    assert checkpoint["status"] == "failed"
+    assert "上限" in checkpoint["stages"]["draft"]["error"]
+    assert api.drafts == drafts
+
+    # 上限を上げれば続きから再開できる
+    configure(daily_usd=1000)
+    resumed = checkpoints.run_checkpointed("key", checkpoints.reset_from(checkpoint, "draft"))
+    assert resumed["status"] == "completed", resumed["stages"]
+    assert resumed["stages"]["rewrite"]["status"] == "done"
+    assert api.rewrites > 0
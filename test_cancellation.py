@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+生成のキャンセル（cancellation.py）のテスト
+
+    python -m pytest -q test_cancellation.py
+"""
+
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import scenario_pipeline
+from benchmark_prompts import synthetic_scenario
+from cancellation import CancelToken, GenerationCancelled, get_cancellation_stats
+from conftest import FakeApi
+from model_router import get_route_stats
+
+EXPERIENCE = "義母が毎週末に連絡なしで家に来る。録音した会話を家族会議で流した。"
+
+
+class _StreamingApi(FakeApi):
+    """初稿をゆっくりストリーミングし、リライトの呼び出しを数える"""
+
+    delay = 0.02
+
+    def __init__(self):
+        super().__init__(synthetic_scenario(EXPERIENCE))
+        self.rewrites = 0
+
+    def respond(self, prompt):
+        if "【元のシナリオ】" in prompt:
+            self.rewrites += 1
+        return self.output
+
+    def create(self, messages, **kwargs):
+        pytest.fail("キャンセルできる呼び出しはストリーミングで行うはず")
+
+
+@pytest.fixture
+def api(use_api):
+    return use_api(_StreamingApi())
+
+
+def _cancel_after(token, seconds):
+    timer = threading.Timer(seconds, token.cancel, args=("キャンセル",))
+    timer.start()
+    return timer
+
+
+def test_cancel_closes_stream(api):
+    token = CancelToken()
+    _cancel_after(token, 0.1)
+
+    start = time.monotonic()
+    with pytest.raises(GenerationCancelled):
+        scenario_pipeline.generate_scenario("key", EXPERIENCE, cancel=token)
+    assert time.monotonic() - start < 1.0
+    assert api.streams[0].closed
+    assert token.saved_output_tokens > 0
+    assert token.saved_sec > 0
+
+
+def test_cancelled_pipeline_skips_rewrite(api):
+    before = {row["route"]: row["errors"] for row in get_route_stats()}
+    token = CancelToken()
+    _cancel_after(token, 0.1)
+
+    with pytest.raises(GenerationCancelled):
+        scenario_pipeline.generate_and_fix_pipelined("key", EXPERIENCE, mode="patch", cancel=token)
+    assert api.rewrites == 0
+    assert token.saved_output_tokens > 0
+
+    # キャンセルはエラーに数えない
+    after = {row["route"]: row["errors"] for row in get_route_stats()}
+    assert all(after[route] == before.get(route, 0) for route in after)
+
+
+def test_cancel_before_start_skips_call(api):
+    token = CancelToken()
+    token.cancel("キャンセル")
+    with pytest.raises(GenerationCancelled):
+        scenario_pipeline.check_and_fix_scenario("key", "シナリオ", cancel=token)
+    assert api.streams == []
+
+
+def test_run_cancellable_cancels_on_interruption(monkeypatch):
+    import app
+
+    monkeypatch.setattr(app.st, "session_state", SimpleNamespace())
+    token = CancelToken()
+    stopped = threading.Event()
+
+    def target():
+        while not token.cancelled:
+            time.sleep(0.01)
+        stopped.set()
+        raise GenerationCancelled(token.reason)
+
+    calls = []
+
+    def render():
+        # Streamlit が再実行を伝えるのと同じく、画面のスレッドで例外になる
+        calls.append(1)
+        if len(calls) == 3:
+            raise KeyboardInterrupt
+
+    before = get_cancellation_stats()["cancellations"]
+    with pytest.raises(KeyboardInterrupt):
+        app.run_cancellable(target, token, render, interval_sec=0.01)
+    assert stopped.is_set()
+    assert token.reason == "キャンセル・入力の変更"
+    assert get_cancellation_stats()["cancellations"] == before + 1
+    assert app.st.session_state.last_cancellation["reason"] == "キャンセル・入力の変更"
+
+
+def test_child_token_follows_parent():
+    parent = CancelToken()
+    child = CancelToken(parent=parent)
+
+    # 子だけを止めても親は止まらず、やり直しで止めた分は親の節約に数えない
+    child.cancel("前編の初稿の変更")
+    child.add_savings(100, 2.0)
+    assert child.cancelled and not parent.cancelled
+    assert child.saved_output_tokens == 100
+    assert (parent.saved_output_tokens, parent.saved_sec) == (0, 0.0)
+
+    # 親のキャンセルで止まった分は、親にも加える
+    other = CancelToken(parent=parent)
+    finished = CancelToken(parent=parent)
+    finished.detach()
+    parent.cancel("キャンセル")
+    other.add_savings(50, 1.0)
+    assert other.cancelled and other.reason == "キャンセル"
+    assert (parent.saved_output_tokens, parent.saved_sec) == (50, 1.0)
+    # 親から外した子は、親がキャンセルされても止まらない
+    assert not finished.cancelled
+    assert CancelToken(parent=parent).cancelled
+
+
+def test_finished_children_are_detached():
+    parent = CancelToken()
+    for _ in range(100):
+        CancelToken(parent=parent).detach()
+    assert parent._callbacks == []
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+生成パイプラインのチェックポイント（checkpoints.py）のテスト
+
+    python -m pytest -q test_checkpoints.py
+"""
+
+import json
+
+import pytest
+
+import checkpoints
+import metrics
+import scenario_pipeline
+from benchmark_prompts import synthetic_scenario
+from conftest import FakeApi
+from scenario_text import enforce_line_breaks
+
+EXPERIENCE = "義母が毎週末に連絡なしで家に来る。録音した会話を家族会議で流した。"
+SETTINGS = {"generation_mode": "single", "rewrite_mode": "patch", "condense": False, "pipelined": False}
+
+
+class _FlakyApi(FakeApi):
+    """初稿は形式どおりのシナリオを返し、リライトは rewrite_failures 回だけ失敗する"""
+
+    def __init__(self, rewrite_failures=0):
+        super().__init__()
+        self.drafts = 0
+        self.rewrites = 0
+        self.rewrite_failures = rewrite_failures
+
+    def respond(self, prompt):
+        if "【元のシナリオ】" in prompt:
+            self.rewrites += 1
+            if self.rewrite_failures:
+                self.rewrite_failures -= 1
+                raise ConnectionError("一時的なAPIエラー")
+            edits = {"edits": [{"part": "前編", "page": 1, "panel": 1, "lines": ["※カメラ：引き", "A子「ただいま」"]}]}
+            return json.dumps(edits, ensure_ascii=False)
+        self.drafts += 1
+        return synthetic_scenario(EXPERIENCE)
+
+
+def test_rewrite_failure_keeps_draft_and_retries_only_rewrite(history_dir, use_api, monkeypatch):
+    api = use_api(_FlakyApi(rewrite_failures=1))
+    checkpoint = checkpoints.run_checkpointed("key", checkpoints.new_checkpoint(EXPERIENCE, SETTINGS))
+
+    assert checkpoint["status"] == "failed"
+    assert checkpoints.failed_stage(checkpoint) == "rewrite"
+    assert "一時的なAPIエラー" in checkpoint["stages"]["rewrite"]["error"]
+    assert checkpoint["stages"]["draft"]["status"] == "done"
+    draft = checkpoint["stages"]["draft"]["output"]
+
+    # 別のプロセスからでも、保存されたチェックポイントで再開できる
+    monkeypatch.setattr(checkpoints, "_memory", {})
+    [saved] = checkpoints.list_unfinished_checkpoints()
+    assert saved["stages"]["draft"]["output"] == draft
+
+    resumed = checkpoints.run_checkpointed("key", checkpoints.reset_from(saved, "rewrite"))
+    assert resumed["status"] == "completed"
+    assert api.drafts == 1
+    assert resumed["stages"]["rewrite"]["output"] != draft
+    assert checkpoints.completed_scenario(resumed) == enforce_line_breaks(resumed["stages"]["rewrite"]["output"])
+    assert set(checkpoints.checkpoint_models(resumed)) == {"draft", "rewrite_patch"}
+
+    checkpoints.delete_checkpoint(resumed["id"])
+    assert checkpoints.list_unfinished_checkpoints() == []
+    assert not list(history_dir.glob("checkpoint_*.json"))
+
+
+def test_pipelined_rewrite_failure_keeps_full_draft(history_dir, use_api):
+    use_api(_FlakyApi(rewrite_failures=10))
+    settings = {**SETTINGS, "pipelined": True}
+    checkpoint = checkpoints.run_checkpointed("key", checkpoints.new_checkpoint(EXPERIENCE, settings))
+
+    assert checkpoints.failed_stage(checkpoint) == "rewrite"
+    assert checkpoint["stages"]["draft"]["output"] == synthetic_scenario(EXPERIENCE)
+
+    skipped = checkpoints.run_checkpointed("key", checkpoints.skip_rewrite(checkpoint))
+    assert skipped["status"] == "completed"
+    assert checkpoints.completed_scenario(skipped) == enforce_line_breaks(synthetic_scenario(EXPERIENCE))
+
+
+def test_rewrite_failure_is_not_silent(use_api):
+    use_api(_FlakyApi(rewrite_failures=10))
+    draft = synthetic_scenario(EXPERIENCE)
+
+    with pytest.raises(scenario_pipeline.RewriteFailed) as failed:
+        scenario_pipeline.check_and_fix_scenario("key", draft, fallback=False)
+    assert failed.value.draft == draft
+
+    # 既定では初稿を返すが、失敗したことは meta とメトリクスに残す
+    metrics.reset()
+    meta = {}
+    assert scenario_pipeline.check_and_fix_scenario("key", draft, meta=meta) == draft
+    assert meta["rewrite_error"]
+    assert "scenario_rewrite_fallbacks_total 1" in metrics.render()
+
+
+def test_pipelined_rewrite_fallback_is_recorded(use_api):
+    use_api(_FlakyApi(rewrite_failures=1))
+    meta = {}
+    draft, rewritten = scenario_pipeline.generate_and_fix_pipelined("key", EXPERIENCE, meta=meta, mode="full")
+
+    # 片方の編だけ初稿のまま返したことが、どちらの編かと一緒に meta に残る
+    assert draft == synthetic_scenario(EXPERIENCE)
+    assert meta["rewrite_error"].count("一時的なAPIエラー") == 1
+    assert meta["rewrite_error"].startswith(("前編: ", "後編: "))
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+履歴の保存先（history_backends.py）と書き込みの後回し（history_writer.py）のテスト
+
+S3互換のバックエンドは、このファイルの中で立てる簡易サーバーを相手に確かめる。
+
+    python -m pytest -q test_history_backends.py
+"""
+
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.sax.saxutils import escape
+
+import pytest
+
+import history_store
+import history_writer
+from history_backends import LocalBackend, S3Backend, SQLiteBackend
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# ============================================================================
+# S3互換の簡易サーバー
+# ============================================================================
+
+class _S3Handler(BaseHTTPRequestHandler):
+    """パス形式の GET / PUT（If-None-Match・If-Match つきも）/ DELETE / HEAD と ListObjectsV2 だけを受けるS3もどき"""
+
+    objects = None  # サーバーごとに {(バケット, キー): 本文}
+    lock = None  # 条件つきPUTの確認と書き込みをまとめて行う
+
+    def log_message(self, *args):
+        pass
+
+    def _split(self):
+        url = urlsplit(self.path)
+        bucket, _, key = url.path.lstrip("/").partition("/")
+        return bucket, unquote(key), parse_qs(url.query)
+
+    def _authorized(self, body=b""):
+        return (
+            self.headers.get("Authorization", "").startswith("AWS4-HMAC-SHA256 Credential=test/")
+            and self.headers.get("x-amz-content-sha256") == hashlib.sha256(body).hexdigest()
+        )
+
+    def _reply(self, status, body=b"", etag=None):
+        self.send_response(status)
+        if etag:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self._authorized(body):
+            return self._reply(403)
+        bucket, key, _ = self._split()
+        with self.lock:
+            current = self.objects.get((bucket, key))
+            if_none_match, if_match = self.headers.get("If-None-Match"), self.headers.get("If-Match")
+            if (if_none_match == "*" and current is not None) or (
+                if_match is not None and (current is None or if_match != f'"{hashlib.md5(current).hexdigest()}"')
+            ):
+                return self._reply(412)
+            self.objects[(bucket, key)] = body
+        self._reply(200, etag=f'"{hashlib.md5(body).hexdigest()}"')
+
+    def do_GET(self):
+        if not self._authorized():
+            return self._reply(403)
+        bucket, key, query = self._split()
+        if not key:
+            prefix = query.get("prefix", [""])[0]
+            contents = "".join(
+                f"<Contents><Key>{escape(k)}</Key><ETag>\"{hashlib.md5(body).hexdigest()}\"</ETag></Contents>"
+                for (b, k), body in sorted(self.objects.items()) if b == bucket and k.startswith(prefix)
+            )
+            xml = (
+                '<?xml version="1.0" encoding="UTF-8"?>'
+                '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                f"<IsTruncated>false</IsTruncated>{contents}</ListBucketResult>"
+            )
+            return self._reply(200, xml.encode("utf-8"))
+        body = self.objects.get((bucket, key))
+        if body is None:
+            return self._reply(404)
+        self._reply(200, body, etag=f'"{hashlib.md5(body).hexdigest()}"')
+
+    def do_HEAD(self):
+        if not self._authorized():
+            return self._reply(403)
+        bucket, key, _ = self._split()
+        body = self.objects.get((bucket, key))
+        if body is None:
+            return self._reply(404)
+        self._reply(200, etag=f'"{hashlib.md5(body).hexdigest()}"')
+
+    def do_DELETE(self):
+        if not self._authorized():
+            return self._reply(403)
+        bucket, key, _ = self._split()
+        self.objects.pop((bucket, key), None)
+        self._reply(204)
+
+
+@pytest.fixture
+def s3_server():
+    handler = type("Handler", (_S3Handler,), {"objects": {}, "lock": threading.Lock()})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+@pytest.fixture(params=["local", "sqlite", "s3"])
+def backend(request, tmp_path):
+    if request.param == "local":
+        return LocalBackend(str(tmp_path))
+    if request.param == "sqlite":
+        return SQLiteBackend(str(tmp_path / "history.sqlite3"))
+    endpoint = request.getfixturevalue("s3_server")
+    return S3Backend(endpoint, "bucket", prefix="history/", access_key="test", secret_key="secret")
+
+# ============================================================================
+# バックエンド
+# ============================================================================
+
+def test_backend_contract(backend):
+    assert backend.names("scenario_") == []
+    assert backend.stamp("scenario_a.json") is None
+    with pytest.raises(KeyError):
+        backend.get("scenario_a.json")
+
+    backend.put("scenario_a.json", {"result": "シナリオ"})
+    backend.put("favorites.json", ["a"])
+    first = backend.stamp("scenario_a.json")
+    assert backend.get("scenario_a.json") == {"result": "シナリオ"}
+    assert backend.names("scenario_") == ["scenario_a.json"]
+
+    backend.put("scenario_a.json", {"result": "直したシナリオ"})
+    assert backend.stamp("scenario_a.json") != first
+    assert backend.get("scenario_a.json") == {"result": "直したシナリオ"}
+
+    with backend.lock("favorites"):
+        assert backend.get("favorites.json") == ["a"]
+
+    assert backend.delete("scenario_a.json") is True
+    assert backend.delete("scenario_a.json") is False
+    assert backend.names("scenario_") == []
+
+
+
+def test_s3_sees_writes_from_other_instances(s3_server):
+    this, other = (
+        S3Backend(s3_server, "bucket", prefix="history/", access_key="test", secret_key="secret", etag_ttl=0.2)
+        for _ in range(2)
+    )
+    this.put("favorites.json", ["a"])
+    this.names("scenario_")
+    first = this.stamp("favorites.json")
+
+    # 別のインスタンスが書き換えた分は、ETagを使い回す秒数が過ぎれば見える
+    other.put("favorites.json", ["a", "b"])
+    other.put("history_index.json", {"records": {}})
+    time.sleep(0.3)
+    assert this.stamp("favorites.json") not in (None, first)
+    assert this.get("favorites.json") == ["a", "b"]
+    assert this.stamp("history_index.json") == other.stamp("history_index.json")
+
+    other.delete("favorites.json")
+    time.sleep(0.3)
+    assert this.stamp("favorites.json") is None
+
+
+_COUNTER_SCRIPT = """
+import sys
+from history_backends import S3Backend
+
+backend = S3Backend(sys.argv[1], "bucket", prefix="history/", access_key="test", secret_key="secret")
+for _ in range(10):
+    with backend.lock("counter"):
+        try:
+            count = backend.get("counter.json")
+        except KeyError:
+            count = 0
+        backend.put("counter.json", count + 1)
+"""
+
+
+def test_s3_lock_works_across_processes(s3_server):
+    procs = [
+        subprocess.Popen([sys.executable, "-c", _COUNTER_SCRIPT, s3_server], cwd=APP_DIR, stderr=subprocess.PIPE)
+        for _ in range(3)
+    ]
+    for proc in procs:
+        assert proc.wait(timeout=60) == 0, proc.stderr.read().decode("utf-8")
+        proc.stderr.close()
+
+    backend = S3Backend(s3_server, "bucket", prefix="history/", access_key="test", secret_key="secret")
+    # 読んで書き換える間にほかのプロセスが書いても、書き換えは失われない
+    assert backend.get("counter.json") == 30
+    assert backend.stamp("locks/counter.lock") is None
+
+
+def test_s3_lock_takes_over_expired_lock(s3_server, monkeypatch):
+    import history_backends
+
+    backend = S3Backend(s3_server, "bucket", prefix="history/", access_key="test", secret_key="secret")
+    monkeypatch.setattr(history_backends, "S3_LOCK_TIMEOUT_SEC", 0.2)
+    with backend.lock("favorites"):
+        # 持っている間は、ほかのインスタンスは取れない
+        other = S3Backend(s3_server, "bucket", prefix="history/", access_key="test", secret_key="secret")
+        other.uri += "#other"
+        with pytest.raises(TimeoutError):
+            with other.lock("favorites"):
+                pass
+
+    # 持ったまま落ちたプロセスのロックは、期限が過ぎれば取り直せる
+    monkeypatch.setattr(history_backends, "S3_LOCK_LEASE_SEC", -1)
+    backend._try_lock("history/locks/favorites.lock")
+    monkeypatch.setattr(history_backends, "S3_LOCK_LEASE_SEC", 60)
+    with backend.lock("favorites"):
+        pass
+    assert backend.stamp("locks/favorites.lock") is None
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """history_store を指定した保存先に向ける"""
+    monkeypatch.setattr(history_store, "HISTORY_DIR", str(tmp_path))
+
+    def use(kind, **env):
+        for name, value in env.items():
+            monkeypatch.setenv(name, value)
+        monkeypatch.setattr(history_store, "BACKEND", kind)
+        return history_store
+
+    yield use
+    history_store.flush_history(timeout=10)
+
+
+def test_s3_history_survives_streamlit_cloud(store, s3_server, monkeypatch):
+    store_ = store(
+        "s3",
+        SCENARIO_S3_ENDPOINT=s3_server,
+        SCENARIO_S3_BUCKET="bucket",
+        AWS_ACCESS_KEY_ID="test",
+        AWS_SECRET_ACCESS_KEY="secret",
+    )
+    monkeypatch.setattr(store_, "is_streamlit_cloud", lambda: True)
+    assert store_.history_enabled()
+
+    location = store_.save_history("体験談", "シナリオ")
+    assert location.startswith("s3://bucket/history/scenario_")
+    key = store_.record_id(store_.load_history()[0])
+    assert store_.flush_history(timeout=10)
+
+    assert store_.toggle_favorite(key)
+    assert store_.update_history(key, "直したシナリオ")
+    assert store_.load_history()[0]["result"] == "直したシナリオ"
+    assert store_.get_statistics()["total_count"] == 1
+    assert store_.delete_history(key)
+    assert store_.load_history() == []
+    assert store_.get_favorites() == []
+
+
+def test_local_history_stays_off_on_streamlit_cloud(store, monkeypatch):
+    store_ = store("local")
+    monkeypatch.setattr(store_, "is_streamlit_cloud", lambda: True)
+    assert not store_.history_enabled()
+    assert store_.save_history("体験談", "シナリオ") is None
+
+# ============================================================================
+# 書き込みの後回し
+# ============================================================================
+
+class _SlowBackend(LocalBackend):
+    """履歴の書き込みが遅い（ネットワーク越しのディスクのような）保存先"""
+
+    delay = 0.3
+    failures = 0
+
+    def put(self, name, data, indent=2):
+        if name.startswith("scenario_"):
+            time.sleep(self.delay)
+            if self.failures:
+                type(self).failures -= 1
+                raise OSError("一時的な書き込みエラー")
+        super().put(name, data, indent=indent)
+
+
+def test_save_history_does_not_wait_for_slow_storage(store, monkeypatch):
+    store_ = store("local")
+    monkeypatch.setattr(store_, "is_streamlit_cloud", lambda: False)
+    monkeypatch.setattr(store_, "create_backend", lambda kind, directory: _SlowBackend(directory))
+    monkeypatch.setattr(_SlowBackend, "failures", 1)
+    monkeypatch.setattr(history_writer, "RETRY_BACKOFF_SEC", 0.01)
+    before = history_writer.write_stats()
+
+    start = time.perf_counter()
+    store_.save_history("体験談", "シナリオ")
+    assert time.perf_counter() - start < _SlowBackend.delay / 2
+
+    # 書き終わる前でも、このプロセスの履歴には出てくる
+    assert [h["result"] for h in store_.load_history()] == ["シナリオ"]
+    assert history_writer.write_stats()["pending"] == 1
+
+    assert store_.flush_history(timeout=10)
+    after = history_writer.write_stats()
+    assert after["pending"] == 0
+    assert after["written"] == before["written"] + 1
+    assert after["retries"] == before["retries"] + 1
+    assert after["failed"] == before["failed"]
+    assert [name for name in os.listdir(store_.HISTORY_DIR) if name.startswith("scenario_")]
+
+
+_EXIT_SCRIPT = """
+import sys, time
+import history_backends, history_store, history_writer
+
+class Slow(history_backends.LocalBackend):
+    def put(self, name, data, indent=2):
+        time.sleep(0.2)
+        super().put(name, data, indent=indent)
+
+history_store.HISTORY_DIR = sys.argv[1]
+history_store.is_streamlit_cloud = lambda: False
+history_store.create_backend = lambda kind, directory: Slow(directory)
+for i in range(3):
+    history_store.save_history(f"体験談{i}", "シナリオ")
+print(history_writer.write_stats()["pending"])
+"""
+
+
+def test_pending_writes_are_flushed_on_exit(tmp_path):
+    proc = subprocess.run(
+        [sys.executable, "-c", _EXIT_SCRIPT, str(tmp_path)],
+        cwd=APP_DIR, capture_output=True, text=True, timeout=60,
+    )
+    assert proc.returncode == 0, proc.stderr
+    # 終了する時点では書き込みが残っていた
+    assert int(proc.stdout.strip()) > 0
+    files = [name for name in os.listdir(tmp_path) if name.startswith("scenario_")]
+    assert len(files) == 3
+    with open(tmp_path / history_store.INDEX_FILENAME, "r", encoding="utf-8") as f:
+        assert sorted(json.load(f)["records"]) == sorted(files)
+
+
+def test_writes_left_at_exit_are_counted(monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(history_writer, "SHUTDOWN_FLUSH_SEC", 0.05)
+    before = history_writer.write_stats()["abandoned"]
+    history_writer.submit(release.wait, description="scenario_test.json")
+    try:
+        history_writer._flush_on_exit()
+        stats = history_writer.write_stats()
+        assert stats["abandoned"] == before + 1
+        assert "1件" in stats["last_error"]
+    finally:
+        release.set()
+        assert history_writer.flush(timeout=10)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+履歴キャッシュ（history_cache.py）のテスト
+
+    python -m pytest -q test_history_cache.py
+"""
+
+import json
+import os
+
+import pytest
+
+import history_cache
+import history_store
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    history_cache.invalidate()
+    yield
+    history_cache.invalidate()
+
+
+def test_lru_eviction_under_cap(monkeypatch):
+    monkeypatch.setattr(history_cache, "CACHE_MAX_BYTES", 3 * history_cache.estimate_size("x" * 1000) + 100)
+    for key in "abc":
+        history_cache.get(key, 1, lambda key=key: key * 1000)
+    # a を使ったので、次に追い出されるのは b
+    history_cache.get("a", 1, lambda: pytest.fail("a はキャッシュにあるはず"))
+    history_cache.get("d", 1, lambda: "d" * 1000)
+
+    stats = history_cache.cache_stats()
+    assert stats["entries"] == 3
+    assert stats["evictions"] == 1
+    assert stats["bytes"] <= stats["max_bytes"]
+    loads = []
+    history_cache.get("b", 1, lambda: loads.append("b") or "b" * 1000)
+    assert loads == ["b"]
+
+
+def test_stamp_change_reloads():
+    assert history_cache.get("k", 1, lambda: "old") == "old"
+    assert history_cache.get("k", 1, lambda: "new") == "old"
+    assert history_cache.get("k", 2, lambda: "new") == "new"
+
+
+def test_values_are_frozen_and_thaw_to_copies():
+    value = history_cache.get("k", 1, lambda: {"result": "本文", "tags": ["a"]})
+    with pytest.raises(TypeError):
+        value["result"] = "書き換え"
+    assert value["tags"] == ("a",)
+
+    copy = history_cache.thaw(value)
+    copy["tags"].append("b")
+    assert copy == {"result": "本文", "tags": ["a", "b"]}
+    assert value["tags"] == ("a",)
+
+
+def test_sessions_share_loaded_records(history_dir):
+    history_store.save_history("体験談", "シナリオ")
+    first = history_store.load_history()[0]
+    second = history_store.load_history()[0]
+    assert first is second
+    assert history_cache.cache_stats()["hits"] >= 1
+
+
+def test_update_and_delete_invalidate(history_dir):
+    history_store.save_history("体験談", "シナリオ")
+    key = history_store.record_id(history_store.load_history()[0])
+
+    assert history_store.update_history(key, "直したシナリオ")
+    record = history_store.load_history()[0]
+    assert record["result"] == "直したシナリオ"
+    assert record["is_edited"] is True
+
+    assert history_store.toggle_favorite(key)
+    assert history_store.get_favorites() == [key]
+    assert history_store.delete_history(key)
+    assert history_store.load_history() == []
+    assert history_store.get_favorites() == []
+
+
+def test_external_edit_is_picked_up(history_dir):
+    history_store.save_history("体験談", "シナリオ")
+    assert history_store.flush_history(timeout=10)
+    history_store.load_history()
+    filename = next(name for name in os.listdir(history_dir) if name.startswith("scenario_"))
+    path = os.path.join(history_dir, filename)
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    data["result"] = "別のプロセスで書き換えたシナリオ"
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+
+    assert history_store.load_history()[0]["result"] == "別のプロセスで書き換えたシナリオ"
+
+
+def test_session_memory_separates_shared_entries():
+    shared = history_cache.get("k", 1, lambda: {"result": "あ" * 10_000})
+    own = "い" * 10_000
+
+    only_shared = history_cache.session_memory([shared])
+    assert only_shared["own_bytes"] == 0
+    assert only_shared["shared_bytes"] == history_cache.estimate_size(shared)
+
+    # 共有エントリの本文を参照しているだけのコピーはセッションの分に数えない
+    copy = {**shared, "similarity": 0.9}
+    report = history_cache.session_memory([copy, own])
+    assert report["shared_bytes"] == 0
+    assert history_cache.estimate_size(own) <= report["own_bytes"] < history_cache.estimate_size(own) + 1000
+
+    history_cache.record_session("session-a", [shared, own])
+    assert [row["session"] for row in history_cache.active_sessions()] == ["session-"]
+
+
+class _LockProbe:
+    """数えられたときに、キャッシュのロックが取られていたかを残す"""
+
+    def __init__(self):
+        self.locked = []
+
+    def __sizeof__(self):
+        self.locked.append(history_cache._lock.locked())
+        return 64
+
+
+def test_session_memory_does_not_block_the_cache():
+    probe = _LockProbe()
+    assert history_cache.session_memory([{"state": probe}])["own_bytes"] > 0
+    # セッションの値を数えている間も、ほかのセッションはキャッシュを読み書きできる
+    assert probe.locked == [False]
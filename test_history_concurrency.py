@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+複数プロセスから同じ履歴ディレクトリに書き込むストレステスト
+
+Streamlitサーバーを複数プロセスで動かしたときに、同じ秒の保存で履歴が上書きされたり、
+お気に入りの同時切り替えで変更が消えたりしないことを確認する。
+
+    python -m pytest -q test_history_concurrency.py
+"""
+
+import json
+import multiprocessing
+import os
+
+import history_store
+
+PROCESSES = 6
+RECORDS_PER_PROCESS = 8
+
+
+def _worker(history_dir, worker, barrier, results):
+    history_store.HISTORY_DIR = history_dir
+    history_store.is_streamlit_cloud = lambda: False
+    barrier.wait()
+
+    keys = []
+    for i in range(RECORDS_PER_PROCESS):
+        filepath = history_store.save_history(f"体験談{worker}-{i}", f"シナリオ{worker}-{i}")
+        keys.append(os.path.basename(filepath)[len(history_store.HISTORY_PREFIX):-len(".json")])
+    # 書き込みは後回しになるので、編集・削除の前に書き終わっていることを確かめる
+    assert history_store.flush_history(timeout=60)
+    # 全プロセスが同じお気に入りファイルを同時に切り替える
+    for key in keys:
+        history_store.toggle_favorite(key)
+    # 偶数番目は編集、最後の1件は削除する
+    for key in keys[::2]:
+        history_store.update_history(key, f"編集済み{key}")
+    history_store.delete_history(keys[-1])
+    results.put(keys)
+
+
+def test_concurrent_processes_keep_every_change(tmp_path):
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(PROCESSES)
+    results = context.Queue()
+    processes = [
+        context.Process(target=_worker, args=(str(tmp_path), worker, barrier, results))
+        for worker in range(PROCESSES)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=120)
+        assert process.exitcode == 0
+    keys_by_worker = [results.get(timeout=10) for _ in processes]
+
+    all_keys = [key for keys in keys_by_worker for key in keys]
+    deleted = {keys[-1] for keys in keys_by_worker}
+    edited = {key for keys in keys_by_worker for key in keys[::2]}
+    assert len(set(all_keys)) == PROCESSES * RECORDS_PER_PROCESS
+
+    # 同じ秒に保存しても上書きされず、削除したものだけが消えている
+    files = sorted(name for name in os.listdir(tmp_path) if name.startswith(history_store.HISTORY_PREFIX))
+    assert len(files) == len(all_keys) - len(deleted)
+    records = {}
+    keys_by_file = {}
+    for name in files:
+        with open(os.path.join(tmp_path, name), "r", encoding="utf-8") as f:
+            data = json.load(f)
+        records[history_store.record_id(data)] = data
+        keys_by_file[name] = history_store.record_id(data)
+    assert set(records) == set(all_keys) - deleted
+    for key, data in records.items():
+        assert data.get("is_edited", False) is (key in edited)
+        if key in edited:
+            assert data["result"] == f"編集済み{key}"
+
+    # お気に入りの切り替えはどれも失われていない
+    with open(os.path.join(tmp_path, history_store.FAVORITES_FILENAME), "r", encoding="utf-8") as f:
+        favorites = json.load(f)
+    assert sorted(favorites) == sorted(records)
+
+    # インデックスにもすべての書き込みが反映されている
+    with open(os.path.join(tmp_path, history_store.INDEX_FILENAME), "r", encoding="utf-8") as f:
+        index = json.load(f)["records"]
+    assert sorted(index) == files
+    for name, key in keys_by_file.items():
+        assert index[name]["is_edited"] is (key in edited)
+
+    # 一時ファイルが残っていない
+    assert not [name for name in os.listdir(tmp_path) if name.startswith(".tmp_")]
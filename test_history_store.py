@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+履歴インデックス（文字数の内訳）のテスト
+
+    python -m pytest -q test_history_store.py
+"""
+
+import json
+import os
+
+import history_store
+
+SCENARIO = """■分析
+体験談の分析
+
+■前編
+【P1】
+1コマ目
+※カメラ：引き
+A子「ただいま」
+
+2コマ目
+義母（また遅い）
+
+━━━━━━━━━━
+■後編
+【P6】
+1コマ目
+※リビング
+B男「ごめん」
+"""
+
+
+def write_record(directory, name, result, timestamp=None):
+    data = {"timestamp": timestamp or name, "experience": "体験談", "result": result}
+    with open(os.path.join(directory, f"scenario_{name}.json"), "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+
+
+def read_index(directory):
+    assert history_store.flush_history(timeout=10)
+    with open(os.path.join(directory, history_store.INDEX_FILENAME), "r", encoding="utf-8") as f:
+        return json.load(f)["records"]
+
+
+def test_save_history_stores_char_stats(history_dir):
+    filepath = history_store.save_history("体験談", SCENARIO)
+    stats = read_index(history_dir)[os.path.basename(filepath)]["char_stats"]
+
+    assert stats["panels"] == {"前編/P1/1": 10, "前編/P1/2": 4, "後編/P6/1": 7}
+    assert stats["pages"] == {"前編/P1": 14, "後編/P6": 7}
+    assert stats["parts"] == {"前編": 14, "後編": 7}
+    assert stats["dialogue"] == 4 + 4 + 3
+    assert stats["narration"] == stats["script_total"] - stats["dialogue"]
+    assert history_store.get_statistics() == {"total_count": 1}
+
+
+def test_update_and_delete_keep_index_in_sync(history_dir):
+    filepath = history_store.save_history("体験談", SCENARIO)
+    filename = os.path.basename(filepath)
+    timestamp = history_store.load_history(limit=1)[0]["timestamp"]
+
+    assert history_store.update_history(timestamp, SCENARIO.replace("ごめん", "ごめんなさい"))
+    entry = read_index(history_dir)[filename]
+    assert entry["is_edited"]
+    assert entry["char_stats"]["pages"]["後編/P6"] == 10
+
+    assert history_store.delete_history(timestamp)
+    assert read_index(history_dir) == {}
+
+
+def test_records_saved_before_the_index_are_added(history_dir):
+    write_record(history_dir, "20240101_000000", SCENARIO)
+    write_record(history_dir, "20240102_000000", "コマのない古い形式")
+
+    records = history_store.sync_history_index()
+    assert set(records) == {"scenario_20240101_000000.json", "scenario_20240102_000000.json"}
+    assert history_store.get_statistics() == {"total_count": 2}
+
+    os.remove(os.path.join(history_dir, "scenario_20240102_000000.json"))
+    assert set(history_store.sync_history_index()) == {"scenario_20240101_000000.json"}
+
+
+def test_summary_reports_outliers(history_dir):
+    for day in range(1, 8):
+        write_record(history_dir, f"202401{day:02d}_000000", SCENARIO)
+    long_scenario = SCENARIO.replace("ごめん", "ごめん" * 100)
+    write_record(history_dir, "20240110_000000", long_scenario)
+
+    summary = history_store.get_char_count_summary()
+    assert summary["scenario_count"] == 8
+    assert summary["script_total"]["median"] == 21
+    assert {(row["timestamp"], row["key"]) for row in summary["outliers"]} == {
+        ("20240110_000000", "全体"),
+        ("20240110_000000", "後編/P6"),
+    }
+
+
+def test_fixing_line_breaks_keeps_revision_and_index(history_dir, monkeypatch):
+    import fix_historical_scenarios
+
+    monkeypatch.setattr(history_store, "BACKEND", "sqlite")
+    history_store.save_history("体験談", SCENARIO.replace("※カメラ：引き\nA子", "※カメラ：引き　A子"))
+    assert history_store.flush_history(timeout=10)
+    [record] = history_store.iter_history_records()
+
+    # 設定されている保存先（ここでは SQLite）の履歴を書き換える
+    assert fix_historical_scenarios.fix_scenario_record(record)
+    [fixed] = history_store.iter_history_records()
+    assert fixed["result"] == fix_historical_scenarios.enforce_line_breaks(record["result"]) != record["result"]
+    assert fixed["fixed_line_breaks"]
+    assert fixed["revisions"][0]["result"] == record["result"]
+    assert fixed["revisions"][0]["replaced_by"] == "fix_line_breaks"
+    assert not fix_historical_scenarios.fix_scenario_record(fixed)
+    assert history_store.sync_history_index()[history_store.HISTORY_PREFIX + fixed["id"] + ".json"]["char_stats"] \
+        == history_store._index_entry(fixed)["char_stats"]
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ストリーミング用の改行整形（LineBreakNormalizer）の差分テスト
+
+ランダムなシナリオ風テキストをランダムな長さの断片に分けて流し込み、
+全文に enforce_line_breaks をかけた結果と1文字も違わないことを確かめる。
+
+    python -m pytest -q test_incremental_line_breaks.py
+    python test_incremental_line_breaks.py
+"""
+
+import random
+import sys
+
+from scenario_text import (
+    NAMED_CHARACTERS,
+    LineBreakNormalizer,
+    _MAX_BREAK_LENGTH,
+    _BREAK_LOOKBEHIND,
+    enforce_line_breaks,
+)
+
+# ランダムなテキストの材料（区切りになるもの・なりかけのもの・空白類）
+_TOKENS = (
+    ["※", "※カメラ：引き", "※状況：リビング", "「", "」", "（", "）", "A子", "B男", "C子", "Z男", "AB子"]
+    + list(NAMED_CHARACTERS)
+    + ["義", "護", "産", "師", "士", "あ", "セリフ", "心の声", "x", "■前編", "■後編", "【P1】", "1コマ目", "━━━━"]
+    + ["\n", "\n", "\n\n", "\n\n\n", " ", "　", "\t", "\r", "  \n  "]
+)
+
+# 手で選んだ境界ケース
+EDGE_CASES = [
+    "",
+    "\n",
+    "\n\n\n",
+    "   ",
+    "※",
+    "※※※",
+    "A子「",
+    "あA子「",
+    "x\n義母「あ」",
+    "あ義母「あ」",
+    "あ義父（心の声）",
+    "x\n弁護士「あ」",
+    "あ看護師「あ」助産師（い）",
+    "※カメラ：引き※リビングA子「こんにちは」A子（心の声）",
+    "※カメラ：引き※リビング\nA子「こんにちは」A子（心の声）",
+    "A子「セリフ1」A子「セリフ2」",
+    "\n\n■前編\n\n\n【P1】\n1コマ目\n※カメラ：寄り母「ただいま」\n\n",
+    "行末の空白　 \n　行頭の空白",
+    "a\r\nb\r\n",
+]
+
+
+def random_text(rng, max_tokens=60):
+    return "".join(rng.choice(_TOKENS) for _ in range(rng.randint(0, max_tokens)))
+
+
+def random_chunks(rng, text, max_size=8):
+    chunks = []
+    index = 0
+    while index < len(text):
+        size = rng.randint(0, max_size)
+        chunks.append(text[index:index + size])
+        index += size
+    return chunks
+
+
+def normalize_streamed(chunks):
+    normalizer = LineBreakNormalizer()
+    pieces = [normalizer.feed(chunk) for chunk in chunks]
+    pieces.append(normalizer.flush())
+    return "".join(pieces)
+
+
+def assert_same_as_batch(text, chunks):
+    expected = enforce_line_breaks(text)
+    actual = normalize_streamed(chunks)
+    assert actual == expected, f"\n入力: {text!r}\n断片: {chunks!r}\n期待: {expected!r}\n実際: {actual!r}"
+
+
+def test_edge_cases_every_split():
+    for text in EDGE_CASES:
+        assert_same_as_batch(text, [text])
+        assert_same_as_batch(text, list(text))
+        for cut in range(len(text) + 1):
+            assert_same_as_batch(text, [text[:cut], text[cut:]])
+
+
+def test_random_texts_random_chunks():
+    for seed in range(3000):
+        rng = random.Random(seed)
+        text = random_text(rng)
+        assert_same_as_batch(text, random_chunks(rng, text))
+
+
+def test_random_texts_one_char_at_a_time():
+    for seed in range(500):
+        rng = random.Random(10_000 + seed)
+        text = random_text(rng)
+        assert_same_as_batch(text, list(text))
+
+
+def test_named_character_is_not_split_at_line_start():
+    for name in ("義母", "義父"):
+        assert enforce_line_breaks(f"x\n{name}「あ」") == f"x\n{name}「あ」"
+        assert enforce_line_breaks(f"x{name}「あ」") == f"x\n{name}「あ」"
+
+
+def test_finalized_text_is_emitted_before_flush():
+    normalizer = LineBreakNormalizer()
+    emitted = normalizer.feed("※カメラ：引き※リビング\nA子「こんにちは」")
+    assert emitted.startswith("※カメラ：引き\n※リビング\nA子")
+    # 末尾の数文字は次の断片で区切りになるかもしれないので保留される
+    assert len(emitted) < len(enforce_line_breaks("※カメラ：引き※リビング\nA子「こんにちは」"))
+
+
+def test_window_stays_bounded_on_long_lines():
+    normalizer = LineBreakNormalizer()
+    text = "あ" * 50_000 + "A子「" + "い" * 50_000
+    pieces = []
+    for char in text:
+        pieces.append(normalizer.feed(char))
+        assert len(normalizer._window) <= _MAX_BREAK_LENGTH + _BREAK_LOOKBEHIND
+    pieces.append(normalizer.flush())
+    assert "".join(pieces) == enforce_line_breaks(text)
+
+
+if __name__ == "__main__":
+    tests = [value for name, value in sorted(globals().items()) if name.startswith("test_")]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"OK   {test.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"FAIL {test.__name__}: {e}")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+同時セッションの負荷テスト（load_test.py）のテスト
+
+    python -m pytest -q test_load_test.py
+"""
+
+from load_test import INTERACTIONS, find_saturation, format_report, run_load_test
+
+CORPUS = [
+    {"id": "a", "experience": "義母が毎週末に連絡なしで家に来る。録音した会話を家族会議で流した。"},
+    {"id": "b", "experience": "夫の浮気を探偵に調べてもらい、弁護士と一緒に証拠を突きつけた。"},
+]
+
+
+def _level(sessions, throughput, p95):
+    return {"sessions": sessions, "throughput_per_sec": throughput, "rerun": {"p95_sec": p95}}
+
+
+def test_concurrent_sessions_run_every_interaction_without_errors():
+    report = run_load_test([1, 2], iterations=1, history=5, corpus=CORPUS)
+
+    for level, sessions in zip(report["levels"], [1, 2]):
+        assert level["sessions"] == sessions
+        assert level["errors"] == 0, level
+        assert list(level["interactions"]) == list(INTERACTIONS)
+        assert all(stats["count"] == sessions for stats in level["interactions"].values())
+        assert level["throughput_per_sec"] > 0
+        assert level["rss_peak_mb"] > 0
+    assert "飽和点" in format_report(report)
+
+
+def test_saturation_is_first_level_over_slo_or_without_gain():
+    assert find_saturation([_level(1, 4.0, 0.2), _level(2, 7.0, 0.4), _level(4, 7.2, 0.8)], 1.0)[0] == 4
+    assert find_saturation([_level(1, 4.0, 0.2), _level(2, 7.0, 1.5)], 1.0)[0] == 2
+    assert find_saturation([_level(1, 4.0, 0.2), _level(2, 7.0, 0.4)], 1.0)[0] is None
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+メトリクス（metrics.py）のテスト
+
+    python -m pytest -q test_metrics.py
+"""
+
+import re
+import socket
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+import checkpoints
+import metrics
+from benchmark_prompts import synthetic_scenario
+from conftest import FakeApi
+
+EXPERIENCE = "義母が毎週末に連絡なしで家に来る。録音した会話を家族会議で流した。"
+SETTINGS = {"generation_mode": "single", "rewrite_mode": "full", "condense": False, "pipelined": False}
+
+
+class _Overloaded(Exception):
+    status_code = 529
+
+
+class _Api(FakeApi):
+    """初稿は形式どおりのシナリオを返し、リライトは overloaded（529）で失敗する"""
+
+    def respond(self, prompt):
+        if "【元のシナリオ】" in prompt:
+            raise _Overloaded("Overloaded")
+        return synthetic_scenario(EXPERIENCE)
+
+
+@pytest.fixture
+def api(history_dir, use_api):
+    metrics.reset()
+    return use_api(_Api())
+
+
+def _sample(text, name, **labels):
+    """テキスト形式から1つの値を読む"""
+    label_text = ",".join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+    pattern = "^" + re.escape(name + (f"{{{label_text}}}" if label_text else "")) + r" (\S+)$"
+    match = re.search(pattern, text, re.MULTILINE)
+    assert match, (name, labels)
+    return float(match.group(1))
+
+
+def test_pipeline_updates_metrics(api):
+    checkpoint = checkpoints.run_checkpointed("key", checkpoints.new_checkpoint(EXPERIENCE, SETTINGS))
+    assert checkpoint["status"] == "failed"
+    draft_model = checkpoint["stages"]["draft"]["models"]["draft"]
+
+    text = metrics.render()
+    assert _sample(text, "scenario_api_requests_total", model=draft_model, stage="draft", status="ok") == 1
+    rewrites = [line for line in text.splitlines()
+                if line.startswith("scenario_api_requests_total") and 'stage="rewrite"' in line]
+    assert rewrites and all('status="529"' in line for line in rewrites)
+    assert _sample(text, "scenario_generations_total", status="failed") == 1
+    assert _sample(text, "scenario_generations_in_flight") == 0
+
+    # ヒストグラムは累積で、+Inf の数が count と一致する
+    buckets = [float(value) for value in re.findall(
+        r'^scenario_stage_duration_seconds_bucket\{stage="draft",le="[^"]+"\} (\S+)$', text, re.MULTILINE)]
+    assert buckets == sorted(buckets) and len(buckets) == len(metrics.LATENCY_BUCKETS) + 1
+    assert buckets[-1] == _sample(text, "scenario_stage_duration_seconds_count", stage="draft") == 1
+
+    # 各モジュールで数えているものも出る
+    assert _sample(text, "scenario_history_records") == 0
+    assert "# TYPE scenario_history_cache_hit_ratio gauge" in text
+    assert "# TYPE scenario_batch_queue_depth gauge" in text
+
+
+def test_metrics_server_serves_text_format(api):
+    metrics.inc("scenario_generations_total", status='say "hi"\n')
+    server = metrics.start_metrics_server(port=0)
+    assert server is not None and metrics.start_metrics_server(port=0) is server
+    host, port = server.server_address[:2]
+
+    with urllib.request.urlopen(f"http://{host}:{port}/metrics", timeout=5) as response:
+        assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+        body = response.read().decode("utf-8")
+    assert 'scenario_generations_total{status="say \\"hi\\"\\n"} 1' in body
+    assert "# TYPE scenario_api_request_duration_seconds histogram" in body
+
+    with pytest.raises(urllib.error.HTTPError):
+        urllib.request.urlopen(f"http://{host}:{port}/other", timeout=5)
+
+
+def test_failures_are_recorded_not_printed(api, monkeypatch):
+    def broken():
+        raise RuntimeError("読み出せない")
+
+    monkeypatch.setattr(metrics, "_collectors", [broken, *metrics._collectors])
+    text = metrics.render()
+    # 読み出せなかったものは数に残り、ほかのものは出る
+    assert _sample(text, "scenario_metrics_collector_errors_total", collector="broken") == 1
+    assert "# TYPE scenario_history_cache_hit_ratio gauge" in text
+
+    monkeypatch.setattr(metrics, "_server", None)
+    with socket.socket() as taken:
+        taken.bind(("127.0.0.1", 0))
+        taken.listen()
+        port = taken.getsockname()[1]
+        assert metrics.start_metrics_server(port=port) is None
+    assert metrics.metrics_server_error().startswith(f"127.0.0.1:{port}: ")
+    monkeypatch.setattr(metrics, "_server_error", None)
+
+
+def test_updates_are_cheap():
+    start = time.perf_counter()
+    for i in range(20_000):
+        metrics.inc("scenario_api_requests_total", stage="draft", model="m", status="ok")
+        metrics.observe("scenario_api_request_duration_seconds", i % 100, stage="draft")
+    # 1回の更新は数マイクロ秒（API呼び出し1回は数十秒）
+    assert (time.perf_counter() - start) / 40_000 < 50e-6
+    metrics.reset()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ステージごとのモデル選択（model_router.py）のテスト
+
+    python -m pytest -q test_model_router.py
+"""
+
+import json
+import os
+
+import pytest
+
+import model_router
+from model_router import FALLBACK_MODELS, choose_route
+
+CONFIG = {
+    "prices_per_mtok": {},
+    "stages": {
+        "draft": {
+            "default": "big",
+            "routes": [
+                {"name": "draft:low-budget", "model": "small", "when": {"max_budget_remaining": 0.1}},
+                {"name": "draft:busy", "model": "small", "when": {"min_queue_depth": 10, "user_tiers": ["standard"]}},
+                {"name": "draft:no-model", "when": {}},
+            ],
+        },
+        "rewrite": {
+            "default": "small",
+            "routes": [{"name": "rewrite:long-draft", "model": "big", "when": {"min_input_tokens": 9000}}],
+        },
+        "condense": {"routes": [{"name": "condense:unknown", "model": "big", "when": {"no_such_condition": 1}}]},
+    },
+}
+
+
+@pytest.fixture
+def routes(tmp_path, monkeypatch):
+    path = tmp_path / "model_routes.json"
+    monkeypatch.setattr(model_router, "ROUTES_PATH", str(path))
+    monkeypatch.setattr(model_router, "_config_cache", {"mtime": None, "config": None})
+    monkeypatch.setattr(model_router, "_in_flight", 0)
+
+    def write(config, mtime=None):
+        path.write_text(json.dumps(config), encoding="utf-8")
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+    write(CONFIG)
+    return write
+
+
+def test_min_input_tokens(routes):
+    assert choose_route("rewrite", 8999)["name"] == "rewrite:default"
+    assert choose_route("rewrite", 9000) == {"name": "rewrite:long-draft", "model": "big", "stage": "rewrite"}
+
+
+def test_max_budget_remaining(routes):
+    assert choose_route("draft", 100, budget_remaining=0.1)["name"] == "draft:low-budget"
+    assert choose_route("draft", 100, budget_remaining=0.5)["name"] == "draft:default"
+    # 予算が不明なら、予算の条件は満たさない
+    assert choose_route("draft", 100, budget_remaining=None)["name"] == "draft:default"
+
+
+def test_queue_depth_and_user_tiers(routes, monkeypatch):
+    monkeypatch.setattr(model_router, "_in_flight", 9)
+    assert choose_route("draft", 100, user_tier="standard")["name"] == "draft:default"
+
+    monkeypatch.setattr(model_router, "_in_flight", 10)
+    assert choose_route("draft", 100, user_tier="standard")["name"] == "draft:busy"
+    # 条件はすべて満たしたときだけ使う
+    assert choose_route("draft", 100, user_tier="premium")["name"] == "draft:default"
+    # 上から順に評価する
+    assert choose_route("draft", 100, user_tier="standard", budget_remaining=0.0)["name"] == "draft:low-budget"
+
+
+def test_falls_back_to_default(routes):
+    assert choose_route("draft", 100) == {"name": "draft:default", "model": "big", "stage": "draft"}
+    # 知らない条件のルールは使わず、default がなければ組み込みのモデル
+    assert choose_route("condense", 100)["model"] == FALLBACK_MODELS["condense"]
+    assert choose_route("outline", 100)["model"] == FALLBACK_MODELS["outline"]
+
+
+def test_reloads_config_when_mtime_changes(routes):
+    routes(CONFIG, mtime=1_000_000)
+    assert choose_route("rewrite", 100)["model"] == "small"
+
+    changed = json.loads(json.dumps(CONFIG))
+    changed["stages"]["rewrite"]["default"] = "medium"
+    routes(changed, mtime=1_000_000)
+    # 更新時刻が同じなら読み直さない
+    assert choose_route("rewrite", 100)["model"] == "small"
+
+    routes(changed, mtime=1_000_010)
+    assert choose_route("rewrite", 100)["model"] == "medium"
+
+    # 編集途中の壊れた設定は無視して、前回の設定を使い続ける
+    path = model_router.ROUTES_PATH
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("{")
+    os.utime(path, (1_000_020, 1_000_020))
+    assert choose_route("rewrite", 100)["model"] == "medium"
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+アウトライン→ページごとの並列展開（scenario_pipeline.generate_scenario_outlined）のテスト
+
+    python -m pytest -q test_outline_generation.py
+"""
+
+import json
+import re
+import threading
+import time
+
+import pytest
+
+import scenario_pipeline
+from benchmark_prompts import synthetic_scenario
+from cancellation import CancelToken
+from conftest import FakeApi, FakeStream
+from scenario_pipeline import check_page, parse_outline, stitch_pages
+from scenario_text import split_pages
+
+EXPERIENCE = "義母が毎週末に連絡なしで家に来る。録音した会話を家族会議で流した。"
+PAGE_KEYS = [(part, page) for part in ("前編", "後編") for page in range(1, 6)]
+OUTLINE = {
+    "analysis": ["核となる感情：怒り"],
+    "emotion_design": ["前編の感情曲線：不満が積もる"],
+    "ochi": {"前編": "No.1", "後編": "No.2"},
+    "characters": [{"name": "A子", "description": "主人公"}, {"name": "義母", "description": "連絡なしで来る"}],
+    "pages": [{"part": part, "page": page, "beat": f"{part}P{page}のあらすじ"} for part, page in PAGE_KEYS],
+}
+EXPAND_PATTERN = re.compile(r"\*\*(前編|後編)の【P(\d)】だけ\*\*")
+
+pytestmark = pytest.mark.usefixtures("history_dir")
+
+
+def _page(part, page):
+    return f"【P{page}】\n1コマ目\n※カメラ：引き\nA子「{part}P{page}のセリフ」\n\n2コマ目\n義母「{part}P{page}」"
+
+
+class _OutlineApi(FakeApi):
+    """アウトラインと各ページを返す。後ろのページほど早く返し、fail のページは失敗する"""
+
+    def __init__(self, outline=OUTLINE, fail=None):
+        super().__init__()
+        self.outline = outline
+        self.fail = fail
+
+    def respond(self, prompt):
+        if "「アウトライン」だけを作成" in prompt:
+            return f"```json\n{json.dumps(self.outline, ensure_ascii=False)}\n```"
+        match = EXPAND_PATTERN.search(prompt)
+        if match is None:
+            return synthetic_scenario(EXPERIENCE)
+        key = (match.group(1), int(match.group(2)))
+        time.sleep(0.01 * (len(PAGE_KEYS) - PAGE_KEYS.index(key)))
+        if key == self.fail:
+            raise ConnectionError("一時的なAPIエラー")
+        return _page(*key)
+
+
+def test_parse_outline():
+    assert parse_outline(f"アウトラインです。\n```json\n{json.dumps(OUTLINE)}\n```") == OUTLINE
+
+    swapped = dict(OUTLINE, pages=[OUTLINE["pages"][1], OUTLINE["pages"][0], *OUTLINE["pages"][2:]])
+    for broken in (
+        swapped,
+        dict(OUTLINE, pages=OUTLINE["pages"][:9]),
+        dict(OUTLINE, characters=[]),
+        {key: value for key, value in OUTLINE.items() if key != "characters"},
+    ):
+        with pytest.raises(ValueError):
+            parse_outline(json.dumps(broken))
+    with pytest.raises(ValueError):
+        parse_outline("アウトラインを作れませんでした")
+
+
+def test_check_page_normalizes_and_reports():
+    text, issues = check_page("■前編\n【P2】\n1コマ目\n※カメラ：寄り　A子「ただいま」", "前編", 2, ["A子"])
+    assert text == "【P2】\n1コマ目\n※カメラ：寄り\nA子「ただいま」"
+    assert issues == []
+
+    text, issues = check_page("【P3】\n1コマ目\n佐藤「どうも」", "後編", 4, ["A子"])
+    assert text.startswith("【P4】\n")
+    assert issues == ["後編P4: ページ番号が違います（【P3】）", "後編P4: アウトラインにない人物のセリフがあります（佐藤）"]
+
+    text, issues = check_page("A子「ただいま」", "前編", 1, ["A子"])
+    assert text == "【P1】\nA子「ただいま」"
+    assert issues == ["前編P1: ページ見出しがありません", "前編P1: コマがありません"]
+
+
+def test_pages_are_stitched_in_order_after_parallel_expansion(use_api, monkeypatch):
+    monkeypatch.setattr(scenario_pipeline, "EXPANSION_WORKERS", len(PAGE_KEYS))
+    use_api(_OutlineApi())
+    meta = {}
+    scenario = scenario_pipeline.generate_scenario_outlined("key", EXPERIENCE, meta=meta)
+
+    pages = [block for block in split_pages(scenario) if block["page"] is not None]
+    assert [(block["part"], block["page"]) for block in pages] == PAGE_KEYS
+    for block in pages:
+        assert f"A子「{block['part']}P{block['page']}のセリフ」" in block["text"]
+    assert scenario.startswith("【体験談の分析】\n・核となる感情：怒り")
+    assert "・義母：連絡なしで来る" in scenario
+    assert meta["expand"]["calls"] == len(PAGE_KEYS)
+    assert meta["expand"]["stitch_issues"] == []
+    assert scenario == stitch_pages(OUTLINE, {key: _page(*key) for key in PAGE_KEYS})[0]
+
+
+class _StuckPagesApi(_OutlineApi):
+    """fail のページはすぐ失敗し、ほかのページは止められるまで書き終わらない"""
+
+    def respond(self, prompt):
+        match = EXPAND_PATTERN.search(prompt)
+        if match is not None and (match.group(1), int(match.group(2))) == self.fail:
+            raise ConnectionError("一時的なAPIエラー")
+        return super().respond(prompt) if match is None else _page(match.group(1), int(match.group(2)))
+
+    def open_stream(self, prompt, message):
+        gate = threading.Event() if EXPAND_PATTERN.search(prompt) else None
+        return FakeStream(message, gate=gate)
+
+
+def test_failed_page_expansion_fails_the_generation(use_api):
+    api = use_api(_OutlineApi(fail=("後編", 3)))
+    scenario = scenario_pipeline.generate_scenario_outlined("key", EXPERIENCE)
+
+    # 1ページでも展開できなければ、欠けたシナリオは返さずにエラーにする
+    assert scenario.startswith("エラーが発生しました")
+    assert "一時的なAPIエラー" in scenario
+    assert len(api.prompts) <= 1 + len(PAGE_KEYS)
+
+
+def test_failed_page_stops_the_other_expansions(use_api):
+    cancel = CancelToken()
+    api = use_api(_StuckPagesApi(fail=("後編", 3)))
+    start = time.monotonic()
+    scenario = scenario_pipeline.generate_scenario_outlined("key", EXPERIENCE, cancel=cancel)
+
+    assert "一時的なAPIエラー" in scenario
+    assert time.monotonic() - start < 5.0
+    # 書きかけのほかのページは接続を切って止める
+    pages = api.streams[1:]
+    assert pages and all(stream.closed for stream in pages)
+    # 生成そのものはキャンセルされていない
+    assert not cancel.cancelled and cancel._callbacks == []
+
+
+def test_broken_outline_falls_back_to_single_draft(use_api):
+    api = use_api(_OutlineApi(outline=dict(OUTLINE, pages=OUTLINE["pages"][:3])))
+    assert scenario_pipeline.generate_scenario_outlined("key", EXPERIENCE) == synthetic_scenario(EXPERIENCE)
+    assert len(api.prompts) == 2
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+後編の初稿を書いている間に前編のリライトを始めるパイプライン
+（scenario_pipeline.generate_and_fix_pipelined・scenario_text.split_parts / join_parts）のテスト
+
+    python -m pytest -q test_pipelined_rewrite.py
+"""
+
+import threading
+
+import pytest
+
+import scenario_pipeline
+from benchmark_prompts import synthetic_scenario
+from cancellation import CancelToken
+from conftest import FakeApi, FakeStream, fake_message
+from scenario_text import join_parts, split_parts
+
+EXPERIENCE = "義母が毎週末に連絡なしで家に来る。録音した会話を家族会議で流した。"
+DRAFT = synthetic_scenario(EXPERIENCE)
+# 続き生成などで、ストリーミングで届いたあとに前編が変わった初稿
+FINAL_DRAFT = DRAFT.replace("・核となる感情：", "・核となる感情（書き直し）：", 1)
+
+pytestmark = pytest.mark.usefixtures("history_dir")
+
+
+def _source(prompt):
+    """リライトのプロンプトから【元のシナリオ】の部分を取り出す"""
+    return prompt.split("【元のシナリオ】\n", 1)[1].split("\n\n【ステップ1", 1)[0]
+
+
+def _rewrite(text):
+    return text.replace("A子「", "A子「直した")
+
+
+class _WholeScenarioApi(FakeApi):
+    """前編・後編だけのリライトを頼まれても、シナリオ全体を書き直して返す（全文リライト）"""
+
+    def respond(self, prompt):
+        if "【元のシナリオ】" in prompt:
+            return _rewrite(DRAFT)
+        return DRAFT
+
+
+class _ChangedDraftApi(FakeApi):
+    """
+    届いた初稿と完成した初稿で前編が違う。届いた前編のリライトは、止められるまで終わらない
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.stale_streams = []
+
+    def respond(self, prompt):
+        if "【元のシナリオ】" in prompt:
+            return _rewrite(_source(prompt))
+        return DRAFT
+
+    def open_stream(self, prompt, message):
+        if "【元のシナリオ】" not in prompt:
+            return _EditedStream(message)
+        if _source(prompt) == split_parts(DRAFT)[0]:
+            stream = FakeStream(message, gate=threading.Event())
+            self.stale_streams.append(stream)
+            return stream
+        return FakeStream(message)
+
+
+class _EditedStream(FakeStream):
+    def get_final_message(self):
+        return fake_message(FINAL_DRAFT)
+
+
+def _rewrite_prompts(api):
+    return [prompt for prompt in api.prompts if "【元のシナリオ】" in prompt]
+
+
+def test_split_and_join_parts_round_trip():
+    first_half, second_half = split_parts(DRAFT)
+    assert first_half.endswith("」") and "■後編" not in first_half
+    assert second_half.startswith("■後編\n━")
+    assert join_parts(first_half, second_half) == DRAFT
+    assert join_parts(first_half + "\n\n", "\n" + second_half) == DRAFT
+
+    # 行の途中の「■後編」は見出しではない
+    assert split_parts("■前編\nA子「■後編はまだ」") == ("■前編\nA子「■後編はまだ」", None)
+    assert split_parts("■前編\n  ■ 後編\n【P1】")[1] == "  ■ 後編\n【P1】"
+
+
+def test_part_rewrite_keeps_only_its_part(use_api):
+    api = use_api(_WholeScenarioApi())
+    draft, rewritten = scenario_pipeline.generate_and_fix_pipelined("key", EXPERIENCE, mode="full")
+
+    assert draft == DRAFT
+    assert rewritten.count("■後編") == 1
+    assert rewritten == _rewrite(DRAFT)
+    first_prompt, second_prompt = _rewrite_prompts(api)
+    assert "前編だけを書き直して出力" in first_prompt and "■後編" not in _source(first_prompt)
+    assert "後編だけを書き直して出力" in second_prompt
+
+
+def test_changed_first_half_cancels_stale_rewrite(use_api):
+    api = use_api(_ChangedDraftApi())
+    meta = {}
+    cancel = CancelToken()
+    draft, rewritten = scenario_pipeline.generate_and_fix_pipelined(
+        "key", EXPERIENCE, meta=meta, mode="full", cancel=cancel
+    )
+
+    assert draft == FINAL_DRAFT
+    assert rewritten == _rewrite(FINAL_DRAFT)
+    # 届いた前編のリライトは、完成した前編で始め直す前に止めている
+    [stale] = api.stale_streams
+    assert stale.closed
+    assert len(_rewrite_prompts(api)) == 3
+    assert meta["rewrite"]["calls"] == 2
+    # やり直しで止めたリライトは、生成のキャンセルで節約した分ではない
+    assert (cancel.saved_output_tokens, cancel.saved_sec) == (0, 0.0)
+    # 終わった前編・後編のトークンは、生成のトークンから外れている
+    assert cancel._callbacks == []
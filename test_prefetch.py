@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+入力中の初稿の先読み（prefetch.py）のテスト
+
+    python -m pytest -q test_prefetch.py
+"""
+
+import json
+import threading
+import time
+
+import pytest
+
+import checkpoints
+import prefetch
+from benchmark_prompts import synthetic_scenario
+from conftest import FakeApi, FakeStream
+
+EXPERIENCE = "義母が毎週末に連絡なしで家に来る。録音した会話を家族会議で流した。"
+SETTINGS = {"generation_mode": "single", "rewrite_mode": "patch", "condense": False, "pipelined": False}
+
+
+class _Api(FakeApi):
+    """初稿は半分まで書いたところで release() まで止まり、リライトはすぐに返す"""
+
+    def __init__(self):
+        super().__init__()
+        self.drafts = 0
+        self.rewrites = 0
+        self._gate = threading.Event()
+
+    def release(self):
+        self._gate.set()
+
+    def respond(self, prompt):
+        if "【元のシナリオ】" in prompt:
+            self.rewrites += 1
+            edits = {"edits": [{"part": "前編", "page": 1, "panel": 1, "lines": ["※カメラ：引き", "A子「ただいま」"]}]}
+            return json.dumps(edits, ensure_ascii=False)
+        self.drafts += 1
+        return synthetic_scenario(EXPERIENCE)
+
+    def open_stream(self, prompt, message):
+        gate = None if "【元のシナリオ】" in prompt else self._gate
+        return FakeStream(message, gate=gate)
+
+
+@pytest.fixture
+def api(history_dir, use_api):
+    return use_api(_Api())
+
+
+def _wait_for_text(speculative, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not speculative.text() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert speculative.text()
+
+
+def test_starts_after_debounce_and_cancels_on_edit(api):
+    before = prefetch.get_prefetch_stats()
+    state = {}
+
+    prefetch.observe_input(state, EXPERIENCE, now=100.0)
+    assert prefetch.maybe_start(state, "key", EXPERIENCE, SETTINGS, debounce=4.0, now=102.0) is None
+    assert prefetch.pending_prefetch(state, EXPERIENCE)
+
+    speculative = prefetch.maybe_start(state, "key", EXPERIENCE, SETTINGS, debounce=4.0, now=104.5)
+    assert speculative is not None and speculative.running
+    assert prefetch.maybe_start(state, "key", EXPERIENCE, SETTINGS, debounce=4.0, now=105.0) is speculative
+    _wait_for_text(speculative)
+
+    # 入力が変わったら、書きかけの初稿は捨てる
+    prefetch.observe_input(state, EXPERIENCE + "追記", now=106.0)
+    assert speculative.wait(5.0) and speculative.status == "cancelled"
+    assert prefetch.take(state, EXPERIENCE + "追記", SETTINGS) is None
+
+    after = prefetch.get_prefetch_stats()
+    assert after["started"] == before["started"] + 1
+    assert after["misses"] == before["misses"] + 1
+    assert after["wasted_output_tokens"] > before["wasted_output_tokens"]
+    assert after["wasted_input_tokens"] > before["wasted_input_tokens"]
+
+
+
+class _StuckStream(FakeStream):
+    """閉じても、gate が開くまで次の行が届かない（切断に時間がかかる接続）"""
+
+    def close(self):
+        pass
+
+
+def test_cancel_does_not_wait_for_the_draft(api, monkeypatch):
+    monkeypatch.setattr(api, "open_stream", lambda prompt, message: _StuckStream(message, gate=api._gate))
+    before = prefetch.get_prefetch_stats()
+    state = {}
+    prefetch.observe_input(state, EXPERIENCE, now=0.0)
+    speculative = prefetch.maybe_start(state, "key", EXPERIENCE, SETTINGS, debounce=0.0, now=0.0)
+    _wait_for_text(speculative)
+
+    # 入力の変更は、初稿の生成が止まるのを待たずに戻る
+    start = time.monotonic()
+    prefetch.observe_input(state, EXPERIENCE + "追記", now=1.0)
+    assert time.monotonic() - start < 1.0
+    assert speculative.running
+    assert prefetch.get_prefetch_stats()["misses"] == before["misses"]
+
+    # 捨てた分は、生成が止まってから1回だけ数える
+    api.release()
+    assert speculative.wait(5.0)
+    speculative.cancel("もう一度")
+    after = prefetch.get_prefetch_stats()
+    assert after["misses"] == before["misses"] + 1
+    assert after["wasted_output_tokens"] > before["wasted_output_tokens"]
+
+def test_generate_adopts_in_progress_draft(api):
+    before = prefetch.get_prefetch_stats()
+    state = {}
+    prefetch.observe_input(state, EXPERIENCE, now=0.0)
+    speculative = prefetch.maybe_start(state, "key", EXPERIENCE, SETTINGS, debounce=0.0, now=0.0)
+    _wait_for_text(speculative)
+
+    # 書きかけのうちに生成ボタンが押された
+    taken = prefetch.take(state, EXPERIENCE, SETTINGS)
+    assert taken is speculative and "speculative_draft" not in state
+    threading.Timer(0.1, api.release).start()
+
+    received = []
+    checkpoint = checkpoints.new_checkpoint(EXPERIENCE, SETTINGS)
+    checkpoint = checkpoints.run_checkpointed(
+        "key", prefetch.adopt(taken, checkpoint, on_draft_text=received.append), on_draft_text=received.append
+    )
+
+    # 初稿は先読みの1回だけで、続きの自動リライトから生成した
+    assert checkpoint["status"] == "completed"
+    assert api.drafts == 1 and api.rewrites == 1
+    assert "".join(received) == synthetic_scenario(EXPERIENCE)
+    assert checkpoint["stages"]["draft"]["output"] == synthetic_scenario(EXPERIENCE)
+    assert set(checkpoints.checkpoint_models(checkpoint)) == {"draft", "rewrite_patch"}
+
+    after = prefetch.get_prefetch_stats()
+    assert after["partial_hits"] == before["partial_hits"] + 1
+    assert after["misses"] == before["misses"]
+
+
+def test_only_prefetches_when_draft_depends_on_experience_alone(api):
+    api.release()
+    state = {}
+    for settings in ({**SETTINGS, "condense": True}, {**SETTINGS, "generation_mode": "outline"}):
+        assert prefetch.maybe_start(state, "key", EXPERIENCE, settings, debounce=0.0) is None
+    assert prefetch.maybe_start(state, "", EXPERIENCE, SETTINGS, debounce=0.0) is None
+
+    speculative = prefetch.maybe_start(state, "key", EXPERIENCE, SETTINGS, debounce=0.0)
+    assert speculative.wait(5.0) and speculative.status == "done"
+    # 生成ボタンを押す前に設定を変えたら、先読みは使わない
+    assert prefetch.take(state, EXPERIENCE, {**SETTINGS, "condense": True}) is None
+    assert prefetch.take(state, EXPERIENCE, SETTINGS) is None
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+操作ごとのプロファイラ（profiler.py）のテスト
+
+    python -m pytest -q test_profiler.py
+"""
+
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import history_store
+import profiler
+
+
+@pytest.fixture
+def trace_log(tmp_path, monkeypatch):
+    path = tmp_path / "profile_traces.jsonl"
+    monkeypatch.setattr(profiler, "TRACE_LOG_PATH", str(path))
+    return path
+
+
+def _rows(trace):
+    return {row["name"]: row for row in trace["breakdown"]}
+
+
+@profiler.profiled("work.sleep")
+def _sleep(seconds):
+    time.sleep(seconds)
+
+
+def _busy_function():
+    return sum(i * i for i in range(200000))
+
+
+def test_disabled_records_nothing(trace_log):
+    with profiler.profile_run("") as trace:
+        with profiler.span("ui.sidebar"):
+            _sleep(0)
+    assert trace is None
+    assert not profiler.profiling_active()
+    assert not trace_log.exists()
+
+
+def test_spans_break_down_run_including_worker_threads(trace_log):
+    with profiler.profile_run("spans", session="s1") as trace:
+        assert profiler.profiling_active()
+        with profiler.span("ui.sidebar"):
+            _sleep(0.02)
+            _sleep(0.02)
+        # 生成スレッドの処理も、呼んだ側のスパンの内側に入る
+        with profiler.span("ui.generation"):
+            thread = threading.Thread(target=profiler.run_in_context(lambda: _sleep(0.03)))
+            thread.start()
+            thread.join()
+        time.sleep(0.01)
+
+    rows = _rows(trace)
+    assert rows["work.sleep"]["count"] == 3
+    assert rows["work.sleep"]["total_ms"] >= 70
+    assert rows["ui.sidebar"]["total_ms"] >= 40
+    assert rows["ui.sidebar"]["self_ms"] < 10
+    assert rows["ui.generation"]["self_ms"] < 10
+    assert rows["(その他)"]["self_ms"] >= 10
+    assert trace["total_ms"] >= 80
+    assert {span["thread"] for span in trace["spans"]} > {"MainThread"}
+
+    [line] = trace_log.read_text(encoding="utf-8").splitlines()
+    saved = json.loads(line)
+    assert saved["session"] == "s1"
+    assert saved["breakdown"] == trace["breakdown"]
+
+
+def test_cprofile_reports_hot_functions(trace_log):
+    with profiler.profile_run("cprofile") as trace:
+        _busy_function()
+    assert any("_busy_function" in row["function"] for row in trace["top_functions"])
+
+    # 例外（Streamlit の再実行など）で抜けても記録する
+    with pytest.raises(KeyboardInterrupt):
+        with profiler.profile_run("spans") as trace:
+            with profiler.span("ui.sidebar"):
+                raise KeyboardInterrupt
+    assert _rows(trace)["ui.sidebar"]["count"] == 1
+    assert len(trace_log.read_text(encoding="utf-8").splitlines()) == 2
+
+
+def test_app_rerun_shows_breakdown(trace_log, tmp_path, monkeypatch):
+    from streamlit.testing.v1 import AppTest
+
+    monkeypatch.setattr(history_store, "HISTORY_DIR", str(tmp_path))
+    monkeypatch.setattr(history_store, "is_streamlit_cloud", lambda: False)
+    monkeypatch.setenv(profiler.PROFILE_ENV, "1")
+
+    at = AppTest.from_file("app.py", default_timeout=60)
+    at.run()
+    at.run()
+    assert not at.exception
+    traces = at.session_state["profile_traces"]
+    assert len(traces) == 2
+    names = _rows(traces[-1])
+    assert {"ui.sidebar", "ui.input", "history.load_history"} <= set(names)
+    assert "spans" not in traces[-1]
+    assert any(expander.label == "🔬 プロファイル" for expander in at.sidebar.expander)
+    assert len(trace_log.read_text(encoding="utf-8").splitlines()) == 2
+
+
+def test_trace_log_follows_history_dir(tmp_path):
+    # 履歴の保存先を移したデプロイでは、記録もそこに書く（リポジトリの output/ には書かない）
+    env = {**os.environ, "SCENARIO_HISTORY_DIR": str(tmp_path)}
+    env.pop("SCENARIO_PROFILE_TRACE_LOG", None)
+    proc = subprocess.run(
+        [sys.executable, "-c", "import profiler; print(profiler.TRACE_LOG_PATH)"],
+        cwd=os.path.dirname(os.path.abspath(profiler.__file__)), env=env, capture_output=True, text=True, timeout=60,
+    )
+    assert proc.returncode == 0, proc.stderr
+    assert proc.stdout.strip() == str(tmp_path / "profile_traces.jsonl")
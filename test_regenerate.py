@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+1ページ・1コマだけの作り直し（scenario_pipeline.regenerate_section）のテスト
+
+    python -m pytest -q test_regenerate.py
+"""
+
+import json
+
+import pytest
+
+import history_store
+import scenario_pipeline
+from benchmark_prompts import synthetic_scenario
+from conftest import FakeApi
+from scenario_text import enforce_line_breaks, split_pages
+
+EXPERIENCE = "義母が毎週末に連絡なしで家に来る。録音した会話を家族会議で流した。"
+SCENARIO = synthetic_scenario(EXPERIENCE).replace(
+    "【シナリオプロット】", "【登場人物】\n・A子：主人公の主婦\n・義母：連絡なしで来る\n\n【シナリオプロット】"
+)
+NEW_PAGE = "【P2】\n1コマ目\n※カメラ：寄り　義母「また来たわよ」A子（うそでしょ…）\n\n2コマ目\n※玄関\n佐藤「こんにちは」"
+
+pytestmark = pytest.mark.usefixtures("history_dir")
+
+
+class _Api(FakeApi):
+    """決まった出力を返す（1ページ分なので使用量も小さい）"""
+
+    usage = (500, 200)
+
+
+def _pages(text):
+    return {(block["part"], block["page"]): block["text"] for block in split_pages(text)}
+
+
+def test_regenerate_page_splices_only_that_page(use_api):
+    api = use_api(_Api(NEW_PAGE))
+    meta = {}
+    scenario, issues = scenario_pipeline.regenerate_section(
+        "key", SCENARIO, "後編", 2, instruction="義母をもっと図々しく", meta=meta
+    )
+
+    before, after = _pages(SCENARIO), _pages(scenario)
+    assert after.keys() == before.keys()
+    changed = [key for key in before if before[key] != after[key]]
+    assert changed == [("後編", 2)]
+    assert after[("後編", 2)].startswith("【P2】\n1コマ目\n※カメラ：寄り\n義母「また来たわよ」\nA子（うそでしょ…）")
+    assert scenario == enforce_line_breaks(scenario)
+    assert issues == ["後編P2: アウトラインにない人物のセリフがあります（佐藤）"]
+
+    # 送るのは書き直すページと前後のページ・登場人物・直したい点だけ
+    [prompt] = api.prompts
+    assert "・A子：主人公の主婦" in prompt and "義母をもっと図々しく" in prompt
+    assert before[("後編", 1)].strip() in prompt and before[("後編", 3)].strip() in prompt
+    assert before[("前編", 1)].strip() not in prompt
+    assert len(prompt) < len(SCENARIO)
+    assert meta["regenerate"]["model"]
+
+
+def test_regenerate_panel_replaces_lines(use_api):
+    lines = ["※カメラ：アップ", "A子「録音、全部聞いてもらいます」"]
+    api = use_api(_Api(json.dumps({"lines": lines}, ensure_ascii=False)))
+    scenario, issues = scenario_pipeline.regenerate_section("key", SCENARIO, "前編", 3, panel=2)
+
+    assert issues == []
+    before, after = _pages(SCENARIO), _pages(scenario)
+    assert [key for key in before if before[key] != after[key]] == [("前編", 3)]
+    assert "2コマ目\n※カメラ：アップ\nA子「録音、全部聞いてもらいます」\n" in after[("前編", 3)]
+    assert "【書き直すコマ】\n2コマ目" in api.prompts[0]
+
+
+def test_regenerate_rejects_missing_section_without_calling_api(use_api):
+    api = use_api(_Api(NEW_PAGE))
+    with pytest.raises(ValueError):
+        scenario_pipeline.regenerate_section("key", SCENARIO, "後編", 9)
+    with pytest.raises(ValueError):
+        scenario_pipeline.regenerate_section("key", SCENARIO, "前編", 1, panel=7)
+    assert api.prompts == []
+
+    # 出力が JSON でなければ差し込まない
+    api.output = "書き直しました"
+    with pytest.raises(ValueError):
+        scenario_pipeline.regenerate_section("key", SCENARIO, "前編", 1, panel=1)
+
+
+def test_history_view_regenerates_page_as_revision(use_api, monkeypatch):
+    from streamlit.testing.v1 import AppTest
+
+    monkeypatch.setattr(history_store, "WRITE_BEHIND", False)
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "key")
+    use_api(_Api(NEW_PAGE.replace("佐藤", "義母")))
+    location = history_store.save_history(EXPERIENCE, SCENARIO, models={"draft": "m"})
+    key = history_store.location_record_id(location)
+    [hist] = history_store.load_history()
+
+    at = AppTest.from_file("app.py", default_timeout=60)
+    at.session_state["selected_history"] = hist
+    at.session_state["selected_history_index"] = 1
+    at.session_state[f"view_{key}_後編"] = True
+    at.session_state[f"view_{key}_後編_pages"] = "P2"
+    at.run()
+    assert not at.exception
+
+    at.button(key=f"view_{key}_後編_P2_run").click().run()
+    assert not at.exception
+    assert any("後編P2を作り直しました" in message.value for message in at.success)
+
+    [saved] = history_store.load_history()
+    assert saved["result"] != SCENARIO and "義母「また来たわよ」" in saved["result"]
+    assert saved["revisions"][0]["result"] == SCENARIO
+    assert saved["revisions"][0]["replaced_by"] == "regenerate"
+    assert set(saved["models"]) == {"draft", "regenerate"}
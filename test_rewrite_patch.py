@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+変更するコマだけのリライト（scenario_pipeline._rewrite_patch・scenario_text.apply_panel_edits）のテスト
+
+    python -m pytest -q test_rewrite_patch.py
+"""
+
+import json
+
+import pytest
+
+import scenario_pipeline
+from benchmark_prompts import synthetic_scenario
+from conftest import FakeApi, fake_message
+from scenario_pipeline import check_and_fix_scenario, parse_patch_response
+from scenario_text import apply_panel_edits, split_sections
+
+DRAFT = synthetic_scenario("義母が毎週末に連絡なしで家に来る。録音した会話を家族会議で流した。")
+FULL_REWRITE = DRAFT.replace("A子「", "A子（", 1)
+EDITS = [
+    {"part": "前編", "page": 1, "panel": 2, "lines": ["※カメラ：寄り", "A子「また来た…」"]},
+    {"part": "後編", "page": 5, "panel": 3, "lines": ["  ※カメラ：引き  ", "義母「ごめんなさい」"]},
+]
+
+pytestmark = pytest.mark.usefixtures("history_dir")
+
+
+def _panels(text):
+    return {
+        (section["part"], section["page"], section["panel"]): section["lines"]
+        for section in split_sections(text)
+        if section["panel"] is not None
+    }
+
+
+class _RewriteApi(FakeApi):
+    """変更箇所のみのリライトには patch を返し、全文リライトには FULL_REWRITE を返す"""
+
+    def __init__(self, patch, stop_reason="end_turn"):
+        super().__init__()
+        self.patch = patch
+        self.stop_reason = stop_reason
+
+    def respond(self, prompt):
+        if "書き直したコマだけを出力" in prompt:
+            return fake_message(self.patch, 3000, 200, self.stop_reason)
+        return FULL_REWRITE
+
+    @property
+    def modes(self):
+        return ["patch" if "書き直したコマだけを出力" in prompt else "full" for prompt in self.prompts]
+
+
+def test_apply_panel_edits_changes_only_those_panels():
+    rewritten = apply_panel_edits(DRAFT, EDITS)
+    before, after = _panels(DRAFT), _panels(rewritten)
+
+    assert [key for key in before if before[key] != after[key]] == [("前編", 1, 2), ("後編", 5, 3)]
+    assert after[("前編", 1, 2)] == ["2コマ目", "※カメラ：寄り", "A子「また来た…」", ""]
+    # 前後の空白は取り、最後のコマに空行は足さない
+    assert after[("後編", 5, 3)] == ["3コマ目", "※カメラ：引き", "義母「ごめんなさい」"]
+    # 3行のコマを2行にしたので、そのぶんだけ短くなる
+    assert len(rewritten.splitlines()) == len(DRAFT.splitlines()) - len(EDITS)
+    assert apply_panel_edits(DRAFT, []) == DRAFT
+
+
+@pytest.mark.parametrize("edit", [
+    {"part": "前編", "page": 6, "panel": 1, "lines": ["A子「…」"]},
+    {"part": "中編", "page": 1, "panel": 1, "lines": ["A子「…」"]},
+    {"part": "前編", "page": 1, "panel": 1, "lines": []},
+    {"part": "前編", "page": 1, "panel": 1, "lines": ["  "]},
+    {"part": "前編", "page": "1", "panel": 1, "lines": ["A子「…」"]},
+    "前編P1の1コマ目",
+])
+def test_apply_panel_edits_rejects_unknown_or_malformed(edit):
+    with pytest.raises(ValueError):
+        apply_panel_edits(DRAFT, [edit])
+
+
+def test_parse_patch_response_handles_fenced_json():
+    payload = json.dumps({"edits": EDITS}, ensure_ascii=False)
+    assert parse_patch_response(payload) == EDITS
+    assert parse_patch_response(f"```json\n{payload}\n```") == EDITS
+    assert parse_patch_response(f"直したコマです。\n```\n{payload}\n```\n以上です。") == EDITS
+    for text in ("直すところはありません", '{"edits": {}}', "[1, 2]", '```json\n{"edits": [\n```'):
+        with pytest.raises(ValueError):
+            parse_patch_response(text)
+
+
+def test_patch_rewrite_applies_edits(use_api):
+    api = use_api(_RewriteApi(f"```json\n{json.dumps({'edits': EDITS}, ensure_ascii=False)}\n```"))
+    meta = {}
+    rewritten = check_and_fix_scenario("key", DRAFT, meta=meta, mode="patch")
+
+    assert rewritten == apply_panel_edits(DRAFT, EDITS)
+    assert api.modes == ["patch"]
+    assert meta["rewrite_patch"]["edits"] == 2
+    assert "rewrite" not in meta
+
+
+@pytest.mark.parametrize("patch, stop_reason", [
+    (json.dumps({"edits": [{"part": "前編", "page": 9, "panel": 1, "lines": ["A子「…」"]}]}), "end_turn"),
+    ('{"edits": [{"part": "前編", "page": 1,', "end_turn"),
+    (json.dumps({"edits": EDITS}, ensure_ascii=False), "max_tokens"),
+])
+def test_patch_rewrite_falls_back_to_full(use_api, patch, stop_reason):
+    api = use_api(_RewriteApi(patch, stop_reason))
+    meta = {}
+    assert check_and_fix_scenario("key", DRAFT, meta=meta, mode="patch") == FULL_REWRITE
+    assert api.modes[-1] == "full" and api.modes.count("full") == 1
+    # 打ち切られたときは続きを生成させてから、それでも足りなければ全文リライト
+    assert api.modes.count("patch") == (scenario_pipeline.MAX_CONTINUATIONS + 1 if stop_reason == "max_tokens" else 1)
+    assert set(meta) == {"rewrite_patch", "rewrite"}
+
+
+def test_draft_without_panels_skips_patch(use_api):
+    api = use_api(_RewriteApi(json.dumps({"edits": []})))
+    assert check_and_fix_scenario("key", "コマに分かれていない初稿", mode="patch") == FULL_REWRITE
+    assert api.modes == ["full"]
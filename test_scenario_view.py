@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+シナリオの表示（前編/後編・ページごとの表示）のテスト
+
+    python -m pytest -q test_scenario_view.py
+"""
+
+import history_store
+from benchmark_prompts import synthetic_scenario
+from scenario_text import split_pages
+
+EXPERIENCE = "義母が毎週末に連絡なしで家に来る。録音した会話を家族会議で流した。"
+
+
+def test_split_pages_round_trips():
+    scenario = synthetic_scenario(EXPERIENCE)
+    blocks = split_pages(scenario)
+
+    assert "\n".join(block["text"] for block in blocks) == scenario
+    pages = [(block["part"], block["page"]) for block in blocks if block["page"] is not None]
+    assert pages == [(part, page) for part in ("前編", "後編") for page in range(1, 6)]
+    assert blocks[0]["part"] is None and "【体験談の分析】" in blocks[0]["text"]
+
+    # 編の見出しがなければ、全体が1つのブロック
+    assert split_pages("ただの文章\n【P1】") == [{"part": None, "page": None, "text": "ただの文章\n【P1】"}]
+
+
+def test_history_view_renders_only_open_page(tmp_path, monkeypatch):
+    from streamlit.testing.v1 import AppTest
+
+    monkeypatch.setattr(history_store, "HISTORY_DIR", str(tmp_path))
+    monkeypatch.setattr(history_store, "is_streamlit_cloud", lambda: False)
+    scenario = synthetic_scenario(EXPERIENCE)
+    hist = {"id": "view", "timestamp": "2025-01-01T00:00:00", "experience": EXPERIENCE, "result": scenario}
+
+    at = AppTest.from_file("app.py", default_timeout=60)
+    at.session_state["selected_history"] = hist
+    at.session_state["selected_history_index"] = 1
+    at.run()
+    assert not at.exception
+
+    def shown_pages():
+        return [m.value for m in at.markdown if m.value.startswith('<div class="output-section">【P')]
+
+    labels = [expander.label for expander in at.main.expander]
+    assert any(label.startswith("■前編（5ページ") for label in labels)
+    assert any(label.startswith("■後編（5ページ") for label in labels)
+    # 最初は前編のP1だけ（後編・ほかのページは送らない）
+    [page] = shown_pages()
+    assert page.startswith('<div class="output-section">【P1】')
+
+    at.session_state["view_view_前編_pages"] = "P3"
+    at.session_state["view_view_後編"] = True
+    at.run()
+    assert not at.exception
+    assert [page.split(">", 1)[1][:4] for page in shown_pages()] == ["【P3】", "【P1】"]
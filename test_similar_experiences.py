@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+似ている体験談の検出（MinHash / LSH）のテスト
+
+    python -m pytest -q test_similar_experiences.py
+"""
+
+import json
+import os
+import random
+import time
+
+import history_store
+from history_store import SIMILARITY_THRESHOLD
+from similar_experiences import (
+    NUM_PERMUTATIONS,
+    ExperienceIndex,
+    estimated_similarity,
+    jaccard_similarity,
+    minhash_signature,
+)
+
+# 数万件の履歴から探すときの予算（秒）
+LOOKUP_BUDGET_SEC = float(os.getenv("SIMILARITY_LOOKUP_BUDGET_SEC", "0.1"))
+
+EXPERIENCE = (
+    "結婚して3年目、義母が毎週末に連絡なしで家に来るようになった。"
+    "勝手に冷蔵庫を開けては「こんな物しか食べさせてないの」と私の料理に文句を言い、"
+    "夫は「母さんも悪気はないから」と取り合ってくれなかった。"
+    "ある日、義母が私の通帳を勝手に見ているところを目撃し、"
+    "こっそり録音した会話を家族会議で流したところ、義父が激怒して義母を叱ってくれた。"
+)
+# 句読点や言い回しを少し変えて貼り直したもの
+EDITED = EXPERIENCE.replace("3年目", "三年目").replace("激怒して", "本気で怒って").replace("。", "！")
+UNRELATED = (
+    "職場のパワハラ上司が部下の手柄を横取りしていた。"
+    "私は日報とメールを全部保存しておき、人事面談でまとめて提出した。"
+)
+
+
+def test_near_duplicates_are_similar():
+    assert jaccard_similarity(EXPERIENCE, EDITED) > 0.7
+    assert jaccard_similarity(EXPERIENCE, UNRELATED) < 0.1
+    assert estimated_similarity(minhash_signature(EXPERIENCE), minhash_signature(EDITED)) > 0.5
+    assert minhash_signature(EXPERIENCE) == minhash_signature(EXPERIENCE + "  \n")
+    assert minhash_signature("") == ""
+
+
+def test_index_sync_adds_replaces_and_removes():
+    index = ExperienceIndex()
+    index.sync({"a": minhash_signature(EXPERIENCE), "b": minhash_signature(UNRELATED)})
+    assert [key for key, _ in index.query(minhash_signature(EDITED), threshold=0.5)] == ["a"]
+
+    index.sync({"b": minhash_signature(EXPERIENCE)})
+    assert len(index) == 1
+    assert [key for key, _ in index.query(minhash_signature(EDITED), threshold=0.5)] == ["b"]
+
+
+def _random_text(rng, length):
+    """ほかと文字3-gramがほとんど重ならない文（よく使う漢字から選ぶ）"""
+    return "".join(chr(rng.randrange(0x4E00, 0x4E00 + 3000)) for _ in range(length))
+
+
+def test_pairs_at_threshold_become_candidates():
+    rng = random.Random(0)
+    index = ExperienceIndex()
+    pairs = []
+    while len(pairs) < 150:
+        text = _random_text(rng, 100)
+        # 先頭を共有して残りを変えると、類似度がしきい値の前後になる
+        other = text[:rng.randrange(74, 80)] + _random_text(rng, 24)
+        similarity = jaccard_similarity(text, other)
+        if SIMILARITY_THRESHOLD <= similarity < SIMILARITY_THRESHOLD + 0.05:
+            key = f"scenario_{len(pairs):06d}.json"
+            index.add(key, minhash_signature(text))
+            pairs.append((key, other))
+
+    # find_similar_histories と同じ緩め方で候補を取る
+    found = sum(
+        key in [match for match, _ in index.query(minhash_signature(other), threshold=SIMILARITY_THRESHOLD - 0.15)]
+        for key, other in pairs
+    )
+    assert found / len(pairs) >= 0.95
+
+
+def test_lookup_budget_with_tens_of_thousands_of_records(history_dir):
+    rng = random.Random(0)
+    records = {}
+    for i in range(30_000):
+        filename = f"scenario_{i:06d}.json"
+        with open(os.path.join(history_dir, filename), "w", encoding="utf-8") as f:
+            f.write("{}")
+        records[filename] = {
+            "index_version": history_store.INDEX_VERSION,
+            "minhash": "".join(format(rng.getrandbits(32), "08x") for _ in range(NUM_PERMUTATIONS)),
+        }
+    target = "scenario_target.json"
+    with open(os.path.join(history_dir, target), "w", encoding="utf-8") as f:
+        json.dump({"timestamp": "target", "experience": EXPERIENCE, "result": "シナリオ"}, f, ensure_ascii=False)
+    records[target] = history_store._index_entry({"experience": EXPERIENCE})
+    with open(os.path.join(history_dir, history_store.INDEX_FILENAME), "w", encoding="utf-8") as f:
+        json.dump({"records": records}, f)
+    # 書いたばかりのディレクトリは一覧をキャッシュしないので、少し前に書いたことにする
+    written_at = time.time() - 60
+    os.utime(history_dir, (written_at, written_at))
+
+    # 最初の1回はインデックスの読み込みとLSHの構築をする。予算は2回目以降の検索
+    query = EDITED * 5  # 長めの体験談
+    assert [match["timestamp"] for match in history_store.find_similar_histories(query)] == ["target"]
+    start = time.perf_counter()
+    matches = history_store.find_similar_histories(query)
+    elapsed = time.perf_counter() - start
+
+    assert [match["timestamp"] for match in matches] == ["target"]
+    assert elapsed <= LOOKUP_BUDGET_SEC
+
+
+def test_find_similar_histories(history_dir):
+    for name, experience in (("20240101_000000", EXPERIENCE), ("20240102_000000", UNRELATED)):
+        with open(os.path.join(history_dir, f"scenario_{name}.json"), "w", encoding="utf-8") as f:
+            json.dump({"timestamp": name, "experience": experience, "result": "シナリオ"}, f, ensure_ascii=False)
+
+    matches = history_store.find_similar_histories(EDITED)
+    assert [match["timestamp"] for match in matches] == ["20240101_000000"]
+    assert matches[0]["similarity"] > 0.7
+    assert history_store.find_similar_histories("まったく別の話です。猫を拾った。") == []
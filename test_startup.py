@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+起動時間のバジェットテスト
+
+新しいプロセスで app.py の import と初回描画を計測し、
+予算を超えたり、重いモジュール（anthropic / dotenv）を起動時に
+読み込んでいたりしたら失敗させる。
+
+    python -m pytest -q test_startup.py
+    python test_startup.py
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 予算（秒）。CIなど遅い環境では環境変数で緩められる
+IMPORT_BUDGET_SEC = float(os.getenv("STARTUP_IMPORT_BUDGET_SEC", "0.3"))
+FIRST_RENDER_BUDGET_SEC = float(os.getenv("STARTUP_FIRST_RENDER_BUDGET_SEC", "2.0"))
+RERUN_BUDGET_SEC = float(os.getenv("STARTUP_RERUN_BUDGET_SEC", "0.5"))
+
+# 最初の生成まで読み込んではいけないモジュール
+DEFERRED_MODULES = ("anthropic", "dotenv")
+
+# 計測用スクリプト（新しいプロセスで実行する）
+_MEASURE_SCRIPT = """
+import json, sys, time
+import streamlit
+
+t0 = time.perf_counter()
+import app
+import_sec = time.perf_counter() - t0
+loaded_on_import = [m for m in {deferred!r} if m in sys.modules]
+
+from streamlit.testing.v1 import AppTest
+
+at = AppTest.from_file("app.py", default_timeout=60)
+t0 = time.perf_counter()
+at.run()
+first_render_sec = time.perf_counter() - t0
+
+t0 = time.perf_counter()
+at.run()
+rerun_sec = time.perf_counter() - t0
+
+print(json.dumps({{
+    "import_sec": import_sec,
+    "first_render_sec": first_render_sec,
+    "rerun_sec": rerun_sec,
+    "loaded_on_import": loaded_on_import,
+    "loaded_on_render": [m for m in {deferred!r} if m in sys.modules],
+    "exceptions": [str(e.value) for e in at.exception],
+}}))
+"""
+
+
+def measure_startup():
+    """新しいプロセスで起動時間を計測する"""
+    env = dict(os.environ)
+    # .envやAPIキーの有無で描画内容が変わらないようにする
+    env.pop("ANTHROPIC_API_KEY", None)
+    proc = subprocess.run(
+        [sys.executable, "-c", _MEASURE_SCRIPT.format(deferred=DEFERRED_MODULES)],
+        cwd=APP_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=180,
+    )
+    assert proc.returncode == 0, proc.stderr
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+_RESULT = None
+
+
+def _result():
+    global _RESULT
+    if _RESULT is None:
+        _RESULT = measure_startup()
+    return _RESULT
+
+
+def test_first_render_has_no_exception():
+    assert _result()["exceptions"] == []
+
+
+def test_heavy_modules_are_deferred():
+    result = _result()
+    assert result["loaded_on_import"] == []
+    assert result["loaded_on_render"] == []
+
+
+def test_import_time_budget():
+    assert _result()["import_sec"] <= IMPORT_BUDGET_SEC
+
+
+def test_first_render_budget():
+    assert _result()["first_render_sec"] <= FIRST_RENDER_BUDGET_SEC
+
+
+def test_rerun_budget():
+    assert _result()["rerun_sec"] <= RERUN_BUDGET_SEC
+
+
+if __name__ == "__main__":
+    result = _result()
+    print("=" * 60)
+    print("起動時間バジェット")
+    print("=" * 60)
+    print(f"import app : {result['import_sec']:.3f}秒 (予算 {IMPORT_BUDGET_SEC}秒)")
+    print(f"初回描画   : {result['first_render_sec']:.3f}秒 (予算 {FIRST_RENDER_BUDGET_SEC}秒)")
+    print(f"再実行     : {result['rerun_sec']:.3f}秒 (予算 {RERUN_BUDGET_SEC}秒)")
+    print(f"起動時に読み込まれた重いモジュール: {result['loaded_on_render'] or 'なし'}")
+
+    over_budget = (
+        result["import_sec"] > IMPORT_BUDGET_SEC
+        or result["first_render_sec"] > FIRST_RENDER_BUDGET_SEC
+        or result["rerun_sec"] > RERUN_BUDGET_SEC
+        or result["loaded_on_render"]
+        or result["exceptions"]
+    )
+    sys.exit(1 if over_budget else 0)
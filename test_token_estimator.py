@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+トークン数の推定とmax_tokensの自動調整（token_estimator.py）のテスト
+
+    python -m pytest -q test_token_estimator.py
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+import token_estimator
+from token_estimator import (
+    CALIBRATION_MAX_FACTOR,
+    CALIBRATION_MIN_FACTOR,
+    CALIBRATION_MIN_SAMPLES,
+    CALIBRATION_WINDOW,
+    MIN_MAX_TOKENS,
+    adaptive_max_tokens,
+    calibration_factor,
+    estimate_tokens_raw,
+    log_usage,
+)
+
+SONNET = "claude-sonnet-4-5-20250929"
+HAIKU = "claude-haiku-3-5-20250313"
+
+
+def _entry(stage="draft", estimated=(100, 100), actual=(100, 100), stop_reason="end_turn"):
+    return {
+        "stage": stage,
+        "estimated_input_tokens_raw": estimated[0],
+        "estimated_output_tokens_raw": estimated[1],
+        "actual_input_tokens": actual[0],
+        "actual_output_tokens": actual[1],
+        "stop_reason": stop_reason,
+    }
+
+
+def _log(times, actual_output, stage="draft", stop_reason="end_turn"):
+    for _ in range(times):
+        usage = SimpleNamespace(input_tokens=100, output_tokens=actual_output)
+        log_usage(stage, SONNET, 100, 100, 2000, usage, stop_reason)
+
+
+def test_estimate_tokens_raw_counts_japanese_per_char():
+    assert estimate_tokens_raw("") == 0
+    assert estimate_tokens_raw(None) == 0
+    assert estimate_tokens_raw("義母が来た。") == 6
+    assert estimate_tokens_raw("ＡＢＣ") == 3  # 全角英字も1文字≒1トークン
+    assert estimate_tokens_raw("abcd") == 1
+    assert estimate_tokens_raw("abcde") == 2
+    assert estimate_tokens_raw("A子「ok」") == 4  # 子「」で3、A・o・kで1
+
+
+def test_append_ratios_skips_truncated_output():
+    ratios = {}
+    token_estimator._append_ratios(ratios, _entry(actual=(150, 50)))
+    assert ratios == {"input": [1.5], "output:draft": [0.5]}
+
+    # max_tokens で打ち切られた出力は本来の長さではないので、入力だけ使う
+    token_estimator._append_ratios(ratios, _entry(actual=(200, 10), stop_reason="max_tokens"))
+    assert ratios == {"input": [1.5, 2.0], "output:draft": [0.5]}
+
+    # 推定・実測のどちらかがなければ使わない
+    token_estimator._append_ratios(ratios, _entry(stage="rewrite", estimated=(0, None), actual=(100, 100)))
+    assert "output:rewrite" not in ratios and len(ratios["input"]) == 2
+
+    for _ in range(CALIBRATION_WINDOW + 10):
+        token_estimator._append_ratios(ratios, _entry())
+    assert len(ratios["input"]) == CALIBRATION_WINDOW
+
+
+def test_calibration_needs_enough_samples(usage_log):
+    _log(CALIBRATION_MIN_SAMPLES - 1, actual_output=150)
+    assert calibration_factor("output:draft") == 1.0
+    assert token_estimator.expected_output_tokens("draft", "") == token_estimator.expected_output_tokens_raw("draft", "")
+
+    _log(1, actual_output=150)
+    assert calibration_factor("output:draft") == pytest.approx(1.5)
+    # 別のステージの記録は使わない
+    assert calibration_factor("output:rewrite") == 1.0
+
+    # 記録はファイルに残り、別のプロセスでも同じ補正になる
+    assert len(usage_log.read_text(encoding="utf-8").splitlines()) == CALIBRATION_MIN_SAMPLES
+    token_estimator._ratios = None
+    assert calibration_factor("output:draft") == pytest.approx(1.5)
+
+
+@pytest.mark.parametrize("actual_output, factor", [(10, CALIBRATION_MIN_FACTOR), (1000, CALIBRATION_MAX_FACTOR)])
+def test_calibration_factor_is_clamped(actual_output, factor):
+    _log(CALIBRATION_MIN_SAMPLES, actual_output=actual_output)
+    assert calibration_factor("output:draft") == factor
+
+
+def test_one_outlier_does_not_shrink_max_tokens():
+    expected = token_estimator.expected_output_tokens("draft", "体験談")
+    before = adaptive_max_tokens(expected, SONNET)
+    _log(1, actual_output=1)
+    assert adaptive_max_tokens(token_estimator.expected_output_tokens("draft", "体験談"), SONNET) == before
+
+
+def test_adaptive_max_tokens_caps():
+    assert adaptive_max_tokens(10000, SONNET) == 14000
+    # 短い出力でも下限までは確保する
+    assert adaptive_max_tokens(100, SONNET) == MIN_MAX_TOKENS
+    # モデルの出力上限を超えない（知らないモデルは既定の上限）
+    assert adaptive_max_tokens(10000, HAIKU) == 8192
+    assert adaptive_max_tokens(100000, "unknown-model") == token_estimator.DEFAULT_MODEL_MAX_OUTPUT_TOKENS
+    assert adaptive_max_tokens(100000, SONNET) == 64000
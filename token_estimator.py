@@ -0,0 +1,254 @@
+"""
+トークン数の推定とmax_tokensの自動調整
+
+APIに送る前に、プロンプトと出力のトークン数をローカルで推定する。
+推定値と実際の使用量（message.usage）は token_usage.jsonl に記録し、
+その比率で推定値を補正（キャリブレーション）する。記録は履歴と同じディレクトリ
+（環境変数 SCENARIO_HISTORY_DIR、既定は output/）に置き、環境変数 SCENARIO_TOKEN_USAGE_LOG で
+別の場所も指定できる（Streamlit Cloud では再デプロイで消えない場所を指定する）。
+"""
+
+import json
+import math
+import os
+import re
+import threading
+from datetime import datetime
+from statistics import median
+
+# ============================================================================
+# 設定
+# ============================================================================
+
+# 日本語（かな・漢字・全角記号）は1文字≒1トークン、それ以外は4文字≒1トークン
+CJK_TOKENS_PER_CHAR = 1.0
+OTHER_CHARS_PER_TOKEN = 4.0
+
+# 前編5P・後編5Pのシナリオ1本分の出力の目安
+DRAFT_BASE_OUTPUT_TOKENS = 6000
+# 体験談が長いほど出力も少し長くなる
+DRAFT_OUTPUT_PER_EXPERIENCE_TOKEN = 0.5
+# アウトライン（分析・登場人物・10ページ分のあらすじ）
+OUTLINE_OUTPUT_TOKENS = 1500
+# 1ページ分の脚本
+EXPAND_OUTPUT_TOKENS = 800
+# リライトは元のシナリオとほぼ同じ長さ
+REWRITE_OUTPUT_RATIO = 1.05
+# 変更するコマだけを出力するリライトは元のシナリオの一部
+PATCH_OUTPUT_RATIO = 0.35
+# 1ページ・1コマの作り直しは元の部分より少し長くなることがある
+REGENERATE_OUTPUT_RATIO = 1.2
+
+# 推定値に対する余裕
+MAX_TOKENS_HEADROOM = 1.4
+MIN_MAX_TOKENS = 2000
+
+# モデルごとの出力上限
+MODEL_MAX_OUTPUT_TOKENS = {
+    "claude-sonnet-4-5-20250929": 64000,
+    "claude-haiku-3-5-20250313": 8192,
+}
+DEFAULT_MODEL_MAX_OUTPUT_TOKENS = 8192
+
+# これを超える体験談は警告・要約の対象
+MAX_EXPERIENCE_TOKENS = 3000
+# 要約後の体験談の目安（文字数）
+CONDENSED_EXPERIENCE_CHARS = 1200
+
+# キャリブレーションに使う直近の記録数
+CALIBRATION_WINDOW = 200
+# これより記録が少ないうちは補正しない（1件の外れ値で推定がすべて動かないように）
+CALIBRATION_MIN_SAMPLES = 5
+# 補正係数の範囲
+CALIBRATION_MIN_FACTOR = 0.5
+CALIBRATION_MAX_FACTOR = 2.0
+
+USAGE_LOG_PATH = os.getenv(
+    "SCENARIO_TOKEN_USAGE_LOG",
+    os.path.join(
+        os.getenv("SCENARIO_HISTORY_DIR", os.path.join(os.path.dirname(__file__), "output")),
+        "token_usage.jsonl",
+    ),
+)
+
+_CJK_PATTERN = re.compile(r'[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
+# ============================================================================
+# 推定
+# ============================================================================
+
+def estimate_tokens_raw(text):
+    """
+    補正なしのトークン数推定
+
+    Args:
+        text: 推定対象のテキスト
+
+    Returns:
+        推定トークン数
+    """
+    if not text:
+        return 0
+    cjk_count = len(_CJK_PATTERN.findall(text))
+    other_count = len(text) - cjk_count
+    return int(math.ceil(cjk_count * CJK_TOKENS_PER_CHAR + other_count / OTHER_CHARS_PER_TOKEN))
+
+def estimate_tokens(text):
+    """
+    キャリブレーション済みのトークン数推定
+
+    Args:
+        text: 推定対象のテキスト
+
+    Returns:
+        推定トークン数
+    """
+    return int(math.ceil(estimate_tokens_raw(text) * calibration_factor("input")))
+
+def expected_output_tokens_raw(stage, source_text):
+    """
+    ステージごとの出力トークン数の目安（補正なし）
+
+    Args:
+        stage: "draft"（初稿生成）、"outline"（アウトライン）、"expand"（1ページの展開）、
+            "rewrite"（自動リライト）、"rewrite_patch"（変更するコマだけのリライト）、
+            "condense"（体験談の要約）、"regenerate"（1ページ・1コマの作り直し）
+        source_text: draft・outline・condenseなら体験談、expandならページのあらすじ、
+            rewrite・rewrite_patchなら元のシナリオ、regenerateなら作り直す部分
+
+    Returns:
+        推定出力トークン数
+    """
+    if stage == "rewrite":
+        raw = estimate_tokens_raw(source_text) * REWRITE_OUTPUT_RATIO
+    elif stage == "rewrite_patch":
+        raw = estimate_tokens_raw(source_text) * PATCH_OUTPUT_RATIO
+    elif stage == "outline":
+        raw = OUTLINE_OUTPUT_TOKENS
+    elif stage == "expand":
+        raw = EXPAND_OUTPUT_TOKENS
+    elif stage == "condense":
+        raw = CONDENSED_EXPERIENCE_CHARS * CJK_TOKENS_PER_CHAR
+    elif stage == "regenerate":
+        raw = estimate_tokens_raw(source_text) * REGENERATE_OUTPUT_RATIO
+    else:
+        raw = DRAFT_BASE_OUTPUT_TOKENS + estimate_tokens_raw(source_text) * DRAFT_OUTPUT_PER_EXPERIENCE_TOKEN
+    return int(math.ceil(raw))
+
+def expected_output_tokens(stage, source_text):
+    """ステージごとの出力トークン数の目安（キャリブレーション済み）"""
+    raw = expected_output_tokens_raw(stage, source_text)
+    return int(math.ceil(raw * calibration_factor(f"output:{stage}")))
+
+def adaptive_max_tokens(expected_output, model):
+    """
+    推定出力トークン数からmax_tokensを決める
+
+    Args:
+        expected_output: 推定出力トークン数
+        model: 使用するモデルID
+
+    Returns:
+        max_tokens（モデルの上限を超えない）
+    """
+    model_cap = MODEL_MAX_OUTPUT_TOKENS.get(model, DEFAULT_MODEL_MAX_OUTPUT_TOKENS)
+    wanted = int(math.ceil(expected_output * MAX_TOKENS_HEADROOM))
+    return max(min(wanted, model_cap), min(MIN_MAX_TOKENS, model_cap))
+
+def is_oversized_experience(experience):
+    """体験談が長すぎるかどうか"""
+    return estimate_tokens(experience) > MAX_EXPERIENCE_TOKENS
+
+# ============================================================================
+# 使用量の記録とキャリブレーション
+# ============================================================================
+
+_lock = threading.Lock()
+_ratios = None  # {"input": [...], "output:draft": [...], ...}
+
+
+def _load_ratios():
+    """ログから実測/推定の比率を読み込む（プロセス内で1回だけ）"""
+    global _ratios
+    if _ratios is not None:
+        return _ratios
+
+    ratios = {}
+    try:
+        with open(USAGE_LOG_PATH, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    _append_ratios(ratios, json.loads(line))
+                except ValueError:
+                    continue
+    except OSError:
+        pass
+    _ratios = ratios
+    return _ratios
+
+def _append_ratios(ratios, entry):
+    """1件の記録から比率を追加"""
+    pairs = [("input", entry.get("estimated_input_tokens_raw"), entry.get("actual_input_tokens"))]
+    # 出力が打ち切られた記録は本来の長さを表さないので除外
+    if entry.get("stop_reason") != "max_tokens":
+        pairs.append((
+            f"output:{entry.get('stage')}",
+            entry.get("estimated_output_tokens_raw"),
+            entry.get("actual_output_tokens"),
+        ))
+    for key, estimated, actual in pairs:
+        if estimated and actual:
+            window = ratios.setdefault(key, [])
+            window.append(actual / estimated)
+            del window[:-CALIBRATION_WINDOW]
+
+def calibration_factor(key="input"):
+    """
+    推定値の補正係数（実測/推定の中央値）
+
+    記録が CALIBRATION_MIN_SAMPLES 件に満たなければ1.0。
+    中央値は CALIBRATION_MIN_FACTOR〜CALIBRATION_MAX_FACTOR の範囲に収める。
+
+    Args:
+        key: "input" または "output:<ステージ名>"
+    """
+    with _lock:
+        ratios = _load_ratios().get(key)
+        if not ratios or len(ratios) < CALIBRATION_MIN_SAMPLES:
+            return 1.0
+        return min(max(median(ratios), CALIBRATION_MIN_FACTOR), CALIBRATION_MAX_FACTOR)
+
+def log_usage(stage, model, estimated_input_raw, estimated_output_raw, max_tokens, usage, stop_reason):
+    """
+    推定値と実際の使用量を記録する
+
+    Args:
+        stage: パイプラインのステージ名
+        model: 使用したモデルID
+        estimated_input_raw: 補正なしの推定入力トークン数
+        estimated_output_raw: 補正なしの推定出力トークン数
+        max_tokens: 指定したmax_tokens
+        usage: message.usage（input_tokens / output_tokens を持つ）
+        stop_reason: message.stop_reason
+    """
+    entry = {
+        "timestamp": datetime.now().isoformat(),
+        "stage": stage,
+        "model": model,
+        "estimated_input_tokens_raw": estimated_input_raw,
+        "estimated_output_tokens_raw": estimated_output_raw,
+        "max_tokens": max_tokens,
+        "actual_input_tokens": getattr(usage, "input_tokens", 0),
+        "actual_output_tokens": getattr(usage, "output_tokens", 0),
+        "stop_reason": stop_reason,
+    }
+
+    with _lock:
+        _append_ratios(_load_ratios(), entry)
+        try:
+            os.makedirs(os.path.dirname(USAGE_LOG_PATH), exist_ok=True)
+            with open(USAGE_LOG_PATH, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        except OSError:
+            pass
+    return entry